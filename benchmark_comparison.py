@@ -34,6 +34,9 @@ def benchmark_clustering(data, method, package_name, iterations=3):
             func = fastcluster.linkage_vector
         elif package_name == 'xinyi_fastcluster':
             import xinyi_fastcluster as fastcluster
+            # 内置包的 fastcluster.py 没有 set_num_threads，此时 OpenMP 默认使用全部核心
+            if hasattr(fastcluster, 'set_num_threads'):
+                fastcluster.set_num_threads(os.cpu_count())
             func = fastcluster.linkage_vector
         else:
             raise ImportError(f"Unknown package: {package_name}")
@@ -71,13 +74,11 @@ def run_comparison():
     
     methods = ['single', 'ward', 'centroid']
     
-    # 设置OpenMP环境变量
-    os.environ['OMP_NUM_THREADS'] = str(os.cpu_count())
+    # 设置OpenMP环境变量（在导入扩展模块之前才有效）
     os.environ['OMP_PROC_BIND'] = 'true'
     os.environ['OMP_PLACES'] = 'cores'
     
     print(f"使用 {os.cpu_count()} 个CPU核心")
-    print(f"OMP_NUM_THREADS = {os.environ['OMP_NUM_THREADS']}")
     print()
     
     results = {}
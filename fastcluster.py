@@ -19,22 +19,34 @@ is located in the directory inst/doc/ in the source distribution and may
 also be obtained at <https://danifold.net/fastcluster.html>.
 """
 
-__all__ = ['single', 'complete', 'average', 'weighted', 'ward', 'centroid', 'median', 'linkage', 'linkage_vector']
+__all__ = ['single', 'complete', 'average', 'weighted', 'ward', 'centroid', 'median', 'linkage', 'linkage_vector', 'linkage_sparse', 'linkage_many', 'linkage_vector_many', 'MST', 'pdist', 'fcluster', 'cut_tree', 'optimal_leaf_ordering', 'leaves_list', 'cophenetic_correlation', 'set_num_threads', 'get_num_threads', 'num_threads', 'simd_level']
 __version_info__ = ('1', '3', '0')
 __version__ = '.'.join(__version_info__)
 
-from numpy import double, empty, array, ndarray, var, cov, dot, expand_dims, \
-    ceil, sqrt
+from mmap import mmap
+from hashlib import blake2b
+from zlib import crc32
+from os import PathLike, fspath, makedirs, remove, path as os_path
+from threading import local
+from contextlib import contextmanager
+from numpy import double, float32, intp, intc, int64, empty, array, ndarray, \
+    var, cov, dot, expand_dims, ceil, sqrt, load, memmap, cumsum, arange, \
+    bincount, searchsorted, sort, minimum, concatenate, ascontiguousarray
 from numpy.linalg import inv
+from numpy.lib.format import open_memmap
 try:
-    from scipy.spatial.distance import pdist
+    from scipy.spatial.distance import pdist as _scipy_pdist
 except ImportError:
-    def pdist(*args, **kwargs):
-        raise ImportError('The fastcluster.linkage function cannot process '
-                          'vector data since the function '
+    def _scipy_pdist(*args, **kwargs):
+        raise ImportError('The fastcluster.pdist function cannot process '
+                          'this metric since the function '
                           'scipy.spatial.distance.pdist could not be  '
                           'imported.')
-from _fastcluster import linkage_wrap, linkage_vector_wrap
+from _fastcluster import linkage_wrap, linkage_vector_wrap, pdist_wrap, \
+    linkage_sparse_wrap, linkage_many_wrap, linkage_vector_many_wrap, \
+    max_threads_wrap, simd_level_wrap, fcluster_wrap, cut_tree_wrap, \
+    optimal_leaf_ordering_wrap, leaves_list_wrap, cophenetic_correlation_wrap, \
+    MST_update_wrap
 
 def single(D):
     '''Single linkage clustering (alias). See the help on the “linkage”
@@ -80,7 +92,10 @@ mthidx = {'single'   : 0,
           'centroid' : 5,
           'median'   : 6 }
 
-def linkage(X, method='single', metric='euclidean', preserve_input=True):
+def linkage(X, method='single', metric='euclidean', preserve_input=True,
+            threads=None, optimal_ordering=False, return_leaves=False,
+            checkpoint=None, checkpoint_interval=1000, callback=None,
+            callback_interval=1000):
     r'''Hierarchical, agglomerative clustering on a dissimilarity matrix or on
 Euclidean data.
 
@@ -89,8 +104,10 @@ parameters and output format as the functions of the same name in the
 module scipy.cluster.hierarchy.
 
 The argument X is preferably a NumPy array with floating point entries
-(X.dtype==numpy.double). Any other data format will be converted before
-it is processed.
+(X.dtype==numpy.double). Single precision input (X.dtype==numpy.single)
+is processed in single precision without conversion, which halves the
+memory footprint of the condensed matrix. The output Z is always double.
+Any other data format will be converted before it is processed.
 
 If X is a one-dimensional array, it is considered a condensed matrix of
 pairwise dissimilarities in the format which is returned by
@@ -121,15 +138,72 @@ been used as scratch memory. (The single linkage algorithm does not
 write to the distance matrix or its copy anyway, so the 'preserve_input'
 flag has no effect in this case.)
 
+Condensed matrices which do not fit into memory can be clustered from
+disk: X may be the path to a one-dimensional .npy file or a numpy.memmap.
+The matrix is then memory-mapped instead of being read into memory, and
+the clustering routines access it with read-ahead hints. A file given by
+its path is never modified: the methods which write to the matrix work
+on a private copy-on-write mapping, so that only the modified pages are
+held in memory (or swap). For a numpy.memmap, 'preserve_input=True'
+likewise selects a private copy-on-write mapping of the same file instead
+of a copy in memory, while 'preserve_input=False' lets the method write
+to a writeable map directly.
+
 If X contains vector data, it must be a two-dimensional array with N
 observations in D dimensions as an (N×D) array. The preserve_input
 argument is ignored in this case. The specified metric is used to
 generate pairwise distances from the input. The following two function
 calls yield the same output:
 
-  linkage(pdist(X, metric), method="...", preserve_input=False)
+  linkage(scipy.spatial.distance.pdist(X, metric), method="...",
+          preserve_input=False)
   linkage(X, metric=metric, method="...")
 
+The dissimilarities are computed with the function fastcluster.pdist,
+which is multithreaded and writes them directly into the working array of
+the clustering step, for the metrics where it agrees with SciPy. The
+metrics 'dice', 'matching', 'sokalsneath', 'kulsinski' and
+'sokalmichener', which fastcluster defines differently (see
+linkage_vector), and user-defined metrics are passed on to SciPy.
+
+If fastcluster was built with OpenMP, the optional argument 'threads'
+limits the number of threads for this call. By default, the limit set by
+the context manager num_threads or by set_num_threads applies.
+
+If 'optimal_ordering' is True, the children in the output are swapped as
+by the function optimal_leaf_ordering, as in SciPy. The leaf ordering uses
+the input dissimilarities (or the dissimilarities from the vector data)
+without computing them again, and the working copy of the clustering step
+serves as its scratch memory. Since it needs the dissimilarities after
+the clustering, 'optimal_ordering' implies 'preserve_input=True'.
+
+If 'return_leaves' is True, the output is the pair (Z, leaves_list(Z)),
+ie. the dendrogram together with the order of its leaves.
+
+Long runs of the methods 'centroid' and 'median' can be resumed after an
+interruption. If 'checkpoint' is the path to a directory, the working copy
+of the dissimilarities is the file matrix.npy in this directory, and the
+clustering step saves its state there every 'checkpoint_interval' merging
+steps. The state file takes O(N) space: the matrix is updated in place,
+and a log of the entries which were changed since the last checkpoint
+restores it. If the call is interrupted, eg. because the process is
+killed, the same call again continues from the last checkpoint instead of
+starting over. The state file identifies the problem by the method, the
+metric, the data type and a checksum of the input, which costs a pass over
+the input. If they do not match on resume, a ValueError is raised and the
+checkpoint is left unchanged. The files are removed when the clustering
+has finished.
+
+If 'callback' is given, it is called every 'callback_interval' merging steps
+as callback(step, N, distance) with the number of steps so far, the number
+of points and the distance of the last step. (Except for the methods
+'centroid' and 'median', the steps are not found in the order of the output,
+so the distances need not increase.) If the callback returns False, the
+clustering is aborted with a RuntimeError, and exceptions in the callback
+are passed on. A run with checkpoints can be resumed after this. At the same
+interval, the clustering checks for signals, so that it can be interrupted
+with Ctrl-C (KeyboardInterrupt) while it runs.
+
 The general scheme of the agglomerative clustering procedure is as
 follows:
 
@@ -227,26 +301,136 @@ raised.
 
 The linkage method does not treat NumPy's masked arrays as special
 and simply ignores the mask.'''
-    X = array(X, subok=True)
+    if checkpoint is not None and method not in ('centroid', 'median'):
+        raise ValueError("Checkpoints are available for the methods "
+                         "'centroid' and 'median'.")
+    if checkpoint is not None:
+        checkpoint = fspath(checkpoint)
+    # The dissimilarities for the optimal leaf ordering
+    D = None
+    if isinstance(X, (str, PathLike)):
+        if optimal_ordering:
+            D = load(X, mmap_mode='r')
+        # The file is opened read-only or copy-on-write, so it is never
+        # modified and no further copy is necessary.
+        X = load(X, mmap_mode='r' if method=='single' else 'c')
+        preserve_input = False
+    elif optimal_ordering:
+        preserve_input = True
+    X = array(X, copy=None, subok=True)
+    checkpoint_id = (0, 0) if checkpoint is None else \
+        _checkpoint_id(X, metric)
     if X.ndim==1:
-        if method=='single':
+        N = _condensed_size(X)
+        if optimal_ordering and D is None:
+            D = X
+        if checkpoint is not None:
+            X, preserve_input = _checkpoint_matrix(X, N, checkpoint), False
+        elif method=='single':
             preserve_input = False
-        X = array(X, dtype=double, copy=True if preserve_input else None,
-                  order='C', subok=True)
-        NN = len(X)
-        N = int(ceil(sqrt(NN*2)))
-        if (N*(N-1)//2) != NN:
-            raise ValueError(r'The length of the condensed distance matrix '
-                             r'must be (k \choose 2) for k data points!')
+        elif preserve_input or not X.flags.writeable:
+            X, preserve_input = _private_copy(X), False
+        X = array(X, dtype=_float_dtype(X),
+                  copy=True if preserve_input else None, order='C', subok=True)
     else:
         assert X.ndim==2
         N = len(X)
-        X = pdist(X, metric=metric)
-        X = array(X, dtype=double, order='C', subok=True)
+        X = _vector_dissimilarities(X, metric, threads)
+        if optimal_ordering:
+            D = X
+            if method!='single' and checkpoint is None:
+                X = X.copy()
+        if checkpoint is not None:
+            X = _checkpoint_matrix(X, N, checkpoint)
     Z = empty((N-1,4))
     if N > 1:
-        linkage_wrap(N, X, Z, mthidx[method])
-    return Z
+        linkage_wrap(N, X, Z, mthidx[method], _is_file_mapped(X),
+                     _threads(threads), checkpoint, int(checkpoint_interval),
+                     callback, int(callback_interval), *checkpoint_id)
+    if optimal_ordering and N > 2:
+        # The working copy X is not needed any more.
+        M = X if X is not D and X.dtype==double and \
+            not _is_file_mapped(X) else None
+        optimal_leaf_ordering_wrap(Z, array(D, dtype=_float_dtype(D),
+                                            copy=None, order='C'),
+                                   M, _threads(threads))
+    if checkpoint is not None:
+        # Unmap the working matrix before its file is removed. The state
+        # file goes first, so that an interruption here leaves no state
+        # without its matrix.
+        X = M = None
+        for name in ('state', 'state.tmp', 'undo', 'matrix.npy'):
+            if os_path.exists(os_path.join(checkpoint, name)):
+                remove(os_path.join(checkpoint, name))
+    return (Z, _leaves(Z)) if return_leaves else Z
+
+def _condensed_size(X):
+    '''Number of points for the condensed distance matrix X.'''
+    NN = len(X)
+    N = int(ceil(sqrt(NN*2)))
+    if (N*(N-1)//2) != NN:
+        raise ValueError(r'The length of the condensed distance matrix '
+                         r'must be (k \choose 2) for k data points!')
+    return N
+
+def _checkpoint_matrix(X, N, checkpoint):
+    '''Working matrix for the clustering with checkpoints in the directory
+'checkpoint': the file matrix.npy there, mapped writeable. It is a copy of X
+unless the directory holds the state of an interrupted run.'''
+    filename = os_path.join(checkpoint, 'matrix.npy')
+    if os_path.exists(os_path.join(checkpoint, 'state')):
+        M = load(filename, mmap_mode='r+')
+        if M.dtype!=_float_dtype(X) or M.shape!=X.shape:
+            raise ValueError('The checkpoint in {} belongs to a clustering of '
+                             'different data.'.format(checkpoint))
+        return M
+    makedirs(checkpoint, exist_ok=True)
+    M = open_memmap(filename, mode='w+', dtype=_float_dtype(X),
+                    shape=(N*(N-1)//2,))
+    M[:] = X
+    return M
+
+def _checkpoint_id(X, metric):
+    '''Identification of the input X of a clustering with checkpoints for the
+state file: a code for the metric (-1 for a condensed matrix) and a 64-bit
+checksum of the data, its type and its shape.'''
+    X = ascontiguousarray(X)
+    checksum = blake2b(digest_size=8)
+    checksum.update('{} {}'.format(X.dtype.str, X.shape).encode())
+    checksum.update(memoryview(X).cast('B'))
+    if X.ndim==1:
+        code = -1
+    else:
+        name = metric if isinstance(metric, str) else \
+            getattr(metric, '__qualname__', repr(metric))
+        code = crc32(name.encode()) >> 1 # fits into a 32-bit long
+    return code, int.from_bytes(checksum.digest(), 'little')
+
+def _private_copy(X):
+    '''Working copy of a condensed matrix which the clustering methods may
+overwrite. A memory-mapped file is mapped again copy-on-write, so that the
+matrix stays on disk.'''
+    if isinstance(X, memmap) and isinstance(X.base, mmap) and \
+            X.filename is not None and X.flags.c_contiguous and \
+            X.dtype in (float32, double):
+        return memmap(X.filename, dtype=X.dtype, mode='c', offset=X.offset,
+                      shape=X.shape)
+    return array(X, dtype=_float_dtype(X), order='C')
+
+def _is_file_mapped(X):
+    '''Whether the memory of the array X is a memory-mapped file.'''
+    while X is not None:
+        if isinstance(X, mmap):
+            return True
+        X = getattr(X, 'base', None)
+    return False
+
+def _float_dtype(X):
+    '''Floating point type in which the data X is processed: single
+precision input stays single precision, everything else is converted to
+double.'''
+    X = array(X, copy=None, subok=True)
+    return float32 if X.dtype==float32 else double
 
 # This dictionary must agree with the enum metric_codes in fastcluster_python.cpp.
 mtridx = {'euclidean'      :  0,
@@ -276,7 +460,33 @@ booleanmetrics = ('jaccard', 'yule', 'matching', 'dice', 'kulsinski',
                   'rogerstanimoto', 'sokalmichener', 'russellrao',
                   'sokalsneath', 'kulsinski')
 
-def linkage_vector(X, method='single', metric='euclidean', extraarg=None):
+# Metrics for which fastcluster.pdist gives the same dissimilarities as
+# scipy.spatial.distance.pdist. The other metrics differ: fastcluster
+# converts the input to Boolean for 'dice' and 'matching', it defines 0/0
+# as 0 for 'dice' and 'sokalsneath', and SciPy does not accept 'kulsinski'
+# and 'sokalmichener' any more. linkage() computes them with SciPy.
+_scipy_compatible_metrics = ('euclidean', 'minkowski', 'cityblock',
+                             'seuclidean', 'sqeuclidean', 'cosine',
+                             'correlation', 'hamming', 'jaccard', 'chebychev',
+                             'canberra', 'braycurtis', 'mahalanobis', 'yule',
+                             'rogerstanimoto', 'russellrao')
+
+# With algorithm='auto', single linkage with the Euclidean metric uses the
+# dual-tree Borůvka algorithm for data in at most _BORUVKA_MAX_DIM dimensions
+# from _BORUVKA_MIN_N points on. The k-d tree prunes well only in low
+# dimensions; for unstructured data in more than four dimensions, Prim's
+# algorithm is faster.
+_BORUVKA_MAX_DIM = 4
+_BORUVKA_MIN_N = 2000
+
+# This dictionary must agree with the enum algorithm_codes in fastcluster_python.cpp.
+algidx = {'prim'      : 0,
+          'boruvka'   : 1,
+          'nndescent' : 2 }
+
+def linkage_vector(X, method='single', metric='euclidean', extraarg=None,
+                   algorithm='auto', n_neighbors=15, threads=None,
+                   return_leaves=False, callback=None, callback_interval=1000):
     r'''Hierarchical (agglomerative) clustering on Euclidean data.
 
 Compared to the 'linkage' method, 'linkage_vector' uses a memory-saving
@@ -298,13 +508,57 @@ differ in some instances since a number of mistakes and typos (both in
 the code and in the documentation) were corrected in the fastcluster
 package.
 
+For single linkage, the argument 'algorithm' selects how the minimum
+spanning tree is computed:
+
+algorithm='prim': Prim's algorithm, with Θ(N^2) distance evaluations.
+
+algorithm='boruvka': the dual-tree Borůvka algorithm on a k-d tree, for
+  the metrics 'euclidean' and 'sqeuclidean' only. It needs far fewer
+  distance evaluations when the data has a low (intrinsic) dimension,
+  such as geospatial coordinates or 2-dimensional embeddings, but it
+  becomes slower than Prim's algorithm in high dimensions.
+
+algorithm='nndescent': approximate single linkage for any metric. An
+  approximate graph of the 'n_neighbors' nearest neighbors of each point
+  is built by NN-descent, and the dendrogram is computed from the
+  minimum spanning tree of this graph. If the graph is not connected,
+  its components are joined by their exact shortest edges, at a cost of
+  N distance evaluations per point outside the largest component.
+  The merging distances are exact distances between points, and each is
+  at least the exact single linkage distance of the same step. Larger
+  values of 'n_neighbors' give a better approximation and take longer.
+  If 'n_neighbors' is so large that NN-descent would not be faster than
+  the exact algorithm, which is the case for 8·n_neighbors² ≥ N, the
+  exact single linkage is computed with Prim's algorithm instead.
+  The random initialization uses a fixed seed, so the output is
+  reproducible.
+
+algorithm='auto' (default): 'boruvka' for the metrics 'euclidean' and
+  'sqeuclidean' in at most four dimensions and with at least 2000 points,
+  'prim' otherwise.
+
+The algorithms 'prim' and 'boruvka' give the same output, except that
+merging steps at equal distances may be listed in a different order and
+may join different (but equivalent) pairs of clusters. For the methods
+other than 'single', only 'auto' is accepted.
+
+The arguments 'threads', 'return_leaves', 'callback' and
+'callback_interval' have the same meaning as for 'linkage'. The algorithms
+'boruvka' and 'nndescent' add the edges of the minimum spanning tree in
+rounds, and the callback is called after the first round which passes a
+multiple of 'callback_interval' steps. NN-descent also checks for signals
+after each of its rounds, before the first merging step.
+
 Therefore, the available metrics with their definitions are listed below
 as a reference. The symbols u and v mostly denote vectors in R^D with
 coordinates u_j and v_j respectively. See below for additional metrics
 for Boolean vectors. Unless otherwise stated, the input array X is
 converted to a floating point array (X.dtype==numpy.double) if it does
-not have already the required data type. Some metrics accept Boolean
-input; in this case this is stated explicitly below.
+not have already the required data type. Single precision input
+(X.dtype==numpy.single) is kept and processed in single precision. Some
+metrics accept Boolean input; in this case this is stated explicitly
+below.
 
 If a NaN value occurs, either in the original dissimilarities or as an
 updated dissimilarity, an error is raised. In principle, the clustering
@@ -452,22 +706,75 @@ metric='matching':
   (False, True) but the Hamming distance is 0.5.
 
 metric='sokalmichener' is an alias for 'matching'.'''
+    X, metric, extraarg, algorithm = _vector_args(X, method, metric, extraarg,
+                                                  algorithm)
+    N = len(X)
+    Z = empty((N-1,4))
+    if N > 1:
+        linkage_vector_wrap(X, Z, mthidx[method], mtridx[metric], extraarg,
+                            algidx[algorithm], _n_neighbors(n_neighbors, N),
+                            _threads(threads), callback, int(callback_interval))
+    return (Z, _leaves(Z)) if return_leaves else Z
+
+def _n_neighbors(n_neighbors, N):
+    '''Number of neighbors for NN-descent on N points: at most the N-1 other
+points. Values below 1 are passed on and rejected by the C++ module.'''
+    return min(n_neighbors, N-1)
+
+def _vector_args(X, method, metric, extraarg, algorithm):
+    '''Input conversion and argument checks for linkage_vector. Returns the
+tuple (X, metric, extraarg, algorithm) for linkage_vector_wrap.'''
     if method=='single':
         assert metric!='USER'
-        if metric == 'hamming':
-            X = array(X, subok=True)
-            dtype = bool if X.dtype==bool else double
-        else:
-            dtype = bool if metric in booleanmetrics else double
-        X = array(X, dtype=dtype, order='C', subok=True)
+        X = _metric_input(X, metric)
     else:
         assert metric=='euclidean'
-        X = array(X, dtype=double, copy=(True if method=='ward' else None),
+        X = array(X, dtype=_float_dtype(X),
+                  copy=(True if method=='ward' else None),
                   order='C', subok=True)
     assert X.ndim==2
     N = len(X)
-    Z = empty((N-1,4))
 
+    X, metric, extraarg = _metric_args(X, metric, extraarg)
+    if algorithm!='auto' and algorithm not in algidx:
+        raise ValueError('Invalid algorithm: {}'.format(algorithm))
+    euclidean = method=='single' and metric in ('euclidean', 'sqeuclidean')
+    if algorithm!='auto' and method!='single':
+        raise ValueError("The algorithm '{}' is only available for single "
+                         "linkage.".format(algorithm))
+    if algorithm=='boruvka' and not euclidean:
+        raise ValueError("The algorithm 'boruvka' is only available for the "
+                         "'euclidean' and 'sqeuclidean' metrics.")
+    if algorithm=='auto':
+        algorithm = 'boruvka' if euclidean and N >= _BORUVKA_MIN_N and \
+            X.shape[1] <= _BORUVKA_MAX_DIM else 'prim'
+    return X, metric, extraarg, algorithm
+
+def _vector_dissimilarities(X, metric, threads):
+    '''Condensed matrix in the working precision of the vector data X for
+'linkage', with the dissimilarities of scipy.spatial.distance.pdist.'''
+    dtype = _float_dtype(X)
+    if isinstance(metric, str) and metric in _scipy_compatible_metrics:
+        X = pdist(X, metric=metric, threads=threads)
+    else:
+        X = _scipy_pdist(X, metric=metric)
+    return array(X, dtype=dtype, order='C', subok=True)
+
+def _metric_input(X, metric):
+    '''Convert the data X to the type in which the metric processes it.'''
+    if metric == 'hamming':
+        X = array(X, subok=True)
+        dtype = bool if X.dtype==bool else _float_dtype(X)
+    elif metric in booleanmetrics:
+        dtype = bool
+    else:
+        dtype = _float_dtype(X)
+    return array(X, dtype=dtype, order='C', subok=True)
+
+def _metric_args(X, metric, extraarg):
+    '''Auxiliary data for the metrics which need it, and translation of
+metrics which are expressed by other ones. Returns the triple
+(X, metric, extraarg) for the C++ dissimilarity classes.'''
     if metric=='seuclidean':
         if extraarg is None:
             extraarg = var(X, axis=0, ddof=1)
@@ -476,7 +783,7 @@ metric='sokalmichener' is an alias for 'matching'.'''
             extraarg = inv(cov(X, rowvar=False))
         # instead of the inverse covariance matrix, pass the matrix product
         # with the data matrix!
-        extraarg = array(dot(X,extraarg), dtype=double, order='C', subok=True)
+        extraarg = array(dot(X,extraarg), dtype=X.dtype, order='C', subok=True)
     elif metric=='correlation':
         X = X-expand_dims(X.mean(axis=1),1)
         metric='cosine'
@@ -485,6 +792,572 @@ metric='sokalmichener' is an alias for 'matching'.'''
         metric, extraarg = 'USER', metric
     elif metric!='minkowski':
         assert extraarg is None
+    return X, metric, extraarg
+
+def pdist(X, metric='euclidean', extraarg=None, threads=None):
+    r'''Pairwise dissimilarities between the rows of the (N×D) array X, in
+the condensed format of scipy.spatial.distance.pdist.
+
+The metrics and their definitions are the same as for linkage_vector;
+see there for the list. The optional argument 'extraarg' is the
+parameter p for the 'minkowski' metric (default 2, as in SciPy), the
+variance vector for 'seuclidean' and the inverse covariance matrix for
+'mahalanobis'. The computation is multithreaded if fastcluster was built
+with OpenMP, and it does not need SciPy. The argument 'threads' limits
+the number of threads as for 'linkage'.
+
+The output has the floating point type in which X is processed: float32
+for single precision input and numpy.double otherwise.
+
+If 'metric' is a Python function or a metric name which fastcluster does
+not implement, the call is passed on to scipy.spatial.distance.pdist.'''
+    if not isinstance(metric, str) or \
+            (metric not in mtridx and metric!='correlation') or \
+            metric=='USER':
+        if extraarg is not None:
+            raise TypeError('No extra parameter is allowed for this metric.')
+        return _scipy_pdist(X, metric=metric)
+    if metric=='minkowski' and extraarg is None:
+        extraarg = 2.
+    X = _metric_input(X, metric)
+    if X.ndim!=2:
+        raise ValueError('The input array must be two-dimensional.')
+    X, metric, extraarg = _metric_args(X, metric, extraarg)
+    N = len(X)
+    D = empty(N*(N-1)//2, dtype=_float_dtype(X))
+    if N > 1:
+        pdist_wrap(X, D, mtridx[metric], extraarg, _threads(threads))
+    return D
+
+def linkage_sparse(G, N=None):
+    r'''Single linkage clustering of a sparse graph of dissimilarities.
+
+The graph G is either a SciPy sparse matrix (eg. in CSR format, as
+returned by sklearn.neighbors.kneighbors_graph with mode='distance') or a
+triple (i, j, w) of one-dimensional arrays, which lists the edges
+between the points i[k] and j[k] with the dissimilarity w[k]. Every
+stored entry is an edge, including explicitly stored zeros. The graph is
+treated as undirected: an entry at (i,j) is an edge between i and j
+regardless of the order, and the matrix need not be symmetric.
+
+The number of points N is the size of the square matrix G. For edge
+arrays, it defaults to the largest point index plus one.
+
+The edges are sorted by their dissimilarity, and Kruskal's algorithm
+builds the minimum spanning forest, which determines the single linkage
+dendrogram. In contrast to the 'linkage' function, the memory
+requirement is proportional to the number of edges instead of N^2. The
+output has the same format as for 'linkage'. If the graph is a complete
+graph of dissimilarities, the output is the same as for
+
+  linkage(D, method='single')
+
+with the corresponding condensed matrix D.
+
+If the graph is not connected, the dendrogram joins its connected
+components in the last steps at an infinite distance, in the order of
+their smallest point indices. Hence, if all dissimilarities are finite,
+the number of connected components is one plus the number of infinite
+distances in the output.
+
+Single precision weights are processed in single precision. A NaN
+dissimilarity raises an error.'''
+    if hasattr(G, 'tocoo'):
+        if G.ndim!=2 or G.shape[0]!=G.shape[1]:
+            raise ValueError('The sparse matrix must be square.')
+        if N is not None and N!=G.shape[0]:
+            raise ValueError('N does not match the size of the matrix.')
+        N = G.shape[0]
+        G = G.tocoo()
+        i, j, w = G.row, G.col, G.data
+    else:
+        i, j, w = G
+    i = array(i, dtype=intp, copy=None, order='C').ravel()
+    j = array(j, dtype=intp, copy=None, order='C').ravel()
+    w = array(w, dtype=_float_dtype(w), copy=None, order='C').ravel()
+    if not len(i)==len(j)==len(w):
+        raise ValueError('The edge arrays must have the same length.')
+    if N is None:
+        N = int(max(i.max(), j.max()))+1 if len(w) else 1
+    if len(w) and (min(i.min(), j.min()) < 0 or max(i.max(), j.max()) >= N):
+        raise ValueError('Point index out of range.')
+    Z = empty((N-1,4))
     if N > 1:
-        linkage_vector_wrap(X, Z, mthidx[method], mtridx[metric], extraarg)
+        linkage_sparse_wrap(N, i, j, w, Z)
     return Z
+
+def linkage_many(Xs, method='single', metric='euclidean', preserve_input=True,
+                 stack=False, threads=None):
+    r'''Hierarchical clustering of many data sets in one call.
+
+Xs is a sequence of inputs for the 'linkage' function, ie. condensed
+distance matrices or (N×D) arrays of vector data, which may have
+different sizes. The parameters method, metric and preserve_input apply
+to all of them and have the same meaning as for 'linkage'. The output is
+the same as for
+
+  [linkage(X, method, metric, preserve_input) for X in Xs]
+
+All inputs are converted and checked first. Then the data sets are
+clustered in parallel on the OpenMP threads, with the GIL released for
+the whole batch. This removes most of the per-call overhead when there
+are many small data sets. Each data set is clustered by one thread, so
+for a few big data sets, the 'linkage' function with its parallel
+algorithms is the better choice. The argument 'threads' limits the number
+of threads as for 'linkage'. A KeyboardInterrupt (Ctrl-C) stops the batch
+after the data sets which are being clustered at that moment.
+
+If stack is False, the result is a list of the dendrograms, which are
+views into one array. If stack is True, the result is a pair (Z, offsets)
+of this stacked array Z with the dendrograms one after the other and the
+integer array 'offsets' of length len(Xs)+1, such that
+Z[offsets[k]:offsets[k+1]] is the dendrogram of the k-th data set.
+
+If a data set contains a NaN value, an error is raised for the first such
+data set in the batch, and no results are returned.'''
+    mth = mthidx[method]
+    tasks = []
+    for X in Xs:
+        X = array(X, copy=None, subok=True)
+        if X.ndim==1:
+            N = _condensed_size(X)
+            X_ = array(X, dtype=_float_dtype(X), copy=None, order='C',
+                       subok=True)
+            # The working copy is made by the clustering thread, unless the
+            # conversion has copied X already.
+            copy = method!='single' and X_ is X and \
+                (preserve_input or not X.flags.writeable)
+            X = X_
+        else:
+            assert X.ndim==2
+            N = len(X)
+            X = _vector_dissimilarities(X, metric, threads)
+            copy = False
+        tasks.append((N, X, copy))
+    Z, offsets = _stacked_output([task[0] for task in tasks])
+    if tasks:
+        linkage_many_wrap(tasks, Z, mth, _threads(threads))
+    return _batch_result(Z, offsets, stack)
+
+def linkage_vector_many(Xs, method='single', metric='euclidean',
+                        extraarg=None, algorithm='auto', n_neighbors=15,
+                        stack=False, threads=None):
+    r'''Memory-saving hierarchical clustering of many vector data sets in one
+call.
+
+Xs is a sequence of (N×D) arrays, which may have different sizes. The
+other parameters apply to all data sets and have the same meaning as for
+'linkage_vector'. If the extra argument for the 'seuclidean' or
+'mahalanobis' metric is not given, it is computed for each data set
+separately. The output is the same as for
+
+  [linkage_vector(X, method, metric, extraarg, algorithm, n_neighbors)
+   for X in Xs]
+
+and has the format described for 'linkage_many', depending on the
+parameter 'stack'. As there, all inputs are checked first, and then the
+data sets are clustered in parallel with the GIL released for the whole
+batch. A metric given as a Python function cannot run without the GIL;
+the data sets are then clustered one after the other. The argument
+'threads' limits the number of threads as for 'linkage'.'''
+    mth = mthidx[method]
+    tasks = []
+    for X in Xs:
+        X, metric_k, extraarg_k, algorithm_k = \
+            _vector_args(X, method, metric, extraarg, algorithm)
+        N = len(X)
+        if N < 2:
+            algorithm_k = 'prim'
+        tasks.append((X, extraarg_k, algidx[algorithm_k],
+                      _n_neighbors(n_neighbors, N)))
+    Z, offsets = _stacked_output([len(X) for X, _, _, _ in tasks])
+    if tasks and metric_k=='USER':
+        # A metric in Python needs the GIL.
+        for k, task in enumerate(tasks):
+            if offsets[k+1] > offsets[k]:
+                linkage_vector_wrap(task[0], Z[offsets[k]:offsets[k+1]], mth,
+                                    mtridx[metric_k], *task[1:])
+    elif tasks:
+        linkage_vector_many_wrap(tasks, Z, mth, mtridx[metric_k],
+                                 _threads(threads))
+    return _batch_result(Z, offsets, stack)
+
+def _stacked_output(Ns):
+    '''Output array for a batch of dendrograms of N points each, and the
+offsets of the dendrograms in it.'''
+    Ns = array(Ns, dtype=intp)
+    if (Ns < 1).any():
+        raise ValueError('At least one element is needed for clustering.')
+    offsets = empty(len(Ns)+1, dtype=intp)
+    offsets[0] = 0
+    cumsum(Ns-1, out=offsets[1:])
+    return empty((offsets[-1],4)), offsets
+
+def _batch_result(Z, offsets, stack):
+    '''Return value of linkage_many and linkage_vector_many.'''
+    if stack:
+        return Z, offsets
+    return [Z[offsets[k]:offsets[k+1]] for k in range(len(offsets)-1)]
+
+# The dual-tree Borůvka algorithm takes about as long for all points as the
+# insertion of this many new points into the minimum spanning tree.
+_MST_REBUILD_MIN = 256
+
+class MST:
+    r'''Minimum spanning tree of vector data, for single linkage clustering
+of a data set which grows over time:
+
+    mst = fastcluster.MST(X, metric='euclidean')
+    Z = mst.linkage()
+    Z = mst.add_points(X_new)
+
+The arguments 'metric', 'extraarg' and 'threads' have the same meaning
+as for linkage_vector. The stepwise dendrogram is the same as
+linkage_vector(X, method='single', metric=metric, extraarg=extraarg) for
+all points added so far, except possibly for the order of merging steps
+at equal distances.
+
+add_points(X_new) computes only the dissimilarities from each new point
+to the points before it and updates the tree by the cycle property
+(Chin and Houck, 1978). This takes O(N·k) time for k new points instead
+of O(N²) for the clustering from scratch. For data which linkage_vector
+clusters with the Borůvka algorithm, the tree is recomputed from scratch
+instead if many points are added at once, since this is faster.
+
+The data-dependent defaults of the 'seuclidean' and 'mahalanobis' metrics
+(the variances and the inverse covariance matrix) are computed from the
+initial data and kept fixed, so that the metric does not change when
+points are added. MST objects can be pickled, e.g. to update a clustering
+in a later session.'''
+    def __init__(self, X, metric='euclidean', extraarg=None, threads=None):
+        X = _metric_input(X, metric)
+        if X.ndim!=2:
+            raise ValueError('The input array must be two-dimensional.')
+        if metric=='seuclidean' and extraarg is None:
+            extraarg = var(X, axis=0, ddof=1)
+        elif metric=='mahalanobis' and extraarg is None:
+            extraarg = inv(cov(X, rowvar=False))
+        self._metric = metric
+        self._extraarg = extraarg
+        self._threads = threads
+        # The edges of the tree as pairs of points, and their weights before
+        # the postprocessing of the metric, e.g. squared Euclidean distances
+        self._edges = empty((0,2), dtype=intp)
+        self._weights = empty(0)
+        self._update(X, 0)
+
+    def linkage(self):
+        '''The stepwise dendrogram of all points in the format of
+linkage_vector.'''
+        return self._Z.copy()
+
+    def add_points(self, X_new):
+        '''Add the points X_new (as rows of a 2-dimensional array) and return
+the updated stepwise dendrogram. The new points have the indices
+N, N+1, ... in the dendrogram if there were N points before.'''
+        X_new = _metric_input(X_new, self._metric)
+        if X_new.ndim!=2 or X_new.shape[1]!=self._X.shape[1]:
+            raise ValueError('The new points must have the same dimension as '
+                             'the old ones.')
+        self._update(concatenate((self._X, array(X_new, dtype=self._X.dtype))),
+                     len(self._X))
+        return self.linkage()
+
+    def _update(self, X, N0):
+        '''Compute the tree of the points X from scratch (N0=0) or insert
+the points from index N0 on into the current tree of X[:N0]. The state
+changes only on success.'''
+        N = len(X)
+        edges = empty((max(N-1, 0), 2), dtype=intp)
+        weights = empty(max(N-1, 0))
+        edges[:len(self._edges)] = self._edges
+        weights[:len(self._weights)] = self._weights
+        Z = empty((max(N-1, 0), 4))
+        if N > 1:
+            X_, metric, extraarg, algorithm = _vector_args(
+                X, 'single', self._metric, self._extraarg, 'auto')
+            if algorithm=='boruvka' and N-N0 >= _MST_REBUILD_MIN:
+                N0 = 0
+            MST_update_wrap(X_, Z, edges, weights, mtridx[metric], extraarg,
+                            algidx[algorithm], N0, _threads(self._threads))
+        self._X = X
+        self._edges = edges
+        self._weights = weights
+        self._Z = Z
+
+# This dictionary must agree with the enum criterion_codes in
+# fastcluster_python.cpp.
+fclidx = {'inconsistent'      : 0,
+          'distance'          : 1,
+          'maxclust'          : 2,
+          'monocrit'          : 3,
+          'maxclust_monocrit' : 4 }
+
+def fcluster(Z, t, criterion='inconsistent', depth=2, R=None, monocrit=None):
+    r'''Flat clusters from the dendrogram Z, which is the output of
+'linkage' or of the other clustering functions. This is a replacement for
+scipy.cluster.hierarchy.fcluster with the same arguments and output: an
+array of N cluster labels 1, 2, ..., numbered in the same order as by
+SciPy. The criteria are:
+
+  'inconsistent': the subtrees whose inconsistency coefficients are at
+     most t form the clusters. The coefficients are the fourth column of
+     the inconsistency matrix R, which is computed up to the given depth
+     as by scipy.cluster.hierarchy.inconsistent if R is None.
+  'distance': the subtrees whose merging heights are at most t.
+  'maxclust': the subtrees for the smallest height which gives at most t
+     clusters.
+  'monocrit': the subtrees whose root has a value monocrit[i] ≤ t, for an
+     array monocrit with one value per merging step.
+  'maxclust_monocrit': the smallest threshold on monocrit which gives at
+     most t clusters.
+
+monocrit must be monotone, ie. the value of a merging step must not be
+smaller than the values of the steps below it. SciPy relies on this as
+well, and for 'maxclust_monocrit' also on monocrit being sorted along the
+steps. fastcluster does not: the threshold is always the smallest one,
+while SciPy may form fewer clusters than t otherwise. For t ≥ N, the
+'maxclust' criteria put every point into its own cluster, labeled in the
+order of the points, as SciPy does.
+
+The clusters are formed in O(N) time (O(2^depth·N) for the inconsistency
+coefficients), and the call releases the GIL.'''
+    Z = _linkage_input(Z)
+    N = len(Z)+1
+    if criterion not in fclidx:
+        raise ValueError('Invalid cluster formation criterion: {}'.format(
+            criterion))
+    V = None
+    if criterion=='inconsistent':
+        if int(depth)!=depth or depth < 0:
+            raise ValueError('The depth must be a nonnegative integer.')
+        if R is not None:
+            R = array(R, dtype=double, copy=None)
+            if R.shape!=(N-1, 4):
+                raise ValueError('The inconsistency matrix must have the '
+                                 'shape (N-1)×4.')
+            V = array(R[:,3], dtype=double, order='C')
+    elif criterion in ('monocrit', 'maxclust_monocrit'):
+        if monocrit is None:
+            raise ValueError('The criterion {} needs the argument '
+                             'monocrit.'.format(criterion))
+        V = array(monocrit, dtype=double, order='C').ravel()
+        if len(V)!=N-1:
+            raise ValueError('monocrit must have one value per merging step.')
+    if criterion in ('maxclust', 'maxclust_monocrit'):
+        t = int(t)
+        if t < 1:
+            raise ValueError('The number of clusters must be positive.')
+        t = min(t, N)
+    T = empty(N, dtype=intc)
+    fcluster_wrap(Z, T, fclidx[criterion], float(t), int(depth), V)
+    return T
+
+def cut_tree(Z, n_clusters=None, height=None):
+    r'''Cut the dendrogram Z at several numbers of clusters or heights. This is
+a replacement for scipy.cluster.hierarchy.cut_tree with the same arguments
+and output: an (N×k) array of type int64, whose column j holds the cluster
+labels 0, 1, ... for the j-th value in n_clusters respectively height. The
+labels are numbered in the order of the smallest point index of each
+cluster. If both arguments are None, the k=N columns are the cuts for N,
+N-1, ..., 1 clusters.
+
+As in SciPy, the merging steps are taken in the order of their heights
+(for equal heights, in the reverse order of a breadth-first search from
+the root, right child first), so that the cuts are nested. Cutting at a
+height is only meaningful for dendrograms with monotone heights. For the
+others (from centroid and median linkage), every cut consists of the
+subtrees below its steps, which SciPy does not ensure. SciPy also returns
+zeros instead of singletons for a cut without steps (N clusters or below
+the lowest height) in any but the first column.
+
+Each cut takes O(N) time, and the call releases the GIL.'''
+    Z = _linkage_input(Z)
+    N = len(Z)+1
+    if height is not None and n_clusters is not None:
+        raise ValueError('At least one of either height or n_clusters '
+                         'must be None')
+    elif height is None and n_clusters is None:
+        steps = arange(N)
+    elif height is not None:
+        steps = searchsorted(sort(Z[:,2]), height)
+    else:
+        steps = N - searchsorted(arange(N), n_clusters)
+    # N-1 steps merge all points, and SciPy's output for more steps is
+    # zero as well.
+    steps = minimum(array(steps, dtype=intp).ravel(), N-1)
+    C = empty((N, len(steps)), dtype=int64)
+    cut_tree_wrap(Z, steps, C)
+    return C
+
+def optimal_leaf_ordering(Z, y, metric='euclidean', threads=None):
+    r'''Reorder the dendrogram Z so that the sum of the dissimilarities
+between neighboring leaves is minimal. This is a replacement for
+scipy.cluster.hierarchy.optimal_leaf_ordering with the same arguments and
+output: a copy of Z in which the two children of some merging steps are
+swapped.
+
+y is the condensed matrix of dissimilarities from which Z was computed,
+or an (N×D) array of vector data, whose dissimilarities are computed by
+fastcluster.pdist with the given metric. Single precision input is
+processed in single precision. The ordering is computed with the dynamic
+program by Bar-Joseph, Gifford and Jaakkola, which prunes most of the
+candidates. It needs scratch memory of the size of a condensed matrix of
+doubles; use linkage(..., optimal_ordering=True) to reuse the working
+copy of the clustering step for this. If fastcluster was built with
+OpenMP, the large merging steps are processed by several threads, which
+the argument 'threads' limits as for 'linkage'.
+
+The optimal order is not unique in general, so that the output may differ
+from SciPy's in the orientation of some steps, but the sum of the
+dissimilarities is the same. A NaN dissimilarity raises an error.'''
+    Z = array(_linkage_input(Z), copy=True)
+    N = len(Z)+1
+    y = _dissimilarities(y, N, metric, threads)
+    if N > 2:
+        optimal_leaf_ordering_wrap(Z, y, None, _threads(threads))
+    return Z
+
+def cophenetic_correlation(Z, y, metric='euclidean', threads=None):
+    r'''The cophenetic correlation coefficient of the dendrogram Z: the
+Pearson correlation between the dissimilarities and the cophenetic
+distances, ie. the heights of the merging steps at which the pairs of
+points are joined. This is the same as the first output of
+scipy.cluster.hierarchy.cophenet(Z, y), but the matrix of cophenetic
+distances is never formed: besides the input, the memory is O(N) per
+thread.
+
+The argument y is the condensed matrix of dissimilarities or vector data,
+and 'metric' and 'threads' have the same meaning as for
+'optimal_leaf_ordering'. Single precision input is read in single
+precision and accumulated in double precision. A NaN dissimilarity raises
+an error.'''
+    Z = _linkage_input(Z)
+    N = len(Z)+1
+    y = _dissimilarities(y, N, metric, threads)
+    return cophenetic_correlation_wrap(Z, y, _threads(threads))
+
+def _dissimilarities(y, N, metric, threads):
+    '''Condensed matrix in the working precision from a condensed matrix or
+vector data for the dendrogram of N points'''
+    y = array(y, copy=None, subok=True)
+    if y.ndim==2:
+        y = _vector_dissimilarities(y, metric, threads)
+    elif y.ndim!=1:
+        raise ValueError('y must be a condensed matrix or an array of '
+                         'vector data.')
+    if len(y)!=N*(N-1)//2:
+        raise ValueError('The dissimilarities do not match the linkage '
+                         'matrix.')
+    return array(y, dtype=_float_dtype(y), copy=None, order='C')
+
+def leaves_list(Z):
+    r'''The order of the points in the dendrogram Z from left to right, as an
+array of type int32. This is a replacement for
+scipy.cluster.hierarchy.leaves_list with the same output, and the same as
+the order of the leaves in scipy.cluster.hierarchy.dendrogram. The search
+is iterative and takes O(N) time without the GIL, so that it also works
+for deep dendrograms, for which SciPy exceeds the recursion limit. See
+also the argument 'return_leaves' of 'linkage' and 'linkage_vector'.'''
+    return _leaves(_linkage_input(Z))
+
+def _leaves(Z):
+    '''leaves_list for a dendrogram which needs no checks'''
+    leaves = empty(len(Z)+1, dtype=intc)
+    leaves_list_wrap(Z, leaves)
+    return leaves
+
+def _linkage_input(Z):
+    '''Check a dendrogram in the output format of 'linkage' and return it as
+a C-contiguous array of doubles: every node except the root is merged
+exactly once, in a later step than the step which forms it.'''
+    Z = array(Z, dtype=double, copy=None, order='C')
+    if Z.ndim!=2 or Z.shape[1]!=4:
+        raise ValueError('The linkage matrix must have four columns.')
+    N = len(Z)+1
+    if not ((Z[:,:2] >= 0) & (Z[:,:2] < N + arange(N-1)[:,None])).all():
+        raise ValueError('Invalid linkage matrix.')
+    nodes = Z[:,:2].astype(intp)
+    if (nodes!=Z[:,:2]).any() or \
+            (bincount(nodes.ravel(), minlength=2*N-2)!=1).any():
+        raise ValueError('Invalid linkage matrix.')
+    return Z
+
+# Default thread limit for all calls (None: no limit), and the limit of the
+# num_threads context manager, which is local to each Python thread.
+_num_threads = None
+_thread_limit = local()
+
+def set_num_threads(n):
+    r'''Limit the number of OpenMP threads for all subsequent calls.
+
+n is a positive integer, or None to remove the limit. Without a limit,
+fastcluster uses as many threads as OpenMP provides, ie. the value of the
+environment variable OMP_NUM_THREADS when the module was loaded or else
+the number of processor cores. A limit above this number has no effect.
+Changing OMP_NUM_THREADS with os.environ after the import has no effect
+either, but this function can lower the number of threads at any time.
+
+The limit applies to the calls from all Python threads. The context
+manager num_threads and the argument 'threads' of the clustering
+functions take precedence for the current Python thread respectively for
+a single call. Without OpenMP, the limit has no effect.'''
+    global _num_threads
+    _num_threads = _check_threads(n)
+
+def get_num_threads():
+    r'''Number of threads which a call from the current Python thread uses
+without the argument 'threads', after the limits from set_num_threads and
+num_threads. This is 1 if fastcluster was built without OpenMP.'''
+    n = max_threads_wrap()
+    limit = _threads(None)
+    return min(n, limit) if limit else n
+
+@contextmanager
+def num_threads(n):
+    r'''Context manager which limits the number of OpenMP threads for the
+calls in its body, for example
+
+  with fastcluster.num_threads(4):
+      Z = fastcluster.linkage(X, method='average')
+
+The limit applies to the current Python thread only, so that several
+Python threads (eg. the workers of a Dask cluster) can use different
+limits. It overrides set_num_threads; n=None restores the default.'''
+    n = _check_threads(n)
+    saved = getattr(_thread_limit, 'value', None)
+    _thread_limit.value = n
+    try:
+        yield
+    finally:
+        _thread_limit.value = saved
+
+def simd_level():
+    r'''Instruction set level of the vectorized distance kernels: one of
+'avx512', 'avx2' (with FMA), 'sse2', 'neon' or 'scalar'.
+
+On x86 processors, fastcluster contains the kernels for several levels and
+chooses the best one for the CPU when the module is loaded. The
+environment variable FASTCLUSTER_SIMD (set to 'sse2', 'avx2' or 'avx512'
+before the import) lowers the level, eg. to compare results between
+machines: the levels sum up the coordinates in a different order, so that
+the distances may differ in the last bits.'''
+    return simd_level_wrap()
+
+def _check_threads(n):
+    '''Check a thread limit: None or a positive integer.'''
+    if n is None:
+        return None
+    if int(n)!=n or n < 1:
+        raise ValueError('The number of threads must be a positive integer.')
+    return int(n)
+
+def _threads(threads):
+    '''The thread limit for a call, as an argument for the C++ functions:
+0 means no limit.'''
+    threads = _check_threads(threads)
+    if threads is None:
+        threads = getattr(_thread_limit, 'value', None)
+    if threads is None:
+        threads = _num_threads
+    return threads or 0
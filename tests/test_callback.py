@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''Test the progress callback of the linkage and linkage_vector functions,
+aborting the clustering from the callback and interrupting it with a
+signal.'''
+print('''
+Test program for the 'fastcluster' package.
+Copyright:
+  * Until package version 1.1.23: (c) 2011 Daniel Müllner <https://danifold.net>
+  * All changes from version 1.1.24 on: (c) Google Inc. <https://www.google.com>''')
+import ctypes
+import os
+import tempfile
+import numpy as np
+import fastcluster
+
+version = '1.3.0'
+if fastcluster.__version__ != version:
+    raise ValueError('Wrong module version: {} instead of {}.'.format(fastcluster.__version__, version))
+
+import atexit
+def print_seed():
+  print("Seed: {0}".format(seed))
+atexit.register(print_seed)
+
+seed = np.random.randint(0,1e9)
+
+np.random.seed(seed)
+
+methods = ('single', 'complete', 'average', 'weighted', 'ward', 'centroid',
+           'median')
+
+# Methods and algorithms for linkage_vector. The algorithms 'boruvka' and
+# 'nndescent' add several edges per round and report after the rounds.
+vector_methods = (('single', 'prim'), ('single', 'boruvka'),
+                  ('single', 'nndescent'), ('ward', 'auto'),
+                  ('centroid', 'auto'), ('median', 'auto'))
+
+def test():
+    N = np.random.randint(2,500)
+    D = fastcluster.pdist(np.random.rand(N,3))
+    interval = np.random.randint(1,50)
+    for method in methods:
+        Z = fastcluster.linkage(D, method=method)
+        reports = []
+        np.testing.assert_array_equal(
+            fastcluster.linkage(D, method=method,
+                                callback=lambda *args: reports.append(args),
+                                callback_interval=interval), Z)
+        # Reports after every 'interval' steps, until the last or
+        # second-to-last step
+        steps = [step for step, _, _ in reports]
+        assert steps == list(range(interval, N, interval))[:len(steps)]
+        assert len(steps) >= (N-2)//interval
+        for step, n, dist in reports:
+            assert n == N
+            assert dist in Z[:,2]
+
+    # Abort from the callback
+    for method in methods:
+        try:
+            fastcluster.linkage(D, method=method,
+                                callback=lambda step, n, dist: step < N//2,
+                                callback_interval=1)
+            if N > 3:
+                raise AssertionError('The callback did not abort the '
+                                     'clustering!')
+        except RuntimeError:
+            pass
+        try:
+            fastcluster.linkage(D, method=method,
+                                callback=lambda step, n, dist: 1/0,
+                                callback_interval=1)
+            if N > 2:
+                raise AssertionError('The exception in the callback was not '
+                                     'passed on!')
+        except ZeroDivisionError:
+            pass
+
+    # An aborted run with checkpoints continues from the last checkpoint.
+    with tempfile.TemporaryDirectory() as checkpoint:
+        for method in ('centroid', 'median'):
+            Z = fastcluster.linkage(D, method=method)
+            for stop in (N//3, 2*N//3):
+                try:
+                    fastcluster.linkage(D, method=method,
+                                        checkpoint=checkpoint,
+                                        checkpoint_interval=7,
+                                        callback=lambda step, n, dist:
+                                        step < stop,
+                                        callback_interval=1)
+                except RuntimeError:
+                    pass
+            np.testing.assert_array_equal(
+                fastcluster.linkage(D, method=method, checkpoint=checkpoint,
+                                    checkpoint_interval=7), Z)
+            assert os.listdir(checkpoint) == []
+
+    # The same for linkage_vector
+    X = np.random.rand(N,3)
+    for method, algorithm in vector_methods:
+        for metric in (('euclidean', 'cityblock')
+                       if algorithm in ('prim', 'nndescent')
+                       else ('euclidean',)):
+            Z = fastcluster.linkage_vector(X, method=method, metric=metric,
+                                           algorithm=algorithm, n_neighbors=2)
+            reports = []
+            np.testing.assert_array_equal(
+                fastcluster.linkage_vector(
+                    X, method=method, metric=metric, algorithm=algorithm,
+                    n_neighbors=2, callback=lambda *args: reports.append(args),
+                    callback_interval=interval), Z)
+            steps = [step for step, _, _ in reports]
+            if algorithm in ('prim', 'auto'):
+                assert steps == list(range(interval, N, interval))[:len(steps)]
+                assert len(steps) >= (N-2)//interval
+            else:
+                assert all(step_next >= step+interval for step, step_next
+                           in zip(steps, steps[1:]))
+                assert all(step < N for step in steps)
+            for step, n, dist in reports:
+                assert n == N
+                assert dist in Z[:,2]
+
+            try:
+                fastcluster.linkage_vector(
+                    X, method=method, metric=metric, algorithm=algorithm,
+                    n_neighbors=2, callback=lambda step, n, dist: 1/0,
+                    callback_interval=1)
+                if N > 2:
+                    raise AssertionError('The exception in the callback was '
+                                         'not passed on!')
+            except ZeroDivisionError:
+                pass
+
+    # A pending interrupt is raised at the next report. The C function
+    # PyErr_SetInterrupt as the callback sets the flag without running
+    # Python code, which would raise the KeyboardInterrupt itself. It
+    # ignores the arguments.
+    interrupt = ctypes.PYFUNCTYPE(None, ctypes.c_ssize_t, ctypes.c_ssize_t,
+                                  ctypes.c_double)(('PyErr_SetInterrupt',
+                                                    ctypes.pythonapi))
+    N = 100
+    D = fastcluster.pdist(np.random.rand(N,3))
+    for method in methods:
+        try:
+            fastcluster.linkage(D, method=method, callback=interrupt,
+                                callback_interval=10)
+            raise AssertionError('The clustering was not interrupted!')
+        except KeyboardInterrupt:
+            pass
+    X = np.random.rand(N,3)
+    for method, algorithm in vector_methods:
+        if algorithm=='nndescent':
+            # Too few reports to raise the interrupt
+            continue
+        try:
+            fastcluster.linkage_vector(X, method=method, algorithm=algorithm,
+                                       callback=interrupt,
+                                       callback_interval=10)
+            raise AssertionError('The clustering was not interrupted!')
+        except KeyboardInterrupt:
+            pass
+
+if __name__ == "__main__":
+    test()
+    print('OK.')
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''Test the checkpoints of the methods 'centroid' and 'median': a run which
+is killed and resumed must give the same dendrogram as a run without
+interruption.'''
+print('''
+Test program for the 'fastcluster' package.
+Copyright:
+  * Until package version 1.1.23: (c) 2011 Daniel Müllner <https://danifold.net>
+  * All changes from version 1.1.24 on: (c) Google Inc. <https://www.google.com>''')
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+import fastcluster
+
+version = '1.3.0'
+if fastcluster.__version__ != version:
+    raise ValueError('Wrong module version: {} instead of {}.'.format(fastcluster.__version__, version))
+
+import atexit
+def print_seed():
+  print("Seed: {0}".format(seed))
+atexit.register(print_seed)
+
+seed = np.random.randint(0,1e9)
+
+np.random.seed(seed)
+
+# Clustering with checkpoints in a fresh interpreter
+child = '''
+import sys, fastcluster
+fastcluster.linkage(sys.argv[1], method=sys.argv[2], checkpoint=sys.argv[3],
+                    checkpoint_interval=int(sys.argv[4]))
+'''
+
+def kill_run(filename, method, checkpoint, interval):
+    '''Start the clustering in a child process and kill it soon after the
+first checkpoint. Return whether it was interrupted.'''
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    p = subprocess.Popen([sys.executable, '-c', child, filename, method,
+                          checkpoint, str(interval)], env=env)
+    state = os.path.join(checkpoint, 'state')
+    while p.poll() is None and not os.path.exists(state):
+        time.sleep(.001)
+    time.sleep(np.random.rand()*.2)
+    p.kill()
+    p.wait()
+    return os.path.exists(state)
+
+def test():
+    n = np.random.randint(2,200)
+    X = np.random.rand(n,3)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        checkpoint = os.path.join(tmpdir, 'checkpoint')
+        for method in ('centroid', 'median'):
+            for dtype in (np.double, np.single):
+                D = fastcluster.pdist(X).astype(dtype)
+                Z = fastcluster.linkage(D, method=method)
+                interval = np.random.randint(1,10)
+                np.testing.assert_array_equal(
+                    fastcluster.linkage(D, method=method,
+                                        checkpoint=checkpoint,
+                                        checkpoint_interval=interval), Z)
+                # The files are removed after the clustering.
+                assert os.listdir(checkpoint) == []
+            np.testing.assert_array_equal(
+                fastcluster.linkage(X, method=method, checkpoint=checkpoint,
+                                    optimal_ordering=True),
+                fastcluster.linkage(X, method=method, optimal_ordering=True))
+
+        # Interrupted runs
+        n = 2000
+        D = fastcluster.pdist(np.random.rand(n,3))
+        filename = os.path.join(tmpdir, 'D.npy')
+        np.save(filename, D)
+        D_other = fastcluster.pdist(np.random.rand(n-1,3))
+        for method in ('centroid', 'median'):
+            Z = fastcluster.linkage(D, method=method)
+            for interval in (7, 1000):
+                for _ in range(2):
+                    interrupted = kill_run(filename, method, checkpoint,
+                                           interval)
+                if interrupted:
+                    # The checkpoint belongs to a different problem.
+                    try:
+                        fastcluster.linkage(D_other, method=method,
+                                            checkpoint=checkpoint)
+                        raise AssertionError('fastcluster did not detect '
+                                             'a wrong checkpoint!')
+                    except ValueError:
+                        pass
+                np.testing.assert_array_equal(
+                    fastcluster.linkage(filename, method=method,
+                                        checkpoint=checkpoint,
+                                        checkpoint_interval=interval), Z)
+                assert os.listdir(checkpoint) == []
+
+        # A checkpoint is only resumed for the same data, data type, method
+        # and metric. The run is stopped by the callback after the first
+        # checkpoint.
+        n = np.random.randint(20,200)
+        X = np.random.rand(n,3)
+        D = fastcluster.pdist(X)
+        D_same_n = fastcluster.pdist(np.random.rand(n,3))
+        def stop(step, n, dist):
+            return step < 10
+        for method in ('centroid', 'median'):
+            for data, dtype in ((X, np.double), (D, np.double),
+                                (D, np.single)):
+                data = data.astype(dtype)
+                Z = fastcluster.linkage(data, method=method)
+                try:
+                    fastcluster.linkage(data, method=method,
+                                        checkpoint=checkpoint,
+                                        checkpoint_interval=3,
+                                        callback=stop, callback_interval=1)
+                except RuntimeError:
+                    pass
+                files = sorted(os.listdir(checkpoint))
+                assert 'state' in files
+                others = [(data.astype(np.single if dtype==np.double
+                                       else np.double), {}),
+                          (D_same_n.astype(dtype) if data.ndim==1
+                           else np.random.rand(n,3), {}),
+                          (data, {'method': 'median' if method=='centroid'
+                                  else 'centroid'})]
+                if data.ndim==2:
+                    others.append((data, {'metric': 'cityblock'}))
+                for other, kwargs in others:
+                    kwargs = dict({'method': method}, **kwargs)
+                    try:
+                        fastcluster.linkage(other, checkpoint=checkpoint,
+                                            **kwargs)
+                        raise AssertionError('fastcluster resumed a '
+                                             'checkpoint for a different '
+                                             'problem!')
+                    except ValueError:
+                        pass
+                    assert sorted(os.listdir(checkpoint)) == files
+                np.testing.assert_array_equal(
+                    fastcluster.linkage(data, method=method,
+                                        checkpoint=checkpoint), Z)
+                assert os.listdir(checkpoint) == []
+
+    try:
+        fastcluster.linkage(D, method='average', checkpoint=tmpdir)
+        raise AssertionError('fastcluster accepted a checkpoint for a '
+                             'method without checkpoints!')
+    except ValueError:
+        pass
+
+if __name__ == "__main__":
+    test()
+    print('OK.')
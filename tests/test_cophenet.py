@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''Test the cophenetic correlation coefficient against
+scipy.cluster.hierarchy.cophenet.'''
+print('''
+Test program for the 'fastcluster' package.
+Copyright:
+  * Until package version 1.1.23: (c) 2011 Daniel Müllner <https://danifold.net>
+  * All changes from version 1.1.24 on: (c) Google Inc. <https://www.google.com>''')
+import numpy as np
+import fastcluster
+from scipy.cluster import hierarchy
+
+version = '1.3.0'
+if fastcluster.__version__ != version:
+    raise ValueError('Wrong module version: {} instead of {}.'.format(fastcluster.__version__, version))
+
+import atexit
+def print_seed():
+  print("Seed: {0}".format(seed))
+atexit.register(print_seed)
+
+seed = np.random.randint(0,1e9)
+
+np.random.seed(seed)
+
+def test():
+    N = np.random.randint(3,300)
+    # Integer coordinates give equal heights.
+    for X in (np.random.rand(N,3), np.random.randint(0,4,(N,2))):
+        D = fastcluster.pdist(X)
+        for method in ('single', 'complete', 'average', 'weighted', 'ward',
+                       'centroid', 'median'):
+            Z = fastcluster.linkage(D, method=method)
+            c = hierarchy.cophenet(Z, D)[0]
+            np.testing.assert_allclose(fastcluster.cophenetic_correlation(Z, D),
+                                       c, rtol=1e-12)
+            np.testing.assert_allclose(fastcluster.cophenetic_correlation(Z, X),
+                                       c, rtol=1e-12)
+            np.testing.assert_allclose(
+                fastcluster.cophenetic_correlation(Z, D.astype(np.float32)),
+                hierarchy.cophenet(Z, D.astype(np.float32).astype(np.double))[0],
+                rtol=1e-10)
+
+    # NaN detection
+    D[np.random.randint(len(D))] = np.nan
+    try:
+        fastcluster.cophenetic_correlation(Z, D)
+        raise AssertionError('fastcluster did not detect a NaN value!')
+    except FloatingPointError:
+        pass
+
+if __name__ == "__main__":
+    test()
+    print('OK.')
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''Test the flat clusters, cuts and leaf order of a dendrogram against
+scipy.cluster.hierarchy.fcluster, cut_tree and leaves_list.'''
+print('''
+Test program for the 'fastcluster' package.
+Copyright:
+  * Until package version 1.1.23: (c) 2011 Daniel Müllner <https://danifold.net>
+  * All changes from version 1.1.24 on: (c) Google Inc. <https://www.google.com>''')
+import numpy as np
+import fastcluster
+from scipy.cluster import hierarchy
+
+version = '1.3.0'
+if fastcluster.__version__ != version:
+    raise ValueError('Wrong module version: {} instead of {}.'.format(fastcluster.__version__, version))
+
+import atexit
+def print_seed():
+  print("Seed: {0}".format(seed))
+atexit.register(print_seed)
+
+seed = np.random.randint(0,1e9)
+
+np.random.seed(seed)
+
+def check(T, T_scipy):
+    assert T.dtype==T_scipy.dtype
+    np.testing.assert_array_equal(T, T_scipy)
+
+def check_fcluster(Z):
+    N = len(Z)+1
+    # Thresholds at the merging heights test the ties.
+    for t in np.concatenate((np.unique(Z[:,2]), [-1.])):
+        check(fastcluster.fcluster(Z, t, 'distance'),
+              hierarchy.fcluster(Z, t, 'distance'))
+    R = hierarchy.inconsistent(Z, 3)
+    for t in (.5, .8, 1.2):
+        for depth in range(4):
+            check(fastcluster.fcluster(Z, t, depth=depth),
+                  hierarchy.fcluster(Z, t, depth=depth))
+        check(fastcluster.fcluster(Z, t, R=R),
+              hierarchy.fcluster(Z, t, R=R))
+    monocrit = hierarchy.maxRstat(Z, hierarchy.inconsistent(Z), 3)
+    for t in np.unique(monocrit):
+        check(fastcluster.fcluster(Z, t, 'monocrit', monocrit=monocrit),
+              hierarchy.fcluster(Z, t, 'monocrit', monocrit=monocrit))
+    # SciPy needs sorted heights for the 'maxclust' criteria.
+    if np.all(np.diff(Z[:,2]) >= 0):
+        for t in range(1, N+2):
+            check(fastcluster.fcluster(Z, t, 'maxclust'),
+                  hierarchy.fcluster(Z, t, 'maxclust'))
+            check(fastcluster.fcluster(Z, t, 'maxclust_monocrit',
+                                       monocrit=Z[:,2]),
+                  hierarchy.fcluster(Z, t, 'maxclust_monocrit',
+                                     monocrit=Z[:,2]))
+    # Otherwise, the threshold is the smallest one for at most t clusters.
+    maxdists = hierarchy.maxdists(Z)
+    for t in range(1, N):
+        T = fastcluster.fcluster(Z, t, 'maxclust')
+        threshold = np.sort(maxdists)[N-1-t]
+        check(T, hierarchy.fcluster(Z, threshold, 'distance'))
+        assert T.max() <= t
+        lower = maxdists[maxdists < threshold]
+        if len(lower):
+            assert hierarchy.fcluster(Z, lower.max(), 'distance').max() > t
+    check(fastcluster.fcluster(Z, N, 'maxclust'), np.arange(1, N+1,
+                                                             dtype=np.intc))
+
+def check_cut_tree(Z):
+    N = len(Z)+1
+    check(fastcluster.cut_tree(Z), hierarchy.cut_tree(Z))
+    # SciPy returns zeros for N clusters in other than the first column.
+    n_clusters = np.concatenate(([N+1], np.random.randint(0, N, 5)))
+    check(fastcluster.cut_tree(Z, n_clusters=n_clusters),
+          hierarchy.cut_tree(Z, n_clusters=n_clusters))
+    check(fastcluster.cut_tree(Z, n_clusters=1),
+          hierarchy.cut_tree(Z, n_clusters=1))
+    height = np.concatenate(([-1.], Z[:,2][Z[:,2] > Z[:,2].min()]))
+    check(fastcluster.cut_tree(Z, height=height),
+          hierarchy.cut_tree(Z, height=height))
+
+def test():
+    N = np.random.randint(2,100)
+    # Integer coordinates give equal heights.
+    for X in (np.random.rand(N,2), np.random.randint(0,4,(N,2))):
+        for method in ('single', 'complete', 'average', 'weighted', 'ward',
+                       'centroid', 'median'):
+            Z = fastcluster.linkage(X, method=method)
+            check_fcluster(Z)
+            check(fastcluster.leaves_list(Z), hierarchy.leaves_list(Z))
+            Z_, leaves = fastcluster.linkage(X, method=method,
+                                             return_leaves=True)
+            np.testing.assert_array_equal(Z_, Z)
+            check(leaves, hierarchy.leaves_list(Z))
+            Z_, leaves = fastcluster.linkage(X, method=method,
+                                             optimal_ordering=True,
+                                             return_leaves=True)
+            check(leaves, hierarchy.leaves_list(Z_))
+            if method in ('single', 'ward', 'centroid', 'median'):
+                Z_, leaves = fastcluster.linkage_vector(X, method=method,
+                                                        return_leaves=True)
+                check(leaves, hierarchy.leaves_list(Z_))
+            # SciPy's cut_tree requires monotone heights.
+            if method not in ('centroid', 'median'):
+                check_cut_tree(Z)
+    # Growing gaps between the points give a chain of N-1 nested clusters,
+    # deeper than SciPy's recursion limit.
+    N = 20000
+    X = (np.arange(N, dtype=np.double)**2).reshape(N, 1)
+    Z = fastcluster.linkage_vector(X)
+    check(fastcluster.leaves_list(Z),
+          np.concatenate((np.arange(N-1, 1, -1), [0, 1])).astype(np.intc))
+    # Invalid dendrograms are rejected.
+    Z[-1,0] = Z[-1,1]
+    try:
+        fastcluster.fcluster(Z, 1.)
+        raise AssertionError('fastcluster did not detect an invalid '
+                             'linkage matrix!')
+    except ValueError:
+        pass
+
+if __name__ == "__main__":
+    test()
+    print('OK.')
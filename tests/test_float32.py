@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''Test the single precision code path: float32 input must give the same
+dendrograms as double input, up to single precision rounding.'''
+print('''
+Test program for the 'fastcluster' package.
+Copyright:
+  * Until package version 1.1.23: (c) 2011 Daniel Müllner <https://danifold.net>
+  * All changes from version 1.1.24 on: (c) Google Inc. <https://www.google.com>''')
+import tracemalloc
+import numpy as np
+import fastcluster
+
+version = '1.3.0'
+if fastcluster.__version__ != version:
+    raise ValueError('Wrong module version: {} instead of {}.'.format(fastcluster.__version__, version))
+
+import atexit
+def print_seed():
+  print("Seed: {0}".format(seed))
+atexit.register(print_seed)
+
+seed = np.random.randint(0,1e9)
+
+np.random.seed(seed)
+
+rtol = 1e-4 # relative tolerance for methods with floating point updates
+
+def test():
+    n = np.random.randint(2,100)
+    dim = np.random.randint(2,13)
+
+    # Part 1: distance matrix input
+    D = np.random.rand(n*(n-1)//2).astype(np.float32)
+    D2 = D.copy()
+    for method in ['single', 'complete', 'average', 'weighted', 'ward',
+                   'centroid', 'median']:
+        Z32 = fastcluster.linkage(D, method=method)
+        Z64 = fastcluster.linkage(D.astype(np.double), method=method)
+        # SciPy accepts only double linkage matrices, so Z is double for
+        # float32 input, too. The checks below show that the clustering
+        # itself runs in single precision.
+        assert Z32.dtype==np.double
+        if method in ('single', 'complete'):
+            # No arithmetic on the dissimilarities: results must be exact.
+            np.testing.assert_array_equal(Z32, Z64)
+        else:
+            np.testing.assert_allclose(np.sort(Z32[:,2]), np.sort(Z64[:,2]),
+                                       rtol=rtol)
+        if method!='single':
+            np.testing.assert_array_equal(D, D2)
+        if method in ('average', 'weighted'):
+            # The cluster averages are formed in single precision: the
+            # heights are float32 numbers, which they are not for double
+            # input in general.
+            np.testing.assert_array_equal(
+                Z32[:,2].astype(np.float32).astype(np.double), Z32[:,2])
+
+    # The float32 matrix is the working array for preserve_input=False:
+    # the clustering writes into it, and no copy is made: apart from the
+    # output, Python allocates only a few hundred bytes.
+    D2 = np.random.rand(499500).astype(np.float32)
+    for method in ['complete', 'average', 'weighted', 'ward', 'centroid',
+                   'median']:
+        D3 = D2.copy()
+        tracemalloc.start()
+        Z32 = fastcluster.linkage(D3, method=method, preserve_input=False)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        assert np.any(D3!=D2)
+        assert peak < Z32.nbytes + 4096
+        np.testing.assert_array_equal(Z32,
+                                      fastcluster.linkage(D2, method=method))
+
+    # Part 2: vector input
+    X = np.random.rand(n,dim).astype(np.float32)
+    X64 = X.astype(np.double)
+    assert fastcluster.pdist(X).dtype==np.float32
+    for metric in ['euclidean', 'sqeuclidean', 'cityblock', 'chebychev',
+                   'cosine', 'seuclidean']:
+        Z32 = fastcluster.linkage_vector(X, method='single', metric=metric)
+        Z64 = fastcluster.linkage_vector(X64, method='single', metric=metric)
+        assert Z32.dtype==np.double
+        # Cancellation in the metrics: small distances are only accurate
+        # relative to the scale of the data.
+        np.testing.assert_allclose(Z32[:,2], Z64[:,2], rtol=rtol,
+                                   atol=rtol*Z64[-1,2])
+    for method in ['ward', 'centroid', 'median']:
+        Z32 = fastcluster.linkage_vector(X, method=method)
+        Z64 = fastcluster.linkage_vector(X64, method=method)
+        np.testing.assert_allclose(np.sort(Z32[:,2]), np.sort(Z64[:,2]),
+                                   rtol=rtol, atol=rtol*Z64[:,2].max())
+
+    # Part 3: NaN detection in single precision
+    if n > 2:
+        D[np.random.randint(len(D))] = np.nan
+        for method in ['single', 'average', 'ward']:
+            try:
+                fastcluster.linkage(D, method=method)
+                raise AssertionError('fastcluster did not detect a NaN value!')
+            except FloatingPointError:
+                pass
+
+if __name__ == "__main__":
+    test()
+    print('OK.')
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''Test the batch functions linkage_many and linkage_vector_many against
+single calls of linkage and linkage_vector.'''
+print('''
+Test program for the 'fastcluster' package.
+Copyright:
+  * Until package version 1.1.23: (c) 2011 Daniel Müllner <https://danifold.net>
+  * All changes from version 1.1.24 on: (c) Google Inc. <https://www.google.com>''')
+import numpy as np
+import fastcluster
+import threading
+import time
+import _thread
+
+version = '1.3.0'
+if fastcluster.__version__ != version:
+    raise ValueError('Wrong module version: {} instead of {}.'.format(fastcluster.__version__, version))
+
+import atexit
+def print_seed():
+  print("Seed: {0}".format(seed))
+atexit.register(print_seed)
+
+seed = np.random.randint(0,1e9)
+
+np.random.seed(seed)
+
+def check(L, ref):
+    assert len(L)==len(ref)
+    for Z, Zref in zip(L, ref):
+        np.testing.assert_array_equal(Z, Zref)
+
+def test():
+    count = np.random.randint(1, 30)
+    dim = np.random.randint(1, 5)
+    Xs = [np.random.rand(np.random.randint(1, 60), dim) for _ in range(count)]
+    # Integer data with ties, in single precision for some data sets.
+    Xs += [np.round(10*np.random.rand(np.random.randint(2, 60), dim)).astype(
+        np.random.choice([np.float32, np.double])) for _ in range(count)]
+    Ds = [fastcluster.pdist(X) for X in Xs if len(X)>1]
+
+    # Part 1: condensed matrices and vector data, both output formats. The
+    # input must not be modified.
+    for method in ['single', 'complete', 'average', 'weighted', 'ward',
+                   'centroid', 'median']:
+        D2 = [D.copy() for D in Ds]
+        ref = [fastcluster.linkage(D, method=method) for D in Ds]
+        check(fastcluster.linkage_many(Ds, method=method), ref)
+        check(D2, Ds)
+        Z, offsets = fastcluster.linkage_many(Ds, method=method, stack=True)
+        check([Z[offsets[k]:offsets[k+1]] for k in range(len(Ds))], ref)
+        check(fastcluster.linkage_many(Xs, method=method),
+              [fastcluster.linkage(X, method=method) for X in Xs])
+
+    for method in ['single', 'ward', 'centroid', 'median']:
+        check(fastcluster.linkage_vector_many(Xs, method=method),
+              [fastcluster.linkage_vector(X, method=method) for X in Xs])
+    for metric in ['cityblock', 'chebychev', 'hamming', 'jaccard']:
+        check(fastcluster.linkage_vector_many(Xs, metric=metric),
+              [fastcluster.linkage_vector(X, metric=metric) for X in Xs])
+    # NN-descent with the same number of neighbors as in single calls, also
+    # for data sets which are large enough for NN-descent to be used.
+    Ys = Xs + [np.random.rand(np.random.randint(100, 400), dim)
+               for _ in range(3)]
+    for n_neighbors in (1, 2, 3, 15, 1000):
+        check(fastcluster.linkage_vector_many(Ys, algorithm='nndescent',
+                                              n_neighbors=n_neighbors),
+              [fastcluster.linkage_vector(Y, algorithm='nndescent',
+                                          n_neighbors=n_neighbors)
+               for Y in Ys])
+    for f in (fastcluster.linkage_vector_many,
+              lambda Ys, **kwargs: [fastcluster.linkage_vector(Y, **kwargs)
+                                    for Y in Ys]):
+        try:
+            f(Ys, algorithm='nndescent', n_neighbors=0)
+            raise AssertionError('fastcluster accepted n_neighbors=0!')
+        except ValueError:
+            pass
+    # A metric in Python is evaluated with the GIL, one data set at a time.
+    fn = lambda u, v: np.abs(u-v).sum()
+    check(fastcluster.linkage_vector_many(Xs, metric=fn),
+          [fastcluster.linkage_vector(X, metric=fn) for X in Xs])
+
+    # Part 2: NaN detection in one of the data sets
+    D = Ds[np.random.randint(len(Ds))]
+    D[np.random.randint(len(D))] = np.nan
+    try:
+        fastcluster.linkage_many(Ds, method='average')
+        raise AssertionError('fastcluster did not detect a NaN value!')
+    except FloatingPointError:
+        pass
+
+    # Part 3: Ctrl-C during a batch stops the tasks which have not started.
+    # The interrupt comes from another thread while the GIL is released.
+    Ds = [fastcluster.pdist(np.random.rand(600, 3)) for _ in range(300)]
+    Xs = [np.random.rand(600, 3) for _ in range(300)]
+    for f, data, method in ((fastcluster.linkage_many, Ds, 'average'),
+                            (fastcluster.linkage_vector_many, Xs, 'centroid')):
+        start = time.time()
+        f(data, method=method)
+        full = time.time()-start
+        timer = threading.Timer(0.05*full, _thread.interrupt_main)
+        start = time.time()
+        timer.start()
+        try:
+            f(data, method=method)
+            raise AssertionError('The batch was not interrupted!')
+        except KeyboardInterrupt:
+            pass
+        assert time.time()-start < 0.5*full, \
+            'The batch was only interrupted at the end.'
+
+if __name__ == "__main__":
+    test()
+    print('OK.')
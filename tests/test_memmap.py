@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''Test clustering of condensed matrices which are memory-mapped from disk:
+the results must agree with in-memory input, and the file must not be
+modified unless preserve_input=False is given for a writeable map.'''
+print('''
+Test program for the 'fastcluster' package.
+Copyright:
+  * Until package version 1.1.23: (c) 2011 Daniel Müllner <https://danifold.net>
+  * All changes from version 1.1.24 on: (c) Google Inc. <https://www.google.com>''')
+import os
+import tempfile
+import numpy as np
+import fastcluster
+
+version = '1.3.0'
+if fastcluster.__version__ != version:
+    raise ValueError('Wrong module version: {} instead of {}.'.format(fastcluster.__version__, version))
+
+import atexit
+def print_seed():
+  print("Seed: {0}".format(seed))
+atexit.register(print_seed)
+
+seed = np.random.randint(0,1e9)
+
+np.random.seed(seed)
+
+def test():
+    n = np.random.randint(2,100)
+    D = np.random.rand(n*(n-1)//2)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for dtype in (np.double, np.single):
+            D_ = D.astype(dtype)
+            filename = os.path.join(tmpdir, 'D.npy')
+            np.save(filename, D_)
+            for method in ['single', 'complete', 'average', 'weighted', 'ward',
+                           'centroid', 'median']:
+                Z = fastcluster.linkage(D_, method=method)
+                # Path to a .npy file
+                np.testing.assert_array_equal(
+                    fastcluster.linkage(filename, method=method), Z)
+                # Read-only and copy-on-write maps
+                for mode in ('r', 'c'):
+                    X = np.load(filename, mmap_mode=mode)
+                    np.testing.assert_array_equal(
+                        fastcluster.linkage(X, method=method,
+                                            preserve_input=False), Z)
+                    del X
+                # Writeable map with preserve_input=True
+                X = np.load(filename, mmap_mode='r+')
+                np.testing.assert_array_equal(
+                    fastcluster.linkage(X, method=method), Z)
+                np.testing.assert_array_equal(X, D_)
+                del X
+                np.testing.assert_array_equal(np.load(filename), D_)
+            # Writeable map with preserve_input=False: the file is used as
+            # scratch memory.
+            X = np.load(filename, mmap_mode='r+')
+            np.testing.assert_array_equal(
+                fastcluster.linkage(X, method='average', preserve_input=False),
+                fastcluster.linkage(D_, method='average'))
+            del X
+
+if __name__ == "__main__":
+    test()
+    print('OK.')
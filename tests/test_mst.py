@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''Test the incremental single linkage clustering by fastcluster.MST against
+the clustering from scratch by fastcluster.linkage_vector.'''
+print('''
+Test program for the 'fastcluster' package.
+Copyright:
+  * Until package version 1.1.23: (c) 2011 Daniel Müllner <https://danifold.net>
+  * All changes from version 1.1.24 on: (c) Google Inc. <https://www.google.com>''')
+import pickle
+import numpy as np
+import fastcluster
+
+version = '1.3.0'
+if fastcluster.__version__ != version:
+    raise ValueError('Wrong module version: {} instead of {}.'.format(fastcluster.__version__, version))
+
+import atexit
+def print_seed():
+  print("Seed: {0}".format(seed))
+atexit.register(print_seed)
+
+seed = np.random.randint(0,1e9)
+
+np.random.seed(seed)
+
+def check(Z, Z_ref, ties):
+    # The heights are unique, the merging steps only without ties.
+    np.testing.assert_allclose(np.sort(Z[:,2]), np.sort(Z_ref[:,2]),
+                               rtol=1e-12, atol=1e-12)
+    if not ties:
+        np.testing.assert_array_equal(Z[:,(0,1,3)], Z_ref[:,(0,1,3)])
+
+def test():
+    for metric in ('euclidean', 'sqeuclidean', 'cityblock', 'chebychev',
+                   'minkowski', 'cosine', 'seuclidean', 'mahalanobis',
+                   'jaccard', 'hamming'):
+        N0 = np.random.randint(1,200)
+        N = N0 + np.random.randint(1,100)
+        dim = np.random.randint(2,6)
+        X = np.random.rand(N,dim)
+        ties = metric in ('jaccard', 'hamming')
+        if ties:
+            X = X < .5
+        extraarg = None
+        if metric=='minkowski':
+            extraarg = 3.
+        elif metric=='seuclidean':
+            extraarg = np.random.rand(dim) + .5
+        elif metric=='mahalanobis':
+            extraarg = np.linalg.inv(np.cov(X, rowvar=False))
+        mst = fastcluster.MST(X[:N0], metric=metric, extraarg=extraarg)
+        check(mst.linkage(),
+              fastcluster.linkage_vector(X[:N0], metric=metric,
+                                         extraarg=extraarg), ties)
+        # Several batches, the last one after pickling
+        cuts = np.sort(np.random.randint(N0, N+1, 2))
+        mst.add_points(X[N0:cuts[0]])
+        mst.add_points(X[cuts[0]:cuts[1]])
+        mst = pickle.loads(pickle.dumps(mst))
+        Z = mst.add_points(X[cuts[1]:])
+        check(Z, fastcluster.linkage_vector(X, metric=metric,
+                                            extraarg=extraarg), ties)
+        np.testing.assert_array_equal(mst.linkage(), Z)
+
+    # Single precision, and a data set large enough for the Borůvka algorithm
+    N = np.random.randint(2000,3000)
+    X = np.random.rand(N,3).astype(np.float32)
+    mst = fastcluster.MST(X[:N-100])
+    Z = mst.add_points(X[N-100:])
+    np.testing.assert_allclose(np.sort(Z[:,2]),
+                               np.sort(fastcluster.linkage_vector(X)[:,2]),
+                               rtol=1e-6)
+
+    # Errors do not change the tree.
+    X_new = np.random.rand(5,3).astype(np.float32)
+    X_new[2,1] = np.nan
+    try:
+        mst.add_points(X_new)
+        raise AssertionError('fastcluster did not detect a NaN value!')
+    except FloatingPointError:
+        pass
+    try:
+        mst.add_points(np.random.rand(5,4))
+        raise AssertionError('fastcluster did not detect the wrong dimension!')
+    except ValueError:
+        pass
+    np.testing.assert_array_equal(mst.linkage(), Z)
+
+if __name__ == "__main__":
+    test()
+    print('OK.')
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''Test the optimal leaf ordering against an exhaustive search and against
+scipy.cluster.hierarchy.optimal_leaf_ordering.'''
+print('''
+Test program for the 'fastcluster' package.
+Copyright:
+  * Until package version 1.1.23: (c) 2011 Daniel Müllner <https://danifold.net>
+  * All changes from version 1.1.24 on: (c) Google Inc. <https://www.google.com>''')
+import itertools
+import numpy as np
+import fastcluster
+from scipy.cluster import hierarchy
+from scipy.spatial.distance import squareform
+
+version = '1.3.0'
+if fastcluster.__version__ != version:
+    raise ValueError('Wrong module version: {} instead of {}.'.format(fastcluster.__version__, version))
+
+import atexit
+def print_seed():
+  print("Seed: {0}".format(seed))
+atexit.register(print_seed)
+
+seed = np.random.randint(0,1e9)
+
+np.random.seed(seed)
+
+def cost(Z, D):
+    '''Sum of the dissimilarities between neighboring leaves'''
+    leaves = hierarchy.leaves_list(Z)
+    return squareform(D)[leaves[:-1], leaves[1:]].sum()
+
+def swapped(Z, Z_ordered):
+    '''Whether Z_ordered differs from Z only by swapped children'''
+    return np.array_equal(np.sort(Z[:,:2], axis=1),
+                          np.sort(Z_ordered[:,:2], axis=1)) and \
+        np.array_equal(Z[:,2:], Z_ordered[:,2:])
+
+def test():
+    # Exhaustive search over the orientations of all steps
+    N = np.random.randint(3,9)
+    X = np.random.rand(N,2)
+    D = fastcluster.pdist(X)
+    Z = fastcluster.linkage(D, method='average')
+    Z_ordered = fastcluster.optimal_leaf_ordering(Z, D)
+    assert swapped(Z, Z_ordered)
+    best = np.inf
+    for flip in itertools.product((False, True), repeat=N-1):
+        Z_flipped = Z.copy()
+        Z_flipped[np.array(flip),:2] = Z_flipped[np.array(flip),1::-1]
+        best = min(best, cost(Z_flipped, D))
+    np.testing.assert_allclose(cost(Z_ordered, D), best, rtol=1e-14)
+
+    N = np.random.randint(3,300)
+    # Integer coordinates give many optimal orders.
+    for X in (np.random.rand(N,3), np.random.randint(0,3,(N,2))):
+        D = fastcluster.pdist(X)
+        for method in ('single', 'complete', 'average', 'weighted', 'ward',
+                       'centroid', 'median'):
+            Z = fastcluster.linkage(D, method=method)
+            Z_ordered = fastcluster.optimal_leaf_ordering(Z, D)
+            assert swapped(Z, Z_ordered)
+            # SciPy's order is optimal or worse.
+            assert cost(Z_ordered, D) <= \
+                cost(hierarchy.optimal_leaf_ordering(Z, D), D)*(1+1e-12)
+            # The same in the clustering call, from the condensed matrix
+            # (reusing the working copy) and from the vector data
+            np.testing.assert_array_equal(
+                fastcluster.linkage(D, method=method, optimal_ordering=True),
+                Z_ordered)
+            np.testing.assert_array_equal(
+                fastcluster.linkage(X, method=method, optimal_ordering=True),
+                Z_ordered)
+        np.testing.assert_array_equal(
+            fastcluster.optimal_leaf_ordering(Z, X), Z_ordered)
+        D32 = D.astype(np.float32)
+        Z_ordered = fastcluster.optimal_leaf_ordering(Z, D32)
+        assert swapped(Z, Z_ordered)
+        assert cost(Z_ordered, D32.astype(np.double)) <= \
+            cost(hierarchy.optimal_leaf_ordering(Z, D32.astype(np.double)),
+                 D32.astype(np.double))*(1+1e-6)
+
+    # NaN detection
+    D[np.random.randint(len(D))] = np.nan
+    try:
+        fastcluster.optimal_leaf_ordering(Z, D)
+        raise AssertionError('fastcluster did not detect a NaN value!')
+    except FloatingPointError:
+        pass
+
+if __name__ == "__main__":
+    test()
+    print('OK.')
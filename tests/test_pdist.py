@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''Test the native pdist function against scipy.spatial.distance.pdist and
+make sure that linkage on vector data uses it consistently.'''
+print('''
+Test program for the 'fastcluster' package.
+Copyright:
+  * Until package version 1.1.23: (c) 2011 Daniel Müllner <https://danifold.net>
+  * All changes from version 1.1.24 on: (c) Google Inc. <https://www.google.com>''')
+import numpy as np
+import fastcluster
+from scipy.spatial.distance import pdist
+
+version = '1.3.0'
+if fastcluster.__version__ != version:
+    raise ValueError('Wrong module version: {} instead of {}.'.format(fastcluster.__version__, version))
+
+import atexit
+def print_seed():
+  print("Seed: {0}".format(seed))
+atexit.register(print_seed)
+
+seed = np.random.randint(0,1e9)
+
+np.random.seed(seed)
+
+rtol = 1e-12 # relative tolerance for double precision
+rtol32 = 1e-4 # relative tolerance for single precision
+atol = 1e-14 # absolute tolerance for distances which should be zero
+
+# fastcluster metric name: SciPy metric name
+float_metrics = {'euclidean': 'euclidean',
+                 'sqeuclidean': 'sqeuclidean',
+                 'cityblock': 'cityblock',
+                 'chebychev': 'chebyshev',
+                 'seuclidean': 'seuclidean',
+                 'cosine': 'cosine',
+                 'correlation': 'correlation',
+                 'canberra': 'canberra',
+                 'braycurtis': 'braycurtis',
+                 'minkowski': 'minkowski',
+                 'mahalanobis': 'mahalanobis'}
+
+bool_metrics = {'hamming': 'hamming',
+                'matching': 'hamming',
+                'jaccard': 'jaccard',
+                'dice': 'dice',
+                'rogerstanimoto': 'rogerstanimoto',
+                'russellrao': 'russellrao',
+                'sokalsneath': 'sokalsneath'}
+
+def test():
+    dim = np.random.randint(2,13)
+    n = np.random.randint(dim+2,100)
+
+    X = np.random.randn(n,dim)
+    for metric, scipy_metric in float_metrics.items():
+        D = fastcluster.pdist(X, metric)
+        assert D.dtype==np.double
+        np.testing.assert_allclose(D, pdist(X, scipy_metric), rtol=rtol,
+                                   atol=atol)
+        D32 = fastcluster.pdist(X.astype(np.float32), metric)
+        assert D32.dtype==np.float32
+        np.testing.assert_allclose(D32, D, rtol=rtol32, atol=rtol32)
+
+    p = np.random.uniform(.5, 5)
+    np.testing.assert_allclose(fastcluster.pdist(X, 'minkowski', p),
+                               pdist(X, 'minkowski', p=p), rtol=rtol)
+
+    # Boolean input; no zero vectors, since SciPy returns NaN for some metrics
+    B = np.random.randint(0, 2, size=(n,dim), dtype=bool)
+    B[:,0] = True
+    for metric, scipy_metric in bool_metrics.items():
+        D = fastcluster.pdist(B, metric)
+        np.testing.assert_allclose(D, pdist(B, scipy_metric), rtol=rtol)
+
+    # User-defined metrics are passed on to SciPy.
+    fn = lambda u, v: np.abs(u-v).sum()
+    np.testing.assert_allclose(fastcluster.pdist(X, fn),
+                               pdist(X, 'cityblock'), rtol=rtol)
+
+    # linkage on vector data gives the same output as before for every
+    # Boolean metric: the dissimilarities of SciPy, also for non-Boolean
+    # input and zero rows. A NaN dissimilarity (eg. 0/0 for 'dice') is an
+    # error, and metrics which SciPy does not know are rejected.
+    F = np.random.randint(0, 3, size=(n,dim))*np.random.uniform(.1, 2)
+    F[:3] = 0
+    for data in (F, F.astype(bool), np.random.rand(n,dim)):
+        for metric in fastcluster.booleanmetrics + ('hamming',):
+            try:
+                D = pdist(data, metric)
+            except ValueError:
+                try:
+                    fastcluster.linkage(data, metric=metric)
+                    raise AssertionError('fastcluster accepted the metric '
+                                         '{}!'.format(metric))
+                except ValueError:
+                    continue
+            if np.isnan(D).any():
+                try:
+                    fastcluster.linkage(data, metric=metric)
+                    raise AssertionError('fastcluster did not raise an '
+                                         'error for NaN dissimilarities!')
+                except FloatingPointError:
+                    continue
+            for method in ['single', 'average']:
+                np.testing.assert_array_equal(
+                    fastcluster.linkage(data, method=method, metric=metric),
+                    fastcluster.linkage(D, method=method))
+
+    # linkage on vector data equals linkage on the condensed matrix
+    for method in ['single', 'average', 'ward']:
+        for metric in ['euclidean', 'cityblock', 'cosine']:
+            np.testing.assert_array_equal(
+                fastcluster.linkage(X, method=method, metric=metric),
+                fastcluster.linkage(fastcluster.pdist(X, metric),
+                                    method=method))
+
+if __name__ == "__main__":
+    test()
+    print('OK.')
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''Test the runtime choice of the SIMD kernels: every instruction set level
+which the CPU supports must give the same distances, up to rounding, and
+exactly the same nearest-neighbor searches. The distances of the vectorized
+metrics are also compared with SciPy.'''
+print('''
+Test program for the 'fastcluster' package.
+Copyright:
+  * Until package version 1.1.23: (c) 2011 Daniel Müllner <https://danifold.net>
+  * All changes from version 1.1.24 on: (c) Google Inc. <https://www.google.com>''')
+import os
+import subprocess
+import sys
+import tempfile
+import numpy as np
+import fastcluster
+from scipy.spatial import distance
+
+version = '1.3.0'
+if fastcluster.__version__ != version:
+    raise ValueError('Wrong module version: {} instead of {}.'.format(fastcluster.__version__, version))
+
+import atexit
+def print_seed():
+  print("Seed: {0}".format(seed))
+atexit.register(print_seed)
+
+seed = np.random.randint(0,1e9)
+
+np.random.seed(seed)
+
+levels = ['scalar', 'neon', 'sse2', 'avx2', 'avx512']
+# Metrics with vectorized kernels
+metrics = ('sqeuclidean', 'cityblock', 'chebychev', 'canberra', 'braycurtis',
+           'cosine')
+# Metrics for Boolean data, with bit counts of packed words
+boolean_metrics = ('jaccard', 'yule', 'dice', 'rogerstanimoto', 'russellrao',
+                   'sokalsneath', 'matching')
+
+# Results in a fresh interpreter, with the kernels capped at the given level:
+# distances and dendrogram heights from the arithmetic kernels, dendrograms
+# which depend only on the nearest-neighbor searches, and the distances of
+# the Boolean metrics.
+child = '''
+import sys, numpy as np, fastcluster
+X = np.load(sys.argv[1])
+D = np.concatenate([fastcluster.pdist(X, metric) for metric in %r])
+Z = fastcluster.linkage_vector(X, method='ward')
+np.save(sys.argv[2], np.concatenate((D, np.sort(Z[:,2]))))
+Y = np.load(sys.argv[3])
+D = fastcluster.pdist(Y, 'cityblock')
+np.save(sys.argv[4], np.stack([fastcluster.linkage(D, method=method)
+    for method in ('complete', 'average', 'centroid')] +
+    [fastcluster.linkage_vector(Y, metric='cityblock')]))
+B = np.load(sys.argv[5])
+np.save(sys.argv[6], np.concatenate([fastcluster.pdist(B, metric)
+    for metric in %r]))
+print(fastcluster.simd_level())
+''' % (metrics, boolean_metrics)
+
+def run_level(level, X, Y, B, tmpdir):
+    env = dict(os.environ, FASTCLUSTER_SIMD=level)
+    env['PYTHONPATH'] = os.pathsep.join(sys.path)
+    files = [os.path.join(tmpdir, name + '.npy')
+             for name in ('X', level + '_X', 'Y', level + '_Y',
+                          'B', level + '_B')]
+    np.save(files[0], X)
+    np.save(files[2], Y)
+    np.save(files[4], B)
+    out = subprocess.check_output([sys.executable, '-c', child] + files,
+                                  env=env)
+    return (out.decode().split()[-1], np.load(files[1]), np.load(files[3]),
+            np.load(files[5]))
+
+def test():
+    level = fastcluster.simd_level()
+    assert level in levels
+    if level not in ('sse2', 'avx2', 'avx512'):
+        return
+
+    n = np.random.randint(2,60)
+    # Long enough vectors for the dispatched kernels, plus a remainder
+    dim = np.random.randint(24,100)
+    # Integer coordinates, which give many ties in the nearest-neighbor
+    # searches. The rows of the distance matrix are long enough for the
+    # vectorized argmin.
+    m = np.random.randint(30,300)
+    Y = np.random.randint(0,5,(m,2)).astype(np.double)
+    D = fastcluster.pdist(Y, 'cityblock')
+    ref_Y = np.stack([fastcluster.linkage(D, method=method)
+                      for method in ('complete', 'average', 'centroid')] +
+                     [fastcluster.linkage_vector(Y, metric='cityblock')])
+    # Boolean vectors over several words, with a partial last word
+    B = np.random.rand(n, np.random.randint(65,300)) < .3
+    D = [fastcluster.pdist(B, metric) for metric in boolean_metrics]
+    for metric, DD in zip(boolean_metrics, D):
+        if hasattr(distance, metric):
+            np.testing.assert_allclose(DD, distance.pdist(B, metric),
+                                       rtol=1e-14)
+    ref_B = np.concatenate(D)
+    for dtype, rtol in ((np.double, 1e-12), (np.float32, 1e-5)):
+        X = np.random.rand(n,dim).astype(dtype)
+        # Some equal coordinates, for the zero numerators in canberra
+        X[:,:dim//3] = np.round(X[:,:dim//3])
+        D = [fastcluster.pdist(X, metric) for metric in metrics]
+        for metric, DD in zip(metrics, D):
+            np.testing.assert_allclose(DD,
+                                       distance.pdist(X.astype(np.double),
+                                                      metric),
+                                       rtol=rtol, atol=rtol)
+        ref_X = np.concatenate(D +
+            [np.sort(fastcluster.linkage_vector(X, method='ward')[:,2])])
+        for cap in ('sse2', 'avx2', 'avx512'):
+            with tempfile.TemporaryDirectory() as tmpdir:
+                chosen, res_X, res_Y, res_B = run_level(cap, X, Y, B,
+                                                        tmpdir)
+            # The cap never raises the level.
+            assert levels.index(chosen) <= levels.index(level)
+            np.testing.assert_allclose(res_X, ref_X, rtol=rtol)
+            # The argmin kernels break ties like the scalar loops.
+            np.testing.assert_array_equal(res_Y, ref_Y)
+            np.testing.assert_array_equal(res_B, ref_B)
+
+if __name__ == "__main__":
+    test()
+    print('OK.')
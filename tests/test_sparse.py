@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''Test single linkage on sparse dissimilarity graphs against linkage on the
+condensed matrix.'''
+print('''
+Test program for the 'fastcluster' package.
+Copyright:
+  * Until package version 1.1.23: (c) 2011 Daniel Müllner <https://danifold.net>
+  * All changes from version 1.1.24 on: (c) Google Inc. <https://www.google.com>''')
+import numpy as np
+import fastcluster
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.cluster.hierarchy import fcluster
+
+version = '1.3.0'
+if fastcluster.__version__ != version:
+    raise ValueError('Wrong module version: {} instead of {}.'.format(fastcluster.__version__, version))
+
+import atexit
+def print_seed():
+  print("Seed: {0}".format(seed))
+atexit.register(print_seed)
+
+seed = np.random.randint(0,1e9)
+
+np.random.seed(seed)
+
+def test():
+    n = np.random.randint(2,200)
+
+    # Part 1: the complete graph gives the same dendrogram as the condensed
+    # matrix, both as edge arrays and as a (non-symmetric) sparse matrix.
+    D = np.random.rand(n*(n-1)//2)
+    i, j = np.triu_indices(n, 1)
+    Z = fastcluster.linkage(D, method='single')
+    np.testing.assert_array_equal(fastcluster.linkage_sparse((i, j, D)), Z)
+    G = coo_matrix((D, (j, i)), shape=(n, n)).tocsr()
+    np.testing.assert_array_equal(fastcluster.linkage_sparse(G), Z)
+    D32 = D.astype(np.float32)
+    np.testing.assert_array_equal(fastcluster.linkage_sparse((i, j, D32)),
+                                  fastcluster.linkage(D32, method='single'))
+
+    # Part 2: a random sparse graph. The connected components are joined at
+    # infinite distance, and cutting the dendrogram below infinity gives the
+    # connected components of the graph.
+    m = np.random.randint(0, 2*n)
+    i = np.random.randint(0, n, m)
+    j = np.random.randint(0, n, m)
+    w = np.random.rand(m)
+    G = coo_matrix((w, (i, j)), shape=(n, n))
+    Z = fastcluster.linkage_sparse(G)
+    assert Z.shape==(n-1, 4)
+    ncomp, labels = connected_components(G, directed=False)
+    assert np.count_nonzero(np.isinf(Z[:,2]))==ncomp-1
+    assert np.all(Z[:n-ncomp,2] <= 1)
+    T = fcluster(Z, 2, 'distance')
+    assert len(set(zip(T, labels)))==len(set(T))==ncomp
+
+    # Part 3: NaN detection
+    if m > 0:
+        w[np.random.randint(m)] = np.nan
+        try:
+            fastcluster.linkage_sparse((i, j, w), n)
+            raise AssertionError('fastcluster did not detect a NaN value!')
+        except FloatingPointError:
+            pass
+
+if __name__ == "__main__":
+    test()
+    print('OK.')
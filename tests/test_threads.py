@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''Test the thread limits: the output must not depend on the number of
+threads, and the limits must be applied and restored as documented.'''
+print('''
+Test program for the 'fastcluster' package.
+Copyright:
+  * Until package version 1.1.23: (c) 2011 Daniel Müllner <https://danifold.net>
+  * All changes from version 1.1.24 on: (c) Google Inc. <https://www.google.com>''')
+import numpy as np
+import fastcluster
+
+version = '1.3.0'
+if fastcluster.__version__ != version:
+    raise ValueError('Wrong module version: {} instead of {}.'.format(fastcluster.__version__, version))
+
+import atexit
+def print_seed():
+  print("Seed: {0}".format(seed))
+atexit.register(print_seed)
+
+seed = np.random.randint(0,1e9)
+
+np.random.seed(seed)
+
+def test():
+    # Part 1: The parallel code paths start at 4096 points. Integer data has
+    # many ties, which the threads must break in the same way as the serial
+    # loops.
+    n = np.random.randint(4100, 4400)
+    dim = np.random.randint(1, 4)
+    X = np.round(6*np.random.rand(n, dim))
+    D = fastcluster.pdist(X, threads=1)
+    np.testing.assert_array_equal(fastcluster.pdist(X, threads=3), D)
+    for method in ['single', 'complete', 'average', 'weighted', 'ward',
+                   'centroid', 'median']:
+        Z = fastcluster.linkage(D, method=method, threads=1)
+        np.testing.assert_array_equal(fastcluster.linkage(D, method=method,
+                                                          threads=3), Z)
+    for method in ['single', 'ward', 'centroid', 'median']:
+        Z = fastcluster.linkage_vector(X, method=method, threads=1)
+        with fastcluster.num_threads(3):
+            np.testing.assert_array_equal(
+                fastcluster.linkage_vector(X, method=method), Z)
+
+    # Part 2: The limits are nested as documented and restored afterwards.
+    default = fastcluster.get_num_threads()
+    assert default >= 1
+    try:
+        fastcluster.set_num_threads(1)
+        assert fastcluster.get_num_threads()==1
+        with fastcluster.num_threads(2):
+            assert fastcluster.get_num_threads()==min(2, default)
+            with fastcluster.num_threads(None):
+                assert fastcluster.get_num_threads()==1
+            assert fastcluster.get_num_threads()==min(2, default)
+        assert fastcluster.get_num_threads()==1
+    finally:
+        fastcluster.set_num_threads(None)
+    fastcluster.linkage(D[:10], threads=1)
+    assert fastcluster.get_num_threads()==default
+    for threads in [0, -1, 1.5]:
+        try:
+            fastcluster.linkage(D, threads=threads)
+            raise AssertionError('Invalid thread limit accepted.')
+        except ValueError:
+            pass
+
+if __name__ == "__main__":
+    test()
+    print('OK.')
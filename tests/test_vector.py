@@ -11,6 +11,7 @@ import sys
 import fastcluster as fc
 import numpy as np
 from scipy.spatial.distance import pdist, squareform
+from scipy.cluster.hierarchy import is_valid_linkage
 import math
 
 version = '1.3.0'
@@ -114,6 +115,31 @@ def __test_all(n,dim):
 
     check(Z2, method, D)
 
+  # The dual-tree Borůvka algorithm, on integer data with many ties
+  for metric in ['euclidean', 'sqeuclidean']:
+    sys.stdout.write("Metric: " + metric + "...Algorithm: boruvka...")
+    Z2 = fc.linkage_vector(pcd, method, metric, algorithm='boruvka')
+    check(Z2, method, pdist(pcd, metric=metric))
+
+  # NN-descent is exact if every point has all other points as neighbors.
+  # (For so many neighbors, Prim's algorithm is used instead.)
+  sys.stdout.write("Metric: cityblock...Algorithm: nndescent...")
+  D = pdist(pcd, metric='cityblock')
+  Z2 = fc.linkage_vector(pcd, method, 'cityblock', algorithm='nndescent',
+                         n_neighbors=n)
+  check(Z2, method, D)
+  # Approximate single linkage: the sorted merging distances are distances
+  # between points and at least those of the exact dendrogram.
+  for n_neighbors in (1, 2, 4):
+    if 8*n_neighbors**2 < n:
+      Z2 = fc.linkage_vector(pcd, method, 'cityblock', algorithm='nndescent',
+                             n_neighbors=n_neighbors)
+      Z = fc.linkage_vector(pcd, method, 'cityblock')
+      if not is_valid_linkage(Z2) or \
+            np.any(np.sort(Z2[:,2]) < np.sort(Z[:,2])) or \
+            np.any(~np.isin(Z2[:,2], D)):
+        raise AssertionError('Wrong approximate single linkage.', Z2)
+
   D = pdist(pcd)
   for method in ['ward', 'centroid', 'median']:
     Z2 = fc.linkage_vector(pcd, method)
@@ -28,13 +28,7 @@ def get_optimization_flags():
     # 基础优化
     flags.extend(['-O3', '-DNDEBUG', '-funroll-loops'])
     
-    # 检查是否禁用快速数学
-    import os
-    if not os.environ.get('DISABLE_FAST_MATH', ''):
-        flags.append('-ffast-math')
-        print("✓ 快速数学优化已启用")
-    else:
-        print("⚠ 快速数学优化已禁用")
+    # 不使用 -ffast-math：它假定没有 NaN，会使 NaN 距离的检测失效。
     
     # 检测架构
     import platform
@@ -43,48 +37,15 @@ def get_optimization_flags():
     
     print(f"检测到架构: {machine} ({system})")
     
-    # 架构特定的优化
+    # 只使用架构的基线指令集，不使用 -march=native 等本机标志，
+    # 这样编译出的扩展也能在较旧的 CPU 上运行。
     if machine == 'arm64' or machine == 'aarch64':
-        # ARM64 架构 (Apple Silicon, ARM服务器)
-        if system == 'darwin':
-            # macOS ARM64 - 使用Apple Silicon优化
-            flags.extend(['-mcpu=native', '-mtune=native'])
-            print("✓ Apple Silicon 优化已启用")
-        else:
-            # Linux ARM64
-            flags.extend(['-mcpu=native', '-mtune=native'])
-            flags.append('-mfpu=neon')
-            print("✓ ARM64 NEON 优化已启用")
-        
+        # ARM64 的基线指令集已包含 NEON
+        print("✓ ARM64 NEON 内核已启用")
     elif machine == 'x86_64' or machine == 'amd64':
-        # x86_64 架构
-        flags.extend(['-march=native', '-mtune=native'])
-        print("✓ x86_64 优化已启用")
-        
-        # 检测 x86 SIMD 支持
-        try:
-            # 检查 AVX2 支持
-            result = subprocess.run(['grep', '-q', 'avx2', '/proc/cpuinfo'], 
-                                  capture_output=True, check=False)
-            if result.returncode == 0:
-                flags.extend(['-mavx2', '-mfma'])
-                print("✓ AVX2 支持已启用")
-            
-            # 检查 AVX 支持
-            result = subprocess.run(['grep', '-q', 'avx', '/proc/cpuinfo'], 
-                                  capture_output=True, check=False)
-            if result.returncode == 0:
-                flags.append('-mavx')
-                print("✓ AVX 支持已启用")
-            
-            # SSE2 通常都支持
-            flags.append('-msse2')
-            print("✓ SSE2 支持已启用")
-            
-        except:
-            # 如果检测失败，使用保守的优化
-            flags.extend(['-msse2'])
-            print("⚠ 使用保守的 x86 SIMD 优化")
+        # 基线为 SSE2。AVX2/FMA 和 AVX-512 内核已编译在扩展中，
+        # 加载时根据 CPU 特性选择。
+        print("✓ x86_64: SSE2 基线，AVX2/AVX-512 内核在运行时选择")
     else:
         # 其他架构，使用通用优化
         print(f"⚠ 未知架构 {machine}，使用通用优化")
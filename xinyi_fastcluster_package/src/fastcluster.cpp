@@ -25,6 +25,18 @@
 
       MST_linkage_core_vector: single linkage clustering for vector data
 
+      MST_linkage_core_sqeuclidean: the same for the squared Euclidean metric,
+      with blocked dot products and pruning by the norm expansion
+
+      MST_linkage_core_boruvka: single linkage for low-dimensional Euclidean
+      data by the dual-tree Borůvka algorithm on a k-d tree (March, Ram, Gray)
+
+      MST_linkage_core_nndescent: approximate single linkage from a
+      nearest-neighbor graph by NN-descent (Dong, Charikar, Li)
+
+      MST_insert_points: insertion of new points into the minimum spanning
+      tree of vector data, for incremental single linkage (Chin, Houck)
+
       generic_linkage_vector: generic algorithm for vector data, suitable for
       the Ward, centroid and median methods.
 
@@ -32,6 +44,9 @@
       nearest neighbors. This method seems faster than "generic_linkage_vector"
       for the centroid and median methods but slower for the Ward method.
 
+  (3) MST_linkage_core_sparse: single linkage of a sparse graph of
+      dissimilarities by Kruskal's algorithm.
+
   All these implementation treat infinity values correctly. They throw an
   exception if a NaN distance value occurs.
 */
@@ -68,20 +83,72 @@
 #include <cstddef> // for std::ptrdiff_t
 #include <limits> // for std::numeric_limits<...>::infinity()
 #include <algorithm> // for std::fill_n
-#include <stdexcept> // for std::runtime_error
+#include <vector> // for std::vector
+#include <stdexcept> // for std::runtime_error, std::invalid_argument
 #include <string> // for std::string
+#include <cstring> // for std::memcpy, std::strcmp
+#include <cstdio> // for std::FILE, checkpoint files
+#include <cerrno> // for errno
 
 // Cross-platform SIMD support
+/* On x86 with GCC (from version 7) and Clang, the SIMD kernels are compiled
+   for several instruction set levels in the same binary, and the best level
+   for the CPU is chosen at run time; see simd_utils below. Other compilers
+   and platforms use the instruction set from the build flags only.
+*/
+#ifndef HAVE_SIMD_DISPATCH
+#if (defined(__x86_64__) || defined(__i386__)) && \
+  (__GNUC__ >= 7 || defined(__clang__))
+#define HAVE_SIMD_DISPATCH 1
+#endif
+#endif
+#if HAVE_SIMD_DISPATCH
+#include <immintrin.h>
+#include <cstdlib> // for std::getenv
+#else
 #ifdef __SSE2__
 #include <emmintrin.h>
 #endif
 #ifdef __AVX__
 #include <immintrin.h>
 #endif
+#endif
 #ifdef __ARM_NEON
 #include <arm_neon.h>
 #endif
 
+// posix_madvise for read-ahead on memory-mapped input
+#ifndef HAVE_POSIX_MADVISE
+#if defined(__unix__) || defined(__APPLE__)
+#include <stdint.h> // for uintptr_t
+#include <sys/mman.h>
+#include <unistd.h>
+#define HAVE_POSIX_MADVISE 1
+#endif
+#endif
+
+// fsync/_commit to write checkpoint files through to the disk
+#ifndef HAVE_FSYNC
+#if defined(__unix__) || defined(__APPLE__)
+#include <unistd.h>
+#define HAVE_FSYNC 1
+#elif defined(_WIN32)
+#include <io.h> // for _commit, _fileno
+#define HAVE_FSYNC 1
+#endif
+#endif
+
+// MoveFileEx to replace a checkpoint file atomically on Windows
+#ifdef _WIN32
+#ifndef NOMINMAX
+#define NOMINMAX // no min/max macros, which break std::numeric_limits
+#endif
+#ifndef WIN32_LEAN_AND_MEAN
+#define WIN32_LEAN_AND_MEAN
+#endif
+#include <windows.h>
+#endif
+
 // OpenMP support for parallelization
 #ifdef _OPENMP
 #include <omp.h>
@@ -165,6 +232,12 @@ typedef int_fast32_t t_index;
 #if (INT_MAX > MAX_INDEX)
 #error The integer format "int" must not have a greater range than "t_index".
 #endif
+/* t_float is the precision of the output (the dendrogram) and of the list of
+   merging steps. The clustering cores are templates in the floating point type
+   of the input, so that single-precision dissimilarities can be processed
+   without conversion. Inside these templates, the template parameter t_float
+   hides this global type.
+*/
 typedef double t_float;
 
 // Cross-platform SIMD utilities
@@ -175,10 +248,24 @@ namespace simd_utils {
         SIMD_SSE2 = 1,
         SIMD_AVX = 2,
         SIMD_AVX2 = 4,
-        SIMD_NEON = 8
+        SIMD_NEON = 8,
+        SIMD_FMA = 16,
+        SIMD_AVX512F = 32,
+        SIMD_POPCNT = 64,
+        SIMD_AVX512VPOPCNTDQ = 128
     };
-    
-    inline int get_simd_features() {
+
+    // Instruction set levels of the kernels
+    enum SIMDLevel {
+        SIMD_LEVEL_SCALAR = 0,
+        SIMD_LEVEL_NEON,
+        SIMD_LEVEL_SSE2,
+        SIMD_LEVEL_AVX2,   // AVX2 and FMA
+        SIMD_LEVEL_AVX512  // AVX-512F
+    };
+
+    // SIMD features which the build flags enable
+    inline int compiled_simd_features() {
         int features = SIMD_NONE;
 #ifdef __SSE2__
         features |= SIMD_SSE2;
@@ -191,17 +278,32 @@ namespace simd_utils {
 #endif
 #ifdef __ARM_NEON
         features |= SIMD_NEON;
+#endif
+#ifdef __FMA__
+        features |= SIMD_FMA;
+#endif
+#ifdef __AVX512F__
+        features |= SIMD_AVX512F;
+#endif
+#ifdef __POPCNT__
+        features |= SIMD_POPCNT;
+#endif
+#ifdef __AVX512VPOPCNTDQ__
+        features |= SIMD_AVX512VPOPCNTDQ;
 #endif
         return features;
     }
-    
+
+    /* Kernels for the instruction set of the build flags. With runtime
+       dispatch, they are used for short vectors and on CPUs without AVX2.
+    */
     // Vectorized squared Euclidean distance calculation
-    inline t_float simd_sqeuclidean(const t_float* a, const t_float* b, t_index dim) {
+    inline t_float sqeuclidean_baseline(const t_float* a, const t_float* b, t_index dim) {
         t_float sum = 0.0;
         t_index i = 0;
         
 #ifdef __AVX2__
-        if (get_simd_features() & SIMD_AVX2) {
+        if (compiled_simd_features() & SIMD_AVX2) {
             __m256d sum_vec = _mm256_setzero_pd();
             for (; i + 4 <= dim; i += 4) {
                 __m256d va = _mm256_loadu_pd(a + i);
@@ -216,7 +318,7 @@ namespace simd_utils {
             sum = temp[0] + temp[1] + temp[2] + temp[3];
         }
 #elif defined(__SSE2__)
-        if (get_simd_features() & SIMD_SSE2) {
+        if (compiled_simd_features() & SIMD_SSE2) {
             __m128d sum_vec = _mm_setzero_pd();
             for (; i + 2 <= dim; i += 2) {
                 __m128d va = _mm_loadu_pd(a + i);
@@ -231,1190 +333,5195 @@ namespace simd_utils {
             sum = temp[0] + temp[1];
         }
 #elif defined(__ARM_NEON)
-        if (get_simd_features() & SIMD_NEON) {
+        if (compiled_simd_features() & SIMD_NEON) {
+            // 对于double类型，使用float64x2_t
+            float64x2_t sum_vec = vdupq_n_f64(0.0);
+            for (; i + 2 <= dim; i += 2) {
+                float64x2_t va = vld1q_f64(a + i);
+                float64x2_t vb = vld1q_f64(b + i);
+                float64x2_t diff = vsubq_f64(va, vb);
+                float64x2_t square = vmulq_f64(diff, diff);
+                sum_vec = vaddq_f64(sum_vec, square);
+            }
+            // Horizontal sum
+            sum = vgetq_lane_f64(sum_vec, 0) + vgetq_lane_f64(sum_vec, 1);
+        }
+#endif
+        
+        // Handle remaining elements
+        for (; i < dim; ++i) {
+            t_float diff = a[i] - b[i];
+            sum += diff * diff;
+        }
+
+        return sum;
+    }
+
+    // Single-precision variant: twice as many lanes per vector register
+    inline float sqeuclidean_baseline(const float* a, const float* b, t_index dim) {
+        float sum = 0.0f;
+        t_index i = 0;
+
+#ifdef __AVX2__
+        if (compiled_simd_features() & SIMD_AVX2) {
+            __m256 sum_vec = _mm256_setzero_ps();
+            for (; i + 8 <= dim; i += 8) {
+                __m256 va = _mm256_loadu_ps(a + i);
+                __m256 vb = _mm256_loadu_ps(b + i);
+                __m256 diff = _mm256_sub_ps(va, vb);
+                __m256 square = _mm256_mul_ps(diff, diff);
+                sum_vec = _mm256_add_ps(sum_vec, square);
+            }
+            // Horizontal sum
+            float temp[8];
+            _mm256_storeu_ps(temp, sum_vec);
+            sum = ((temp[0] + temp[1]) + (temp[2] + temp[3])) +
+                  ((temp[4] + temp[5]) + (temp[6] + temp[7]));
+        }
+#elif defined(__SSE2__)
+        if (compiled_simd_features() & SIMD_SSE2) {
+            __m128 sum_vec = _mm_setzero_ps();
+            for (; i + 4 <= dim; i += 4) {
+                __m128 va = _mm_loadu_ps(a + i);
+                __m128 vb = _mm_loadu_ps(b + i);
+                __m128 diff = _mm_sub_ps(va, vb);
+                __m128 square = _mm_mul_ps(diff, diff);
+                sum_vec = _mm_add_ps(sum_vec, square);
+            }
+            // Horizontal sum
+            float temp[4];
+            _mm_storeu_ps(temp, sum_vec);
+            sum = (temp[0] + temp[1]) + (temp[2] + temp[3]);
+        }
+#elif defined(__ARM_NEON)
+        if (compiled_simd_features() & SIMD_NEON) {
             float32x4_t sum_vec = vdupq_n_f32(0.0f);
             for (; i + 4 <= dim; i += 4) {
-                float32x4_t va = vld1q_f32(reinterpret_cast<const float*>(a + i));
-                float32x4_t vb = vld1q_f32(reinterpret_cast<const float*>(b + i));
+                float32x4_t va = vld1q_f32(a + i);
+                float32x4_t vb = vld1q_f32(b + i);
                 float32x4_t diff = vsubq_f32(va, vb);
                 float32x4_t square = vmulq_f32(diff, diff);
                 sum_vec = vaddq_f32(sum_vec, square);
             }
             // Horizontal sum
-            float32x2_t sum2 = vadd_f32(vget_low_f32(sum_vec), vget_high_f32(sum_vec));
+            float32x2_t sum2 = vadd_f32(vget_low_f32(sum_vec),
+                                        vget_high_f32(sum_vec));
             sum = vget_lane_f32(vpadd_f32(sum2, sum2), 0);
         }
 #endif
-        
+
         // Handle remaining elements
         for (; i < dim; ++i) {
-            t_float diff = a[i] - b[i];
+            float diff = a[i] - b[i];
             sum += diff * diff;
         }
-        
+
         return sum;
     }
-    
-    // Vectorized minimum search
-    inline t_index simd_find_min(const t_float* data, t_index start, t_index end, t_float* min_val) {
-        t_float min_value = data[start];
-        t_index min_index = start;
-        
-        t_index i = start + 1;
-        
+
+    // Dot products of one vector p with four vectors r0..r3 at once, so
+    // that p is loaded only once per four rows.
+    inline void dot4_baseline(const t_float* p, const t_float* r0,
+                              const t_float* r1, const t_float* r2,
+                              const t_float* r3, t_index dim, t_float* out) {
+        t_float s0 = 0.0, s1 = 0.0, s2 = 0.0, s3 = 0.0;
+        t_index i = 0;
+
 #ifdef __AVX2__
-        if (get_simd_features() & SIMD_AVX2 && (end - start) >= 4) {
-            __m256d min_vec = _mm256_set1_pd(min_value);
-            __m256i indices = _mm256_setr_epi64x(start, start+1, start+2, start+3);
-            __m256i step = _mm256_set1_epi64x(4);
-            
-            for (; i + 4 <= end; i += 4) {
-                __m256d values = _mm256_loadu_pd(data + i);
-                __m256d mask = _mm256_cmp_pd(values, min_vec, _CMP_LT_OQ);
-                
-                if (!_mm256_testz_pd(mask, mask)) {
-                    // Find minimum in this vector
-                    for (t_index j = 0; j < 4; ++j) {
-                        if (data[i + j] < min_value) {
-                            min_value = data[i + j];
-                            min_index = i + j;
-                        }
-                    }
-                    min_vec = _mm256_set1_pd(min_value);
-                }
-                indices = _mm256_add_epi64(indices, step);
+        if (compiled_simd_features() & SIMD_AVX2) {
+            __m256d a0 = _mm256_setzero_pd(), a1 = a0, a2 = a0, a3 = a0;
+            for (; i + 4 <= dim; i += 4) {
+                __m256d vp = _mm256_loadu_pd(p + i);
+                a0 = _mm256_add_pd(a0, _mm256_mul_pd(vp, _mm256_loadu_pd(r0 + i)));
+                a1 = _mm256_add_pd(a1, _mm256_mul_pd(vp, _mm256_loadu_pd(r1 + i)));
+                a2 = _mm256_add_pd(a2, _mm256_mul_pd(vp, _mm256_loadu_pd(r2 + i)));
+                a3 = _mm256_add_pd(a3, _mm256_mul_pd(vp, _mm256_loadu_pd(r3 + i)));
+            }
+            // Horizontal sums
+            t_float temp[4];
+            _mm256_storeu_pd(temp, a0);
+            s0 = (temp[0] + temp[1]) + (temp[2] + temp[3]);
+            _mm256_storeu_pd(temp, a1);
+            s1 = (temp[0] + temp[1]) + (temp[2] + temp[3]);
+            _mm256_storeu_pd(temp, a2);
+            s2 = (temp[0] + temp[1]) + (temp[2] + temp[3]);
+            _mm256_storeu_pd(temp, a3);
+            s3 = (temp[0] + temp[1]) + (temp[2] + temp[3]);
+        }
+#elif defined(__SSE2__)
+        if (compiled_simd_features() & SIMD_SSE2) {
+            // Two accumulators per row to hide the latency of the additions
+            __m128d a0 = _mm_setzero_pd(), a1 = a0, a2 = a0, a3 = a0;
+            __m128d b0 = a0, b1 = a0, b2 = a0, b3 = a0;
+            for (; i + 4 <= dim; i += 4) {
+                __m128d vp = _mm_loadu_pd(p + i);
+                __m128d vq = _mm_loadu_pd(p + i + 2);
+                a0 = _mm_add_pd(a0, _mm_mul_pd(vp, _mm_loadu_pd(r0 + i)));
+                b0 = _mm_add_pd(b0, _mm_mul_pd(vq, _mm_loadu_pd(r0 + i + 2)));
+                a1 = _mm_add_pd(a1, _mm_mul_pd(vp, _mm_loadu_pd(r1 + i)));
+                b1 = _mm_add_pd(b1, _mm_mul_pd(vq, _mm_loadu_pd(r1 + i + 2)));
+                a2 = _mm_add_pd(a2, _mm_mul_pd(vp, _mm_loadu_pd(r2 + i)));
+                b2 = _mm_add_pd(b2, _mm_mul_pd(vq, _mm_loadu_pd(r2 + i + 2)));
+                a3 = _mm_add_pd(a3, _mm_mul_pd(vp, _mm_loadu_pd(r3 + i)));
+                b3 = _mm_add_pd(b3, _mm_mul_pd(vq, _mm_loadu_pd(r3 + i + 2)));
+            }
+            // Horizontal sums
+            t_float temp[2];
+            _mm_storeu_pd(temp, _mm_add_pd(a0, b0));
+            s0 = temp[0] + temp[1];
+            _mm_storeu_pd(temp, _mm_add_pd(a1, b1));
+            s1 = temp[0] + temp[1];
+            _mm_storeu_pd(temp, _mm_add_pd(a2, b2));
+            s2 = temp[0] + temp[1];
+            _mm_storeu_pd(temp, _mm_add_pd(a3, b3));
+            s3 = temp[0] + temp[1];
+        }
+#elif defined(__ARM_NEON)
+        if (compiled_simd_features() & SIMD_NEON) {
+            float64x2_t a0 = vdupq_n_f64(0.0), a1 = a0, a2 = a0, a3 = a0;
+            for (; i + 2 <= dim; i += 2) {
+                float64x2_t vp = vld1q_f64(p + i);
+                a0 = vaddq_f64(a0, vmulq_f64(vp, vld1q_f64(r0 + i)));
+                a1 = vaddq_f64(a1, vmulq_f64(vp, vld1q_f64(r1 + i)));
+                a2 = vaddq_f64(a2, vmulq_f64(vp, vld1q_f64(r2 + i)));
+                a3 = vaddq_f64(a3, vmulq_f64(vp, vld1q_f64(r3 + i)));
             }
+            // Horizontal sums
+            s0 = vgetq_lane_f64(a0, 0) + vgetq_lane_f64(a0, 1);
+            s1 = vgetq_lane_f64(a1, 0) + vgetq_lane_f64(a1, 1);
+            s2 = vgetq_lane_f64(a2, 0) + vgetq_lane_f64(a2, 1);
+            s3 = vgetq_lane_f64(a3, 0) + vgetq_lane_f64(a3, 1);
         }
 #endif
-        
+
         // Handle remaining elements
-        for (; i < end; ++i) {
-            if (data[i] < min_value) {
-                min_value = data[i];
-                min_index = i;
-            }
+        for (; i < dim; ++i) {
+            s0 += p[i] * r0[i];
+            s1 += p[i] * r1[i];
+            s2 += p[i] * r2[i];
+            s3 += p[i] * r3[i];
         }
-        
-        *min_val = min_value;
-        return min_index;
+
+        out[0] = s0;
+        out[1] = s1;
+        out[2] = s2;
+        out[3] = s3;
     }
-}
 
-/* Method codes.
+    // Single-precision variant
+    inline void dot4_baseline(const float* p, const float* r0,
+                              const float* r1, const float* r2,
+                              const float* r3, t_index dim, float* out) {
+        float s0 = 0.0f, s1 = 0.0f, s2 = 0.0f, s3 = 0.0f;
+        t_index i = 0;
 
-   These codes must agree with the METHODS array in fastcluster.R and the
-   dictionary mthidx in fastcluster.py.
-*/
-enum method_codes {
-  // non-Euclidean methods
-  METHOD_METR_SINGLE           = 0,
-  METHOD_METR_COMPLETE         = 1,
-  METHOD_METR_AVERAGE          = 2,
-  METHOD_METR_WEIGHTED         = 3,
-  METHOD_METR_WARD             = 4,
-  METHOD_METR_WARD_D           = METHOD_METR_WARD,
-  METHOD_METR_CENTROID         = 5,
-  METHOD_METR_MEDIAN           = 6,
-  METHOD_METR_WARD_D2          = 7,
+#ifdef __AVX2__
+        if (compiled_simd_features() & SIMD_AVX2) {
+            __m256 a0 = _mm256_setzero_ps(), a1 = a0, a2 = a0, a3 = a0;
+            for (; i + 8 <= dim; i += 8) {
+                __m256 vp = _mm256_loadu_ps(p + i);
+                a0 = _mm256_add_ps(a0, _mm256_mul_ps(vp, _mm256_loadu_ps(r0 + i)));
+                a1 = _mm256_add_ps(a1, _mm256_mul_ps(vp, _mm256_loadu_ps(r1 + i)));
+                a2 = _mm256_add_ps(a2, _mm256_mul_ps(vp, _mm256_loadu_ps(r2 + i)));
+                a3 = _mm256_add_ps(a3, _mm256_mul_ps(vp, _mm256_loadu_ps(r3 + i)));
+            }
+            // Horizontal sums
+            float temp[8];
+            _mm256_storeu_ps(temp, a0);
+            s0 = ((temp[0] + temp[1]) + (temp[2] + temp[3])) +
+                 ((temp[4] + temp[5]) + (temp[6] + temp[7]));
+            _mm256_storeu_ps(temp, a1);
+            s1 = ((temp[0] + temp[1]) + (temp[2] + temp[3])) +
+                 ((temp[4] + temp[5]) + (temp[6] + temp[7]));
+            _mm256_storeu_ps(temp, a2);
+            s2 = ((temp[0] + temp[1]) + (temp[2] + temp[3])) +
+                 ((temp[4] + temp[5]) + (temp[6] + temp[7]));
+            _mm256_storeu_ps(temp, a3);
+            s3 = ((temp[0] + temp[1]) + (temp[2] + temp[3])) +
+                 ((temp[4] + temp[5]) + (temp[6] + temp[7]));
+        }
+#elif defined(__SSE2__)
+        if (compiled_simd_features() & SIMD_SSE2) {
+            __m128 a0 = _mm_setzero_ps(), a1 = a0, a2 = a0, a3 = a0;
+            __m128 b0 = a0, b1 = a0, b2 = a0, b3 = a0;
+            for (; i + 8 <= dim; i += 8) {
+                __m128 vp = _mm_loadu_ps(p + i);
+                __m128 vq = _mm_loadu_ps(p + i + 4);
+                a0 = _mm_add_ps(a0, _mm_mul_ps(vp, _mm_loadu_ps(r0 + i)));
+                b0 = _mm_add_ps(b0, _mm_mul_ps(vq, _mm_loadu_ps(r0 + i + 4)));
+                a1 = _mm_add_ps(a1, _mm_mul_ps(vp, _mm_loadu_ps(r1 + i)));
+                b1 = _mm_add_ps(b1, _mm_mul_ps(vq, _mm_loadu_ps(r1 + i + 4)));
+                a2 = _mm_add_ps(a2, _mm_mul_ps(vp, _mm_loadu_ps(r2 + i)));
+                b2 = _mm_add_ps(b2, _mm_mul_ps(vq, _mm_loadu_ps(r2 + i + 4)));
+                a3 = _mm_add_ps(a3, _mm_mul_ps(vp, _mm_loadu_ps(r3 + i)));
+                b3 = _mm_add_ps(b3, _mm_mul_ps(vq, _mm_loadu_ps(r3 + i + 4)));
+            }
+            // Horizontal sums
+            float temp[4];
+            _mm_storeu_ps(temp, _mm_add_ps(a0, b0));
+            s0 = (temp[0] + temp[1]) + (temp[2] + temp[3]);
+            _mm_storeu_ps(temp, _mm_add_ps(a1, b1));
+            s1 = (temp[0] + temp[1]) + (temp[2] + temp[3]);
+            _mm_storeu_ps(temp, _mm_add_ps(a2, b2));
+            s2 = (temp[0] + temp[1]) + (temp[2] + temp[3]);
+            _mm_storeu_ps(temp, _mm_add_ps(a3, b3));
+            s3 = (temp[0] + temp[1]) + (temp[2] + temp[3]);
+        }
+#elif defined(__ARM_NEON)
+        if (compiled_simd_features() & SIMD_NEON) {
+            float32x4_t a0 = vdupq_n_f32(0.0f), a1 = a0, a2 = a0, a3 = a0;
+            for (; i + 4 <= dim; i += 4) {
+                float32x4_t vp = vld1q_f32(p + i);
+                a0 = vaddq_f32(a0, vmulq_f32(vp, vld1q_f32(r0 + i)));
+                a1 = vaddq_f32(a1, vmulq_f32(vp, vld1q_f32(r1 + i)));
+                a2 = vaddq_f32(a2, vmulq_f32(vp, vld1q_f32(r2 + i)));
+                a3 = vaddq_f32(a3, vmulq_f32(vp, vld1q_f32(r3 + i)));
+            }
+            // Horizontal sums
+            float32x2_t h;
+            h = vadd_f32(vget_low_f32(a0), vget_high_f32(a0));
+            s0 = vget_lane_f32(vpadd_f32(h, h), 0);
+            h = vadd_f32(vget_low_f32(a1), vget_high_f32(a1));
+            s1 = vget_lane_f32(vpadd_f32(h, h), 0);
+            h = vadd_f32(vget_low_f32(a2), vget_high_f32(a2));
+            s2 = vget_lane_f32(vpadd_f32(h, h), 0);
+            h = vadd_f32(vget_low_f32(a3), vget_high_f32(a3));
+            s3 = vget_lane_f32(vpadd_f32(h, h), 0);
+        }
+#endif
 
-  MIN_METHOD_CODE              = 0,
-  MAX_METHOD_CODE              = 7
-};
+        // Handle remaining elements
+        for (; i < dim; ++i) {
+            s0 += p[i] * r0[i];
+            s1 += p[i] * r1[i];
+            s2 += p[i] * r2[i];
+            s3 += p[i] * r3[i];
+        }
 
-enum method_codes_vector {
-  // Euclidean methods
-  METHOD_VECTOR_SINGLE         = 0,
-  METHOD_VECTOR_WARD           = 1,
-  METHOD_VECTOR_CENTROID       = 2,
-  METHOD_VECTOR_MEDIAN         = 3,
+        out[0] = s0;
+        out[1] = s1;
+        out[2] = s2;
+        out[3] = s3;
+    }
 
-  MIN_METHOD_VECTOR_CODE       = 0,
-  MAX_METHOD_VECTOR_CODE       = 3
-};
+    /* Position of the first smallest entry in data[0:n] if it is smaller
+       than min, and then min is set to this entry; otherwise -1. NaN
+       entries are never selected, but they set the flag nan.
 
-// self-destructing array pointer
-template <typename type>
-class auto_array_ptr{
-private:
-  type * ptr;
-  auto_array_ptr(auto_array_ptr const &); // non construction-copyable
-  auto_array_ptr& operator=(auto_array_ptr const &); // non copyable
-public:
-  auto_array_ptr()
-    : ptr(NULL)
-  { }
-  template <typename index>
-  auto_array_ptr(index const size)
-    : ptr(new type[size])
-  { }
-  template <typename index, typename value>
-  auto_array_ptr(index const size, value const val)
-    : ptr(new type[size])
-  {
-    FILL_N(ptr, size, val);
-  }
-  ~auto_array_ptr() {
-    delete [] ptr; }
-  void free() {
-    delete [] ptr;
-    ptr = NULL;
-  }
-  template <typename index>
-  void init(index const size) {
-    ptr = new type [size];
-  }
-  template <typename index, typename value>
-  void init(index const size, value const val) {
-    init(size);
-    FILL_N(ptr, size, val);
-  }
-  inline operator type *() const { return ptr; }
-};
+       This is the scan of the clustering cores with strict comparisons in
+       ascending order, so that the vectorized kernels below must break
+       ties in the same way.
+    */
+    template <typename T>
+    inline t_index argmin_baseline(const T* data, t_index n, T & min,
+                                   bool & nan) {
+        t_index idx = -1;
+        T m = min;
+        for (t_index i = 0; i < n; ++i) {
+#if HAVE_DIAGNOSTIC
+#pragma GCC diagnostic push
+#pragma GCC diagnostic ignored "-Wfloat-equal"
+#endif
+            if (data[i] < m) {
+                m = data[i];
+                idx = i;
+            }
+            else if (fc_isnan(data[i]))
+                nan = true;
+#if HAVE_DIAGNOSTIC
+#pragma GCC diagnostic pop
+#endif
+        }
+        min = m;
+        return idx;
+    }
 
-// Cache-aligned node structure
-struct alignas(32) node {
-  t_index node1, node2;
-  t_float dist;
-};
+    /* Kernels for the metrics cityblock, chebychev, canberra, braycurtis and
+       for the dot product of the cosine metric. Each kernel is written once,
+       as a template in a vector type V, and compiled for several vector
+       widths: with the vector extensions of GCC and Clang, V has 16 bytes
+       (SSE2 or NEON) for the baseline and 32 respectively 64 bytes for the
+       AVX2 and AVX-512 kernels below. Without the extensions, V is the
+       floating point type itself, a vector of one lane. The helpers vload,
+       vset1, vabs, vblend, hsum and hmax have overloads for both cases.
+
+       The lanes are accumulated separately and added at the end, so that
+       the sums may differ from a scalar loop in the last bits. The maximum
+       in chebychev does not round and is exact.
+    */
+#ifndef HAVE_VECTOR_EXTENSIONS
+#if defined(__GNUC__) || defined(__clang__)
+#define HAVE_VECTOR_EXTENSIONS 1
+#endif
+#endif
 
-inline bool operator< (const node a, const node b) {
-  return (a.dist < b.dist);
-}
+    /* The kernels and the vector helpers are always inlined into the
+       functions for each instruction set, so that the vector code is
+       generated for the instruction set of the caller. The helpers modify
+       their first argument instead of returning a vector: GCC warns about
+       the calling convention of functions which return wide vectors without
+       AVX, even when they are always inlined.
+    */
+#if HAVE_VECTOR_EXTENSIONS
+#define KERNEL_INLINE inline __attribute__((always_inline))
+#else
+#define KERNEL_INLINE inline
+#endif
 
-class cluster_result {
-private:
-  auto_array_ptr<node> Z;
-  t_index pos;
+    // Lane type and number of lanes of V; a scalar is a vector of one lane.
+    template <typename V>
+    struct vec_traits {
+        typedef V scalar;
+        static const int lanes = 1;
+    };
 
-public:
-  cluster_result(const t_index size)
-    : Z(size)
-    , pos(0)
-  {}
+    inline void vload(double & x, const double * const p) { x = *p; }
+    inline void vload(float & x, const float * const p) { x = *p; }
 
-  void append(const t_index node1, const t_index node2, const t_float dist) {
-    Z[pos].node1 = node1;
-    Z[pos].node2 = node2;
-    Z[pos].dist  = dist;
-    ++pos;
-  }
+    inline void vset1(double & x, const double c) { x = c; }
+    inline void vset1(float & x, const float c) { x = c; }
 
-  node * operator[] (const t_index idx) const { return Z + idx; }
+    inline void vabs(double & x) { x = std::fabs(x); }
+    inline void vabs(float & x) { x = std::fabs(x); }
 
-  /* Define several methods to postprocess the distances. All these functions
-     are monotone, so they do not change the sorted order of distances. */
+    // x = a where c is true
+    inline void vblend(double & x, const bool c, const double a) {
+        if (c) x = a;
+    }
+    inline void vblend(float & x, const bool c, const float a) {
+        if (c) x = a;
+    }
 
-  void sqrt() const {
-    for (node * ZZ=Z; ZZ!=Z+pos; ++ZZ) {
-      ZZ->dist = std::sqrt(ZZ->dist);
+    inline double hsum(const double x) { return x; }
+    inline float hsum(const float x) { return x; }
+    inline double hmax(const double x) { return x; }
+    inline float hmax(const float x) { return x; }
+
+#if HAVE_VECTOR_EXTENSIONS
+    typedef double vec2d __attribute__((vector_size(16)));
+    typedef double vec4d __attribute__((vector_size(32)));
+    typedef double vec8d __attribute__((vector_size(64)));
+    typedef float vec4f __attribute__((vector_size(16)));
+    typedef float vec8f __attribute__((vector_size(32)));
+    typedef float vec16f __attribute__((vector_size(64)));
+
+    template <typename V, typename T>
+    struct vec_traits_ext {
+        typedef T scalar;
+        static const int lanes = sizeof(V)/sizeof(T);
+    };
+    template <> struct vec_traits<vec2d> : vec_traits_ext<vec2d, double> {};
+    template <> struct vec_traits<vec4d> : vec_traits_ext<vec4d, double> {};
+    template <> struct vec_traits<vec8d> : vec_traits_ext<vec8d, double> {};
+    template <> struct vec_traits<vec4f> : vec_traits_ext<vec4f, float> {};
+    template <> struct vec_traits<vec8f> : vec_traits_ext<vec8f, float> {};
+    template <> struct vec_traits<vec16f> : vec_traits_ext<vec16f, float> {};
+
+    /* The vector versions of the helpers are selected by the scalar type
+       of the pointer respectively by the integer mask type. Comparisons of
+       vectors give masks of integer lanes with all bits set where true; the
+       floating point lanes are combined bitwise through them.
+    */
+    template <typename V>
+    KERNEL_INLINE void vload(V & x,
+                             const typename vec_traits<V>::scalar * const p) {
+        std::memcpy(&x, p, sizeof(V));
     }
-  }
 
-  void sqrt(const t_float) const { // ignore the argument
-    sqrt();
-  }
+    template <typename V>
+    KERNEL_INLINE void vset1(V & x, const typename vec_traits<V>::scalar c) {
+        for (int l = 0; l < vec_traits<V>::lanes; ++l) x[l] = c;
+    }
 
-  void sqrtdouble(const t_float) const { // ignore the argument
-    for (node * ZZ=Z; ZZ!=Z+pos; ++ZZ) {
-      ZZ->dist = std::sqrt(2*ZZ->dist);
+    template <typename V>
+    KERNEL_INLINE void vabs(V & x) {
+        typedef decltype(x < x) M;
+        V sign;
+        vset1(sign, static_cast<typename vec_traits<V>::scalar>(-0.0));
+        x = reinterpret_cast<V>(reinterpret_cast<M>(x) &
+                                ~reinterpret_cast<M>(sign));
     }
-  }
 
-  #ifdef R_pow
-  #define my_pow R_pow
-  #else
-  #define my_pow std::pow
-  #endif
+    template <typename V, typename M>
+    KERNEL_INLINE void vblend(V & x, const M & c, const V & a) {
+        x = reinterpret_cast<V>((reinterpret_cast<M>(a) & c) |
+                                (reinterpret_cast<M>(x) & ~c));
+    }
 
-  void power(const t_float p) const {
-    t_float const q = 1/p;
-    for (node * ZZ=Z; ZZ!=Z+pos; ++ZZ) {
-      ZZ->dist = my_pow(ZZ->dist,q);
+    template <typename V>
+    KERNEL_INLINE typename vec_traits<V>::scalar hsum(const V & x) {
+        typename vec_traits<V>::scalar sum = x[0];
+        for (int l = 1; l < vec_traits<V>::lanes; ++l) sum += x[l];
+        return sum;
     }
-  }
 
-  void plusone(const t_float) const { // ignore the argument
-    for (node * ZZ=Z; ZZ!=Z+pos; ++ZZ) {
-      ZZ->dist += 1;
+    template <typename V>
+    KERNEL_INLINE typename vec_traits<V>::scalar hmax(const V & x) {
+        typename vec_traits<V>::scalar max = x[0];
+        for (int l = 1; l < vec_traits<V>::lanes; ++l)
+            if (x[l] > max) max = x[l];
+        return max;
     }
-  }
+#endif
 
-  void divide(const t_float denom) const {
-    for (node * ZZ=Z; ZZ!=Z+pos; ++ZZ) {
-      ZZ->dist /= denom;
+    // Vector type of the baseline kernels
+    template <typename T>
+    struct baseline_vector {
+        typedef T type;
+    };
+#if HAVE_VECTOR_EXTENSIONS
+    template <> struct baseline_vector<double> { typedef vec2d type; };
+    template <> struct baseline_vector<float> { typedef vec4f type; };
+#endif
+
+    // |a-b| for scalars
+    template <typename T>
+    inline T absdiff(const T a, const T b) {
+        T d = a - b;
+        vabs(d);
+        return d;
     }
-  }
-};
 
-class doubly_linked_list {
-  /*
-    Class for a doubly linked list. Initially, the list is the integer range
-    [0, size]. We provide a forward iterator and a method to delete an index
-    from the list.
-
-    Typical use: for (i=L.start; L<size; i=L.succ[I])
-    or
-    for (i=somevalue; L<size; i=L.succ[I])
-  */
-public:
-  t_index start;
-  auto_array_ptr<t_index> succ;
-
-private:
-  auto_array_ptr<t_index> pred;
-  // Not necessarily private, we just do not need it in this instance.
-
-public:
-  doubly_linked_list(const t_index size)
-    // Initialize to the given size.
-    : start(0)
-    , succ(size+1)
-    , pred(size+1)
-  {
-    for (t_index i=0; i<size; ++i) {
-      pred[i+1] = i;
-      succ[i] = i+1;
+    // Sum of |a[k]-b[k]|
+    template <typename V>
+    KERNEL_INLINE typename vec_traits<V>::scalar cityblock_kernel(
+        const typename vec_traits<V>::scalar* a,
+        const typename vec_traits<V>::scalar* b, t_index dim) {
+        const int L = vec_traits<V>::lanes;
+        // Two accumulators to hide the latency of the additions
+        V s0 = V(), s1 = V();
+        t_index i = 0;
+        for (; i + 2*L <= dim; i += 2*L) {
+            V x0, y0, x1, y1;
+            vload(x0, a + i); vload(y0, b + i);
+            vload(x1, a + i + L); vload(y1, b + i + L);
+            x0 -= y0; vabs(x0); s0 += x0;
+            x1 -= y1; vabs(x1); s1 += x1;
+        }
+        typename vec_traits<V>::scalar sum = hsum(s0 + s1);
+        for (; i < dim; ++i) sum += absdiff(a[i], b[i]);
+        return sum;
     }
-    // pred[0] is never accessed!
-    //succ[size] is never accessed!
-  }
-
-  ~doubly_linked_list() {}
 
-  void remove(const t_index idx) {
-    // Remove an index from the list.
-    if (idx==start) {
-      start = succ[idx];
-    }
-    else {
-      succ[pred[idx]] = succ[idx];
-      pred[succ[idx]] = pred[idx];
+    /* Maximum of |a[k]-b[k]|, starting from 0. NaN differences are skipped
+       like in the comparison diff>max of a scalar loop.
+    */
+    template <typename V>
+    KERNEL_INLINE typename vec_traits<V>::scalar chebychev_kernel(
+        const typename vec_traits<V>::scalar* a,
+        const typename vec_traits<V>::scalar* b, t_index dim) {
+        const int L = vec_traits<V>::lanes;
+        V m0 = V(), m1 = V();
+        t_index i = 0;
+        for (; i + 2*L <= dim; i += 2*L) {
+            V x0, y0, x1, y1;
+            vload(x0, a + i); vload(y0, b + i);
+            vload(x1, a + i + L); vload(y1, b + i + L);
+            x0 -= y0; vabs(x0); vblend(m0, x0 > m0, x0);
+            x1 -= y1; vabs(x1); vblend(m1, x1 > m1, x1);
+        }
+        vblend(m0, m1 > m0, m1);
+        typename vec_traits<V>::scalar max = hmax(m0);
+        for (; i < dim; ++i) {
+            const typename vec_traits<V>::scalar diff = absdiff(a[i], b[i]);
+            if (diff > max) max = diff;
+        }
+        return max;
     }
-    succ[idx] = 0; // Mark as inactive
-  }
 
-  bool is_inactive(t_index idx) const {
-    return (succ[idx]==0);
-  }
-};
-
-// Optimized indexing functions with cache-friendly access patterns
-// D is the upper triangular part of a symmetric (NxN)-matrix
-// We require r_ < c_ !
-#define D_(r_,c_) ( D[(static_cast<std::ptrdiff_t>(2*N-3-(r_))*(r_)>>1)+(c_)-1] )
-
-// Cache-friendly distance matrix access with prefetching
-#define D_CACHE_FRIENDLY(r_,c_) ( \
-  __builtin_prefetch(&D[(static_cast<std::ptrdiff_t>(2*N-3-(r_))*(r_)>>1)+(c_)-1], 0, 3), \
-  D[(static_cast<std::ptrdiff_t>(2*N-3-(r_))*(r_)>>1)+(c_)-1] \
-)
-
-// Z is an ((N-1)x4)-array with cache alignment
-#define Z_(_r, _c) (Z[(_r)*4 + (_c)])
+    /* Sum of |a[k]-b[k]| / (|a[k]|+|b[k]|), where terms with a zero
+       numerator are zero. The denominator of these terms is replaced by 1
+       before the division, so that the kernel does not raise the FE_INVALID
+       flag for 0/0, which the clustering cores test.
+    */
+    template <typename V>
+    KERNEL_INLINE typename vec_traits<V>::scalar canberra_kernel(
+        const typename vec_traits<V>::scalar* a,
+        const typename vec_traits<V>::scalar* b, t_index dim) {
+        typedef typename vec_traits<V>::scalar T;
+        const int L = vec_traits<V>::lanes;
+        const V zero = V();
+        V s = V();
+        t_index i = 0;
+        for (; i + L <= dim; i += L) {
+            V x, y, den;
+            vload(x, a + i); vload(y, b + i);
+            V num = x - y;
+            vabs(num); vabs(x); vabs(y);
+            vset1(den, static_cast<T>(1));
+#if HAVE_DIAGNOSTIC
+#pragma GCC diagnostic push
+#pragma GCC diagnostic ignored "-Wfloat-equal"
+#endif
+            vblend(den, num != zero, x + y);
+#if HAVE_DIAGNOSTIC
+#pragma GCC diagnostic pop
+#endif
+            s += num / den;
+        }
+        T sum = hsum(s);
+        for (; i < dim; ++i) {
+            const T num = absdiff(a[i], b[i]);
+#if HAVE_DIAGNOSTIC
+#pragma GCC diagnostic push
+#pragma GCC diagnostic ignored "-Wfloat-equal"
+#endif
+            if (num != 0) sum += num / (std::fabs(a[i]) + std::fabs(b[i]));
+#if HAVE_DIAGNOSTIC
+#pragma GCC diagnostic pop
+#endif
+        }
+        return sum;
+    }
 
-/*
-  Lookup function for a union-find data structure.
+    // Sum of |a[k]-b[k]| divided by the sum of |a[k]+b[k]|
+    template <typename V>
+    KERNEL_INLINE typename vec_traits<V>::scalar braycurtis_kernel(
+        const typename vec_traits<V>::scalar* a,
+        const typename vec_traits<V>::scalar* b, t_index dim) {
+        const int L = vec_traits<V>::lanes;
+        V s1 = V(), s2 = V();
+        t_index i = 0;
+        for (; i + L <= dim; i += L) {
+            V x, y;
+            vload(x, a + i); vload(y, b + i);
+            V d = x - y;
+            x += y;
+            vabs(d); vabs(x);
+            s1 += d;
+            s2 += x;
+        }
+        typename vec_traits<V>::scalar sum1 = hsum(s1), sum2 = hsum(s2);
+        for (; i < dim; ++i) {
+            sum1 += absdiff(a[i], b[i]);
+            sum2 += std::fabs(a[i] + b[i]);
+        }
+        return sum1/sum2;
+    }
 
-  The function finds the root of idx by going iteratively through all
-  parent elements until a root is found. An element i is a root if
-  nodes[i] is zero. To make subsequent searches faster, the entry for
-  idx and all its parents is updated with the root element.
- */
-class union_find {
-private:
-  auto_array_ptr<t_index> parent;
-  t_index nextparent;
+    // Dot product of a and b
+    template <typename V>
+    KERNEL_INLINE typename vec_traits<V>::scalar dot_kernel(
+        const typename vec_traits<V>::scalar* a,
+        const typename vec_traits<V>::scalar* b, t_index dim) {
+        const int L = vec_traits<V>::lanes;
+        V s0 = V(), s1 = V();
+        t_index i = 0;
+        for (; i + 2*L <= dim; i += 2*L) {
+            V x0, y0, x1, y1;
+            vload(x0, a + i); vload(y0, b + i);
+            vload(x1, a + i + L); vload(y1, b + i + L);
+            s0 += x0 * y0;
+            s1 += x1 * y1;
+        }
+        typename vec_traits<V>::scalar sum = hsum(s0 + s1);
+        for (; i < dim; ++i) sum += a[i] * b[i];
+        return sum;
+    }
 
-public:
-  union_find(const t_index size)
-    : parent(size>0 ? 2*size-1 : 0, 0)
-    , nextparent(size)
-  { }
+    /* Number of bits set in x. GCC and Clang compile the builtin to the
+       popcnt instruction if the build flags or the target attribute of the
+       caller enable it, and to a shorter or longer bit-twiddling sequence
+       otherwise.
+    */
+    KERNEL_INLINE t_index popcount64(const uint64_t x) {
+#if defined(__GNUC__) || defined(__clang__)
+        return static_cast<t_index>(__builtin_popcountll(x));
+#else
+        uint64_t v = x - ((x >> 1) & 0x5555555555555555ULL);
+        v = (v & 0x3333333333333333ULL) + ((v >> 2) & 0x3333333333333333ULL);
+        v = (v + (v >> 4)) & 0x0f0f0f0f0f0f0f0fULL;
+        return static_cast<t_index>((v * 0x0101010101010101ULL) >> 56);
+#endif
+    }
 
-  t_index Find (t_index idx) const {
-    if (parent[idx] != 0 ) { // a → b
-      t_index p = idx;
-      idx = parent[idx];
-      if (parent[idx] != 0 ) { // a → b → c
-        do {
-          idx = parent[idx];
-        } while (parent[idx] != 0);
-        do {
-          t_index tmp = parent[p];
-          parent[p] = idx;
-          p = tmp;
-        } while (parent[p] != idx);
-      }
+    /* Numbers of bits set in a&b, a^b and a&~b for Boolean vectors a and b
+       which are packed into n words of 64 bits: the counts of the
+       True/True, unequal and True/False coordinates.
+    */
+    KERNEL_INLINE void bool_counts_kernel(const uint64_t* a,
+                                          const uint64_t* b, t_index n,
+                                          t_index & tt, t_index & xo,
+                                          t_index & tf) {
+        t_index c_tt = 0, c_xo = 0, c_tf = 0;
+        for (t_index w = 0; w < n; ++w) {
+            c_tt += popcount64(a[w] & b[w]);
+            c_xo += popcount64(a[w] ^ b[w]);
+            c_tf += popcount64(a[w] & ~b[w]);
+        }
+        tt = c_tt;
+        xo = c_xo;
+        tf = c_tf;
     }
-    return idx;
-  }
 
-  void Union (const t_index node1, const t_index node2) {
-    parent[node1] = parent[node2] = nextparent++;
-  }
-};
+#if HAVE_SIMD_DISPATCH
+    /* Kernels for the wider instruction sets. The "target" attribute lets
+       the compiler generate AVX2/FMA respectively AVX-512 code for these
+       functions only, whatever the build flags are, so they must only be
+       called after the CPU check in select_kernels.
 
-class nan_error{};
-#ifdef FE_INVALID
-class fenv_error{};
+       The sums are accumulated in a different order than in the baseline
+       kernels and with fused multiply-adds, so that the results may differ
+       from them in the last bits.
+    */
+#define SIMD_TARGET_AVX2 __attribute__((target("avx2,fma")))
+#define SIMD_TARGET_AVX512 __attribute__((target("avx2,fma,avx512f")))
+#define SIMD_TARGET_POPCNT __attribute__((target("popcnt")))
+#if __GNUC__ >= 8 || defined(__clang__)
+#define HAVE_VPOPCNTDQ 1
+#define SIMD_TARGET_VPOPCNTDQ \
+  __attribute__((target("popcnt,avx2,fma,avx512f,avx512vpopcntdq")))
 #endif
 
-static void MST_linkage_core(const t_index N, const t_float * const D,
-                             cluster_result & Z2) {
-/*
-    N: integer, number of data points
-    D: condensed distance matrix N*(N-1)/2
-    Z2: output data structure
-
-    The basis of this algorithm is an algorithm by Rohlf:
+    SIMD_TARGET_AVX2 static inline double hsum_avx2(const __m256d & v) {
+        const __m128d h = _mm_add_pd(_mm256_castpd256_pd128(v),
+                                     _mm256_extractf128_pd(v, 1));
+        return _mm_cvtsd_f64(_mm_add_sd(h, _mm_unpackhi_pd(h, h)));
+    }
 
-    F. James Rohlf, Hierarchical clustering using the minimum spanning tree,
-    The Computer Journal, vol. 16, 1973, p. 93–95.
-*/
-  t_index i;
-  t_index idx2;
-  doubly_linked_list active_nodes(N);
-  auto_array_ptr<t_float> d(N);
+    SIMD_TARGET_AVX2 static inline float hsum_avx2(const __m256 & v) {
+        __m128 h = _mm_add_ps(_mm256_castps256_ps128(v),
+                              _mm256_extractf128_ps(v, 1));
+        h = _mm_add_ps(h, _mm_movehl_ps(h, h));
+        return _mm_cvtss_f32(_mm_add_ss(h, _mm_shuffle_ps(h, h, 1)));
+    }
 
-  t_index prev_node;
-  t_float min;
+    SIMD_TARGET_AVX2
+    static double sqeuclidean_avx2(const double* a, const double* b,
+                                   t_index dim) {
+        // Two accumulators to hide the latency of the additions
+        __m256d s0 = _mm256_setzero_pd(), s1 = s0;
+        t_index i = 0;
+        for (; i + 8 <= dim; i += 8) {
+            const __m256d d0 = _mm256_sub_pd(_mm256_loadu_pd(a + i),
+                                             _mm256_loadu_pd(b + i));
+            const __m256d d1 = _mm256_sub_pd(_mm256_loadu_pd(a + i + 4),
+                                             _mm256_loadu_pd(b + i + 4));
+            s0 = _mm256_fmadd_pd(d0, d0, s0);
+            s1 = _mm256_fmadd_pd(d1, d1, s1);
+        }
+        if (i + 4 <= dim) {
+            const __m256d d0 = _mm256_sub_pd(_mm256_loadu_pd(a + i),
+                                             _mm256_loadu_pd(b + i));
+            s0 = _mm256_fmadd_pd(d0, d0, s0);
+            i += 4;
+        }
+        double sum = hsum_avx2(_mm256_add_pd(s0, s1));
+        for (; i < dim; ++i) {
+            const double diff = a[i] - b[i];
+            sum += diff * diff;
+        }
+        return sum;
+    }
 
-  // first iteration
-  idx2 = 1;
-  min = std::numeric_limits<t_float>::infinity();
-  for (i=1; i<N; ++i) {
-    d[i] = D[i-1];
-#if HAVE_DIAGNOSTIC
-#pragma GCC diagnostic push
-#pragma GCC diagnostic ignored "-Wfloat-equal"
-#endif
-    if (d[i] < min) {
-      min = d[i];
-      idx2 = i;
+    SIMD_TARGET_AVX2
+    static float sqeuclidean_avx2(const float* a, const float* b,
+                                  t_index dim) {
+        __m256 s0 = _mm256_setzero_ps(), s1 = s0;
+        t_index i = 0;
+        for (; i + 16 <= dim; i += 16) {
+            const __m256 d0 = _mm256_sub_ps(_mm256_loadu_ps(a + i),
+                                            _mm256_loadu_ps(b + i));
+            const __m256 d1 = _mm256_sub_ps(_mm256_loadu_ps(a + i + 8),
+                                            _mm256_loadu_ps(b + i + 8));
+            s0 = _mm256_fmadd_ps(d0, d0, s0);
+            s1 = _mm256_fmadd_ps(d1, d1, s1);
+        }
+        if (i + 8 <= dim) {
+            const __m256 d0 = _mm256_sub_ps(_mm256_loadu_ps(a + i),
+                                            _mm256_loadu_ps(b + i));
+            s0 = _mm256_fmadd_ps(d0, d0, s0);
+            i += 8;
+        }
+        float sum = hsum_avx2(_mm256_add_ps(s0, s1));
+        for (; i < dim; ++i) {
+            const float diff = a[i] - b[i];
+            sum += diff * diff;
+        }
+        return sum;
     }
-    else if (fc_isnan(d[i]))
-      throw (nan_error());
-#if HAVE_DIAGNOSTIC
-#pragma GCC diagnostic pop
-#endif
-  }
-  Z2.append(0, idx2, min);
 
-  for (t_index j=1; j<N-1; ++j) {
-    prev_node = idx2;
-    active_nodes.remove(prev_node);
+    SIMD_TARGET_AVX2
+    static void dot4_avx2(const double* p, const double* r0,
+                          const double* r1, const double* r2,
+                          const double* r3, t_index dim, double* out) {
+        __m256d a0 = _mm256_setzero_pd(), a1 = a0, a2 = a0, a3 = a0;
+        t_index i = 0;
+        for (; i + 4 <= dim; i += 4) {
+            const __m256d vp = _mm256_loadu_pd(p + i);
+            a0 = _mm256_fmadd_pd(vp, _mm256_loadu_pd(r0 + i), a0);
+            a1 = _mm256_fmadd_pd(vp, _mm256_loadu_pd(r1 + i), a1);
+            a2 = _mm256_fmadd_pd(vp, _mm256_loadu_pd(r2 + i), a2);
+            a3 = _mm256_fmadd_pd(vp, _mm256_loadu_pd(r3 + i), a3);
+        }
+        double s0 = hsum_avx2(a0), s1 = hsum_avx2(a1),
+            s2 = hsum_avx2(a2), s3 = hsum_avx2(a3);
+        for (; i < dim; ++i) {
+            s0 += p[i] * r0[i];
+            s1 += p[i] * r1[i];
+            s2 += p[i] * r2[i];
+            s3 += p[i] * r3[i];
+        }
+        out[0] = s0;
+        out[1] = s1;
+        out[2] = s2;
+        out[3] = s3;
+    }
 
-    idx2 = active_nodes.succ[0];
-    min = d[idx2];
-    for (i=idx2; i<prev_node; i=active_nodes.succ[i]) {
-      t_float tmp = D_(i, prev_node);
-#if HAVE_DIAGNOSTIC
-#pragma GCC diagnostic push
-#pragma GCC diagnostic ignored "-Wfloat-equal"
-#endif
-      if (tmp < d[i])
-        d[i] = tmp;
-      else if (fc_isnan(tmp))
-        throw (nan_error());
-#if HAVE_DIAGNOSTIC
-#pragma GCC diagnostic pop
-#endif
-      if (d[i] < min) {
-        min = d[i];
-        idx2 = i;
-      }
+    SIMD_TARGET_AVX2
+    static void dot4_avx2(const float* p, const float* r0,
+                          const float* r1, const float* r2,
+                          const float* r3, t_index dim, float* out) {
+        __m256 a0 = _mm256_setzero_ps(), a1 = a0, a2 = a0, a3 = a0;
+        t_index i = 0;
+        for (; i + 8 <= dim; i += 8) {
+            const __m256 vp = _mm256_loadu_ps(p + i);
+            a0 = _mm256_fmadd_ps(vp, _mm256_loadu_ps(r0 + i), a0);
+            a1 = _mm256_fmadd_ps(vp, _mm256_loadu_ps(r1 + i), a1);
+            a2 = _mm256_fmadd_ps(vp, _mm256_loadu_ps(r2 + i), a2);
+            a3 = _mm256_fmadd_ps(vp, _mm256_loadu_ps(r3 + i), a3);
+        }
+        float s0 = hsum_avx2(a0), s1 = hsum_avx2(a1),
+            s2 = hsum_avx2(a2), s3 = hsum_avx2(a3);
+        for (; i < dim; ++i) {
+            s0 += p[i] * r0[i];
+            s1 += p[i] * r1[i];
+            s2 += p[i] * r2[i];
+            s3 += p[i] * r3[i];
+        }
+        out[0] = s0;
+        out[1] = s1;
+        out[2] = s2;
+        out[3] = s3;
     }
-    for (; i<N; i=active_nodes.succ[i]) {
-      t_float tmp = D_(prev_node, i);
+
+    /* Combine the lanes of a vectorized argmin with the scalar remainder
+       data[i:n]. Lane l holds its smallest entry val[l] below min at the
+       position pos[l], or pos[l] is negative. Since every lane keeps its
+       first minimum, the smallest position among the lanes with the same
+       value is the first one in data.
+    */
+    template <typename T, typename I>
+    inline t_index argmin_finish(const T* val, const I* pos, int lanes,
+                                 const T* data, t_index i, t_index n,
+                                 T & min, bool & nan) {
+        t_index idx = -1;
+        T m = min;
 #if HAVE_DIAGNOSTIC
 #pragma GCC diagnostic push
 #pragma GCC diagnostic ignored "-Wfloat-equal"
 #endif
-      if (d[i] > tmp)
-        d[i] = tmp;
-      else if (fc_isnan(tmp))
-        throw (nan_error());
+        for (int l = 0; l < lanes; ++l) {
+            if (pos[l] >= 0 &&
+                (val[l] < m || (val[l] == m && pos[l] < idx))) {
+                m = val[l];
+                idx = static_cast<t_index>(pos[l]);
+            }
+        }
 #if HAVE_DIAGNOSTIC
 #pragma GCC diagnostic pop
 #endif
-      if (d[i] < min) {
-        min = d[i];
-        idx2 = i;
-      }
+        const t_index rest = argmin_baseline(data + i, n - i, m, nan);
+        if (rest >= 0) idx = i + rest;
+        min = m;
+        return idx;
     }
-    Z2.append(prev_node, idx2, min);
-  }
-}
 
-/* Functions for the update of the dissimilarity array */
+    /* Vectorized argmin: every lane keeps its smallest entry and the
+       position of it in an index vector, so the loop has no branches. The
+       lanes are only combined at the end.
+    */
+    SIMD_TARGET_AVX2
+    static t_index argmin_avx2(const double* data, t_index n, double & min,
+                               bool & nan) {
+        __m256d vmin = _mm256_set1_pd(min);
+        __m256i vpos = _mm256_set1_epi64x(-1);
+        __m256i cur = _mm256_setr_epi64x(0, 1, 2, 3);
+        const __m256i step = _mm256_set1_epi64x(4);
+        __m256d unord = _mm256_setzero_pd();
+        t_index i = 0;
+        for (; i + 4 <= n; i += 4) {
+            const __m256d v = _mm256_loadu_pd(data + i);
+            const __m256d lt = _mm256_cmp_pd(v, vmin, _CMP_LT_OQ);
+            unord = _mm256_or_pd(unord, _mm256_cmp_pd(v, v, _CMP_UNORD_Q));
+            vmin = _mm256_blendv_pd(vmin, v, lt);
+            vpos = _mm256_castpd_si256(
+                _mm256_blendv_pd(_mm256_castsi256_pd(vpos),
+                                 _mm256_castsi256_pd(cur), lt));
+            cur = _mm256_add_epi64(cur, step);
+        }
+        if (_mm256_movemask_pd(unord)) nan = true;
+        double val[4];
+        long long pos[4];
+        _mm256_storeu_pd(val, vmin);
+        _mm256_storeu_si256(reinterpret_cast<__m256i *>(pos), vpos);
+        return argmin_finish(val, pos, 4, data, i, n, min, nan);
+    }
 
-// Compiler optimization hints
-#pragma GCC optimize("O3,unroll-loops,fast-math")
+    SIMD_TARGET_AVX2
+    static t_index argmin_avx2(const float* data, t_index n, float & min,
+                               bool & nan) {
+        __m256 vmin = _mm256_set1_ps(min);
+        __m256i vpos = _mm256_set1_epi32(-1);
+        __m256i cur = _mm256_setr_epi32(0, 1, 2, 3, 4, 5, 6, 7);
+        const __m256i step = _mm256_set1_epi32(8);
+        __m256 unord = _mm256_setzero_ps();
+        t_index i = 0;
+        for (; i + 8 <= n; i += 8) {
+            const __m256 v = _mm256_loadu_ps(data + i);
+            const __m256 lt = _mm256_cmp_ps(v, vmin, _CMP_LT_OQ);
+            unord = _mm256_or_ps(unord, _mm256_cmp_ps(v, v, _CMP_UNORD_Q));
+            vmin = _mm256_blendv_ps(vmin, v, lt);
+            vpos = _mm256_castps_si256(
+                _mm256_blendv_ps(_mm256_castsi256_ps(vpos),
+                                 _mm256_castsi256_ps(cur), lt));
+            cur = _mm256_add_epi32(cur, step);
+        }
+        if (_mm256_movemask_ps(unord)) nan = true;
+        float val[8];
+        int pos[8];
+        _mm256_storeu_ps(val, vmin);
+        _mm256_storeu_si256(reinterpret_cast<__m256i *>(pos), vpos);
+        return argmin_finish(val, pos, 8, data, i, n, min, nan);
+    }
 
-inline static void f_single( t_float * __restrict__ const b, const t_float a ) {
-  if (__builtin_expect(*b > a, false)) *b = a;
-}
-inline static void f_complete( t_float * __restrict__ const b, const t_float a ) {
-  if (__builtin_expect(*b < a, false)) *b = a;
-}
-inline static void f_average( t_float * __restrict__ const b, const t_float a, const t_float s, const t_float t) {
-  *b = s*a + t*(*b);
-  #ifndef FE_INVALID
+    /* The AVX-512 kernels process the remainder of the vectors with masked
+       loads, which do not touch the memory of the masked-out lanes.
+    */
 #if HAVE_DIAGNOSTIC
 #pragma GCC diagnostic push
-#pragma GCC diagnostic ignored "-Wfloat-equal"
+// False positives for the _mm512_*reduce_* functions in the headers of GCC 12
+#pragma GCC diagnostic ignored "-Wuninitialized"
+#pragma GCC diagnostic ignored "-Wmaybe-uninitialized"
 #endif
-  if (__builtin_expect(fc_isnan(*b), false)) {
-    throw(nan_error());
-  }
+    SIMD_TARGET_AVX512
+    static double sqeuclidean_avx512(const double* a, const double* b,
+                                     t_index dim) {
+        __m512d s0 = _mm512_setzero_pd(), s1 = s0;
+        t_index i = 0;
+        for (; i + 16 <= dim; i += 16) {
+            const __m512d d0 = _mm512_sub_pd(_mm512_loadu_pd(a + i),
+                                             _mm512_loadu_pd(b + i));
+            const __m512d d1 = _mm512_sub_pd(_mm512_loadu_pd(a + i + 8),
+                                             _mm512_loadu_pd(b + i + 8));
+            s0 = _mm512_fmadd_pd(d0, d0, s0);
+            s1 = _mm512_fmadd_pd(d1, d1, s1);
+        }
+        if (i + 8 <= dim) {
+            const __m512d d0 = _mm512_sub_pd(_mm512_loadu_pd(a + i),
+                                             _mm512_loadu_pd(b + i));
+            s0 = _mm512_fmadd_pd(d0, d0, s0);
+            i += 8;
+        }
+        if (i < dim) {
+            const __mmask8 m = static_cast<__mmask8>((1u << (dim - i)) - 1);
+            const __m512d d1 = _mm512_sub_pd(_mm512_maskz_loadu_pd(m, a + i),
+                                             _mm512_maskz_loadu_pd(m, b + i));
+            s1 = _mm512_fmadd_pd(d1, d1, s1);
+        }
+        return _mm512_reduce_add_pd(_mm512_add_pd(s0, s1));
+    }
+
+    SIMD_TARGET_AVX512
+    static float sqeuclidean_avx512(const float* a, const float* b,
+                                    t_index dim) {
+        __m512 s0 = _mm512_setzero_ps(), s1 = s0;
+        t_index i = 0;
+        for (; i + 32 <= dim; i += 32) {
+            const __m512 d0 = _mm512_sub_ps(_mm512_loadu_ps(a + i),
+                                            _mm512_loadu_ps(b + i));
+            const __m512 d1 = _mm512_sub_ps(_mm512_loadu_ps(a + i + 16),
+                                            _mm512_loadu_ps(b + i + 16));
+            s0 = _mm512_fmadd_ps(d0, d0, s0);
+            s1 = _mm512_fmadd_ps(d1, d1, s1);
+        }
+        if (i + 16 <= dim) {
+            const __m512 d0 = _mm512_sub_ps(_mm512_loadu_ps(a + i),
+                                            _mm512_loadu_ps(b + i));
+            s0 = _mm512_fmadd_ps(d0, d0, s0);
+            i += 16;
+        }
+        if (i < dim) {
+            const __mmask16 m = static_cast<__mmask16>((1u << (dim - i)) - 1);
+            const __m512 d1 = _mm512_sub_ps(_mm512_maskz_loadu_ps(m, a + i),
+                                            _mm512_maskz_loadu_ps(m, b + i));
+            s1 = _mm512_fmadd_ps(d1, d1, s1);
+        }
+        return _mm512_reduce_add_ps(_mm512_add_ps(s0, s1));
+    }
+
+    SIMD_TARGET_AVX512
+    static void dot4_avx512(const double* p, const double* r0,
+                            const double* r1, const double* r2,
+                            const double* r3, t_index dim, double* out) {
+        __m512d a0 = _mm512_setzero_pd(), a1 = a0, a2 = a0, a3 = a0;
+        t_index i = 0;
+        for (; i + 8 <= dim; i += 8) {
+            const __m512d vp = _mm512_loadu_pd(p + i);
+            a0 = _mm512_fmadd_pd(vp, _mm512_loadu_pd(r0 + i), a0);
+            a1 = _mm512_fmadd_pd(vp, _mm512_loadu_pd(r1 + i), a1);
+            a2 = _mm512_fmadd_pd(vp, _mm512_loadu_pd(r2 + i), a2);
+            a3 = _mm512_fmadd_pd(vp, _mm512_loadu_pd(r3 + i), a3);
+        }
+        if (i < dim) {
+            const __mmask8 m = static_cast<__mmask8>((1u << (dim - i)) - 1);
+            const __m512d vp = _mm512_maskz_loadu_pd(m, p + i);
+            a0 = _mm512_fmadd_pd(vp, _mm512_maskz_loadu_pd(m, r0 + i), a0);
+            a1 = _mm512_fmadd_pd(vp, _mm512_maskz_loadu_pd(m, r1 + i), a1);
+            a2 = _mm512_fmadd_pd(vp, _mm512_maskz_loadu_pd(m, r2 + i), a2);
+            a3 = _mm512_fmadd_pd(vp, _mm512_maskz_loadu_pd(m, r3 + i), a3);
+        }
+        out[0] = _mm512_reduce_add_pd(a0);
+        out[1] = _mm512_reduce_add_pd(a1);
+        out[2] = _mm512_reduce_add_pd(a2);
+        out[3] = _mm512_reduce_add_pd(a3);
+    }
+
+    SIMD_TARGET_AVX512
+    static void dot4_avx512(const float* p, const float* r0,
+                            const float* r1, const float* r2,
+                            const float* r3, t_index dim, float* out) {
+        __m512 a0 = _mm512_setzero_ps(), a1 = a0, a2 = a0, a3 = a0;
+        t_index i = 0;
+        for (; i + 16 <= dim; i += 16) {
+            const __m512 vp = _mm512_loadu_ps(p + i);
+            a0 = _mm512_fmadd_ps(vp, _mm512_loadu_ps(r0 + i), a0);
+            a1 = _mm512_fmadd_ps(vp, _mm512_loadu_ps(r1 + i), a1);
+            a2 = _mm512_fmadd_ps(vp, _mm512_loadu_ps(r2 + i), a2);
+            a3 = _mm512_fmadd_ps(vp, _mm512_loadu_ps(r3 + i), a3);
+        }
+        if (i < dim) {
+            const __mmask16 m = static_cast<__mmask16>((1u << (dim - i)) - 1);
+            const __m512 vp = _mm512_maskz_loadu_ps(m, p + i);
+            a0 = _mm512_fmadd_ps(vp, _mm512_maskz_loadu_ps(m, r0 + i), a0);
+            a1 = _mm512_fmadd_ps(vp, _mm512_maskz_loadu_ps(m, r1 + i), a1);
+            a2 = _mm512_fmadd_ps(vp, _mm512_maskz_loadu_ps(m, r2 + i), a2);
+            a3 = _mm512_fmadd_ps(vp, _mm512_maskz_loadu_ps(m, r3 + i), a3);
+        }
+        out[0] = _mm512_reduce_add_ps(a0);
+        out[1] = _mm512_reduce_add_ps(a1);
+        out[2] = _mm512_reduce_add_ps(a2);
+        out[3] = _mm512_reduce_add_ps(a3);
+    }
+
+    SIMD_TARGET_AVX512
+    static t_index argmin_avx512(const double* data, t_index n,
+                                 double & min, bool & nan) {
+        const __m512d inf =
+            _mm512_set1_pd(std::numeric_limits<double>::infinity());
+        __m512d vmin = _mm512_set1_pd(min);
+        __m512i vpos = _mm512_set1_epi64(-1);
+        __m512i cur = _mm512_setr_epi64(0, 1, 2, 3, 4, 5, 6, 7);
+        const __m512i step = _mm512_set1_epi64(8);
+        __mmask8 unord = 0;
+        for (t_index i = 0; i < n; i += 8) {
+            // Infinity in the masked-out lanes is never selected.
+            const __mmask8 m = (n - i >= 8) ? static_cast<__mmask8>(0xff) :
+                static_cast<__mmask8>((1u << (n - i)) - 1);
+            const __m512d v = _mm512_mask_loadu_pd(inf, m, data + i);
+            const __mmask8 lt = _mm512_cmp_pd_mask(v, vmin, _CMP_LT_OQ);
+            unord |= _mm512_cmp_pd_mask(v, v, _CMP_UNORD_Q);
+            vmin = _mm512_mask_mov_pd(vmin, lt, v);
+            vpos = _mm512_mask_mov_epi64(vpos, lt, cur);
+            cur = _mm512_add_epi64(cur, step);
+        }
+        if (unord) nan = true;
+        const double m = _mm512_reduce_min_pd(vmin);
+        if (!(m < min)) return -1;
+        const __mmask8 eq =
+            _mm512_cmp_pd_mask(vmin, _mm512_set1_pd(m), _CMP_EQ_OQ);
+        const t_index idx =
+            static_cast<t_index>(_mm512_mask_reduce_min_epi64(eq, vpos));
+        // Not m: the lanes may hold both 0.0 and -0.0.
+        min = data[idx];
+        return idx;
+    }
+
+    SIMD_TARGET_AVX512
+    static t_index argmin_avx512(const float* data, t_index n,
+                                 float & min, bool & nan) {
+        const __m512 inf =
+            _mm512_set1_ps(std::numeric_limits<float>::infinity());
+        __m512 vmin = _mm512_set1_ps(min);
+        __m512i vpos = _mm512_set1_epi32(-1);
+        __m512i cur = _mm512_setr_epi32(0, 1, 2, 3, 4, 5, 6, 7,
+                                        8, 9, 10, 11, 12, 13, 14, 15);
+        const __m512i step = _mm512_set1_epi32(16);
+        __mmask16 unord = 0;
+        for (t_index i = 0; i < n; i += 16) {
+            const __mmask16 m = (n - i >= 16) ? static_cast<__mmask16>(0xffff) :
+                static_cast<__mmask16>((1u << (n - i)) - 1);
+            const __m512 v = _mm512_mask_loadu_ps(inf, m, data + i);
+            const __mmask16 lt = _mm512_cmp_ps_mask(v, vmin, _CMP_LT_OQ);
+            unord |= _mm512_cmp_ps_mask(v, v, _CMP_UNORD_Q);
+            vmin = _mm512_mask_mov_ps(vmin, lt, v);
+            vpos = _mm512_mask_mov_epi32(vpos, lt, cur);
+            cur = _mm512_add_epi32(cur, step);
+        }
+        if (unord) nan = true;
+        const float m = _mm512_reduce_min_ps(vmin);
+        if (!(m < min)) return -1;
+        const __mmask16 eq =
+            _mm512_cmp_ps_mask(vmin, _mm512_set1_ps(m), _CMP_EQ_OQ);
+        const t_index idx =
+            static_cast<t_index>(_mm512_mask_reduce_min_epi32(eq, vpos));
+        min = data[idx];
+        return idx;
+    }
 #if HAVE_DIAGNOSTIC
 #pragma GCC diagnostic pop
 #endif
-  #endif
-}
-inline static void f_weighted( t_float * const b, const t_float a) {
-  *b = (a+*b)*.5;
-  #ifndef FE_INVALID
+#endif
+
+    // The metric kernels for one floating point type
+    template <typename T>
+    struct metric_kernels {
+        typedef T (*kernel)(const T*, const T*, t_index);
+        kernel cityblock;
+        kernel chebychev;
+        kernel canberra;
+        kernel braycurtis;
+        kernel dot;
+    };
+
+    template <typename V>
+    inline metric_kernels<typename vec_traits<V>::scalar>
+    metric_kernels_baseline() {
+        metric_kernels<typename vec_traits<V>::scalar> K;
+        K.cityblock = cityblock_kernel<V>;
+        K.chebychev = chebychev_kernel<V>;
+        K.canberra = canberra_kernel<V>;
+        K.braycurtis = braycurtis_kernel<V>;
+        K.dot = dot_kernel<V>;
+        return K;
+    }
+
+#if HAVE_SIMD_DISPATCH
+    /* The metric kernel K for the vector type V, compiled for AVX2
+       respectively AVX-512.
+    */
+    template <typename V,
+              typename metric_kernels<typename vec_traits<V>::scalar>::kernel K>
+    SIMD_TARGET_AVX2 static typename vec_traits<V>::scalar
+    metric_avx2(const typename vec_traits<V>::scalar* a,
+                const typename vec_traits<V>::scalar* b, t_index dim) {
+        return K(a, b, dim);
+    }
+
+    template <typename V,
+              typename metric_kernels<typename vec_traits<V>::scalar>::kernel K>
+    SIMD_TARGET_AVX512 static typename vec_traits<V>::scalar
+    metric_avx512(const typename vec_traits<V>::scalar* a,
+                  const typename vec_traits<V>::scalar* b, t_index dim) {
+        return K(a, b, dim);
+    }
+
+    template <typename V>
+    inline metric_kernels<typename vec_traits<V>::scalar> metric_kernels_avx2() {
+        metric_kernels<typename vec_traits<V>::scalar> K;
+        K.cityblock = metric_avx2<V, cityblock_kernel<V> >;
+        K.chebychev = metric_avx2<V, chebychev_kernel<V> >;
+        K.canberra = metric_avx2<V, canberra_kernel<V> >;
+        K.braycurtis = metric_avx2<V, braycurtis_kernel<V> >;
+        K.dot = metric_avx2<V, dot_kernel<V> >;
+        return K;
+    }
+
+    template <typename V>
+    inline metric_kernels<typename vec_traits<V>::scalar>
+    metric_kernels_avx512() {
+        metric_kernels<typename vec_traits<V>::scalar> K;
+        K.cityblock = metric_avx512<V, cityblock_kernel<V> >;
+        K.chebychev = metric_avx512<V, chebychev_kernel<V> >;
+        K.canberra = metric_avx512<V, canberra_kernel<V> >;
+        K.braycurtis = metric_avx512<V, braycurtis_kernel<V> >;
+        K.dot = metric_avx512<V, dot_kernel<V> >;
+        return K;
+    }
+
+    // bool_counts_kernel with the popcnt instruction
+    SIMD_TARGET_POPCNT
+    static void bool_counts_popcnt(const uint64_t* a, const uint64_t* b,
+                                   t_index n, t_index & tt, t_index & xo,
+                                   t_index & tf) {
+        bool_counts_kernel(a, b, n, tt, xo, tf);
+    }
+
+#if HAVE_VPOPCNTDQ
+    // The same counts for eight words at a time
 #if HAVE_DIAGNOSTIC
 #pragma GCC diagnostic push
-#pragma GCC diagnostic ignored "-Wfloat-equal"
+#pragma GCC diagnostic ignored "-Wuninitialized"
+#pragma GCC diagnostic ignored "-Wmaybe-uninitialized"
 #endif
-  if (fc_isnan(*b)) {
-    throw(nan_error());
-  }
+    SIMD_TARGET_VPOPCNTDQ
+    static void bool_counts_avx512(const uint64_t* a, const uint64_t* b,
+                                   t_index n, t_index & tt, t_index & xo,
+                                   t_index & tf) {
+        __m512i s_tt = _mm512_setzero_si512(), s_xo = s_tt, s_tf = s_tt;
+        for (t_index w = 0; w < n; w += 8) {
+            // The masked loads fill the words beyond n with zeros.
+            const __mmask8 m = (n - w >= 8) ? static_cast<__mmask8>(0xff) :
+                static_cast<__mmask8>((1u << (n - w)) - 1);
+            const __m512i x = _mm512_maskz_loadu_epi64(m, a + w);
+            const __m512i y = _mm512_maskz_loadu_epi64(m, b + w);
+            s_tt = _mm512_add_epi64(s_tt,
+                _mm512_popcnt_epi64(_mm512_and_si512(x, y)));
+            s_xo = _mm512_add_epi64(s_xo,
+                _mm512_popcnt_epi64(_mm512_xor_si512(x, y)));
+            s_tf = _mm512_add_epi64(s_tf,
+                _mm512_popcnt_epi64(_mm512_andnot_si512(y, x)));
+        }
+        tt = static_cast<t_index>(_mm512_reduce_add_epi64(s_tt));
+        xo = static_cast<t_index>(_mm512_reduce_add_epi64(s_xo));
+        tf = static_cast<t_index>(_mm512_reduce_add_epi64(s_tf));
+    }
 #if HAVE_DIAGNOSTIC
 #pragma GCC diagnostic pop
 #endif
-  #endif
+#endif
+#endif
+
+    // Table of the kernels for the chosen instruction set level
+    struct kernel_table {
+        SIMDLevel level;
+        int features;
+        double (*sqeuclidean_d)(const double*, const double*, t_index);
+        float (*sqeuclidean_f)(const float*, const float*, t_index);
+        void (*dot4_d)(const double*, const double*, const double*,
+                       const double*, const double*, t_index, double*);
+        void (*dot4_f)(const float*, const float*, const float*,
+                       const float*, const float*, t_index, float*);
+        t_index (*argmin_d)(const double*, t_index, double &, bool &);
+        t_index (*argmin_f)(const float*, t_index, float &, bool &);
+        metric_kernels<double> metrics_d;
+        metric_kernels<float> metrics_f;
+        void (*bool_counts)(const uint64_t*, const uint64_t*, t_index,
+                            t_index &, t_index &, t_index &);
+    };
+
+    inline SIMDLevel compiled_simd_level() {
+        const int features = compiled_simd_features();
+        if (features & SIMD_AVX2) return SIMD_LEVEL_AVX2;
+        if (features & SIMD_SSE2) return SIMD_LEVEL_SSE2;
+        if (features & SIMD_NEON) return SIMD_LEVEL_NEON;
+        return SIMD_LEVEL_SCALAR;
+    }
+
+    inline const char * simd_level_name(const SIMDLevel level) {
+        switch (level) {
+        case SIMD_LEVEL_NEON: return "neon";
+        case SIMD_LEVEL_SSE2: return "sse2";
+        case SIMD_LEVEL_AVX2: return "avx2";
+        case SIMD_LEVEL_AVX512: return "avx512";
+        default: return "scalar";
+        }
+    }
+
+    /* Choose the kernels for the CPU. The environment variable
+       FASTCLUSTER_SIMD (one of "sse2", "avx2", "avx512") caps the level,
+       eg. to compare results between the levels; values which the CPU does
+       not support, or which are below the level of the build flags, have no
+       effect.
+    */
+    inline kernel_table select_kernels() {
+        kernel_table K;
+        K.level = compiled_simd_level();
+        K.features = compiled_simd_features();
+        K.sqeuclidean_d = sqeuclidean_baseline;
+        K.sqeuclidean_f = sqeuclidean_baseline;
+        K.dot4_d = dot4_baseline;
+        K.dot4_f = dot4_baseline;
+        K.argmin_d = argmin_baseline;
+        K.argmin_f = argmin_baseline;
+        K.metrics_d =
+          metric_kernels_baseline<baseline_vector<double>::type>();
+        K.metrics_f =
+          metric_kernels_baseline<baseline_vector<float>::type>();
+        K.bool_counts = bool_counts_kernel;
+#if HAVE_SIMD_DISPATCH
+        // __builtin_cpu_supports also checks that the OS saves the wide
+        // registers on context switches.
+        __builtin_cpu_init();
+        if (__builtin_cpu_supports("sse2")) K.features |= SIMD_SSE2;
+        if (__builtin_cpu_supports("avx")) K.features |= SIMD_AVX;
+        if (__builtin_cpu_supports("avx2")) K.features |= SIMD_AVX2;
+        if (__builtin_cpu_supports("fma")) K.features |= SIMD_FMA;
+        if (__builtin_cpu_supports("avx512f")) K.features |= SIMD_AVX512F;
+        if (__builtin_cpu_supports("popcnt")) K.features |= SIMD_POPCNT;
+#if HAVE_VPOPCNTDQ
+        if (__builtin_cpu_supports("avx512vpopcntdq"))
+          K.features |= SIMD_AVX512VPOPCNTDQ;
+#endif
+
+        SIMDLevel cap = SIMD_LEVEL_AVX512;
+        const char * const env = std::getenv("FASTCLUSTER_SIMD");
+        if (env) {
+          if (std::strcmp(env, "sse2")==0) cap = SIMD_LEVEL_SSE2;
+          else if (std::strcmp(env, "avx2")==0) cap = SIMD_LEVEL_AVX2;
+        }
+
+        const int avx2 = SIMD_AVX2 | SIMD_FMA;
+        if ((K.features & avx2)==avx2 && cap >= SIMD_LEVEL_AVX2) {
+          K.level = SIMD_LEVEL_AVX2;
+          K.sqeuclidean_d = sqeuclidean_avx2;
+          K.sqeuclidean_f = sqeuclidean_avx2;
+          K.dot4_d = dot4_avx2;
+          K.dot4_f = dot4_avx2;
+          K.argmin_d = argmin_avx2;
+          K.argmin_f = argmin_avx2;
+          K.metrics_d = metric_kernels_avx2<vec4d>();
+          K.metrics_f = metric_kernels_avx2<vec8f>();
+          if (K.features & SIMD_POPCNT) K.bool_counts = bool_counts_popcnt;
+          if ((K.features & SIMD_AVX512F) && cap >= SIMD_LEVEL_AVX512) {
+            K.level = SIMD_LEVEL_AVX512;
+            K.sqeuclidean_d = sqeuclidean_avx512;
+            K.sqeuclidean_f = sqeuclidean_avx512;
+            K.dot4_d = dot4_avx512;
+            K.dot4_f = dot4_avx512;
+            K.argmin_d = argmin_avx512;
+            K.argmin_f = argmin_avx512;
+            K.metrics_d = metric_kernels_avx512<vec8d>();
+            K.metrics_f = metric_kernels_avx512<vec16f>();
+#if HAVE_VPOPCNTDQ
+            if (K.features & SIMD_AVX512VPOPCNTDQ)
+              K.bool_counts = bool_counts_avx512;
+#endif
+          }
+        }
+#endif
+        return K;
+    }
+
+    // Initialized once when the extension module is loaded.
+    static const kernel_table kernels = select_kernels();
+
+    // SIMD features of the CPU (with runtime dispatch) or of the build flags
+    inline int get_simd_features() {
+        return kernels.features;
+    }
+
+    // Name of the instruction set level of the kernels in use
+    inline const char * simd_level() {
+        return simd_level_name(kernels.level);
+    }
+
+    /* Public kernels. Vectors shorter than MIN_DISPATCH_LENGTH are handled
+       by the inlined baseline kernels: for them, the indirect call costs
+       more than the wider registers save.
+    */
+    const t_index MIN_DISPATCH_LENGTH = 24;
+
+    // Vectorized squared Euclidean distance calculation
+    inline double simd_sqeuclidean(const double* a, const double* b,
+                                   t_index dim) {
+#if HAVE_SIMD_DISPATCH
+        if (dim >= MIN_DISPATCH_LENGTH)
+          return kernels.sqeuclidean_d(a, b, dim);
+#endif
+        return sqeuclidean_baseline(a, b, dim);
+    }
+
+    inline float simd_sqeuclidean(const float* a, const float* b,
+                                  t_index dim) {
+#if HAVE_SIMD_DISPATCH
+        if (dim >= MIN_DISPATCH_LENGTH)
+          return kernels.sqeuclidean_f(a, b, dim);
+#endif
+        return sqeuclidean_baseline(a, b, dim);
+    }
+
+    // Dot products of one vector p with four vectors r0..r3 at once
+    inline void simd_dot4(const double* p, const double* r0,
+                          const double* r1, const double* r2,
+                          const double* r3, t_index dim, double* out) {
+#if HAVE_SIMD_DISPATCH
+        if (dim >= MIN_DISPATCH_LENGTH)
+          return kernels.dot4_d(p, r0, r1, r2, r3, dim, out);
+#endif
+        dot4_baseline(p, r0, r1, r2, r3, dim, out);
+    }
+
+    inline void simd_dot4(const float* p, const float* r0,
+                          const float* r1, const float* r2,
+                          const float* r3, t_index dim, float* out) {
+#if HAVE_SIMD_DISPATCH
+        if (dim >= MIN_DISPATCH_LENGTH)
+          return kernels.dot4_f(p, r0, r1, r2, r3, dim, out);
+#endif
+        dot4_baseline(p, r0, r1, r2, r3, dim, out);
+    }
+
+    // Vectorized argmin; see argmin_baseline
+    inline t_index simd_argmin(const double* data, t_index n, double & min,
+                               bool & nan) {
+#if HAVE_SIMD_DISPATCH
+        if (n >= MIN_DISPATCH_LENGTH)
+          return kernels.argmin_d(data, n, min, nan);
+#endif
+        return argmin_baseline(data, n, min, nan);
+    }
+
+    inline t_index simd_argmin(const float* data, t_index n, float & min,
+                               bool & nan) {
+#if HAVE_SIMD_DISPATCH
+        if (n >= MIN_DISPATCH_LENGTH)
+          return kernels.argmin_f(data, n, min, nan);
+#endif
+        return argmin_baseline(data, n, min, nan);
+    }
+
+    // Kernels of the other metrics; see cityblock_kernel etc. above
+    inline const metric_kernels<double> & metric_table(const double *) {
+        return kernels.metrics_d;
+    }
+
+    inline const metric_kernels<float> & metric_table(const float *) {
+        return kernels.metrics_f;
+    }
+
+    template <typename T>
+    inline T simd_cityblock(const T* a, const T* b, t_index dim) {
+#if HAVE_SIMD_DISPATCH
+        if (dim >= MIN_DISPATCH_LENGTH)
+          return metric_table(a).cityblock(a, b, dim);
+#endif
+        return cityblock_kernel<typename baseline_vector<T>::type>(a, b, dim);
+    }
+
+    template <typename T>
+    inline T simd_chebychev(const T* a, const T* b, t_index dim) {
+#if HAVE_SIMD_DISPATCH
+        if (dim >= MIN_DISPATCH_LENGTH)
+          return metric_table(a).chebychev(a, b, dim);
+#endif
+        return chebychev_kernel<typename baseline_vector<T>::type>(a, b, dim);
+    }
+
+    template <typename T>
+    inline T simd_canberra(const T* a, const T* b, t_index dim) {
+#if HAVE_SIMD_DISPATCH
+        if (dim >= MIN_DISPATCH_LENGTH)
+          return metric_table(a).canberra(a, b, dim);
+#endif
+        return canberra_kernel<typename baseline_vector<T>::type>(a, b, dim);
+    }
+
+    template <typename T>
+    inline T simd_braycurtis(const T* a, const T* b, t_index dim) {
+#if HAVE_SIMD_DISPATCH
+        if (dim >= MIN_DISPATCH_LENGTH)
+          return metric_table(a).braycurtis(a, b, dim);
+#endif
+        return braycurtis_kernel<typename baseline_vector<T>::type>(a, b, dim);
+    }
+
+    template <typename T>
+    inline T simd_dot(const T* a, const T* b, t_index dim) {
+#if HAVE_SIMD_DISPATCH
+        if (dim >= MIN_DISPATCH_LENGTH)
+          return metric_table(a).dot(a, b, dim);
+#endif
+        return dot_kernel<typename baseline_vector<T>::type>(a, b, dim);
+    }
+
+    /* Bit counts of packed Boolean vectors; see bool_counts_kernel. This
+       kernel is dispatched for all lengths: without the popcnt instruction,
+       each word costs more than the indirect call.
+    */
+    inline void simd_bool_counts(const uint64_t* a, const uint64_t* b,
+                                 t_index n, t_index & tt, t_index & xo,
+                                 t_index & tf) {
+#if HAVE_SIMD_DISPATCH
+        kernels.bool_counts(a, b, n, tt, xo, tf);
+#else
+        bool_counts_kernel(a, b, n, tt, xo, tf);
+#endif
+    }
 }
-inline static void f_ward( t_float * const b, const t_float a, const t_float c, const t_float s, const t_float t, const t_float v) {
-  *b = ( (v+s)*a - v*c + (v+t)*(*b) ) / (s+t+v);
-  //*b = a+(*b)-(t*a+s*(*b)+v*c)/(s+t+v);
-  #ifndef FE_INVALID
+
+/* Method codes.
+
+   These codes must agree with the METHODS array in fastcluster.R and the
+   dictionary mthidx in fastcluster.py.
+*/
+enum method_codes {
+  // non-Euclidean methods
+  METHOD_METR_SINGLE           = 0,
+  METHOD_METR_COMPLETE         = 1,
+  METHOD_METR_AVERAGE          = 2,
+  METHOD_METR_WEIGHTED         = 3,
+  METHOD_METR_WARD             = 4,
+  METHOD_METR_WARD_D           = METHOD_METR_WARD,
+  METHOD_METR_CENTROID         = 5,
+  METHOD_METR_MEDIAN           = 6,
+  METHOD_METR_WARD_D2          = 7,
+
+  MIN_METHOD_CODE              = 0,
+  MAX_METHOD_CODE              = 7
+};
+
+enum method_codes_vector {
+  // Euclidean methods
+  METHOD_VECTOR_SINGLE         = 0,
+  METHOD_VECTOR_WARD           = 1,
+  METHOD_VECTOR_CENTROID       = 2,
+  METHOD_VECTOR_MEDIAN         = 3,
+
+  MIN_METHOD_VECTOR_CODE       = 0,
+  MAX_METHOD_VECTOR_CODE       = 3
+};
+
+// self-destructing array pointer
+template <typename type>
+class auto_array_ptr{
+private:
+  type * ptr;
+  auto_array_ptr(auto_array_ptr const &); // non construction-copyable
+  auto_array_ptr& operator=(auto_array_ptr const &); // non copyable
+public:
+  auto_array_ptr()
+    : ptr(NULL)
+  { }
+  template <typename index>
+  auto_array_ptr(index const size)
+    : ptr(new type[size])
+  { }
+  template <typename index, typename value>
+  auto_array_ptr(index const size, value const val)
+    : ptr(new type[size])
+  {
+    FILL_N(ptr, size, val);
+  }
+  ~auto_array_ptr() {
+    delete [] ptr; }
+  void free() {
+    delete [] ptr;
+    ptr = NULL;
+  }
+  template <typename index>
+  void init(index const size) {
+    ptr = new type [size];
+  }
+  template <typename index, typename value>
+  void init(index const size, value const val) {
+    init(size);
+    FILL_N(ptr, size, val);
+  }
+  inline operator type *() const { return ptr; }
+};
+
+// Cache-aligned node structure
+struct alignas(32) node {
+  t_index node1, node2;
+  t_float dist;
+};
+
+inline bool operator< (const node a, const node b) {
+  return (a.dist < b.dist);
+}
+
+class cluster_result {
+private:
+  auto_array_ptr<node> Z;
+  t_index pos;
+
+public:
+  cluster_result(const t_index size)
+    : Z(size)
+    , pos(0)
+  {}
+
+  void append(const t_index node1, const t_index node2, const t_float dist) {
+    Z[pos].node1 = node1;
+    Z[pos].node2 = node2;
+    Z[pos].dist  = dist;
+    ++pos;
+  }
+
+  node * operator[] (const t_index idx) const { return Z + idx; }
+
+  // Write or read the steps so far for a checkpoint (see checkpoint_file).
+  template <typename t_archive>
+  void transfer(t_archive & F) {
+    F.value(pos);
+    F.array(static_cast<node *>(Z), pos);
+  }
+
+  /* Define several methods to postprocess the distances. All these functions
+     are monotone, so they do not change the sorted order of distances. */
+
+  void sqrt() const {
+    for (node * ZZ=Z; ZZ!=Z+pos; ++ZZ) {
+      ZZ->dist = std::sqrt(ZZ->dist);
+    }
+  }
+
+  void sqrt(const t_float) const { // ignore the argument
+    sqrt();
+  }
+
+  void sqrtdouble(const t_float) const { // ignore the argument
+    for (node * ZZ=Z; ZZ!=Z+pos; ++ZZ) {
+      ZZ->dist = std::sqrt(2*ZZ->dist);
+    }
+  }
+
+  #ifdef R_pow
+  #define my_pow R_pow
+  #else
+  #define my_pow std::pow
+  #endif
+
+  void power(const t_float p) const {
+    t_float const q = 1/p;
+    for (node * ZZ=Z; ZZ!=Z+pos; ++ZZ) {
+      ZZ->dist = my_pow(ZZ->dist,q);
+    }
+  }
+
+  void plusone(const t_float) const { // ignore the argument
+    for (node * ZZ=Z; ZZ!=Z+pos; ++ZZ) {
+      ZZ->dist += 1;
+    }
+  }
+
+  void divide(const t_float denom) const {
+    for (node * ZZ=Z; ZZ!=Z+pos; ++ZZ) {
+      ZZ->dist /= denom;
+    }
+  }
+};
+
+class linkage_progress {
+  /*
+    Progress reports from the clustering cores. The cores call the function
+    operator after their merging steps, and report() is called every
+    interval steps. It may throw an exception to abort the clustering.
+    Long phases without merging steps call poll() instead, which may abort
+    the clustering in the same way.
+  */
+private:
+  const t_index interval;
+  t_index next;
+
+public:
+  linkage_progress(const t_index interval_)
+    : interval(interval_>0 ? interval_ : 1)
+    , next(interval)
+  {}
+
+  virtual ~linkage_progress() {}
+
+  // step merging steps are done, the last one at the distance dist.
+  inline void operator() (const t_index step, const t_float dist) {
+    if (step>=next) {
+      next = step+interval;
+      report(step, dist);
+    }
+  }
+
+  virtual void poll() {}
+
+protected:
+  virtual void report(const t_index step, const t_float dist) = 0;
+};
+
+class doubly_linked_list {
+  /*
+    Class for a doubly linked list. Initially, the list is the integer range
+    [0, size]. We provide a forward iterator and a method to delete an index
+    from the list.
+
+    Typical use: for (i=L.start; L<size; i=L.succ[I])
+    or
+    for (i=somevalue; L<size; i=L.succ[I])
+  */
+public:
+  t_index start;
+  auto_array_ptr<t_index> succ;
+
+private:
+  auto_array_ptr<t_index> pred;
+  // Not necessarily private, we just do not need it in this instance.
+
+public:
+  doubly_linked_list(const t_index size)
+    // Initialize to the given size.
+    : start(0)
+    , succ(size+1)
+    , pred(size+1)
+  {
+    for (t_index i=0; i<size; ++i) {
+      pred[i+1] = i;
+      succ[i] = i+1;
+    }
+    // pred[0] is never accessed!
+    //succ[size] is never accessed!
+  }
+
+  ~doubly_linked_list() {}
+
+  void remove(const t_index idx) {
+    // Remove an index from the list.
+    if (idx==start) {
+      start = succ[idx];
+    }
+    else {
+      succ[pred[idx]] = succ[idx];
+      pred[succ[idx]] = pred[idx];
+    }
+    succ[idx] = 0; // Mark as inactive
+  }
+
+  bool is_inactive(t_index idx) const {
+    return (succ[idx]==0);
+  }
+};
+
+class active_index_array {
+  /*
+    The active indices in increasing order, stored contiguously. Scans over
+    the active nodes are then plain array loops with independent loads
+    instead of the pointer chasing through doubly_linked_list::succ, and
+    they can be split into chunks for several threads.
+
+    Removing an index leaves a gap, which is marked by a negative entry.
+    compact() closes the gaps once less than half of the entries are live,
+    so that every scan touches at most twice as many entries as there are
+    active nodes, and the cost of compaction is amortized over the removals.
+    Positions are stable between two calls to compact().
+
+    Typical use:
+
+      FOR_ACTIVE(i, A, 0, A.pos(j))         // active i < j
+      FOR_ACTIVE(i, A, A.pos(j)+1, A.size)  // active i > j
+  */
+public:
+  t_index size; // number of entries, including gaps
+
+private:
+  t_index live; // number of active indices
+  auto_array_ptr<t_index> idx;
+  auto_array_ptr<t_index> position;
+
+public:
+  active_index_array(const t_index size_)
+    : size(size_)
+    , live(size_)
+    , idx(size_)
+    , position(size_)
+  {
+    for (t_index i=0; i<size; ++i) {
+      position[i] = idx[i] = i;
+    }
+  }
+
+  inline t_index operator[] (const t_index k) const {
+    return idx[k];
+  }
+
+  // Position of the index i in the array. Stays valid for the last removed
+  // index until the next compaction.
+  inline t_index pos(const t_index i) const {
+    return position[i];
+  }
+
+  // The smallest active index.
+  t_index first() const {
+    t_index k = 0;
+    while (idx[k]<0) ++k;
+    return idx[k];
+  }
+
+  // The smallest active index greater than the active index i, or N if
+  // there is none.
+  t_index succ(const t_index i, const t_index N) const {
+    for (t_index k=position[i]+1; k<size; ++k) {
+      if (idx[k]>=0) return idx[k];
+    }
+    return N;
+  }
+
+  void remove(const t_index i) {
+    idx[position[i]] = -1;
+    --live;
+  }
+
+  // The stale position of a removed index holds a gap or, after compaction,
+  // a different active index.
+  bool is_inactive(const t_index i) const {
+    return idx[position[i]]!=i;
+  }
+
+  // Write or read the state for a checkpoint (see checkpoint_file). N is
+  // the size which was passed to the constructor.
+  template <typename t_archive>
+  void transfer(t_archive & F, const t_index N) {
+    F.value(size);
+    F.value(live);
+    F.array(static_cast<t_index *>(idx), N);
+    F.array(static_cast<t_index *>(position), N);
+  }
+
+  void compact() {
+    if (2*live >= size) return;
+    t_index k2 = 0;
+    for (t_index k=0; k<size; ++k) {
+      if (idx[k]>=0) {
+        position[idx[k]] = k2;
+        idx[k2++] = idx[k];
+      }
+    }
+    size = k2;
+  }
+};
+
+// Loop over the active indices j_ at the positions [k0_, k1_) of the
+// active_index_array A_.
+#define FOR_ACTIVE(j_, A_, k0_, k1_) \
+  for (t_index k_=(k0_), k_end_=(k1_); k_<k_end_; ++k_) \
+    if (((j_)=(A_)[k_])>=0)
+
+template <typename t_float>
+inline static t_float & condensed_at(t_float * const D, const t_index N,
+                                     const t_index r, const t_index c) {
+  return D[(static_cast<std::ptrdiff_t>(2*N-3-r)*r>>1)+c-1];
+}
+
+/*
+  Row offsets of a condensed matrix: D(r, c) is D[offset[r]+c] for r < c.
+
+  The clustering cores look up D(j, idx) for many rows j in every step. The
+  table replaces the multiplication in condensed_at by a load from an array
+  of N entries, which is read in the same order as the rows and stays in the
+  cache. Its size is negligible next to the matrix.
+*/
+class condensed_rows {
+private:
+  auto_array_ptr<std::ptrdiff_t> offset;
+
+public:
+  explicit condensed_rows(const t_index N)
+    : offset(N>0 ? N : 1)
+  {
+    for (t_index r=0; r<N; ++r) {
+      offset[r] = (static_cast<std::ptrdiff_t>(2*N-3-r)*r>>1)-1;
+    }
+  }
+
+  std::ptrdiff_t operator[] (const t_index r) const {
+    return offset[r];
+  }
+};
+
+// D is the upper triangular part of a symmetric (NxN)-matrix, with the row
+// offsets D_rows in scope.
+// We require r_ < c_ !
+#define D_(r_,c_) ( D[D_rows[r_]+(c_)] )
+
+/*
+  Nearest-neighbor scans over a row tail D(r, c0:N).
+
+  In the condensed layout, the row tail is contiguous, and the scan runs
+  through the vectorized simd_utils::simd_argmin over all columns, active or
+  not. The cores therefore set the entries D(i, idx) of a node idx to
+  infinity with retire() when they remove it. Since the comparisons are
+  strict, such an entry is never selected, and the result is the same as
+  from the loop
+
+    FOR_ACTIVE(c, active_nodes, k0, active_nodes.size) {
+      if (D_(r, c) < min) {
+        min = D_(r, c);
+        idx = c;
+      }
+    }
+
+  where k0 is the position of the first active index c >= c0, and
+  entries = active_nodes.size - k0. Only the entries D(i, idx) for i < idx
+  need to be retired, since the row of idx itself is never scanned again.
+
+  row_argmin returns false if the caller must run this loop itself, when
+  less than a quarter of the columns in the row tail are active.
+*/
+template <typename t_float>
+inline static bool row_argmin(t_float * const D,
+                              const condensed_rows & D_rows, const t_index N,
+                              const t_index r, const t_index c0,
+                              const t_index entries,
+                              t_float & min, t_index & idx, bool & nan) {
+  if (c0>=N) return true;
+  if (4*entries < N-c0) return false;
+  const t_index k = simd_utils::simd_argmin(&D_(r, c0), N-c0, min, nan);
+  if (k>=0) idx = c0+k;
+  return true;
+}
+
+// Read the entry D(i, idx) of a node idx which is being removed, and set it
+// to infinity for row_argmin.
+template <typename t_float>
+inline static t_float retire(t_float & entry) {
+  const t_float a = entry;
+  entry = std::numeric_limits<t_float>::infinity();
+  return a;
+}
+
+// Cache-friendly distance matrix access with prefetching
+#define D_CACHE_FRIENDLY(r_,c_) ( \
+  __builtin_prefetch(&D[(static_cast<std::ptrdiff_t>(2*N-3-(r_))*(r_)>>1)+(c_)-1], 0, 3), \
+  D[(static_cast<std::ptrdiff_t>(2*N-3-(r_))*(r_)>>1)+(c_)-1] \
+)
+
+/*
+  Read-ahead hints for condensed matrices which are memory-mapped from disk
+  and may be larger than the main memory.
+
+  The clustering cores access D in two patterns: a contiguous row tail
+  D(r, c:N) and a strided column D(0:r, r). The kernel's default read-ahead
+  only helps the first and wastes I/O on the second. For out-of-core input,
+  the cores therefore switch the mapping to random access after the initial
+  sequential pass and request every row tail explicitly before it is
+  scanned, so that the page-in of the row overlaps with the column scan.
+
+  These are hints only: errors are ignored, and on platforms without
+  posix_madvise the functions do nothing.
+*/
+enum readahead_advice {
+  READAHEAD_SEQUENTIAL,
+  READAHEAD_RANDOM,
+  READAHEAD_WILLNEED
+};
+
+static void readahead(const void * const ptr, const std::ptrdiff_t bytes,
+                      const readahead_advice advice) {
+#if HAVE_POSIX_MADVISE
+  if (bytes<=0) return;
+  static const uintptr_t pagesize =
+    static_cast<uintptr_t>(sysconf(_SC_PAGESIZE));
+  const uintptr_t start =
+    reinterpret_cast<uintptr_t>(ptr) & ~(pagesize-1);
+  const uintptr_t end =
+    reinterpret_cast<uintptr_t>(ptr) + static_cast<uintptr_t>(bytes);
+  const int flag = (advice==READAHEAD_SEQUENTIAL) ? POSIX_MADV_SEQUENTIAL :
+    (advice==READAHEAD_RANDOM) ? POSIX_MADV_RANDOM : POSIX_MADV_WILLNEED;
+  posix_madvise(reinterpret_cast<void *>(start), end-start, flag);
+#else
+  (void)ptr; (void)bytes; (void)advice;
+#endif
+}
+
+/*
+  Write the dirty pages of a shared memory mapping back to its file, for the
+  checkpoints of generic_linkage. Errors are ignored as for the hints above:
+  the pages are written back by the operating system anyway.
+*/
+static void sync_mapping(const void * const ptr, const std::ptrdiff_t bytes) {
+#if HAVE_POSIX_MADVISE
+  if (bytes<=0) return;
+  static const uintptr_t pagesize =
+    static_cast<uintptr_t>(sysconf(_SC_PAGESIZE));
+  const uintptr_t start =
+    reinterpret_cast<uintptr_t>(ptr) & ~(pagesize-1);
+  const uintptr_t end =
+    reinterpret_cast<uintptr_t>(ptr) + static_cast<uintptr_t>(bytes);
+  msync(reinterpret_cast<void *>(start), end-start, MS_SYNC);
+#else
+  (void)ptr; (void)bytes;
+#endif
+}
+
+// Request the row tail D(r_, c_:N) before it is scanned.
+#define D_ROW_READAHEAD(r_, c_) do { \
+  if ((c_)<N) readahead(&D_(r_, c_), \
+                        static_cast<std::ptrdiff_t>((N-(c_))*sizeof(t_float)), \
+                        READAHEAD_WILLNEED); \
+  } while (0)
+
+// Z is an ((N-1)x4)-array with cache alignment
+#define Z_(_r, _c) (Z[(_r)*4 + (_c)])
+
+/*
+  Lookup function for a union-find data structure.
+
+  The function finds the root of idx by going iteratively through all
+  parent elements until a root is found. An element i is a root if
+  nodes[i] is zero. To make subsequent searches faster, the entry for
+  idx and all its parents is updated with the root element.
+ */
+class union_find {
+private:
+  auto_array_ptr<t_index> parent;
+  t_index nextparent;
+
+public:
+  union_find(const t_index size)
+    : parent(size>0 ? 2*size-1 : 0, 0)
+    , nextparent(size)
+  { }
+
+  t_index Find (t_index idx) const {
+    if (parent[idx] != 0 ) { // a → b
+      t_index p = idx;
+      idx = parent[idx];
+      if (parent[idx] != 0 ) { // a → b → c
+        do {
+          idx = parent[idx];
+        } while (parent[idx] != 0);
+        do {
+          t_index tmp = parent[p];
+          parent[p] = idx;
+          p = tmp;
+        } while (parent[p] != idx);
+      }
+    }
+    return idx;
+  }
+
+  void Union (const t_index node1, const t_index node2) {
+    parent[node1] = parent[node2] = nextparent++;
+  }
+};
+
+class nan_error{};
+#ifdef FE_INVALID
+class fenv_error{};
+#endif
+
+#ifdef _OPENMP
+/*
+  Parallel building blocks for the clustering cores.
+
+  The parallel loops run over the positions of an active_index_array, so
+  that the active nodes can be split statically between the threads. This
+  pays off only if the loops are long enough to amortize the thread
+  synchronization; the cores fall back to the serial loops below
+  parallel_threshold active nodes.
+*/
+static const t_index parallel_threshold = 4096;
+
+inline static bool use_parallel(const t_index active) {
+  return active>=parallel_threshold && omp_get_max_threads()>1;
+}
+
+/*
+  One step of Prim's algorithm: update the distances d[i] of the active nodes
+  i to the tree with the distances dist_to_prev(i) to the node which was
+  added last, and return the active node with the smallest distance.
+
+  Ties are broken as in the serial loop with strict comparisons in ascending
+  index order: the smallest index wins, and if all distances are infinite,
+  the first active node is returned. NaN distances are reported after the
+  parallel region, since exceptions must not leave it.
+*/
+template <typename t_float, typename t_dist>
+static t_index parallel_prim_step(const active_index_array & active_nodes,
+                                  t_float * const d,
+                                  const t_dist & dist_to_prev,
+                                  t_float & min) {
+  t_float best = std::numeric_limits<t_float>::infinity();
+  t_index best_idx = -1;
+  bool nan_found = false;
+#pragma omp parallel reduction(||:nan_found)
+  {
+    t_float local = std::numeric_limits<t_float>::infinity();
+    t_index local_idx = -1;
+#pragma omp for schedule(static) nowait
+    for (t_index k=0; k<active_nodes.size; ++k) {
+      const t_index i = active_nodes[k];
+      if (i<0) continue;
+      const t_float tmp = dist_to_prev(i);
+#if HAVE_DIAGNOSTIC
+#pragma GCC diagnostic push
+#pragma GCC diagnostic ignored "-Wfloat-equal"
+#endif
+      if (tmp < d[i])
+        d[i] = tmp;
+      else if (fc_isnan(tmp))
+        nan_found = true;
+      if (d[i] < local) {
+        local = d[i];
+        local_idx = i;
+      }
+    }
+#pragma omp critical
+    if (local_idx>=0 &&
+        (best_idx<0 || local < best || (local==best && local_idx < best_idx))) {
+      best = local;
+      best_idx = local_idx;
+    }
+#if HAVE_DIAGNOSTIC
+#pragma GCC diagnostic pop
+#endif
+  }
+  if (nan_found) throw(nan_error());
+  if (best_idx<0) best_idx = active_nodes.first();
+  min = d[best_idx];
+  return best_idx;
+}
+#endif
+
+template <typename t_float>
+static void MST_linkage_core(const t_index N, const t_float * const D,
+                             cluster_result & Z2,
+                             const bool out_of_core = false,
+                             linkage_progress * const progress = NULL) {
+/*
+    N: integer, number of data points
+    D: condensed distance matrix N*(N-1)/2
+    Z2: output data structure
+    out_of_core: D is memory-mapped from disk; issue read-ahead hints
+    progress: progress reports (optional)
+
+    The basis of this algorithm is an algorithm by Rohlf:
+
+    F. James Rohlf, Hierarchical clustering using the minimum spanning tree,
+    The Computer Journal, vol. 16, 1973, p. 93–95.
+*/
+
+  t_index i;
+  t_index idx2;
+  active_index_array active_nodes(N);
+  auto_array_ptr<t_float> d(N);
+  const condensed_rows D_rows(N);
+
+  t_index prev_node;
+  t_float min;
+
+  // first iteration
+  idx2 = 1;
+  min = std::numeric_limits<t_float>::infinity();
+  for (i=1; i<N; ++i) {
+    d[i] = D_(0, i);
+#if HAVE_DIAGNOSTIC
+#pragma GCC diagnostic push
+#pragma GCC diagnostic ignored "-Wfloat-equal"
+#endif
+    if (d[i] < min) {
+      min = d[i];
+      idx2 = i;
+    }
+    else if (fc_isnan(d[i]))
+      throw (nan_error());
+#if HAVE_DIAGNOSTIC
+#pragma GCC diagnostic pop
+#endif
+  }
+  Z2.append(0, idx2, min);
+  active_nodes.remove(0);
+  if (out_of_core) readahead(D, static_cast<std::ptrdiff_t>(N)*(N-1)/2*
+                             static_cast<std::ptrdiff_t>(sizeof(t_float)),
+                             READAHEAD_RANDOM);
+
+  for (t_index j=1; j<N-1; ++j) {
+    if (progress) (*progress)(j, min);
+    prev_node = idx2;
+    active_nodes.compact();
+    active_nodes.remove(prev_node);
+    if (out_of_core) D_ROW_READAHEAD(prev_node, prev_node+1);
+
+#ifdef _OPENMP
+    // There are N-1-j active nodes in this step.
+    if (use_parallel(N-1-j)) {
+      idx2 = parallel_prim_step(active_nodes, &*d,
+                                [&](const t_index i) -> t_float {
+                                  return (i<prev_node) ? D_(i, prev_node)
+                                    : D_(prev_node, i);
+                                },
+                                min);
+      Z2.append(prev_node, idx2, min);
+      continue;
+    }
+#endif
+
+    idx2 = active_nodes.first();
+    min = d[idx2];
+    FOR_ACTIVE(i, active_nodes, 0, active_nodes.pos(prev_node)) {
+      t_float tmp = D_(i, prev_node);
+#if HAVE_DIAGNOSTIC
+#pragma GCC diagnostic push
+#pragma GCC diagnostic ignored "-Wfloat-equal"
+#endif
+      if (tmp < d[i])
+        d[i] = tmp;
+      else if (fc_isnan(tmp))
+        throw (nan_error());
+#if HAVE_DIAGNOSTIC
+#pragma GCC diagnostic pop
+#endif
+      if (d[i] < min) {
+        min = d[i];
+        idx2 = i;
+      }
+    }
+    FOR_ACTIVE(i, active_nodes, active_nodes.pos(prev_node)+1,
+               active_nodes.size) {
+      t_float tmp = D_(prev_node, i);
+#if HAVE_DIAGNOSTIC
+#pragma GCC diagnostic push
+#pragma GCC diagnostic ignored "-Wfloat-equal"
+#endif
+      if (d[i] > tmp)
+        d[i] = tmp;
+      else if (fc_isnan(tmp))
+        throw (nan_error());
+#if HAVE_DIAGNOSTIC
+#pragma GCC diagnostic pop
+#endif
+      if (d[i] < min) {
+        min = d[i];
+        idx2 = i;
+      }
+    }
+    Z2.append(prev_node, idx2, min);
+  }
+}
+
+/* Functions for the update of the dissimilarity array */
+
+// Compiler optimization hints
+#pragma GCC optimize("O3,unroll-loops")
+
+template <typename t_float>
+inline static void f_single( t_float * __restrict__ const b, const t_float a ) {
+  if (__builtin_expect(*b > a, false)) *b = a;
+}
+template <typename t_float>
+inline static void f_complete( t_float * __restrict__ const b, const t_float a ) {
+  if (__builtin_expect(*b < a, false)) *b = a;
+}
+template <typename t_float>
+inline static void f_average( t_float * __restrict__ const b, const t_float a, const t_float s, const t_float t) {
+  *b = s*a + t*(*b);
+  #ifndef FE_INVALID
+#if HAVE_DIAGNOSTIC
+#pragma GCC diagnostic push
+#pragma GCC diagnostic ignored "-Wfloat-equal"
+#endif
+  if (__builtin_expect(fc_isnan(*b), false)) {
+    throw(nan_error());
+  }
+#if HAVE_DIAGNOSTIC
+#pragma GCC diagnostic pop
+#endif
+  #endif
+}
+template <typename t_float>
+inline static void f_weighted( t_float * const b, const t_float a) {
+  *b = (a+*b)*.5;
+  #ifndef FE_INVALID
+#if HAVE_DIAGNOSTIC
+#pragma GCC diagnostic push
+#pragma GCC diagnostic ignored "-Wfloat-equal"
+#endif
+  if (fc_isnan(*b)) {
+    throw(nan_error());
+  }
+#if HAVE_DIAGNOSTIC
+#pragma GCC diagnostic pop
+#endif
+  #endif
+}
+template <typename t_float>
+inline static void f_ward( t_float * const b, const t_float a, const t_float c, const t_float s, const t_float t, const t_float v) {
+  *b = ( (v+s)*a - v*c + (v+t)*(*b) ) / (s+t+v);
+  //*b = a+(*b)-(t*a+s*(*b)+v*c)/(s+t+v);
+  #ifndef FE_INVALID
+#if HAVE_DIAGNOSTIC
+#pragma GCC diagnostic push
+#pragma GCC diagnostic ignored "-Wfloat-equal"
+#endif
+  if (fc_isnan(*b)) {
+    throw(nan_error());
+  }
+#if HAVE_DIAGNOSTIC
+#pragma GCC diagnostic pop
+#endif
+  #endif
+}
+template <typename t_float>
+inline static void f_centroid( t_float * const b, const t_float a, const t_float stc, const t_float s, const t_float t) {
+  *b = s*a - stc + t*(*b);
+  #ifndef FE_INVALID
+  if (fc_isnan(*b)) {
+    throw(nan_error());
+  }
+#if HAVE_DIAGNOSTIC
+#pragma GCC diagnostic pop
+#endif
+  #endif
+}
+template <typename t_float>
+inline static void f_median( t_float * const b, const t_float a, const t_float c_4) {
+  *b = (a+(*b))*.5 - c_4;
+  #ifndef FE_INVALID
+#if HAVE_DIAGNOSTIC
+#pragma GCC diagnostic push
+#pragma GCC diagnostic ignored "-Wfloat-equal"
+#endif
+  if (fc_isnan(*b)) {
+    throw(nan_error());
+  }
+#if HAVE_DIAGNOSTIC
+#pragma GCC diagnostic pop
+#endif
+  #endif
+}
+
+#ifdef _OPENMP
+/*
+  Nearest neighbor of the node idx2 among the active nodes, if it is closer
+  than the current candidate idx1 at distance min.
+
+  Ties are broken exactly as in the serial scan with strict comparisons in
+  ascending index order: the current candidate wins every tie, otherwise the
+  smallest index wins. Each thread scans a contiguous chunk in ascending
+  order, and the thread results are combined by (value, index).
+*/
+template <typename t_float>
+static void parallel_nn_search(const t_index N, const t_float * const D,
+                               const condensed_rows & D_rows,
+                               const active_index_array & active_nodes,
+                               const t_index idx2,
+                               t_float & min, t_index & idx1) {
+  t_float best = std::numeric_limits<t_float>::infinity();
+  t_index best_idx = N;
+#pragma omp parallel
+  {
+    t_float local = std::numeric_limits<t_float>::infinity();
+    t_index local_idx = N;
+#pragma omp for schedule(static) nowait
+    for (t_index k=0; k<active_nodes.size; ++k) {
+      const t_index i = active_nodes[k];
+      if (i<0 || i==idx2) continue;
+      const t_float d = (i<idx2) ? D_(i,idx2) : D_(idx2,i);
+      if (d < local) {
+        local = d;
+        local_idx = i;
+      }
+    }
+#if HAVE_DIAGNOSTIC
+#pragma GCC diagnostic push
+#pragma GCC diagnostic ignored "-Wfloat-equal"
+#endif
+#pragma omp critical
+    if (local < best || (local==best && local_idx < best_idx)) {
+      best = local;
+      best_idx = local_idx;
+    }
+#if HAVE_DIAGNOSTIC
+#pragma GCC diagnostic pop
+#endif
+  }
+  if (best < min) {
+    min = best;
+    idx1 = best_idx;
+  }
+}
+
+/*
+  Parallel Lance-Williams update after the nodes idx1 < idx2 have been merged
+  into idx2 and idx1 has been removed from active_nodes. This is the same
+  update as the three serial loops per method in NN_chain_core.
+
+  Exceptions must not leave an OpenMP region, and the floating point
+  exception flags are thread-local. NaN results are therefore collected from
+  all threads and reported afterwards.
+*/
+template <method_codes method, typename t_members, typename t_float>
+static void parallel_nn_chain_update(const t_index N, t_float * const D,
+                                     const condensed_rows & D_rows,
+                                     const t_members * const members,
+                                     const active_index_array & active_nodes,
+                                     const t_index idx1, const t_index idx2,
+                                     const t_float min,
+                                     const t_float size1,
+                                     const t_float size2) {
+  // The weights are only defined for average linkage. Do not divide by zero
+  // otherwise, since this would raise the FE_INVALID flag.
+  const t_float s = (method==METHOD_METR_AVERAGE) ? size1/(size1+size2) : 0;
+  const t_float t = (method==METHOD_METR_AVERAGE) ? size2/(size1+size2) : 0;
+  bool nan_found = false;
+#pragma omp parallel reduction(||:nan_found)
+  {
+#ifdef FE_INVALID
+    // Stale flags from earlier work in the thread pool must not count, but
+    // the calling thread keeps its own flags for the final check.
+    if (omp_get_thread_num()!=0) feclearexcept(FE_INVALID);
+#endif
+#pragma omp for schedule(static)
+    for (t_index k=0; k<active_nodes.size; ++k) {
+      const t_index i = active_nodes[k];
+      if (i<0 || i==idx2) continue;
+      t_float * const b = (i<idx2) ? &D_(i, idx2) : &D_(idx2, i);
+      const t_float a = (i<idx1) ? retire(D_(i, idx1)) : D_(idx1, i);
+      try {
+        switch (method) {
+        case METHOD_METR_SINGLE:
+          f_single(b, a);
+          break;
+        case METHOD_METR_COMPLETE:
+          f_complete(b, a);
+          break;
+        case METHOD_METR_AVERAGE:
+          f_average(b, a, s, t);
+          break;
+        case METHOD_METR_WEIGHTED:
+          f_weighted(b, a);
+          break;
+        case METHOD_METR_WARD:
+          f_ward(b, a, min, size1, size2, static_cast<t_float>(members[i]));
+          break;
+        default:
+          break;
+        }
+      }
+      catch (const nan_error &) {
+        nan_found = true;
+      }
+    }
+#ifdef FE_INVALID
+    if (fetestexcept(FE_INVALID)) nan_found = true;
+#endif
+  }
+  if (nan_found) throw(nan_error());
+}
+#endif
+
+template <method_codes method, typename t_members, typename t_float>
+static void NN_chain_core(const t_index N, t_float * const D, t_members * const members, cluster_result & Z2,
+                          const bool out_of_core = false,
+                          linkage_progress * const progress = NULL) {
+/*
+    N: integer
+    D: condensed distance matrix N*(N-1)/2
+    Z2: output data structure
+    out_of_core: D is memory-mapped from disk; issue read-ahead hints
+    progress: progress reports (optional)
+
+    This is the NN-chain algorithm, described on page 86 in the following book:
+
+    Fionn Murtagh, Multidimensional Clustering Algorithms,
+    Vienna, Würzburg: Physica-Verlag, 1985.
+*/
+
+  t_index i;
+
+  auto_array_ptr<t_index> NN_chain(N);
+  t_index NN_chain_tip = 0;
+
+  t_index idx1, idx2;
+
+  t_float size1 = 0, size2 = 0;
+  active_index_array active_nodes(N);
+  const condensed_rows D_rows(N);
+
+  t_float min;
+  // NaN values were ruled out at the start; row_argmin needs a flag anyway.
+  bool nan_found = false;
+
+  for (t_float const * DD=D; DD!=D+(static_cast<std::ptrdiff_t>(N)*(N-1)>>1);
+       ++DD) {
+#if HAVE_DIAGNOSTIC
+#pragma GCC diagnostic push
+#pragma GCC diagnostic ignored "-Wfloat-equal"
+#endif
+    if (fc_isnan(*DD)) {
+      throw(nan_error());
+    }
+#if HAVE_DIAGNOSTIC
+#pragma GCC diagnostic pop
+#endif
+  }
+
+  if (out_of_core) readahead(D, static_cast<std::ptrdiff_t>(N)*(N-1)/2*
+                             static_cast<std::ptrdiff_t>(sizeof(t_float)),
+                             READAHEAD_RANDOM);
+
+  #ifdef FE_INVALID
+  if (feclearexcept(FE_INVALID)) throw fenv_error();
+  #endif
+
+  for (t_index j=0; j<N-1; ++j) {
+    active_nodes.compact();
+#ifdef _OPENMP
+    // There are N-j active nodes in this step.
+    const bool parallel = use_parallel(N-j);
+#endif
+    if (NN_chain_tip <= 3) {
+      NN_chain[0] = idx1 = active_nodes.first();
+      NN_chain_tip = 1;
+
+      idx2 = active_nodes.succ(idx1, N);
+      min = D_(idx1,idx2);
+#ifdef _OPENMP
+      if (parallel)
+        parallel_nn_search(N, D, D_rows, active_nodes, idx1, min, idx2);
+      else
+#endif
+      if (!row_argmin(D, D_rows, N, idx1, idx2+1,
+                      active_nodes.size-active_nodes.pos(idx2)-1,
+                      min, idx2, nan_found))
+      FOR_ACTIVE(i, active_nodes, active_nodes.pos(idx2)+1, active_nodes.size) {
+        if (D_(idx1,i) < min) {
+          min = D_(idx1,i);
+          idx2 = i;
+        }
+      }
+    }  // a: idx1   b: idx2
+    else {
+      NN_chain_tip -= 3;
+      idx1 = NN_chain[NN_chain_tip-1];
+      idx2 = NN_chain[NN_chain_tip];
+      min = idx1<idx2 ? D_(idx1,idx2) : D_(idx2,idx1);
+    }  // a: idx1   b: idx2
+
+    do {
+      NN_chain[NN_chain_tip] = idx2;
+      if (out_of_core) D_ROW_READAHEAD(idx2, idx2+1);
+
+#ifdef _OPENMP
+      if (parallel) {
+        parallel_nn_search(N, D, D_rows, active_nodes, idx2, min, idx1);
+      }
+      else
+#endif
+      {
+        FOR_ACTIVE(i, active_nodes, 0, active_nodes.pos(idx2)) {
+          if (D_(i,idx2) < min) {
+            min = D_(i,idx2);
+            idx1 = i;
+          }
+        }
+        if (!row_argmin(D, D_rows, N, idx2, idx2+1,
+                        active_nodes.size-active_nodes.pos(idx2)-1,
+                        min, idx1, nan_found))
+        FOR_ACTIVE(i, active_nodes, active_nodes.pos(idx2)+1, active_nodes.size) {
+          if (D_(idx2,i) < min) {
+            min = D_(idx2,i);
+            idx1 = i;
+          }
+        }
+      }
+
+      idx2 = idx1;
+      idx1 = NN_chain[NN_chain_tip++];
+
+    } while (idx2 != NN_chain[NN_chain_tip-2]);
+
+    Z2.append(idx1, idx2, min);
+    if (progress) (*progress)(j+1, min);
+
+    if (idx1>idx2) {
+      t_index tmp = idx1;
+      idx1 = idx2;
+      idx2 = tmp;
+    }
+
+    if (method==METHOD_METR_AVERAGE ||
+        method==METHOD_METR_WARD) {
+      size1 = static_cast<t_float>(members[idx1]);
+      size2 = static_cast<t_float>(members[idx2]);
+      members[idx2] += members[idx1];
+    }
+
+    // Remove the smaller index from the valid indices (active_nodes).
+    active_nodes.remove(idx1);
+    // The update loops are split at these positions.
+    const t_index pos1 = active_nodes.pos(idx1);
+    const t_index pos2 = active_nodes.pos(idx2);
+    if (out_of_core) {
+      D_ROW_READAHEAD(idx1, idx1+1);
+      D_ROW_READAHEAD(idx2, idx2+1);
+    }
+
+#ifdef _OPENMP
+    if (parallel) {
+      parallel_nn_chain_update<method>(N, D, D_rows, members, active_nodes,
+                                       idx1, idx2, min, size1, size2);
+      continue;
+    }
+#endif
+
+    switch (method) {
+    case METHOD_METR_SINGLE:
+      /*
+      Single linkage.
+
+      Characteristic: new distances are never longer than the old distances.
+      */
+      // Update the distance matrix in the range [start, idx1).
+      FOR_ACTIVE(i, active_nodes, 0, pos1)
+        f_single(&D_(i, idx2), retire(D_(i, idx1)) );
+      // Update the distance matrix in the range (idx1, idx2).
+      FOR_ACTIVE(i, active_nodes, pos1+1, pos2)
+        f_single(&D_(i, idx2), D_(idx1, i) );
+      // Update the distance matrix in the range (idx2, N).
+      FOR_ACTIVE(i, active_nodes, pos2+1, active_nodes.size)
+        f_single(&D_(idx2, i), D_(idx1, i) );
+      break;
+
+    case METHOD_METR_COMPLETE:
+      /*
+      Complete linkage.
+
+      Characteristic: new distances are never shorter than the old distances.
+      */
+      // Update the distance matrix in the range [start, idx1).
+      FOR_ACTIVE(i, active_nodes, 0, pos1)
+        f_complete(&D_(i, idx2), retire(D_(i, idx1)) );
+      // Update the distance matrix in the range (idx1, idx2).
+      FOR_ACTIVE(i, active_nodes, pos1+1, pos2)
+        f_complete(&D_(i, idx2), D_(idx1, i) );
+      // Update the distance matrix in the range (idx2, N).
+      FOR_ACTIVE(i, active_nodes, pos2+1, active_nodes.size)
+        f_complete(&D_(idx2, i), D_(idx1, i) );
+      break;
+
+    case METHOD_METR_AVERAGE: {
+      /*
+      Average linkage.
+
+      Shorter and longer distances can occur.
+      */
+      // Update the distance matrix in the range [start, idx1).
+      t_float s = size1/(size1+size2);
+      t_float t = size2/(size1+size2);
+      FOR_ACTIVE(i, active_nodes, 0, pos1)
+        f_average(&D_(i, idx2), retire(D_(i, idx1)), s, t );
+      // Update the distance matrix in the range (idx1, idx2).
+      FOR_ACTIVE(i, active_nodes, pos1+1, pos2)
+        f_average(&D_(i, idx2), D_(idx1, i), s, t );
+      // Update the distance matrix in the range (idx2, N).
+      FOR_ACTIVE(i, active_nodes, pos2+1, active_nodes.size)
+        f_average(&D_(idx2, i), D_(idx1, i), s, t );
+      break;
+    }
+
+    case METHOD_METR_WEIGHTED:
+      /*
+      Weighted linkage.
+
+      Shorter and longer distances can occur.
+      */
+      // Update the distance matrix in the range [start, idx1).
+      FOR_ACTIVE(i, active_nodes, 0, pos1)
+        f_weighted(&D_(i, idx2), retire(D_(i, idx1)) );
+      // Update the distance matrix in the range (idx1, idx2).
+      FOR_ACTIVE(i, active_nodes, pos1+1, pos2)
+        f_weighted(&D_(i, idx2), D_(idx1, i) );
+      // Update the distance matrix in the range (idx2, N).
+      FOR_ACTIVE(i, active_nodes, pos2+1, active_nodes.size)
+        f_weighted(&D_(idx2, i), D_(idx1, i) );
+      break;
+
+    case METHOD_METR_WARD:
+      /*
+      Ward linkage.
+
+      Shorter and longer distances can occur, not smaller than min(d1,d2)
+      but maybe bigger than max(d1,d2).
+      */
+      // Update the distance matrix in the range [start, idx1).
+      //t_float v = static_cast<t_float>(members[i]);
+      FOR_ACTIVE(i, active_nodes, 0, pos1)
+        f_ward(&D_(i, idx2), retire(D_(i, idx1)), min,
+               size1, size2, static_cast<t_float>(members[i]) );
+      // Update the distance matrix in the range (idx1, idx2).
+      FOR_ACTIVE(i, active_nodes, pos1+1, pos2)
+        f_ward(&D_(i, idx2), D_(idx1, i), min,
+               size1, size2, static_cast<t_float>(members[i]) );
+      // Update the distance matrix in the range (idx2, N).
+      FOR_ACTIVE(i, active_nodes, pos2+1, active_nodes.size)
+        f_ward(&D_(idx2, i), D_(idx1, i), min,
+               size1, size2, static_cast<t_float>(members[i]) );
+      break;
+
+    default:
+      throw std::runtime_error(std::string("Invalid method."));
+    }
+  }
+  #ifdef FE_INVALID
+  if (fetestexcept(FE_INVALID)) throw fenv_error();
+  #endif
+}
+
+template <typename t_float>
+class binary_min_heap {
+  /*
+  Class for a binary min-heap. The data resides in an array A. The elements of
+  A are not changed but two lists I and R of indices are generated which point
+  to elements of A and backwards.
+
+  The heap tree structure is
+
+     H[2*i+1]     H[2*i+2]
+         \            /
+          \          /
+           ≤        ≤
+            \      /
+             \    /
+              H[i]
+
+  where the children must be less or equal than their parent. Thus, H[0]
+  contains the minimum. The lists I and R are made such that H[i] = A[I[i]]
+  and R[I[i]] = i.
+
+  This implementation is not designed to handle NaN values.
+  */
+private:
+  t_float * const A;
+  t_index size;
+  auto_array_ptr<t_index> I;
+  auto_array_ptr<t_index> R;
+
+  // no default constructor
+  binary_min_heap();
+  // noncopyable
+  binary_min_heap(binary_min_heap const &);
+  binary_min_heap & operator=(binary_min_heap const &);
+
+public:
+  binary_min_heap(t_float * const A_, const t_index size_)
+    : A(A_), size(size_), I(size), R(size)
+  { // Allocate memory and initialize the lists I and R to the identity. This
+    // does not make it a heap. Call heapify afterwards!
+    for (t_index i=0; i<size; ++i)
+      R[i] = I[i] = i;
+  }
+
+  binary_min_heap(t_float * const A_, const t_index size1, const t_index size2,
+                  const t_index start)
+    : A(A_), size(size1), I(size1), R(size2)
+  { // Allocate memory and initialize the lists I and R to the identity. This
+    // does not make it a heap. Call heapify afterwards!
+    for (t_index i=0; i<size; ++i) {
+      R[i+start] = i;
+      I[i] = i + start;
+    }
+  }
+
+  ~binary_min_heap() {}
+
+  void heapify() {
+    // Arrange the indices I and R so that H[i] := A[I[i]] satisfies the heap
+    // condition H[i] < H[2*i+1] and H[i] < H[2*i+2] for each i.
+    //
+    // Complexity: Θ(size)
+    // Reference: Cormen, Leiserson, Rivest, Stein, Introduction to Algorithms,
+    // 3rd ed., 2009, Section 6.3 “Building a heap”
+    t_index idx;
+    for (idx=(size>>1); idx>0; ) {
+      --idx;
+      update_geq_(idx);
+    }
+  }
+
+  inline t_index argmin() const {
+    // Return the minimal element.
+    return I[0];
+  }
+
+  void heap_pop() {
+    // Remove the minimal element from the heap.
+    --size;
+    I[0] = I[size];
+    R[I[0]] = 0;
+    update_geq_(0);
+  }
+
+  template <typename t_archive>
+  void transfer(t_archive & F, const t_index size_) {
+    // Write or read the heap order for a checkpoint (see checkpoint_file).
+    // size_ is the size which was passed to the constructor. The array A
+    // belongs to the state of the caller.
+    F.value(size);
+    F.array(static_cast<t_index *>(I), size_);
+    F.array(static_cast<t_index *>(R), size_);
+  }
+
+  void remove(t_index idx) {
+    // Remove an element from the heap.
+    --size;
+    R[I[size]] = R[idx];
+    I[R[idx]] = I[size];
+    if ( H(size)<=A[idx] ) {
+      update_leq_(R[idx]);
+    }
+    else {
+      update_geq_(R[idx]);
+    }
+  }
+
+  void replace ( const t_index idxold, const t_index idxnew,
+                 const t_float val) {
+    R[idxnew] = R[idxold];
+    I[R[idxnew]] = idxnew;
+    if (val<=A[idxold])
+      update_leq(idxnew, val);
+    else
+      update_geq(idxnew, val);
+  }
+
+  void update ( const t_index idx, const t_float val ) const {
+    // Update the element A[i] with val and re-arrange the indices to preserve
+    // the heap condition.
+    if (val<=A[idx])
+      update_leq(idx, val);
+    else
+      update_geq(idx, val);
+  }
+
+  void update_leq ( const t_index idx, const t_float val ) const {
+    // Use this when the new value is not more than the old value.
+    A[idx] = val;
+    update_leq_(R[idx]);
+  }
+
+  void update_geq ( const t_index idx, const t_float val ) const {
+    // Use this when the new value is not less than the old value.
+    A[idx] = val;
+    update_geq_(R[idx]);
+  }
+
+private:
+  void update_leq_ (t_index i) const {
+    t_index j;
+    for ( ; (i>0) && ( H(i)<H(j=(i-1)>>1) ); i=j)
+      heap_swap(i,j);
+  }
+
+  void update_geq_ (t_index i) const {
+    t_index j;
+    for ( ; (j=2*i+1)<size; i=j) {
+      if ( H(j)>=H(i) ) {
+        ++j;
+        if ( j>=size || H(j)>=H(i) ) break;
+      }
+      else if ( j+1<size && H(j+1)<H(j) ) ++j;
+      heap_swap(i, j);
+    }
+  }
+
+  void heap_swap(const t_index i, const t_index j) const {
+    // Swap two indices.
+    t_index tmp = I[i];
+    I[i] = I[j];
+    I[j] = tmp;
+    R[I[i]] = i;
+    R[I[j]] = j;
+  }
+
+  inline t_float H(const t_index i) const {
+    return A[I[i]];
+  }
+
+};
+
+/*
+  Checkpoints for generic_linkage
+
+  A long run of generic_linkage can save its state between two merging steps
+  and resume from there after the process was killed. The condensed matrix
+  is part of the state. It must be a shared memory mapping of a file in this
+  case, and it is not copied at a checkpoint. The other arrays take O(N)
+  space and are written to the file "state" in the checkpoint directory,
+  which is replaced atomically by renaming.
+
+  Instead of copying the matrix, every merging step first appends the matrix
+  entries which it is about to overwrite to the file "undo" and flushes it.
+  On resume, these entries are written back in reverse order, which rolls
+  the matrix back to the last checkpoint. The undo log starts with the step
+  of its checkpoint, so that a log which belongs to an older state file is
+  ignored. (The process may be killed between renaming the state file and
+  starting the new log.) A step whose log record is incomplete has not
+  changed the matrix yet.
+
+  The log and the matrix go through the page cache of the operating system,
+  so a killed process leaves a consistent set of files. At each checkpoint,
+  the matrix and the state file are also synced to disk.
+
+  The state file starts with the identification of the problem: the size of
+  the floating point type, N, the method, a code for the metric and a
+  checksum of the input data, which the caller computes. A state file for a
+  different problem is not resumed, and std::invalid_argument is thrown.
+*/
+static const char checkpoint_magic[8] = {'f', 'c', 'l', 'u', 's', 't', '0',
+                                         '2'};
+
+class checkpoint_file {
+  /*
+    Binary file for checkpoints. The same function transfer(F, ...) in a
+    class describes the layout of its state for writing and for reading.
+  */
+private:
+  std::FILE * f;
+  std::string name;
+  bool writing;
+
+  // noncopyable
+  checkpoint_file(checkpoint_file const &);
+  checkpoint_file & operator=(checkpoint_file const &);
+
+public:
+  checkpoint_file()
+    : f(NULL)
+    , writing(false)
+  {}
+
+  ~checkpoint_file() {
+    if (f) std::fclose(f);
+  }
+
+  // Open a file for writing or reading. The return value is false if a file
+  // for reading does not exist.
+  bool open(const std::string & name_, const bool writing_) {
+    close();
+    name = name_;
+    writing = writing_;
+    f = std::fopen(name.c_str(), writing ? "wb" : "rb");
+    if (!f && (writing || errno!=ENOENT)) fail();
+    return f!=NULL;
+  }
+
+  void close() {
+    if (f) {
+      std::FILE * const f_ = f;
+      f = NULL;
+      if (std::fclose(f_)) fail();
+    }
+  }
+
+  template <typename T>
+  bool try_array(T * const data, const t_index n) {
+    const std::size_t count = static_cast<std::size_t>(n);
+    return (writing ? std::fwrite(data, sizeof(T), count, f)
+                    : std::fread(data, sizeof(T), count, f)) == count;
+  }
+
+  template <typename T>
+  void array(T * const data, const t_index n) {
+    if (!try_array(data, n)) fail();
+  }
+
+  template <typename T>
+  void value(T & x) {
+    array(&x, 1);
+  }
+
+  // Hand the buffer to the operating system and, if sync is true, wait
+  // until it is on disk.
+  void flush(const bool sync) {
+    if (std::fflush(f)) fail();
+#if HAVE_FSYNC && defined(_WIN32)
+    if (sync && _commit(_fileno(f))) fail();
+#elif HAVE_FSYNC
+    if (sync && fsync(fileno(f))) fail();
+#else
+    (void)sync;
+#endif
+  }
+
+  void getpos(std::fpos_t & pos) {
+    if (std::fgetpos(f, &pos)) fail();
+  }
+
+  void setpos(const std::fpos_t & pos) {
+    if (std::fsetpos(f, &pos)) fail();
+  }
+
+  void fail() const {
+    throw std::runtime_error(std::string(writing ? "Cannot write" :
+                                         "Cannot read") +
+                             " the checkpoint file " + name + ".");
+  }
+};
+
+template <typename t_float>
+class linkage_checkpoint {
+  /*
+    Checkpoints of generic_linkage in a directory, every interval merging
+    steps. If the directory contains the state of an earlier run for the
+    same problem, resuming() is true, and generic_linkage continues from
+    there.
+  */
+private:
+  const std::string state_name;
+  const std::string undo_name;
+  const t_index interval;
+  const t_index N;
+  const t_index method;
+  const t_index metric;
+  unsigned long long checksum;
+  const condensed_rows D_rows;
+  t_index saved; // step of the last checkpoint, -1 before the first one
+  bool resume;
+  checkpoint_file state;
+  checkpoint_file undo;
+  std::vector<t_index> undo_index;
+  std::vector<t_float> undo_value;
+
+  // noncopyable
+  linkage_checkpoint(linkage_checkpoint const &);
+  linkage_checkpoint & operator=(linkage_checkpoint const &);
+
+  // The identification of the problem at the start of the state file
+  template <typename t_archive>
+  void header(t_archive & F, char * const magic, t_index * const id,
+              unsigned long long & sum) {
+    F.array(magic, 8);
+    F.array(id, 5);
+    F.value(sum);
+  }
+
+  void mismatch(const char * const what) const {
+    throw std::invalid_argument(std::string("The checkpoint ") + state_name +
+                                " belongs to a clustering of " + what + ".");
+  }
+
+  void start_log() {
+    char magic[8];
+    std::memcpy(magic, checkpoint_magic, 8);
+    undo.open(undo_name, true);
+    undo.array(magic, 8);
+    undo.value(saved);
+    undo.flush(false);
+  }
+
+public:
+  linkage_checkpoint(const char * const dir, const t_index interval_,
+                     const t_index N_, const unsigned char method_,
+                     const t_index metric_,
+                     const unsigned long long checksum_)
+    : state_name(std::string(dir) + "/state")
+    , undo_name(std::string(dir) + "/undo")
+    , interval(interval_>0 ? interval_ : 1)
+    , N(N_)
+    , method(method_)
+    , metric(metric_)
+    , checksum(checksum_)
+    , D_rows(N_)
+    , saved(-1)
+    , resume(false)
+  {
+    if (state.open(state_name, false)) {
+      char magic[8];
+      t_index id[5];
+      unsigned long long sum;
+      header(state, magic, id, sum);
+      if (std::memcmp(magic, checkpoint_magic, 8)) {
+        mismatch("an incompatible version");
+      }
+      if (id[0]!=static_cast<t_index>(sizeof(t_float))) {
+        mismatch("a different data type");
+      }
+      if (id[1]!=N || id[2]!=method || id[3]!=metric) {
+        mismatch("a different size, method or metric");
+      }
+      if (sum!=checksum) {
+        mismatch("different data");
+      }
+      saved = id[4];
+      resume = true;
+    }
+  }
+
+  bool resuming() const {
+    return resume;
+  }
+
+  // The step of the last checkpoint
+  t_index step() const {
+    return saved;
+  }
+
+  bool due(const t_index step) const {
+    return saved<0 || step-saved>=interval;
+  }
+
+  // Open a new state file and write the header. The caller writes the
+  // state and calls end_save().
+  checkpoint_file & begin_save(const t_index step) {
+    char magic[8];
+    std::memcpy(magic, checkpoint_magic, 8);
+    t_index id[5] = {static_cast<t_index>(sizeof(t_float)), N, method, metric,
+                     step};
+    state.open(state_name + ".tmp", true);
+    header(state, magic, id, checksum);
+    saved = step;
+    return state;
+  }
+
+  void end_save() {
+    state.flush(true);
+    state.close();
+    // Replace the old state in one step, so that an interruption leaves
+    // either the old or the new state. On Windows, std::rename does not
+    // replace an existing file.
+#ifdef _WIN32
+    const bool replaced =
+      MoveFileExA((state_name + ".tmp").c_str(), state_name.c_str(),
+                  MOVEFILE_REPLACE_EXISTING | MOVEFILE_WRITE_THROUGH) != 0;
+#else
+    const bool replaced =
+      std::rename((state_name + ".tmp").c_str(), state_name.c_str()) == 0;
+#endif
+    if (!replaced) {
+      throw std::runtime_error(std::string("Cannot write the checkpoint file ")
+                               + state_name + ".");
+    }
+    start_log();
+  }
+
+  // Roll the matrix back to the last checkpoint. The state file is then
+  // positioned at the state of generic_linkage; the caller reads it and
+  // calls end_restore().
+  checkpoint_file & begin_restore(t_float * const D) {
+    checkpoint_file log;
+    char magic[8];
+    t_index step;
+    if (log.open(undo_name, false) && log.try_array(magic, 8) &&
+        log.try_array(&step, 1) && !std::memcmp(magic, checkpoint_magic, 8) &&
+        step==saved) {
+      // Find the complete records. Each record has the header
+      // (c1, n1, c2, n2), followed by the indices and the old values of
+      // n1 entries in column c1 and n2 entries in row/column c2.
+      std::vector<std::fpos_t> records;
+      std::fpos_t pos;
+      t_index rec[4];
+      for (;;) {
+        log.getpos(pos);
+        if (!log.try_array(rec, 4)) break;
+        undo_index.resize(static_cast<std::size_t>(rec[1]+rec[3]));
+        undo_value.resize(undo_index.size());
+        if (!log.try_array(undo_index.data(), rec[1]+rec[3]) ||
+            !log.try_array(undo_value.data(), rec[1]+rec[3])) break;
+        records.push_back(pos);
+      }
+      // Write the old values back, last step first.
+      for (std::size_t k=records.size(); k>0; ) {
+        log.setpos(records[--k]);
+        log.array(rec, 4);
+        undo_index.resize(static_cast<std::size_t>(rec[1]+rec[3]));
+        undo_value.resize(undo_index.size());
+        log.array(undo_index.data(), rec[1]+rec[3]);
+        log.array(undo_value.data(), rec[1]+rec[3]);
+        for (t_index e=0; e<rec[1]+rec[3]; ++e) {
+          const t_index c = (e<rec[1]) ? rec[0] : rec[2];
+          const t_index j = undo_index[static_cast<std::size_t>(e)];
+          if (j<c) D_(j, c) = undo_value[static_cast<std::size_t>(e)];
+          else D_(c, j) = undo_value[static_cast<std::size_t>(e)];
+        }
+      }
+    }
+    return state;
+  }
+
+  void end_restore() {
+    state.close();
+    start_log();
+  }
+
+  // Record the entries which the merging step of idx1 into idx2 (idx1<idx2)
+  // overwrites, before the update: the column D(:idx1, idx1) which is
+  // retired and the row and column of idx2. idx1 must still be active.
+  void log(const t_float * const D, const active_index_array & active_nodes,
+           const t_index idx1, const t_index idx2) {
+    t_index j;
+    undo_index.clear();
+    undo_value.clear();
+    FOR_ACTIVE(j, active_nodes, 0, active_nodes.pos(idx1)) {
+      undo_index.push_back(j);
+      undo_value.push_back(D_(j, idx1));
+    }
+    t_index rec[4] = {idx1, static_cast<t_index>(undo_index.size()), idx2, 0};
+    FOR_ACTIVE(j, active_nodes, 0, active_nodes.size) {
+      if (j!=idx1 && j!=idx2) {
+        undo_index.push_back(j);
+        undo_value.push_back((j<idx2) ? D_(j, idx2) : D_(idx2, j));
+      }
+    }
+    rec[3] = static_cast<t_index>(undo_index.size())-rec[1];
+    undo.array(rec, 4);
+    undo.array(undo_index.data(), rec[1]+rec[3]);
+    undo.array(undo_value.data(), rec[1]+rec[3]);
+    undo.flush(false);
+  }
+};
+
+/*
+  The state of generic_linkage between two merging steps, for checkpoints.
+  The steps so far and the number of members per node are part of it.
+*/
+template <typename t_archive, typename t_float, typename t_members>
+static void generic_linkage_state(t_archive & F, const t_index N,
+                                  t_index * const n_nghbr,
+                                  t_float * const mindist,
+                                  t_index * const row_repr,
+                                  active_index_array & active_nodes,
+                                  binary_min_heap<t_float> & nn_distances,
+                                  t_members * const members,
+                                  cluster_result & Z2) {
+  F.array(n_nghbr, N-1);
+  F.array(mindist, N-1);
+  F.array(row_repr, N);
+  active_nodes.transfer(F, N);
+  nn_distances.transfer(F, N-1);
+  if (members) F.array(members, N);
+  Z2.transfer(F);
+}
+
+template <method_codes method, typename t_members, typename t_float>
+static void generic_linkage(const t_index N, t_float * const D, t_members * const members, cluster_result & Z2,
+                            const bool out_of_core = false,
+                            linkage_checkpoint<t_float> * const checkpoint = NULL,
+                            linkage_progress * const progress = NULL) {
+  /*
+    N: integer, number of data points
+    D: condensed distance matrix N*(N-1)/2
+    Z2: output data structure
+    out_of_core: D is memory-mapped from disk; issue read-ahead hints
+    checkpoint: save the state regularly, or resume from a saved state (see
+      linkage_checkpoint)
+    progress: progress reports (optional)
+  */
+
+  const t_index N_1 = N-1;
+  t_index i, j; // loop variables
+  t_index idx1, idx2; // row and column indices
+
+  auto_array_ptr<t_index> n_nghbr(N_1); // array of nearest neighbors
+  auto_array_ptr<t_float> mindist(N_1); // distances to the nearest neighbors
+  auto_array_ptr<t_index> row_repr(N); // row_repr[i]: node number that the
+                                       // i-th row represents
+  active_index_array active_nodes(N);
+  const condensed_rows D_rows(N);
+  binary_min_heap<t_float> nn_distances(&*mindist, N_1); // minimum heap
+      // structure for the distance to the nearest neighbor of each point
+  t_index node1, node2; // node numbers in the output
+  t_float size1, size2; // and their cardinalities
+
+  t_float min; // minimum for nearest-neighbor search
+  t_index i0 = 0; // first merging step
+
+  bool nan_found = false;
+  if (checkpoint && checkpoint->resuming()) {
+    // Continue from the last checkpoint.
+    checkpoint_file & F = checkpoint->begin_restore(D);
+    i0 = checkpoint->step();
+    generic_linkage_state(F, N, &*n_nghbr, &*mindist, &*row_repr, active_nodes,
+                          nn_distances, members, Z2);
+    checkpoint->end_restore();
+  }
+  else {
+    for (i=0; i<N; ++i)
+      // Build a list of row ↔ node label assignments.
+      // Initially i ↦ i
+      row_repr[i] = i;
+
+    // Initialize the minimal distances:
+    // Find the nearest neighbor of each point.
+    // n_nghbr[i] = argmin_{j>i} D(i,j) for i in range(N-1)
+    // The rows are independent and are distributed over the OpenMP threads.
+    // Exceptions must not leave a parallel region, so a NaN is only recorded
+    // here and raised afterwards.
+#ifdef _OPENMP
+#pragma omp parallel for schedule(dynamic, 16) reduction(||:nan_found)
+#endif
+    for (t_index ii=0; ii<N_1; ++ii) {
+      t_float min_val = std::numeric_limits<t_float>::infinity();
+      t_index min_idx = ii+1;
+      // All nodes are active.
+      if (!row_argmin(D, D_rows, N, ii, ii+1, N-ii-1, min_val, min_idx, nan_found))
+      for (t_index jj=ii+1; jj<N; ++jj) {
+        const t_float * const DD = &D_(ii, jj);
+#if HAVE_DIAGNOSTIC
+#pragma GCC diagnostic push
+#pragma GCC diagnostic ignored "-Wfloat-equal"
+#endif
+        if (*DD < min_val) {
+          min_val = *DD;
+          min_idx = jj;
+        }
+        else if (fc_isnan(*DD))
+          nan_found = true;
+#if HAVE_DIAGNOSTIC
+#pragma GCC diagnostic pop
+#endif
+      }
+      mindist[ii] = min_val;
+      n_nghbr[ii] = min_idx;
+    }
+    if (nan_found) throw(nan_error());
+
+    // Put the minimal distances into a heap structure to make the repeated
+    // global minimum searches fast.
+    nn_distances.heapify();
+  }
+  if (out_of_core) readahead(D, static_cast<std::ptrdiff_t>(N)*(N-1)/2*
+                             static_cast<std::ptrdiff_t>(sizeof(t_float)),
+                             READAHEAD_RANDOM);
+
+  #ifdef FE_INVALID
+  if (feclearexcept(FE_INVALID)) throw fenv_error();
+  #endif
+
+  // Main loop: We have N-1 merging steps.
+  for (i=i0; i<N_1; ++i) {
+    if (checkpoint && checkpoint->due(i)) {
+      if (out_of_core) {
+        sync_mapping(D, static_cast<std::ptrdiff_t>(N)*(N-1)/2*
+                     static_cast<std::ptrdiff_t>(sizeof(t_float)));
+      }
+      checkpoint_file & F = checkpoint->begin_save(i);
+      generic_linkage_state(F, N, &*n_nghbr, &*mindist, &*row_repr,
+                            active_nodes, nn_distances, members, Z2);
+      checkpoint->end_save();
+    }
+    /*
+      Here is a special feature that allows fast bookkeeping and updates of the
+      minimal distances.
+
+      mindist[i] stores a lower bound on the minimum distance of the point i to
+      all points of higher index:
+
+          mindist[i] ≥ min_{j>i} D(i,j)
+
+      Normally, we have equality. However, this minimum may become invalid due
+      to the updates in the distance matrix. The rules are:
+
+      1) If mindist[i] is equal to D(i, n_nghbr[i]), this is the correct
+         minimum and n_nghbr[i] is a nearest neighbor.
+
+      2) If mindist[i] is smaller than D(i, n_nghbr[i]), this might not be the
+         correct minimum. The minimum needs to be recomputed.
+
+      3) mindist[i] is never bigger than the true minimum. Hence, we never
+         miss the true minimum if we take the smallest mindist entry,
+         re-compute the value if necessary (thus maybe increasing it) and
+         looking for the now smallest mindist entry until a valid minimal
+         entry is found. This step is done in the lines below.
+
+      The update process for D below takes care that these rules are
+      fulfilled. This makes sure that the minima in the rows D(i,i+1:)of D are
+      re-calculated when necessary but re-calculation is avoided whenever
+      possible.
+
+      The re-calculation of the minima makes the worst-case runtime of this
+      algorithm cubic in N. We avoid this whenever possible, and in most cases
+      the runtime appears to be quadratic.
+    */
+    active_nodes.compact();
+    idx1 = nn_distances.argmin();
+    if (method != METHOD_METR_SINGLE) {
+      while ( mindist[idx1] < D_(idx1, n_nghbr[idx1]) ) {
+        // Recompute the minimum mindist[idx1] and n_nghbr[idx1].
+        n_nghbr[idx1] = j = active_nodes.succ(idx1, N); // exists, maximally N-1
+        if (out_of_core) D_ROW_READAHEAD(idx1, j);
+        min = D_(idx1,j);
+        if (!row_argmin(D, D_rows, N, idx1, j+1,
+                        active_nodes.size-active_nodes.pos(j)-1,
+                        min, n_nghbr[idx1], nan_found))
+        FOR_ACTIVE(j, active_nodes, active_nodes.pos(j)+1, active_nodes.size) {
+          if (D_(idx1,j)<min) {
+            min = D_(idx1,j);
+            n_nghbr[idx1] = j;
+          }
+        }
+        /* Update the heap with the new true minimum and search for the
+           (possibly different) minimal entry. */
+        nn_distances.update_geq(idx1, min);
+        idx1 = nn_distances.argmin();
+      }
+    }
+
+    nn_distances.heap_pop(); // Remove the current minimum from the heap.
+    idx2 = n_nghbr[idx1];
+    if (checkpoint) checkpoint->log(D, active_nodes, idx1, idx2);
+
+    // Write the newly found minimal pair of nodes to the output array.
+    node1 = row_repr[idx1];
+    node2 = row_repr[idx2];
+
+    if (method==METHOD_METR_AVERAGE ||
+        method==METHOD_METR_WARD ||
+        method==METHOD_METR_CENTROID) {
+      size1 = static_cast<t_float>(members[idx1]);
+      size2 = static_cast<t_float>(members[idx2]);
+      members[idx2] += members[idx1];
+    }
+    Z2.append(node1, node2, mindist[idx1]);
+    if (progress) (*progress)(i+1, mindist[idx1]);
+
+    // Remove idx1 from the list of active indices (active_nodes).
+    active_nodes.remove(idx1);
+    const t_index pos1 = active_nodes.pos(idx1);
+    const t_index pos2 = active_nodes.pos(idx2);
+    // Index idx2 now represents the new (merged) node with label N+i.
+    row_repr[idx2] = N+i;
+    if (out_of_core) {
+      D_ROW_READAHEAD(idx1, idx1+1);
+      D_ROW_READAHEAD(idx2, idx2+1);
+    }
+
+    // Update the distance matrix
+    switch (method) {
+    case METHOD_METR_SINGLE:
+      /*
+        Single linkage.
+
+        Characteristic: new distances are never longer than the old distances.
+      */
+      // Update the distance matrix in the range [start, idx1).
+      FOR_ACTIVE(j, active_nodes, 0, pos1) {
+        f_single(&D_(j, idx2), retire(D_(j, idx1)));
+        if (n_nghbr[j] == idx1)
+          n_nghbr[j] = idx2;
+      }
+      
+      // Update the distance matrix in the range (idx1, idx2).
+      FOR_ACTIVE(j, active_nodes, pos1+1, pos2) {
+        f_single(&D_(j, idx2), D_(idx1, j));
+        // If the new value is below the old minimum in a row, update
+        // the mindist and n_nghbr arrays.
+        if (D_(j, idx2) < mindist[j]) {
+          nn_distances.update_leq(j, D_(j, idx2));
+          n_nghbr[j] = idx2;
+        }
+      }
+      
+      // Update the distance matrix in the range (idx2, N).
+      // Recompute the minimum mindist[idx2] and n_nghbr[idx2].
+      if (idx2<N_1) {
+        min = mindist[idx2];
+        FOR_ACTIVE(j, active_nodes, pos2+1, active_nodes.size) {
+          f_single(&D_(idx2, j), D_(idx1, j) );
+          if (D_(idx2, j) < min) {
+            n_nghbr[idx2] = j;
+            min = D_(idx2, j);
+          }
+        }
+        nn_distances.update_leq(idx2, min);
+      }
+      break;
+
+    case METHOD_METR_COMPLETE:
+      /*
+        Complete linkage.
+
+        Characteristic: new distances are never shorter than the old distances.
+      */
+      // Update the distance matrix in the range [start, idx1).
+      FOR_ACTIVE(j, active_nodes, 0, pos1) {
+        f_complete(&D_(j, idx2), retire(D_(j, idx1)) );
+        if (n_nghbr[j] == idx1)
+          n_nghbr[j] = idx2;
+      }
+      // Update the distance matrix in the range (idx1, idx2).
+      FOR_ACTIVE(j, active_nodes, pos1+1, pos2)
+        f_complete(&D_(j, idx2), D_(idx1, j) );
+      // Update the distance matrix in the range (idx2, N).
+      FOR_ACTIVE(j, active_nodes, pos2+1, active_nodes.size)
+        f_complete(&D_(idx2, j), D_(idx1, j) );
+      break;
+
+    case METHOD_METR_AVERAGE: {
+      /*
+        Average linkage.
+
+        Shorter and longer distances can occur.
+      */
+      // Update the distance matrix in the range [start, idx1).
+      t_float s = size1/(size1+size2);
+      t_float t = size2/(size1+size2);
+      FOR_ACTIVE(j, active_nodes, 0, pos1) {
+        f_average(&D_(j, idx2), retire(D_(j, idx1)), s, t);
+        if (n_nghbr[j] == idx1)
+          n_nghbr[j] = idx2;
+      }
+      // Update the distance matrix in the range (idx1, idx2).
+      FOR_ACTIVE(j, active_nodes, pos1+1, pos2) {
+        f_average(&D_(j, idx2), D_(idx1, j), s, t);
+        if (D_(j, idx2) < mindist[j]) {
+          nn_distances.update_leq(j, D_(j, idx2));
+          n_nghbr[j] = idx2;
+        }
+      }
+      // Update the distance matrix in the range (idx2, N).
+      if (idx2<N_1) {
+        n_nghbr[idx2] = j = active_nodes.succ(idx2, N); // exists, maximally N-1
+        f_average(&D_(idx2, j), D_(idx1, j), s, t);
+        min = D_(idx2,j);
+        FOR_ACTIVE(j, active_nodes, active_nodes.pos(j)+1, active_nodes.size) {
+          f_average(&D_(idx2, j), D_(idx1, j), s, t);
+          if (D_(idx2,j) < min) {
+            min = D_(idx2,j);
+            n_nghbr[idx2] = j;
+          }
+        }
+        nn_distances.update(idx2, min);
+      }
+      break;
+    }
+
+    case METHOD_METR_WEIGHTED:
+      /*
+        Weighted linkage.
+
+        Shorter and longer distances can occur.
+      */
+      // Update the distance matrix in the range [start, idx1).
+      FOR_ACTIVE(j, active_nodes, 0, pos1) {
+        f_weighted(&D_(j, idx2), retire(D_(j, idx1)) );
+        if (n_nghbr[j] == idx1)
+          n_nghbr[j] = idx2;
+      }
+      // Update the distance matrix in the range (idx1, idx2).
+      FOR_ACTIVE(j, active_nodes, pos1+1, pos2) {
+        f_weighted(&D_(j, idx2), D_(idx1, j) );
+        if (D_(j, idx2) < mindist[j]) {
+          nn_distances.update_leq(j, D_(j, idx2));
+          n_nghbr[j] = idx2;
+        }
+      }
+      // Update the distance matrix in the range (idx2, N).
+      if (idx2<N_1) {
+        n_nghbr[idx2] = j = active_nodes.succ(idx2, N); // exists, maximally N-1
+        f_weighted(&D_(idx2, j), D_(idx1, j) );
+        min = D_(idx2,j);
+        FOR_ACTIVE(j, active_nodes, active_nodes.pos(j)+1, active_nodes.size) {
+          f_weighted(&D_(idx2, j), D_(idx1, j) );
+          if (D_(idx2,j) < min) {
+            min = D_(idx2,j);
+            n_nghbr[idx2] = j;
+          }
+        }
+        nn_distances.update(idx2, min);
+      }
+      break;
+
+    case METHOD_METR_WARD:
+      /*
+        Ward linkage.
+
+        Shorter and longer distances can occur, not smaller than min(d1,d2)
+        but maybe bigger than max(d1,d2).
+      */
+      // Update the distance matrix in the range [start, idx1).
+      FOR_ACTIVE(j, active_nodes, 0, pos1) {
+        f_ward(&D_(j, idx2), retire(D_(j, idx1)), mindist[idx1],
+               size1, size2, static_cast<t_float>(members[j]) );
+        if (n_nghbr[j] == idx1)
+          n_nghbr[j] = idx2;
+      }
+      // Update the distance matrix in the range (idx1, idx2).
+      FOR_ACTIVE(j, active_nodes, pos1+1, pos2) {
+        f_ward(&D_(j, idx2), D_(idx1, j), mindist[idx1], size1, size2,
+               static_cast<t_float>(members[j]) );
+        if (D_(j, idx2) < mindist[j]) {
+          nn_distances.update_leq(j, D_(j, idx2));
+          n_nghbr[j] = idx2;
+        }
+      }
+      // Update the distance matrix in the range (idx2, N).
+      if (idx2<N_1) {
+        n_nghbr[idx2] = j = active_nodes.succ(idx2, N); // exists, maximally N-1
+        f_ward(&D_(idx2, j), D_(idx1, j), mindist[idx1],
+               size1, size2, static_cast<t_float>(members[j]) );
+        min = D_(idx2,j);
+        FOR_ACTIVE(j, active_nodes, active_nodes.pos(j)+1, active_nodes.size) {
+          f_ward(&D_(idx2, j), D_(idx1, j), mindist[idx1],
+                 size1, size2, static_cast<t_float>(members[j]) );
+          if (D_(idx2,j) < min) {
+            min = D_(idx2,j);
+            n_nghbr[idx2] = j;
+          }
+        }
+        nn_distances.update(idx2, min);
+      }
+      break;
+
+    case METHOD_METR_CENTROID: {
+      /*
+        Centroid linkage.
+
+        Shorter and longer distances can occur, not bigger than max(d1,d2)
+        but maybe smaller than min(d1,d2).
+      */
+      // Update the distance matrix in the range [start, idx1).
+      t_float s = size1/(size1+size2);
+      t_float t = size2/(size1+size2);
+      t_float stc = s*t*mindist[idx1];
+      FOR_ACTIVE(j, active_nodes, 0, pos1) {
+        f_centroid(&D_(j, idx2), retire(D_(j, idx1)), stc, s, t);
+        if (D_(j, idx2) < mindist[j]) {
+          nn_distances.update_leq(j, D_(j, idx2));
+          n_nghbr[j] = idx2;
+        }
+        else if (n_nghbr[j] == idx1)
+          n_nghbr[j] = idx2;
+      }
+      // Update the distance matrix in the range (idx1, idx2).
+      FOR_ACTIVE(j, active_nodes, pos1+1, pos2) {
+        f_centroid(&D_(j, idx2), D_(idx1, j), stc, s, t);
+        if (D_(j, idx2) < mindist[j]) {
+          nn_distances.update_leq(j, D_(j, idx2));
+          n_nghbr[j] = idx2;
+        }
+      }
+      // Update the distance matrix in the range (idx2, N).
+      if (idx2<N_1) {
+        n_nghbr[idx2] = j = active_nodes.succ(idx2, N); // exists, maximally N-1
+        f_centroid(&D_(idx2, j), D_(idx1, j), stc, s, t);
+        min = D_(idx2,j);
+        FOR_ACTIVE(j, active_nodes, active_nodes.pos(j)+1, active_nodes.size) {
+          f_centroid(&D_(idx2, j), D_(idx1, j), stc, s, t);
+          if (D_(idx2,j) < min) {
+            min = D_(idx2,j);
+            n_nghbr[idx2] = j;
+          }
+        }
+        nn_distances.update(idx2, min);
+      }
+      break;
+    }
+
+    case METHOD_METR_MEDIAN: {
+      /*
+        Median linkage.
+
+        Shorter and longer distances can occur, not bigger than max(d1,d2)
+        but maybe smaller than min(d1,d2).
+      */
+      // Update the distance matrix in the range [start, idx1).
+      t_float c_4 = mindist[idx1]*.25;
+      FOR_ACTIVE(j, active_nodes, 0, pos1) {
+        f_median(&D_(j, idx2), retire(D_(j, idx1)), c_4 );
+        if (D_(j, idx2) < mindist[j]) {
+          nn_distances.update_leq(j, D_(j, idx2));
+          n_nghbr[j] = idx2;
+        }
+        else if (n_nghbr[j] == idx1)
+          n_nghbr[j] = idx2;
+      }
+      // Update the distance matrix in the range (idx1, idx2).
+      FOR_ACTIVE(j, active_nodes, pos1+1, pos2) {
+        f_median(&D_(j, idx2), D_(idx1, j), c_4 );
+        if (D_(j, idx2) < mindist[j]) {
+          nn_distances.update_leq(j, D_(j, idx2));
+          n_nghbr[j] = idx2;
+        }
+      }
+      // Update the distance matrix in the range (idx2, N).
+      if (idx2<N_1) {
+        n_nghbr[idx2] = j = active_nodes.succ(idx2, N); // exists, maximally N-1
+        f_median(&D_(idx2, j), D_(idx1, j), c_4 );
+        min = D_(idx2,j);
+        FOR_ACTIVE(j, active_nodes, active_nodes.pos(j)+1, active_nodes.size) {
+          f_median(&D_(idx2, j), D_(idx1, j), c_4 );
+          if (D_(idx2,j) < min) {
+            min = D_(idx2,j);
+            n_nghbr[idx2] = j;
+          }
+        }
+        nn_distances.update(idx2, min);
+      }
+      break;
+    }
+
+    default:
+      throw std::runtime_error(std::string("Invalid method."));
+    }
+  }
+  #ifdef FE_INVALID
+  if (fetestexcept(FE_INVALID)) throw fenv_error();
+  #endif
+}
+
+/*
+  Clustering methods for vector data
+*/
+
+template <typename t_dissimilarity>
+static void MST_linkage_core_vector(const t_index N,
+                                    t_dissimilarity & dist,
+                                    cluster_result & Z2,
+                                    const bool threads = true,
+                                    linkage_progress * const progress = NULL) {
+/*
+    N: integer, number of data points
+    dist: function pointer to the metric
+    Z2: output data structure
+    threads: the metric may be evaluated from several threads at once
+    progress: progress reports (optional)
+
+    The basis of this algorithm is an algorithm by Rohlf:
+
+    F. James Rohlf, Hierarchical clustering using the minimum spanning tree,
+    The Computer Journal, vol. 16, 1973, p. 93–95.
+*/
+  typedef typename t_dissimilarity::float_type t_float;
+  t_index i;
+  t_index idx2;
+  active_index_array active_nodes(N);
+  auto_array_ptr<t_float> d(N);
+
+  t_index prev_node;
+  t_float min;
+
+  // first iteration
+  idx2 = 1;
+  min = std::numeric_limits<t_float>::infinity();
+  for (i=1; i<N; ++i) {
+    d[i] = dist(0,i);
 #if HAVE_DIAGNOSTIC
 #pragma GCC diagnostic push
 #pragma GCC diagnostic ignored "-Wfloat-equal"
 #endif
-  if (fc_isnan(*b)) {
-    throw(nan_error());
-  }
+    if (d[i] < min) {
+      min = d[i];
+      idx2 = i;
+    }
+    else if (fc_isnan(d[i]))
+      throw (nan_error());
 #if HAVE_DIAGNOSTIC
 #pragma GCC diagnostic pop
 #endif
-  #endif
-}
-inline static void f_centroid( t_float * const b, const t_float a, const t_float stc, const t_float s, const t_float t) {
-  *b = s*a - stc + t*(*b);
-  #ifndef FE_INVALID
-  if (fc_isnan(*b)) {
-    throw(nan_error());
   }
+
+  Z2.append(0, idx2, min);
+  active_nodes.remove(0);
+  // The nodes in the tree have d = infinity, so that the argmin below can
+  // run over the whole array d.
+  d[0] = std::numeric_limits<t_float>::infinity();
+
+  for (t_index j=1; j<N-1; ++j) {
+    if (progress) (*progress)(j, min);
+    prev_node = idx2;
+    active_nodes.compact();
+    active_nodes.remove(prev_node);
+    d[prev_node] = std::numeric_limits<t_float>::infinity();
+
+#ifdef _OPENMP
+    // There are N-1-j active nodes in this step.
+    if (threads && use_parallel(N-1-j)) {
+      idx2 = parallel_prim_step(active_nodes, &*d,
+                                [&](const t_index i) -> t_float {
+                                  return dist(i, prev_node);
+                                },
+                                min);
+      Z2.append(prev_node, idx2, min);
+      continue;
+    }
+#else
+    (void)threads;
+#endif
+
+    FOR_ACTIVE(i, active_nodes, 0, active_nodes.size) {
+      t_float tmp = dist(i, prev_node);
+#if HAVE_DIAGNOSTIC
+#pragma GCC diagnostic push
+#pragma GCC diagnostic ignored "-Wfloat-equal"
+#endif
+      if (d[i] > tmp)
+        d[i] = tmp;
+      else if (fc_isnan(tmp))
+        throw (nan_error());
 #if HAVE_DIAGNOSTIC
 #pragma GCC diagnostic pop
 #endif
-  #endif
+    }
+    // The first active node with the smallest distance, or the first active
+    // node if all distances are infinite, as in parallel_prim_step.
+    min = std::numeric_limits<t_float>::infinity();
+    bool nan_found = false;
+    idx2 = simd_utils::simd_argmin(&*d, N, min, nan_found);
+    if (idx2<0) {
+      idx2 = active_nodes.first();
+      min = d[idx2];
+    }
+    Z2.append(prev_node, idx2, min);
+  }
 }
-inline static void f_median( t_float * const b, const t_float a, const t_float c_4) {
-  *b = (a+(*b))*.5 - c_4;
-  #ifndef FE_INVALID
+
+/*
+  One step of Prim's algorithm for the squared Euclidean metric, on the
+  active nodes at the positions [k0, k1) of active_nodes. See
+  MST_linkage_core_sqeuclidean.
+*/
+template <typename t_float>
+static void prim_sqeuclidean_step(const t_float * const X, const t_index dim,
+                                  const t_float * const norm,
+                                  const bool prune,
+                                  const active_index_array & active_nodes,
+                                  const t_index k0, const t_index k1,
+                                  const t_index prev_node,
+                                  t_float * const d,
+                                  t_float & min, t_index & idx2,
+                                  bool & nan_found) {
+  // Bound on the rounding errors of the approximate distances and of the
+  // exact distance, relative to the sum of the squared norms, plus an
+  // absolute term for underflow. Generous, since it only decides when the
+  // exact distance is computed.
+  const t_float tol = static_cast<t_float>(4*dim+16) *
+    std::numeric_limits<t_float>::epsilon();
+  const t_float tiny = tol*std::numeric_limits<t_float>::min();
+  const t_float * const P = X+static_cast<std::ptrdiff_t>(prev_node)*dim;
+  t_index block[4];
+  t_float dot[4];
+  t_index m = 0;
+  t_index k = k0;
+  while (k<k1) {
+    // Collect up to four active nodes in ascending order.
+    for (; k<k1 && m<4; ++k) {
+      if (active_nodes[k]>=0) block[m++] = active_nodes[k];
+    }
+    if (m==0) break;
+    if (prune) {
+      // Pad an incomplete block at the end of the range with its first node.
+      for (t_index l=m; l<4; ++l) block[l] = block[0];
+      simd_utils::simd_dot4(P, X+static_cast<std::ptrdiff_t>(block[0])*dim,
+                            X+static_cast<std::ptrdiff_t>(block[1])*dim,
+                            X+static_cast<std::ptrdiff_t>(block[2])*dim,
+                            X+static_cast<std::ptrdiff_t>(block[3])*dim,
+                            dim, dot);
+    }
+    for (t_index l=0; l<m; ++l) {
+      const t_index i = block[l];
+      const t_float s = norm[i] + norm[prev_node];
 #if HAVE_DIAGNOSTIC
 #pragma GCC diagnostic push
 #pragma GCC diagnostic ignored "-Wfloat-equal"
 #endif
-  if (fc_isnan(*b)) {
-    throw(nan_error());
-  }
+      // Compute the exact distance only if it might be smaller than d[i].
+      if (!prune || s - 2*dot[l] - tol*s - tiny < d[i]) {
+        const t_float tmp = simd_utils::simd_sqeuclidean(
+            X+static_cast<std::ptrdiff_t>(i)*dim, P, dim);
+        if (d[i] > tmp)
+          d[i] = tmp;
+        else if (fc_isnan(tmp))
+          nan_found = true;
+      }
+      if (d[i] < min) {
+        min = d[i];
+        idx2 = i;
+      }
 #if HAVE_DIAGNOSTIC
 #pragma GCC diagnostic pop
 #endif
-  #endif
+    }
+    m = 0;
+  }
 }
 
-template <method_codes method, typename t_members>
-static void NN_chain_core(const t_index N, t_float * const D, t_members * const members, cluster_result & Z2) {
+template <typename t_float>
+static void MST_linkage_core_sqeuclidean(const t_index N,
+                                         const t_float * const X,
+                                         const t_index dim,
+                                         cluster_result & Z2,
+                                         linkage_progress * const progress
+                                         = NULL) {
 /*
-    N: integer
-    D: condensed distance matrix N*(N-1)/2
+    N: integer, number of data points
+    X: (N×dim) array of points
     Z2: output data structure
+    progress: progress reports (optional)
 
-    This is the NN-chain algorithm, described on page 86 in the following book:
+    The same algorithm as MST_linkage_core_vector for the squared Euclidean
+    metric, with the same output.
 
-    Fionn Murtagh, Multidimensional Clustering Algorithms,
-    Vienna, Würzburg: Physica-Verlag, 1985.
+    Most distances in a step of Prim's algorithm do not shorten the distance
+    of a node to the tree. They are first estimated with the norm expansion
+
+      |x_i-x_p|^2 = |x_i|^2 + |x_p|^2 - 2 <x_i, x_p>,
+
+    where the squared norms are computed once and the dot products with the
+    new node p are evaluated for blocks of four nodes at a time. The exact
+    distance is only computed if the estimate, minus a bound on its rounding
+    error, is smaller than the current distance d[i]. The dendrogram is
+    therefore exactly the same as with the direct computation of all
+    distances. If a norm is not finite, this bound is useless, and all
+    distances are computed directly.
 */
   t_index i;
+  t_index idx2;
+  active_index_array active_nodes(N);
+  auto_array_ptr<t_float> d(N);
+  auto_array_ptr<t_float> norm(N);
 
-  auto_array_ptr<t_index> NN_chain(N);
-  t_index NN_chain_tip = 0;
+  t_index prev_node;
+  t_float min;
 
-  t_index idx1, idx2;
+  bool prune = true;
+  for (i=0; i<N; ++i) {
+    const t_float * const Xi = X+static_cast<std::ptrdiff_t>(i)*dim;
+    t_float sum = 0;
+    for (t_index k=0; k<dim; ++k) {
+      sum += Xi[k]*Xi[k];
+    }
+    norm[i] = sum;
+    // Also false for NaN
+    if (!(sum <= std::numeric_limits<t_float>::max())) prune = false;
+  }
 
-  t_float size1, size2;
-  doubly_linked_list active_nodes(N);
+  for (i=0; i<N; ++i) {
+    d[i] = std::numeric_limits<t_float>::infinity();
+  }
+  idx2 = 0;
 
-  t_float min;
+  for (t_index j=0; j<N-1; ++j) {
+    prev_node = idx2;
+    active_nodes.compact();
+    active_nodes.remove(prev_node);
 
-  for (t_float const * DD=D; DD!=D+(static_cast<std::ptrdiff_t>(N)*(N-1)>>1);
-       ++DD) {
+    idx2 = -1;
+    min = std::numeric_limits<t_float>::infinity();
+    bool nan_found = false;
+#ifdef _OPENMP
+    // There are N-1-j active nodes in this step.
+    if (use_parallel(N-1-j)) {
+      // The threads scan contiguous chunks in ascending order, and their
+      // results are combined by (value, index) as in parallel_prim_step.
+#pragma omp parallel reduction(||:nan_found)
+      {
+        const t_index nt = omp_get_num_threads();
+        const t_index t = omp_get_thread_num();
+        const t_index size = active_nodes.size;
+        t_float local = std::numeric_limits<t_float>::infinity();
+        t_index local_idx = -1;
+        prim_sqeuclidean_step(X, dim, &*norm, prune, active_nodes,
+                              size*t/nt, size*(t+1)/nt, prev_node, &*d,
+                              local, local_idx, nan_found);
 #if HAVE_DIAGNOSTIC
 #pragma GCC diagnostic push
 #pragma GCC diagnostic ignored "-Wfloat-equal"
 #endif
-    if (fc_isnan(*DD)) {
-      throw(nan_error());
-    }
+#pragma omp critical
+        if (local_idx>=0 &&
+            (idx2<0 || local < min || (local==min && local_idx < idx2))) {
+          min = local;
+          idx2 = local_idx;
+        }
 #if HAVE_DIAGNOSTIC
 #pragma GCC diagnostic pop
 #endif
-  }
-
-  #ifdef FE_INVALID
-  if (feclearexcept(FE_INVALID)) throw fenv_error();
-  #endif
-
-  for (t_index j=0; j<N-1; ++j) {
-    if (NN_chain_tip <= 3) {
-      NN_chain[0] = idx1 = active_nodes.start;
-      NN_chain_tip = 1;
-
-      idx2 = active_nodes.succ[idx1];
-      min = D_(idx1,idx2);
-      for (i=active_nodes.succ[idx2]; i<N; i=active_nodes.succ[i]) {
-        if (D_(idx1,i) < min) {
-          min = D_(idx1,i);
-          idx2 = i;
-        }
-      }
-    }  // a: idx1   b: idx2
-    else {
-      NN_chain_tip -= 3;
-      idx1 = NN_chain[NN_chain_tip-1];
-      idx2 = NN_chain[NN_chain_tip];
-      min = idx1<idx2 ? D_(idx1,idx2) : D_(idx2,idx1);
-    }  // a: idx1   b: idx2
-
-    do {
-      NN_chain[NN_chain_tip] = idx2;
-
-      for (i=active_nodes.start; i<idx2; i=active_nodes.succ[i]) {
-        if (D_(i,idx2) < min) {
-          min = D_(i,idx2);
-          idx1 = i;
-        }
-      }
-      for (i=active_nodes.succ[idx2]; i<N; i=active_nodes.succ[i]) {
-        if (D_(idx2,i) < min) {
-          min = D_(idx2,i);
-          idx1 = i;
-        }
       }
-
-      idx2 = idx1;
-      idx1 = NN_chain[NN_chain_tip++];
-
-    } while (idx2 != NN_chain[NN_chain_tip-2]);
-
-    Z2.append(idx1, idx2, min);
-
-    if (idx1>idx2) {
-      t_index tmp = idx1;
-      idx1 = idx2;
-      idx2 = tmp;
-    }
-
-    if (method==METHOD_METR_AVERAGE ||
-        method==METHOD_METR_WARD) {
-      size1 = static_cast<t_float>(members[idx1]);
-      size2 = static_cast<t_float>(members[idx2]);
-      members[idx2] += members[idx1];
-    }
-
-    // Remove the smaller index from the valid indices (active_nodes).
-    active_nodes.remove(idx1);
-
-    switch (method) {
-    case METHOD_METR_SINGLE:
-      /*
-      Single linkage.
-
-      Characteristic: new distances are never longer than the old distances.
-      */
-      // Update the distance matrix in the range [start, idx1).
-      for (i=active_nodes.start; i<idx1; i=active_nodes.succ[i])
-        f_single(&D_(i, idx2), D_(i, idx1) );
-      // Update the distance matrix in the range (idx1, idx2).
-      for (; i<idx2; i=active_nodes.succ[i])
-        f_single(&D_(i, idx2), D_(idx1, i) );
-      // Update the distance matrix in the range (idx2, N).
-      for (i=active_nodes.succ[idx2]; i<N; i=active_nodes.succ[i])
-        f_single(&D_(idx2, i), D_(idx1, i) );
-      break;
-
-    case METHOD_METR_COMPLETE:
-      /*
-      Complete linkage.
-
-      Characteristic: new distances are never shorter than the old distances.
-      */
-      // Update the distance matrix in the range [start, idx1).
-      for (i=active_nodes.start; i<idx1; i=active_nodes.succ[i])
-        f_complete(&D_(i, idx2), D_(i, idx1) );
-      // Update the distance matrix in the range (idx1, idx2).
-      for (; i<idx2; i=active_nodes.succ[i])
-        f_complete(&D_(i, idx2), D_(idx1, i) );
-      // Update the distance matrix in the range (idx2, N).
-      for (i=active_nodes.succ[idx2]; i<N; i=active_nodes.succ[i])
-        f_complete(&D_(idx2, i), D_(idx1, i) );
-      break;
-
-    case METHOD_METR_AVERAGE: {
-      /*
-      Average linkage.
-
-      Shorter and longer distances can occur.
-      */
-      // Update the distance matrix in the range [start, idx1).
-      t_float s = size1/(size1+size2);
-      t_float t = size2/(size1+size2);
-      for (i=active_nodes.start; i<idx1; i=active_nodes.succ[i])
-        f_average(&D_(i, idx2), D_(i, idx1), s, t );
-      // Update the distance matrix in the range (idx1, idx2).
-      for (; i<idx2; i=active_nodes.succ[i])
-        f_average(&D_(i, idx2), D_(idx1, i), s, t );
-      // Update the distance matrix in the range (idx2, N).
-      for (i=active_nodes.succ[idx2]; i<N; i=active_nodes.succ[i])
-        f_average(&D_(idx2, i), D_(idx1, i), s, t );
-      break;
     }
-
-    case METHOD_METR_WEIGHTED:
-      /*
-      Weighted linkage.
-
-      Shorter and longer distances can occur.
-      */
-      // Update the distance matrix in the range [start, idx1).
-      for (i=active_nodes.start; i<idx1; i=active_nodes.succ[i])
-        f_weighted(&D_(i, idx2), D_(i, idx1) );
-      // Update the distance matrix in the range (idx1, idx2).
-      for (; i<idx2; i=active_nodes.succ[i])
-        f_weighted(&D_(i, idx2), D_(idx1, i) );
-      // Update the distance matrix in the range (idx2, N).
-      for (i=active_nodes.succ[idx2]; i<N; i=active_nodes.succ[i])
-        f_weighted(&D_(idx2, i), D_(idx1, i) );
-      break;
-
-    case METHOD_METR_WARD:
-      /*
-      Ward linkage.
-
-      Shorter and longer distances can occur, not smaller than min(d1,d2)
-      but maybe bigger than max(d1,d2).
-      */
-      // Update the distance matrix in the range [start, idx1).
-      //t_float v = static_cast<t_float>(members[i]);
-      for (i=active_nodes.start; i<idx1; i=active_nodes.succ[i])
-        f_ward(&D_(i, idx2), D_(i, idx1), min,
-               size1, size2, static_cast<t_float>(members[i]) );
-      // Update the distance matrix in the range (idx1, idx2).
-      for (; i<idx2; i=active_nodes.succ[i])
-        f_ward(&D_(i, idx2), D_(idx1, i), min,
-               size1, size2, static_cast<t_float>(members[i]) );
-      // Update the distance matrix in the range (idx2, N).
-      for (i=active_nodes.succ[idx2]; i<N; i=active_nodes.succ[i])
-        f_ward(&D_(idx2, i), D_(idx1, i), min,
-               size1, size2, static_cast<t_float>(members[i]) );
-      break;
-
-    default:
-      throw std::runtime_error(std::string("Invalid method."));
+    else
+#endif
+    prim_sqeuclidean_step(X, dim, &*norm, prune, active_nodes,
+                          0, active_nodes.size, prev_node, &*d,
+                          min, idx2, nan_found);
+    if (nan_found) throw(nan_error());
+    // All distances are infinite: take the first active node, as the serial
+    // loop in MST_linkage_core_vector does.
+    if (idx2<0) {
+      idx2 = active_nodes.first();
+      min = d[idx2];
     }
+    Z2.append(prev_node, idx2, min);
+    if (progress) (*progress)(j+1, min);
   }
-  #ifdef FE_INVALID
-  if (fetestexcept(FE_INVALID)) throw fenv_error();
-  #endif
 }
 
-class binary_min_heap {
-  /*
-  Class for a binary min-heap. The data resides in an array A. The elements of
-  A are not changed but two lists I and R of indices are generated which point
-  to elements of A and backwards.
-
-  The heap tree structure is
-
-     H[2*i+1]     H[2*i+2]
-         \            /
-          \          /
-           ≤        ≤
-            \      /
-             \    /
-              H[i]
-
-  where the children must be less or equal than their parent. Thus, H[0]
-  contains the minimum. The lists I and R are made such that H[i] = A[I[i]]
-  and R[I[i]] = i.
-
-  This implementation is not designed to handle NaN values.
-  */
-private:
-  t_float * const A;
-  t_index size;
-  auto_array_ptr<t_index> I;
-  auto_array_ptr<t_index> R;
-
-  // no default constructor
-  binary_min_heap();
-  // noncopyable
-  binary_min_heap(binary_min_heap const &);
-  binary_min_heap & operator=(binary_min_heap const &);
+/*
+  k-d tree for the dual-tree Borůvka algorithm in MST_linkage_core_boruvka.
 
+  The points are copied in tree order, so that every node covers a
+  contiguous range [begin, end) of them. A node is split at the median of
+  its widest coordinate until it holds at most leaf_size points, or until
+  all its points coincide. The nodes are stored in preorder, so the
+  children of a node always come after it.
+*/
+template <typename t_float>
+class kd_tree {
 public:
-  binary_min_heap(t_float * const A_, const t_index size_)
-    : A(A_), size(size_), I(size), R(size)
-  { // Allocate memory and initialize the lists I and R to the identity. This
-    // does not make it a heap. Call heapify afterwards!
-    for (t_index i=0; i<size; ++i)
-      R[i] = I[i] = i;
+  static const t_index leaf_size = 16;
+
+  struct kd_node {
+    t_index begin, end;   // range of points in tree order
+    t_index left, right;  // children, or -1 for a leaf
+    t_index comp;         // component of all points in the node, or -1
+    t_float bound;        // upper bound for the candidate distances
+  };
+
+  const t_index N, dim;
+  auto_array_ptr<t_float> P;     // points in tree order
+  auto_array_ptr<t_index> perm;  // tree order → original index
+  auto_array_ptr<kd_node> nodes;
+  auto_array_ptr<t_float> lo, hi; // bounding boxes, dim entries per node
+  t_index size;                   // number of nodes
+
+  kd_tree(const t_index N_, const t_float * const X, const t_index dim_)
+    : N(N_)
+    , dim(dim_)
+    , P(static_cast<std::ptrdiff_t>(N_)*dim_)
+    , perm(N_)
+    , size(0)
+  {
+    // Every leaf except a single root holds at least (leaf_size+1)/2
+    // points, since only nodes with more than leaf_size points are split.
+    const t_index max_nodes = 2*(N/((leaf_size+1)/2)+1);
+    nodes.init(max_nodes);
+    lo.init(static_cast<std::ptrdiff_t>(max_nodes)*dim);
+    hi.init(static_cast<std::ptrdiff_t>(max_nodes)*dim);
+    for (t_index i=0; i<N; ++i) perm[i] = i;
+    build(X, 0, N);
+    for (t_index i=0; i<N; ++i) {
+      std::copy(X+static_cast<std::ptrdiff_t>(perm[i])*dim,
+                X+static_cast<std::ptrdiff_t>(perm[i]+1)*dim,
+                P+static_cast<std::ptrdiff_t>(i)*dim);
+    }
   }
 
-  binary_min_heap(t_float * const A_, const t_index size1, const t_index size2,
-                  const t_index start)
-    : A(A_), size(size1), I(size1), R(size2)
-  { // Allocate memory and initialize the lists I and R to the identity. This
-    // does not make it a heap. Call heapify afterwards!
-    for (t_index i=0; i<size; ++i) {
-      R[i+start] = i;
-      I[i] = i + start;
+  inline const t_float * point(const t_index i) const {
+    return P+static_cast<std::ptrdiff_t>(i)*dim;
+  }
+
+  // Squared distance between the bounding boxes of two nodes.
+  t_float min_sqdist(const t_index a, const t_index b) const {
+    const t_float * const la = lo+static_cast<std::ptrdiff_t>(a)*dim;
+    const t_float * const ha = hi+static_cast<std::ptrdiff_t>(a)*dim;
+    const t_float * const lb = lo+static_cast<std::ptrdiff_t>(b)*dim;
+    const t_float * const hb = hi+static_cast<std::ptrdiff_t>(b)*dim;
+    t_float sum = 0;
+    for (t_index k=0; k<dim; ++k) {
+      const t_float gap = (lb[k] > ha[k]) ? lb[k]-ha[k] :
+        ((la[k] > hb[k]) ? la[k]-hb[k] : 0);
+      sum += gap*gap;
     }
+    return sum;
   }
 
-  ~binary_min_heap() {}
+  // Squared distance between a point and the bounding box of a node.
+  t_float min_sqdist_point(const t_float * const x, const t_index b) const {
+    const t_float * const lb = lo+static_cast<std::ptrdiff_t>(b)*dim;
+    const t_float * const hb = hi+static_cast<std::ptrdiff_t>(b)*dim;
+    t_float sum = 0;
+    for (t_index k=0; k<dim; ++k) {
+      const t_float gap = (lb[k] > x[k]) ? lb[k]-x[k] :
+        ((x[k] > hb[k]) ? x[k]-hb[k] : 0);
+      sum += gap*gap;
+    }
+    return sum;
+  }
 
-  void heapify() {
-    // Arrange the indices I and R so that H[i] := A[I[i]] satisfies the heap
-    // condition H[i] < H[2*i+1] and H[i] < H[2*i+2] for each i.
-    //
-    // Complexity: Θ(size)
-    // Reference: Cormen, Leiserson, Rivest, Stein, Introduction to Algorithms,
-    // 3rd ed., 2009, Section 6.3 “Building a heap”
-    t_index idx;
-    for (idx=(size>>1); idx>0; ) {
-      --idx;
-      update_geq_(idx);
+private:
+  t_index build(const t_float * const X, const t_index begin,
+                const t_index end) {
+    const t_index n = size++;
+    nodes[n].begin = begin;
+    nodes[n].end = end;
+    nodes[n].left = nodes[n].right = -1;
+
+    t_float * const l = lo+static_cast<std::ptrdiff_t>(n)*dim;
+    t_float * const h = hi+static_cast<std::ptrdiff_t>(n)*dim;
+    for (t_index k=0; k<dim; ++k) {
+      l[k] = h[k] = X[static_cast<std::ptrdiff_t>(perm[begin])*dim+k];
+    }
+    for (t_index i=begin+1; i<end; ++i) {
+      const t_float * const Xi = X+static_cast<std::ptrdiff_t>(perm[i])*dim;
+      for (t_index k=0; k<dim; ++k) {
+        if (Xi[k] < l[k]) l[k] = Xi[k];
+        else if (Xi[k] > h[k]) h[k] = Xi[k];
+      }
+    }
+
+    if (end-begin > leaf_size) {
+      t_index split_dim = 0;
+      for (t_index k=1; k<dim; ++k) {
+        if (h[k]-l[k] > h[split_dim]-l[split_dim]) split_dim = k;
+      }
+#if HAVE_DIAGNOSTIC
+#pragma GCC diagnostic push
+#pragma GCC diagnostic ignored "-Wfloat-equal"
+#endif
+      if (h[split_dim]!=l[split_dim]) {
+#if HAVE_DIAGNOSTIC
+#pragma GCC diagnostic pop
+#endif
+        const t_index mid = begin+(end-begin)/2;
+        std::nth_element(perm+begin, perm+mid, perm+end,
+                         [&](const t_index a, const t_index b) {
+          return X[static_cast<std::ptrdiff_t>(a)*dim+split_dim] <
+            X[static_cast<std::ptrdiff_t>(b)*dim+split_dim];
+        });
+        nodes[n].left = build(X, begin, mid);
+        nodes[n].right = build(X, mid, end);
+      }
     }
+    return n;
   }
+};
 
-  inline t_index argmin() const {
-    // Return the minimal element.
-    return I[0];
+/*
+  State of one round of the dual-tree Borůvka algorithm: for every
+  component, the shortest edge to another component that has been found
+  so far.
+*/
+template <typename t_float>
+class boruvka_round {
+public:
+  kd_tree<t_float> & T;
+  const t_index * const comp;    // component of each point in tree order
+  t_float * const cand_d;        // per component: distance, ...
+  t_index * const cand_a;        // ... original indices of the endpoints,
+  t_index * const cand_b;        // cand_a inside the component
+
+  boruvka_round(kd_tree<t_float> & T_, const t_index * const comp_,
+                t_float * const cand_d_, t_index * const cand_a_,
+                t_index * const cand_b_)
+    : T(T_), comp(comp_), cand_d(cand_d_), cand_a(cand_a_), cand_b(cand_b_)
+  { }
+
+  /*
+    Edges are ordered by their distance and then by the pair of original
+    point indices, so that the shortest edge of each component is unique
+    and the chosen edges cannot form a cycle.
+  */
+  inline bool better(const t_index c, const t_float d, const t_index a,
+                     const t_index b) const {
+    if (cand_a[c]<0 || d < cand_d[c]) return true;
+    if (cand_d[c] < d) return false;
+    const t_index e0 = a<b ? a : b, e1 = a<b ? b : a;
+    const t_index f0 = cand_a[c]<cand_b[c] ? cand_a[c] : cand_b[c];
+    const t_index f1 = cand_a[c]<cand_b[c] ? cand_b[c] : cand_a[c];
+    return e0<f0 || (e0==f0 && e1<f1);
   }
 
-  void heap_pop() {
-    // Remove the minimal element from the heap.
-    --size;
-    I[0] = I[size];
-    R[I[0]] = 0;
-    update_geq_(0);
+  /*
+    Upper bound for the distances of improving edges from the points in a
+    node. If all points are in the same component, this is its candidate
+    distance. Otherwise, it is the bound stored in the node, which is the
+    maximum of the candidate distances at the time when the node was last
+    visited. Since the candidate distances only decrease, it stays valid.
+  */
+  inline t_float node_bound(const typename kd_tree<t_float>::kd_node & Q)
+    const {
+    if (Q.comp>=0) {
+      return (cand_a[Q.comp]<0) ? std::numeric_limits<t_float>::infinity()
+        : cand_d[Q.comp];
+    }
+    return Q.bound;
   }
 
-  void remove(t_index idx) {
-    // Remove an element from the heap.
-    --size;
-    R[I[size]] = R[idx];
-    I[R[idx]] = I[size];
-    if ( H(size)<=A[idx] ) {
-      update_leq_(R[idx]);
+  void traverse(const t_index q, const t_index r) {
+    typedef typename kd_tree<t_float>::kd_node kd_node;
+    kd_node & Q = T.nodes[q];
+    const kd_node & R = T.nodes[r];
+    if (Q.comp>=0 && Q.comp==R.comp) return;
+    // The box distance may be rounded up slightly compared to the distance
+    // of two points, so allow for a relative error before pruning.
+    const t_float tol = static_cast<t_float>(4*T.dim+4) *
+      std::numeric_limits<t_float>::epsilon();
+    if (T.min_sqdist(q, r)*(1-tol) > node_bound(Q)) return;
+
+    if (Q.left<0 && R.left<0) {
+      t_float bound = 0;
+      for (t_index i=Q.begin; i<Q.end; ++i) {
+        const t_index c = comp[i];
+        const t_float * const Pi = T.point(i);
+        if (cand_a[c]>=0 && T.min_sqdist_point(Pi, r)*(1-tol) > cand_d[c]) {
+          if (cand_d[c] > bound) bound = cand_d[c];
+          continue;
+        }
+        for (t_index j=R.begin; j<R.end; ++j) {
+          if (comp[j]==c) continue;
+          const t_float d = simd_utils::simd_sqeuclidean(Pi, T.point(j),
+                                                         T.dim);
+          if (better(c, d, T.perm[i], T.perm[j])) {
+            cand_d[c] = d;
+            cand_a[c] = T.perm[i];
+            cand_b[c] = T.perm[j];
+          }
+        }
+        if (cand_a[c]<0) {
+          bound = std::numeric_limits<t_float>::infinity();
+        }
+        else if (cand_d[c] > bound) {
+          bound = cand_d[c];
+        }
+      }
+      Q.bound = bound;
+    }
+    else if (Q.left<0 || (R.left>=0 && R.end-R.begin > Q.end-Q.begin)) {
+      // Descend in the reference tree, closer child first.
+      if (T.min_sqdist(q, R.right) < T.min_sqdist(q, R.left)) {
+        traverse(q, R.right);
+        traverse(q, R.left);
+      }
+      else {
+        traverse(q, R.left);
+        traverse(q, R.right);
+      }
     }
     else {
-      update_geq_(R[idx]);
+      traverse(Q.left, r);
+      traverse(Q.right, r);
+      const t_float bl = T.nodes[Q.left].bound;
+      const t_float br = T.nodes[Q.right].bound;
+      Q.bound = (bl > br) ? bl : br;
     }
   }
+};
 
-  void replace ( const t_index idxold, const t_index idxnew,
-                 const t_float val) {
-    R[idxnew] = R[idxold];
-    I[R[idxnew]] = idxnew;
-    if (val<=A[idxold])
-      update_leq(idxnew, val);
-    else
-      update_geq(idxnew, val);
+template <typename t_float>
+static void MST_linkage_core_boruvka(const t_index N,
+                                     const t_float * const X,
+                                     const t_index dim,
+                                     cluster_result & Z2,
+                                     linkage_progress * const progress = NULL) {
+/*
+    N: integer, number of data points
+    X: (N×dim) array of points
+    Z2: output data structure
+    progress: progress reports after each round (optional)
+
+    Minimum spanning tree for the squared Euclidean metric by the dual-tree
+    Borůvka algorithm (W. B. March, P. Ram, A. G. Gray, Fast Euclidean
+    minimum spanning tree: algorithm, analysis, and applications, KDD 2010).
+
+    In each round, every component of the current spanning forest finds its
+    shortest edge to another component by a simultaneous traversal of a k-d
+    tree with itself, where pairs of nodes are pruned if they lie in the same
+    component or if they are farther apart than the candidate edges of all
+    points in the query node. The number of components at least halves per
+    round. The output lists the edges of the minimum spanning tree in no
+    particular order, so generate_SciPy_dendrogram<false> must sort it.
+
+    The distances are evaluated by the same function as in
+    MST_linkage_core_sqeuclidean, so the output is the same as for Prim's
+    algorithm up to the order of merging steps at equal distances. Points
+    with non-finite coordinates cannot be arranged in a k-d tree; in this
+    case, Prim's algorithm is used.
+*/
+  for (std::ptrdiff_t k=0; k<static_cast<std::ptrdiff_t>(N)*dim; ++k) {
+    // Also true for NaN
+    if (!(std::abs(X[k]) <= std::numeric_limits<t_float>::max())) {
+      MST_linkage_core_sqeuclidean(N, X, dim, Z2, progress);
+      return;
+    }
   }
 
-  void update ( const t_index idx, const t_float val ) const {
-    // Update the element A[i] with val and re-arrange the indices to preserve
-    // the heap condition.
-    if (val<=A[idx])
-      update_leq(idx, val);
-    else
-      update_geq(idx, val);
+  kd_tree<t_float> T(N, X, dim);
+  union_find forest(N);
+  auto_array_ptr<t_index> comp(N);
+  auto_array_ptr<t_index> label(2*N-1);
+  auto_array_ptr<t_float> cand_d(N);
+  auto_array_ptr<t_index> cand_a(N);
+  auto_array_ptr<t_index> cand_b(N);
+
+  t_index edges = 0;
+  while (edges < N-1) {
+    // Number the components consecutively and label the points and nodes.
+    FILL_N(&*label, 2*N-1, -1);
+    t_index ncomp = 0;
+    for (t_index i=0; i<N; ++i) {
+      const t_index root = forest.Find(T.perm[i]);
+      if (label[root]<0) label[root] = ncomp++;
+      comp[i] = label[root];
+    }
+    for (t_index n=T.size-1; n>=0; --n) {
+      typename kd_tree<t_float>::kd_node & Nd = T.nodes[n];
+      if (Nd.left<0) {
+        Nd.comp = comp[Nd.begin];
+        for (t_index i=Nd.begin+1; i<Nd.end; ++i) {
+          if (comp[i]!=Nd.comp) {
+            Nd.comp = -1;
+            break;
+          }
+        }
+      }
+      else {
+        Nd.comp = (T.nodes[Nd.left].comp==T.nodes[Nd.right].comp) ?
+          T.nodes[Nd.left].comp : -1;
+      }
+      Nd.bound = std::numeric_limits<t_float>::infinity();
+    }
+    std::fill_n(&*cand_a, ncomp, -1);
+
+    boruvka_round<t_float> round(T, comp, cand_d, cand_a, cand_b);
+    round.traverse(0, 0);
+
+    for (t_index c=0; c<ncomp; ++c) {
+      const t_index a = forest.Find(cand_a[c]);
+      const t_index b = forest.Find(cand_b[c]);
+      if (a!=b) {
+        forest.Union(a, b);
+        Z2.append(cand_a[c], cand_b[c], cand_d[c]);
+        ++edges;
+      }
+    }
+    if (progress) (*progress)(edges, Z2[edges-1]->dist);
   }
+}
 
-  void update_leq ( const t_index idx, const t_float val ) const {
-    // Use this when the new value is not more than the old value.
-    A[idx] = val;
-    update_leq_(R[idx]);
+/*
+  Kruskal's algorithm on the edges (I[e], J[e]) with dissimilarities W[e],
+  e=0,...,M-1: the edges are sorted by their dissimilarity (stably, so that
+  equal dissimilarities keep the input order), and an edge is appended to Z2
+  if it joins two different components of the union-find structure
+  "forest". Only the order of the edges is stored, so that the memory
+  requirement is O(M) in addition to the input.
+
+  Returns the number of appended edges.
+*/
+template <typename t_float, typename t_node_index>
+static t_index kruskal_forest(const t_index N,
+                              const std::ptrdiff_t M,
+                              const t_node_index * const I,
+                              const t_node_index * const J,
+                              const t_float * const W,
+                              union_find & forest,
+                              cluster_result & Z2) {
+  for (std::ptrdiff_t e=0; e<M; ++e) {
+    if (fc_isnan(W[e])) throw(nan_error());
   }
 
-  void update_geq ( const t_index idx, const t_float val ) const {
-    // Use this when the new value is not less than the old value.
-    A[idx] = val;
-    update_geq_(R[idx]);
+  auto_array_ptr<std::ptrdiff_t> order(M);
+  for (std::ptrdiff_t e=0; e<M; ++e) order[e] = e;
+  std::stable_sort(&*order, order+M,
+                   [&](const std::ptrdiff_t a, const std::ptrdiff_t b) {
+                     return W[a] < W[b];
+                   });
+
+  t_index edges = 0;
+  for (std::ptrdiff_t k=0; k<M && edges<N-1; ++k) {
+    const std::ptrdiff_t e = order[k];
+    const t_index a = forest.Find(static_cast<t_index>(I[e]));
+    const t_index b = forest.Find(static_cast<t_index>(J[e]));
+    if (a!=b) {
+      forest.Union(a, b);
+      Z2.append(static_cast<t_index>(I[e]), static_cast<t_index>(J[e]),
+                W[e]);
+      ++edges;
+    }
+  }
+  return edges;
+}
+
+template <typename t_float, typename t_node_index>
+static void MST_linkage_core_sparse(const t_index N,
+                                    const std::ptrdiff_t M,
+                                    const t_node_index * const I,
+                                    const t_node_index * const J,
+                                    const t_float * const W,
+                                    cluster_result & Z2) {
+/*
+    N: integer, number of data points
+    M: number of edges
+    I, J, W: the edges (I[e], J[e]) with dissimilarity W[e]
+    Z2: output data structure
+
+    Single linkage of a sparse dissimilarity graph by Kruskal's algorithm.
+
+    If the graph is not connected, the components are joined at the end, at
+    infinite distance, in the order of their smallest point index.
+*/
+  union_find forest(N);
+  t_index edges = kruskal_forest(N, M, I, J, W, forest, Z2);
+
+  for (t_index i=1; i<N && edges<N-1; ++i) {
+    const t_index a = forest.Find(0);
+    const t_index b = forest.Find(i);
+    if (a!=b) {
+      forest.Union(a, b);
+      Z2.append(0, i, std::numeric_limits<t_float>::infinity());
+      ++edges;
+    }
   }
+}
+
+/*
+  The dissimilarities between the points shift, shift+1, ... of the
+  dissimilarity object dist, as the points 0, 1, ...
+*/
+template <typename t_dissimilarity>
+class shifted_dissimilarity {
+public:
+  typedef typename t_dissimilarity::float_type float_type;
 
 private:
-  void update_leq_ (t_index i) const {
-    t_index j;
-    for ( ; (i>0) && ( H(i)<H(j=(i-1)>>1) ); i=j)
-      heap_swap(i,j);
+  const t_dissimilarity & dist;
+  const t_index shift;
+
+public:
+  shifted_dissimilarity(const t_dissimilarity & dist_, const t_index shift_)
+    : dist(dist_)
+    , shift(shift_)
+  {}
+
+  inline float_type operator () (const t_index i, const t_index j) const {
+    return dist(i+shift, j+shift);
   }
+};
 
-  void update_geq_ (t_index i) const {
-    t_index j;
-    for ( ; (j=2*i+1)<size; i=j) {
-      if ( H(j)>=H(i) ) {
-        ++j;
-        if ( j>=size || H(j)>=H(i) ) break;
+inline static node mst_edge(const t_index u, const t_index v, const t_float w) {
+  node n;
+  n.node1 = std::min(u, v);
+  n.node2 = std::max(u, v);
+  n.dist = w;
+  return n;
+}
+
+// Order of the candidate edges by their points, so that the result does
+// not depend on the order in which the threads find them
+inline static bool edge_points_less(const node & a, const node & b) {
+  return a.node1 < b.node1 || (a.node1==b.node1 && a.node2 < b.node2);
+}
+
+/*
+  Insert the points N0, ..., N-1 (N0>0) into the minimum spanning tree T of
+  the points 0, ..., N0-1. T is given by the N0-1 edges (edges[2e],
+  edges[2e+1]) with the weights weight[e], in the scale of the dissimilarity
+  object before the postprocessing. On exit, the arrays hold the N-1 edges of
+  the minimum spanning tree of all points.
+
+  By the cycle property, the new tree is the minimum spanning tree of the
+  union of
+    * T,
+    * for each new point z, the edges (z,u) in the minimum spanning tree of T
+      and all edges from z to the old points u,
+    * the minimum spanning tree of the new points.
+  The middle part is computed for each new point z with the algorithm by
+  Chin and Houck:
+
+    F. Chin, D. Houck, Algorithms for updating minimal spanning trees,
+    Journal of Computer and System Sciences, vol. 16, 1978, p. 333–344.
+
+  T is rooted at point 0 and processed in reverse depth-first order, ie.
+  from the leaves up. t(u) is the lightest edge which connects the subtree of
+  u to z and is not decided yet; initially, it is the edge (z,u). For a point
+  u with the parent v, the edge (u,v) and t(u) lie on a cycle with t(v), so
+  the lighter one of (u,v) and t(u) belongs to the tree, while the heavier
+  one replaces t(v) if it is lighter. Finally, t(0) belongs to the tree.
+  Since T is the same for all new points, its depth-first order is computed
+  once, and the new points are distributed over the OpenMP threads if
+  threads is true. The union of the three parts is small, and Kruskal's
+  algorithm (kruskal_forest) gives the final tree.
+
+  Altogether, this takes O(N·k) dissimilarities and steps for k new points.
+*/
+template <typename t_dissimilarity>
+static void MST_insert_points(const t_index N0, const t_index N,
+                              t_dissimilarity & dist,
+                              t_index * const edges,
+                              t_float * const weight,
+                              const bool threads = true) {
+  // The position of each point of T in depth-first order, and for each
+  // position the position of the parent, the edge to the parent and its
+  // weight
+  auto_array_ptr<t_index> pos(N0), parent_pos(N0), parent_edge(N0);
+  auto_array_ptr<t_float> parent_weight(N0);
+  {
+    // Adjacency lists of T, the points in depth-first order and the edge to
+    // the parent of each point
+    auto_array_ptr<t_index> offset(N0+1, 0), adjacent(2*N0), order(N0),
+      stack(N0), point_edge(N0);
+    for (t_index e=0; e<N0-1; ++e) {
+      ++offset[edges[2*e]+1];
+      ++offset[edges[2*e+1]+1];
+    }
+    for (t_index u=0; u<N0; ++u) {
+      offset[u+1] += offset[u];
+    }
+    for (t_index e=0; e<N0-1; ++e) {
+      adjacent[offset[edges[2*e]]++] = e;
+      adjacent[offset[edges[2*e+1]]++] = e;
+    }
+    for (t_index u=N0; u>0; --u) {
+      offset[u] = offset[u-1];
+    }
+    offset[0] = 0;
+
+    t_index top = 0, k = 0;
+    stack[top++] = 0;
+    point_edge[0] = -1;
+    while (top) {
+      const t_index u = stack[--top];
+      order[k] = u;
+      pos[u] = k++;
+      for (t_index a=offset[u]; a<offset[u+1]; ++a) {
+        const t_index e = adjacent[a];
+        if (e==point_edge[u]) continue;
+        const t_index v = (edges[2*e]==u) ? edges[2*e+1] : edges[2*e];
+        point_edge[v] = e;
+        stack[top++] = v;
       }
-      else if ( j+1<size && H(j+1)<H(j) ) ++j;
-      heap_swap(i, j);
+    }
+    for (t_index q=1; q<N0; ++q) {
+      const t_index u = order[q];
+      const t_index e = point_edge[u];
+      parent_edge[q] = e;
+      parent_pos[q] = pos[(edges[2*e]==u) ? edges[2*e+1] : edges[2*e]];
+      parent_weight[q] = weight[e];
     }
   }
 
-  void heap_swap(const t_index i, const t_index j) const {
-    // Swap two indices.
-    t_index tmp = I[i];
-    I[i] = I[j];
-    I[j] = tmp;
-    R[I[i]] = i;
-    R[I[j]] = j;
+  // Candidate edges: the old tree, the edges from the new points which
+  // remain in the trees of the single insertions, and the tree of the new
+  // points
+  std::vector<node> candidates;
+  candidates.reserve(static_cast<std::size_t>(2*N));
+  for (t_index e=0; e<N0-1; ++e) {
+    candidates.push_back(mst_edge(edges[2*e], edges[2*e+1], weight[e]));
+  }
+  if (N-N0>1) {
+    cluster_result Z2(N-N0-1);
+    shifted_dissimilarity<t_dissimilarity> new_points(dist, N0);
+    MST_linkage_core_vector(N-N0, new_points, Z2, threads);
+    for (t_index e=0; e<N-N0-1; ++e) {
+      candidates.push_back(mst_edge(Z2[e]->node1+N0, Z2[e]->node2+N0,
+                                    Z2[e]->dist));
+    }
   }
 
-  inline t_float H(const t_index i) const {
-    return A[I[i]];
+  bool nan_found = false;
+#ifdef _OPENMP
+#pragma omp parallel if(threads) reduction(||:nan_found)
+#endif
+  {
+    // t(u) by the position of u: the weight, and the edge as e for the
+    // edge e of T or as N0-1+u for the edge (z,u)
+    auto_array_ptr<t_float> t_weight(N0);
+    auto_array_ptr<t_index> t_code(N0);
+    std::vector<node> kept;
+#ifdef _OPENMP
+#pragma omp for schedule(dynamic)
+#endif
+    for (t_index z=N0; z<N; ++z) {
+      if (nan_found) continue;
+      for (t_index u=0; u<N0; ++u) {
+        const t_float d = static_cast<t_float>(dist(u, z));
+        t_weight[pos[u]] = d;
+        t_code[pos[u]] = N0-1+u;
+        if (fc_isnan(d)) nan_found = true;
+      }
+      for (t_index q=N0-1; q>0; --q) {
+        const t_index v = parent_pos[q];
+        t_float pass_weight = t_weight[q];
+        t_index pass_code = t_code[q];
+        if (t_weight[q] < parent_weight[q]) {
+          if (t_code[q]>=N0-1) {
+            kept.push_back(mst_edge(t_code[q]-(N0-1), z, t_weight[q]));
+          }
+          pass_weight = parent_weight[q];
+          pass_code = parent_edge[q];
+        }
+        if (pass_weight < t_weight[v]) {
+          t_weight[v] = pass_weight;
+          t_code[v] = pass_code;
+        }
+      }
+      if (t_code[0]>=N0-1) {
+        kept.push_back(mst_edge(t_code[0]-(N0-1), z, t_weight[0]));
+      }
+    }
+#ifdef _OPENMP
+#pragma omp critical
+#endif
+    candidates.insert(candidates.end(), kept.begin(), kept.end());
+  }
+  if (nan_found) throw(nan_error());
+
+  // Kruskal's algorithm on the candidates
+  std::sort(candidates.begin(), candidates.end(), edge_points_less);
+  const std::ptrdiff_t M = static_cast<std::ptrdiff_t>(candidates.size());
+  auto_array_ptr<t_index> I(M), J(M);
+  auto_array_ptr<t_float> W(M);
+  for (std::ptrdiff_t e=0; e<M; ++e) {
+    I[e] = candidates[static_cast<std::size_t>(e)].node1;
+    J[e] = candidates[static_cast<std::size_t>(e)].node2;
+    W[e] = candidates[static_cast<std::size_t>(e)].dist;
+  }
+  candidates.clear();
+
+  union_find forest(N);
+  cluster_result Z2(N-1);
+  kruskal_forest(N, M, &*I, &*J, &*W, forest, Z2);
+  for (t_index e=0; e<N-1; ++e) {
+    edges[2*e] = Z2[e]->node1;
+    edges[2*e+1] = Z2[e]->node2;
+    weight[e] = Z2[e]->dist;
+  }
+}
+
+/*
+  Small pseudo-random number generator (xorshift64*) for the randomized
+  algorithms, so that their output is reproducible on all platforms.
+*/
+class xorshift_rng {
+private:
+  unsigned long long state;
+
+public:
+  explicit xorshift_rng(const unsigned long long seed)
+    : state(seed ? seed : 0x9E3779B97F4A7C15ULL)
+  { }
+
+  unsigned long long operator() () {
+    state ^= state >> 12;
+    state ^= state << 25;
+    state ^= state >> 27;
+    return state * 0x2545F4914F6CDD1DULL;
   }
 
+  // Random integer in [0, n), up to a negligible bias
+  t_index below(const t_index n) {
+    return static_cast<t_index>((*this)() %
+                                static_cast<unsigned long long>(n));
+  }
 };
 
-template <method_codes method, typename t_members>
-static void generic_linkage(const t_index N, t_float * const D, t_members * const members, cluster_result & Z2) {
-  /*
-    N: integer, number of data points
-    D: condensed distance matrix N*(N-1)/2
-    Z2: output data structure
-  */
+/*
+  For each of N points, a bounded max-heap of its K nearest neighbors found
+  so far, with a flag whether the neighbor is new since the last round of
+  NN-descent. Neighbors are ordered by their distance and then by their
+  index. Empty slots hold the index N at infinite distance.
+
+  Every point also has a hash table of the indices in its heap (open
+  addressing with linear probing, S slots, -1 if empty), so that a push
+  checks for duplicates without scanning the heap.
+*/
+template <typename t_float>
+class knn_heaps {
+public:
+  const t_index N, K;
+  auto_array_ptr<t_index> idx;
+  auto_array_ptr<t_float> dist;
+  auto_array_ptr<char> isnew;
 
-  const t_index N_1 = N-1;
-  t_index i, j; // loop variables
-  t_index idx1, idx2; // row and column indices
+private:
+  const t_index S; // a power of 2, at least 2K
+  auto_array_ptr<t_index> table;
 
-  auto_array_ptr<t_index> n_nghbr(N_1); // array of nearest neighbors
-  auto_array_ptr<t_float> mindist(N_1); // distances to the nearest neighbors
-  auto_array_ptr<t_index> row_repr(N); // row_repr[i]: node number that the
-                                       // i-th row represents
-  doubly_linked_list active_nodes(N);
-  binary_min_heap nn_distances(&*mindist, N_1); // minimum heap structure for
-                        // the distance to the nearest neighbor of each point
-  t_index node1, node2; // node numbers in the output
-  t_float size1, size2; // and their cardinalities
+  static t_index table_size(const t_index K_) {
+    t_index S_ = 2;
+    while (S_ < 2*K_) S_ <<= 1;
+    return S_;
+  }
 
-  t_float min; // minimum and row index for nearest-neighbor search
-  t_index idx;
+  inline t_index home(const t_index j) const {
+    return static_cast<t_index>(
+        (static_cast<unsigned long long>(j)*0x9E3779B97F4A7C15ULL) >> 32) &
+      (S-1);
+  }
 
-  for (i=0; i<N; ++i)
-    // Build a list of row ↔ node label assignments.
-    // Initially i ↦ i
-    row_repr[i] = i;
+  // Position of j in the table T, or of the empty slot where it belongs
+  t_index find(t_index const * const T, const t_index j) const {
+    t_index h = home(j);
+    while (T[h]>=0 && T[h]!=j) h = (h+1) & (S-1);
+    return h;
+  }
 
-  // Initialize the minimal distances:
-  // Find the nearest neighbor of each point.
-  // n_nghbr[i] = argmin_{j>i} D(i,j) for i in range(N-1)
-  
-#ifdef _OPENMP
-  // Parallel initialization of nearest neighbors
-  #pragma omp parallel for schedule(dynamic)
-  for (i=0; i<N_1; ++i) {
-    t_float min_val = std::numeric_limits<t_float>::infinity();
-    t_index min_idx = i+1;
-    
-    // Use SIMD-optimized minimum search when possible
-    t_float const * DD = D + (static_cast<std::ptrdiff_t>(2*N-3-i)*i>>1);
-    for (t_index j=i+1; j<N; ++j, ++DD) {
-#if HAVE_DIAGNOSTIC
-#pragma GCC diagnostic push
-#pragma GCC diagnostic ignored "-Wfloat-equal"
-#endif
-      if (*DD < min_val) {
-        min_val = *DD;
-        min_idx = j;
-      }
-      else if (fc_isnan(*DD))
-        throw(nan_error());
+  // Remove j from the table T. The following entries of the probe sequence
+  // are shifted back, so that no entry becomes unreachable.
+  void erase(t_index * const T, const t_index j) {
+    t_index h = find(T, j);
+    for (;;) {
+      T[h] = -1;
+      t_index g = h;
+      do {
+        g = (g+1) & (S-1);
+        if (T[g]<0) return;
+        // T[g] may fill the hole at h if h is between its home slot and g.
+      } while (((g-home(T[g])) & (S-1)) < ((g-h) & (S-1)));
+      T[h] = T[g];
+      h = g;
     }
-#if HAVE_DIAGNOSTIC
-#pragma GCC diagnostic pop
-#endif
-    mindist[i] = min_val;
-    n_nghbr[i] = min_idx;
   }
-#else
-  // Sequential version with SIMD optimization
-  t_float const * DD = D;
-  for (i=0; i<N_1; ++i) {
-    min = std::numeric_limits<t_float>::infinity();
-    for (idx=j=i+1; j<N; ++j, ++DD) {
+
+public:
+  knn_heaps(const t_index N_, const t_index K_)
+    : N(N_)
+    , K(K_)
+    , idx(static_cast<std::ptrdiff_t>(N_)*K_, N_)
+    , dist(static_cast<std::ptrdiff_t>(N_)*K_,
+           std::numeric_limits<t_float>::infinity())
+    , isnew(static_cast<std::ptrdiff_t>(N_)*K_, 0)
+    , S(table_size(K_))
+    , table(static_cast<std::ptrdiff_t>(N_)*S, -1)
+  { }
+
+  static inline bool closer(const t_float d1, const t_index j1,
+                            const t_float d2, const t_index j2) {
 #if HAVE_DIAGNOSTIC
 #pragma GCC diagnostic push
 #pragma GCC diagnostic ignored "-Wfloat-equal"
 #endif
-      if (*DD<min) {
-        min = *DD;
-        idx = j;
-      }
-      else if (fc_isnan(*DD))
-        throw(nan_error());
-    }
+    return d1 < d2 || (d1 == d2 && j1 < j2);
 #if HAVE_DIAGNOSTIC
 #pragma GCC diagnostic pop
 #endif
-    mindist[i] = min;
-    n_nghbr[i] = idx;
   }
-#endif
-
-  // Put the minimal distances into a heap structure to make the repeated
-  // global minimum searches fast.
-  nn_distances.heapify();
-
-  #ifdef FE_INVALID
-  if (feclearexcept(FE_INVALID)) throw fenv_error();
-  #endif
-
-  // Main loop: We have N-1 merging steps.
-  for (i=0; i<N_1; ++i) {
-    /*
-      Here is a special feature that allows fast bookkeeping and updates of the
-      minimal distances.
-
-      mindist[i] stores a lower bound on the minimum distance of the point i to
-      all points of higher index:
 
-          mindist[i] ≥ min_{j>i} D(i,j)
-
-      Normally, we have equality. However, this minimum may become invalid due
-      to the updates in the distance matrix. The rules are:
-
-      1) If mindist[i] is equal to D(i, n_nghbr[i]), this is the correct
-         minimum and n_nghbr[i] is a nearest neighbor.
-
-      2) If mindist[i] is smaller than D(i, n_nghbr[i]), this might not be the
-         correct minimum. The minimum needs to be recomputed.
+  // Offer j at distance d as a neighbor of i. Returns whether the heap of
+  // i changed.
+  bool push(const t_index i, const t_index j, const t_float d) {
+    const std::ptrdiff_t o = static_cast<std::ptrdiff_t>(i)*K;
+    t_index * const I = idx+o;
+    t_float * const D = dist+o;
+    char * const F = isnew+o;
+    if (!closer(d, j, D[0], I[0])) return false;
+    t_index * const T = table+static_cast<std::ptrdiff_t>(i)*S;
+    if (T[find(T, j)]==j) return false;
+    if (I[0]<N) erase(T, I[0]);
+    T[find(T, j)] = j;
+    // Replace the farthest neighbor at the root and sift down.
+    t_index pos = 0;
+    for (;;) {
+      t_index c = 2*pos+1;
+      if (c>=K) break;
+      if (c+1<K && closer(D[c], I[c], D[c+1], I[c+1])) ++c;
+      if (!closer(d, j, D[c], I[c])) break;
+      D[pos] = D[c];
+      I[pos] = I[c];
+      F[pos] = F[c];
+      pos = c;
+    }
+    D[pos] = d;
+    I[pos] = j;
+    F[pos] = 1;
+    return true;
+  }
+};
 
-      3) mindist[i] is never bigger than the true minimum. Hence, we never
-         miss the true minimum if we take the smallest mindist entry,
-         re-compute the value if necessary (thus maybe increasing it) and
-         looking for the now smallest mindist entry until a valid minimal
-         entry is found. This step is done in the lines below.
+/*
+  Approximate K-nearest-neighbor graph by NN-descent (W. Dong, M. Charikar,
+  K. Li, Efficient k-nearest neighbor graph construction for generic
+  similarity measures, WWW 2011).
+
+  Starting from K random neighbors per point, every round compares the
+  neighbors and reverse neighbors of each point with each other ("local
+  join"), since a neighbor of a neighbor is likely to be a neighbor. Only
+  pairs with at least one new entry since the last round are compared.
+
+  The forward and reverse lists of new and old neighbors are sampled down
+  to L = min(K, 60) entries each, which is the sampling rate rho = L/K of
+  the paper. New neighbors which are not sampled stay new for the next
+  round. A round therefore compares at most 6·L² pairs per point, instead
+  of O(K²) for large K. Smaller samples made the iteration converge more
+  slowly in high dimensions without saving time, so the lists are not
+  sampled for K ≤ 60. The iteration stops when fewer than N·K/1000 heap
+  entries changed in a round.
+*/
+template <typename t_dissimilarity>
+static void nn_descent_graph(const t_index N, t_dissimilarity & dist,
+                             knn_heaps<typename t_dissimilarity::float_type>
+                             & H,
+                             linkage_progress * const progress = NULL) {
+  typedef typename t_dissimilarity::float_type t_float;
+  const t_index K = H.K;
+  const std::ptrdiff_t NK = static_cast<std::ptrdiff_t>(N)*K;
+  const int max_rounds = 20;
+  const t_index max_candidates = 60;
+  xorshift_rng rng(static_cast<unsigned long long>(N));
+
+  bool nan_found = false;
+  auto eval = [&](const t_index p, const t_index q) -> t_index {
+    const t_float d = (p<q) ? dist(p, q) : dist(q, p);
+    if (fc_isnan(d)) nan_found = true;
+    return static_cast<t_index>(H.push(p, q, d)) +
+      static_cast<t_index>(H.push(q, p, d));
+  };
+
+  // Fill the heaps with random neighbors. A heap is full when its root,
+  // the farthest entry, is not an empty slot. Since K ≤ N-1, the scan over
+  // the following points from a random start terminates.
+  for (t_index i=0; i<N; ++i) {
+    t_index j = rng.below(N-1);
+    if (j>=i) ++j;
+    while (H.idx[static_cast<std::ptrdiff_t>(i)*K]==N) {
+      eval(i, j);
+      if (nan_found) throw(nan_error());
+      do {
+        j = (j+1==N) ? 0 : j+1;
+      } while (j==i);
+    }
+  }
 
-      The update process for D below takes care that these rules are
-      fulfilled. This makes sure that the minima in the rows D(i,i+1:)of D are
-      re-calculated when necessary but re-calculation is avoided whenever
-      possible.
+  // Sampled forward and reverse neighbor lists, L entries per point
+  const t_index L = (K<max_candidates) ? K : max_candidates;
+  const std::ptrdiff_t NL = static_cast<std::ptrdiff_t>(N)*L;
+  auto_array_ptr<t_index> fwd_new(NL), fwd_old(NL);
+  auto_array_ptr<t_index> rev_new(NL), rev_old(NL);
+  auto_array_ptr<t_index> n_fwd_new(N), n_fwd_old(N);
+  auto_array_ptr<t_index> n_rev_new(N), n_rev_old(N);
+  auto_array_ptr<t_index> seen_new(N), seen_old(N);
+  auto_array_ptr<t_index> cand_new(2*L), cand_old(2*L);
+  auto_array_ptr<t_index> pos_new(K), pos_old(K);
+
+  auto add_reverse = [&](t_index * const R, t_index * const n_R,
+                         t_index * const seen, const t_index j,
+                         const t_index i) {
+    // Reservoir sampling of at most L reverse neighbors
+    const std::ptrdiff_t o = static_cast<std::ptrdiff_t>(j)*L;
+    if (n_R[j]<L) {
+      R[o+n_R[j]++] = i;
+    }
+    else {
+      const t_index r = rng.below(seen[j]+1);
+      if (r<L) R[o+r] = i;
+    }
+    ++seen[j];
+  };
+
+  // Pick min(n, L) of the n heap positions in pos at random (partial
+  // Fisher-Yates shuffle), append their neighbors to the forward list F of
+  // point i and add i to their reverse lists.
+  auto sample = [&](t_index * const pos, const t_index n, const t_index i,
+                    t_index * const F, t_index * const n_F,
+                    t_index * const R, t_index * const n_R,
+                    t_index * const seen) {
+    const std::ptrdiff_t o = static_cast<std::ptrdiff_t>(i)*K;
+    for (t_index s=0; s<n && s<L; ++s) {
+      std::swap(pos[s], pos[s+rng.below(n-s)]);
+      const t_index j = H.idx[o+pos[s]];
+      H.isnew[o+pos[s]] = 0;
+      F[static_cast<std::ptrdiff_t>(i)*L+n_F[i]++] = j;
+      add_reverse(R, n_R, seen, j, i);
+    }
+  };
+
+  for (int round=0; round<max_rounds; ++round) {
+    std::fill_n(&*n_fwd_new, N, 0);
+    std::fill_n(&*n_fwd_old, N, 0);
+    std::fill_n(&*n_rev_new, N, 0);
+    std::fill_n(&*n_rev_old, N, 0);
+    std::fill_n(&*seen_new, N, 0);
+    std::fill_n(&*seen_old, N, 0);
+    for (t_index i=0; i<N; ++i) {
+      const std::ptrdiff_t o = static_cast<std::ptrdiff_t>(i)*K;
+      t_index n_new = 0, n_old = 0;
+      for (t_index k=0; k<K; ++k) {
+        if (H.idx[o+k]==N) continue;
+        if (H.isnew[o+k]) pos_new[n_new++] = k;
+        else pos_old[n_old++] = k;
+      }
+      sample(pos_new, n_new, i, fwd_new, n_fwd_new, rev_new, n_rev_new,
+             seen_new);
+      sample(pos_old, n_old, i, fwd_old, n_fwd_old, rev_old, n_rev_old,
+             seen_old);
+    }
 
-      The re-calculation of the minima makes the worst-case runtime of this
-      algorithm cubic in N. We avoid this whenever possible, and in most cases
-      the runtime appears to be quadratic.
-    */
-    idx1 = nn_distances.argmin();
-    if (method != METHOD_METR_SINGLE) {
-      while ( mindist[idx1] < D_(idx1, n_nghbr[idx1]) ) {
-        // Recompute the minimum mindist[idx1] and n_nghbr[idx1].
-        n_nghbr[idx1] = j = active_nodes.succ[idx1]; // exists, maximally N-1
-        min = D_(idx1,j);
-        for (j=active_nodes.succ[j]; j<N; j=active_nodes.succ[j]) {
-          if (D_(idx1,j)<min) {
-            min = D_(idx1,j);
-            n_nghbr[idx1] = j;
+    std::ptrdiff_t updates = 0;
+    for (t_index v=0; v<N; ++v) {
+      const std::ptrdiff_t l = static_cast<std::ptrdiff_t>(v)*L;
+      t_index * const cn_end =
+        std::copy(rev_new+l, rev_new+l+n_rev_new[v],
+                  std::copy(fwd_new+l, fwd_new+l+n_fwd_new[v], &*cand_new));
+      t_index * const co_end =
+        std::copy(rev_old+l, rev_old+l+n_rev_old[v],
+                  std::copy(fwd_old+l, fwd_old+l+n_fwd_old[v], &*cand_old));
+      std::sort(&*cand_new, cn_end);
+      std::sort(&*cand_old, co_end);
+      const t_index nn = static_cast<t_index>(
+          std::unique(&*cand_new, cn_end)-cand_new);
+      const t_index no = static_cast<t_index>(
+          std::unique(&*cand_old, co_end)-cand_old);
+      for (t_index a=0; a<nn; ++a) {
+        for (t_index b=a+1; b<nn; ++b) {
+          updates += eval(cand_new[a], cand_new[b]);
+        }
+        for (t_index b=0; b<no; ++b) {
+          if (cand_new[a]!=cand_old[b]) {
+            updates += eval(cand_new[a], cand_old[b]);
           }
         }
-        /* Update the heap with the new true minimum and search for the
-           (possibly different) minimal entry. */
-        nn_distances.update_geq(idx1, min);
-        idx1 = nn_distances.argmin();
       }
     }
+    if (nan_found) throw(nan_error());
+    if (progress) progress->poll();
+    if (updates*1000 <= NK) break;
+  }
+}
 
-    nn_distances.heap_pop(); // Remove the current minimum from the heap.
-    idx2 = n_nghbr[idx1];
-
-    // Write the newly found minimal pair of nodes to the output array.
-    node1 = row_repr[idx1];
-    node2 = row_repr[idx2];
+/*
+  Join the components of a spanning forest by exact shortest edges, with
+  Borůvka's algorithm: in each round, every component is joined with its
+  nearest other component. The distances from all points outside the
+  largest component to all other points are evaluated; this suffices,
+  since every edge leaving the largest component ends in another one.
+  The cost per round is therefore N·(N − size of the largest component).
+
+  "edges" is the number of edges in the forest, which grows to N-1.
+*/
+template <typename t_dissimilarity>
+static void connect_components_exact(const t_index N, t_dissimilarity & dist,
+                                     union_find & forest, t_index edges,
+                                     cluster_result & Z2,
+                                     linkage_progress * const progress
+                                     = NULL) {
+  typedef typename t_dissimilarity::float_type t_float;
+  auto_array_ptr<t_index> comp(N);
+  auto_array_ptr<t_index> label(2*N-1);
+  auto_array_ptr<t_index> comp_size(N);
+  auto_array_ptr<t_float> cand_d(N);
+  auto_array_ptr<t_index> cand_a(N);
+  auto_array_ptr<t_index> cand_b(N);
+
+  // Edges are ordered by their distance and then by the pair of point
+  // indices, as in MST_linkage_core_boruvka.
+  auto offer = [&](const t_index c, const t_float d, const t_index a,
+                   const t_index b) {
+    const t_index e0 = a<b ? a : b, e1 = a<b ? b : a;
+    if (cand_a[c]>=0) {
+      const t_index f0 = cand_a[c]<cand_b[c] ? cand_a[c] : cand_b[c];
+      const t_index f1 = cand_a[c]<cand_b[c] ? cand_b[c] : cand_a[c];
+      if (cand_d[c] < d) return;
+      if (!(d < cand_d[c]) && (f0<e0 || (f0==e0 && f1<e1))) return;
+    }
+    cand_d[c] = d;
+    cand_a[c] = a;
+    cand_b[c] = b;
+  };
+
+  while (edges < N-1) {
+    FILL_N(&*label, 2*N-1, -1);
+    t_index ncomp = 0;
+    for (t_index i=0; i<N; ++i) {
+      const t_index root = forest.Find(i);
+      if (label[root]<0) {
+        comp_size[ncomp] = 0;
+        label[root] = ncomp++;
+      }
+      comp[i] = label[root];
+      ++comp_size[comp[i]];
+    }
+    const t_index largest = static_cast<t_index>(
+        std::max_element(&*comp_size, comp_size+ncomp)-comp_size);
+    std::fill_n(&*cand_a, ncomp, -1);
+
+    for (t_index p=0; p<N; ++p) {
+      if (comp[p]==largest) continue;
+      for (t_index q=0; q<N; ++q) {
+        // Pairs of points outside the largest component are evaluated once.
+        if (comp[q]==comp[p] || (comp[q]!=largest && q<p)) continue;
+        const t_float d = (p<q) ? dist(p, q) : dist(q, p);
+        if (fc_isnan(d)) throw(nan_error());
+        offer(comp[p], d, p, q);
+        offer(comp[q], d, q, p);
+      }
+    }
 
-    if (method==METHOD_METR_AVERAGE ||
-        method==METHOD_METR_WARD ||
-        method==METHOD_METR_CENTROID) {
-      size1 = static_cast<t_float>(members[idx1]);
-      size2 = static_cast<t_float>(members[idx2]);
-      members[idx2] += members[idx1];
+    for (t_index c=0; c<ncomp; ++c) {
+      const t_index a = forest.Find(cand_a[c]);
+      const t_index b = forest.Find(cand_b[c]);
+      if (a!=b) {
+        forest.Union(a, b);
+        Z2.append(cand_a[c], cand_b[c], cand_d[c]);
+        ++edges;
+      }
     }
-    Z2.append(node1, node2, mindist[idx1]);
+    if (progress) (*progress)(edges, Z2[edges-1]->dist);
+  }
+}
 
-    // Remove idx1 from the list of active indices (active_nodes).
-    active_nodes.remove(idx1);
-    // Index idx2 now represents the new (merged) node with label N+i.
-    row_repr[idx2] = N+i;
+template <typename t_dissimilarity>
+static void MST_linkage_core_nndescent(const t_index N,
+                                       t_dissimilarity & dist,
+                                       const t_index K,
+                                       cluster_result & Z2,
+                                       linkage_progress * const progress
+                                       = NULL) {
+/*
+    N: integer, number of data points
+    dist: function pointer to the metric
+    K: number of neighbors per point, 1 ≤ K ≤ N-1
+    Z2: output data structure
+    progress: progress reports (optional); NN-descent polls it after each
+      round, and the spanning forest is reported after Kruskal's algorithm
+      and after each round of connect_components_exact
+
+    Approximate single linkage clustering: the minimum spanning tree of an
+    approximate K-nearest-neighbor graph from NN-descent, computed with
+    Kruskal's algorithm. If the graph is not connected, its components are
+    joined by their exact shortest edges. Every merging distance is the
+    exact distance of the joined points, and hence at least the merging
+    distance of exact single linkage at that step. Larger K gives a better
+    approximation at a higher cost.
+*/
+  typedef typename t_dissimilarity::float_type t_float;
+  union_find forest(N);
+  t_index edges;
+  {
+    knn_heaps<t_float> H(N, K);
+    nn_descent_graph(N, dist, H, progress);
+
+    // Edge list of the graph; the neighbor lists are the J column.
+    const std::ptrdiff_t NK = static_cast<std::ptrdiff_t>(N)*K;
+    auto_array_ptr<t_index> I(NK);
+    for (t_index i=0; i<N; ++i) {
+      std::fill_n(I+static_cast<std::ptrdiff_t>(i)*K, K, i);
+    }
+    edges = kruskal_forest(N, NK, &*I, &*H.idx, &*H.dist, forest, Z2);
+  }
+  if (progress && edges>0) (*progress)(edges, Z2[edges-1]->dist);
+  connect_components_exact(N, dist, forest, edges, Z2, progress);
+}
 
-    // Update the distance matrix
-    switch (method) {
-    case METHOD_METR_SINGLE:
-      /*
-        Single linkage.
+/*
+  Whether NN-descent with K neighbors per point is expected to be faster
+  than the exact N(N-1)/2 distance evaluations of Prim's algorithm. A round
+  of local joins compares about 2·K² pairs per point for K ≤ 60, and
+  NN-descent takes several rounds. On the test machine, both took the same
+  time for K² ≈ N/8 (N = 20000 points in 64 dimensions, K = 50). For
+  N = 500 and K = 499, Prim's algorithm took milliseconds, NN-descent 0.2 s.
+*/
+inline static bool nn_descent_pays_off(const t_index N, const t_index K) {
+  return 8*static_cast<double>(K)*static_cast<double>(K) <
+    static_cast<double>(N);
+}
 
-        Characteristic: new distances are never longer than the old distances.
-      */
-      // Update the distance matrix in the range [start, idx1).
 #ifdef _OPENMP
-      #pragma omp parallel for schedule(static)
-      for (t_index k=0; k<N; ++k) {
-        if (active_nodes.succ[k] == 0) continue; // Skip inactive nodes
-        t_index j = k;
-        if (j >= active_nodes.start && j < idx1) {
-          f_single(&D_(j, idx2), D_(j, idx1));
-          if (n_nghbr[j] == idx1)
-            n_nghbr[j] = idx2;
+/*
+  Multithreaded variants of generic_linkage_vector and
+  generic_linkage_vector_alternative below, which call them for large inputs
+  when several threads are available. The active nodes are stored in a
+  compacted index array, so that the nearest neighbor searches can be split
+  between the threads. The output is the same as for the serial cores.
+
+  Nearest neighbor searches for these cores. Every dissimilarity costs a
+  pass over the coordinates here, so the initial search for all points and
+  the rescans in the main loop dominate the running time.
+
+  nn_scan returns the active node j at the positions [k0, k1) of active_nodes
+  with the smallest dissimilarity dist_to(j), and this dissimilarity in min.
+  The range must contain an active node. The result is the same as for the
+  serial scan in ascending index order with strict comparisons: the smallest
+  index wins ties, and if all dissimilarities are infinite, the first active
+  node in the range is returned.
+
+  Long scans are split between the OpenMP threads, and the thread results are
+  combined by (value, index). The dissimilarity functions throw nan_error,
+  which must not leave a parallel region, so a NaN is recorded in the threads
+  and raised afterwards.
+*/
+template <typename t_float, typename t_dist>
+static t_index nn_scan(const active_index_array & active_nodes,
+                       const t_index k0, const t_index k1,
+                       const t_dist & dist_to, t_float & min) {
+  t_index j, idx = -1;
+  min = std::numeric_limits<t_float>::infinity();
+  if (use_parallel(k1-k0)) {
+    bool nan_found = false;
+#pragma omp parallel private(j) reduction(||:nan_found)
+    {
+      t_float local = std::numeric_limits<t_float>::infinity();
+      t_index local_idx = -1;
+#pragma omp for schedule(static) nowait
+      for (t_index k=k0; k<k1; ++k) {
+        if (nan_found || (j=active_nodes[k])<0) continue;
+        try {
+          t_float const tmp = dist_to(j);
+          if (tmp < local) {
+            local = tmp;
+            local_idx = j;
+          }
+        }
+        catch (const nan_error &) {
+          nan_found = true;
         }
       }
-#else
-      for (j=active_nodes.start; j<idx1; j=active_nodes.succ[j]) {
-        f_single(&D_(j, idx2), D_(j, idx1));
-        if (n_nghbr[j] == idx1)
-          n_nghbr[j] = idx2;
+#if HAVE_DIAGNOSTIC
+#pragma GCC diagnostic push
+#pragma GCC diagnostic ignored "-Wfloat-equal"
+#endif
+#pragma omp critical
+      if (local_idx>=0 &&
+          (idx<0 || local < min || (local==min && local_idx < idx))) {
+        min = local;
+        idx = local_idx;
       }
+#if HAVE_DIAGNOSTIC
+#pragma GCC diagnostic pop
 #endif
-      
-      // Update the distance matrix in the range (idx1, idx2).
-      for (; j<idx2; j=active_nodes.succ[j]) {
-        f_single(&D_(j, idx2), D_(idx1, j));
-        // If the new value is below the old minimum in a row, update
-        // the mindist and n_nghbr arrays.
-        if (D_(j, idx2) < mindist[j]) {
-          nn_distances.update_leq(j, D_(j, idx2));
-          n_nghbr[j] = idx2;
-        }
+    }
+    if (nan_found) throw(nan_error());
+  }
+  else
+  FOR_ACTIVE(j, active_nodes, k0, k1) {
+    t_float const tmp = dist_to(j);
+    if (tmp < min) {
+      min = tmp;
+      idx = j;
+    }
+  }
+  if (idx<0) {
+    // All dissimilarities are infinite.
+    for (t_index k=k0; (idx=active_nodes[k])<0; ++k) {}
+  }
+  return idx;
+}
+
+/*
+  The dissimilarities dist_to(j) for the active nodes j at the positions
+  [k0, k1) of active_nodes, stored in out[j]. This is the expensive part of
+  the distance updates in the vector cores, which then process the values
+  serially. Parallelized as in nn_scan.
+*/
+template <typename t_float, typename t_dist>
+static void dist_fill(const active_index_array & active_nodes,
+                      const t_index k0, const t_index k1,
+                      const t_dist & dist_to, t_float * const out) {
+  t_index j;
+  if (use_parallel(k1-k0)) {
+    bool nan_found = false;
+#pragma omp parallel for private(j) schedule(static) reduction(||:nan_found)
+    for (t_index k=k0; k<k1; ++k) {
+      if (nan_found || (j=active_nodes[k])<0) continue;
+      try {
+        out[j] = dist_to(j);
       }
-      
-      // Update the distance matrix in the range (idx2, N).
-      // Recompute the minimum mindist[idx2] and n_nghbr[idx2].
-      if (idx2<N_1) {
-        min = mindist[idx2];
-        for (j=active_nodes.succ[idx2]; j<N; j=active_nodes.succ[j]) {
-          f_single(&D_(idx2, j), D_(idx1, j) );
-          if (D_(idx2, j) < min) {
-            n_nghbr[idx2] = j;
-            min = D_(idx2, j);
-          }
-        }
-        nn_distances.update_leq(idx2, min);
+      catch (const nan_error &) {
+        nan_found = true;
       }
-      break;
+    }
+    if (nan_found) throw(nan_error());
+    return;
+  }
+  FOR_ACTIVE(j, active_nodes, k0, k1) {
+    out[j] = dist_to(j);
+  }
+}
 
-    case METHOD_METR_COMPLETE:
-      /*
-        Complete linkage.
+template <method_codes_vector method, typename t_dissimilarity>
+static void generic_linkage_vector_parallel(const t_index N,
+                                            t_dissimilarity & dist,
+                                            cluster_result & Z2,
+                                            linkage_progress * const progress) {
+  /*
+    N: integer, number of data points
+    dist: function pointer to the metric
+    Z2: output data structure
+    progress: progress reports (optional)
 
-        Characteristic: new distances are never shorter than the old distances.
-      */
-      // Update the distance matrix in the range [start, idx1).
-      for (j=active_nodes.start; j<idx1; j=active_nodes.succ[j]) {
-        f_complete(&D_(j, idx2), D_(j, idx1) );
-        if (n_nghbr[j] == idx1)
-          n_nghbr[j] = idx2;
-      }
-      // Update the distance matrix in the range (idx1, idx2).
-      for (; j<idx2; j=active_nodes.succ[j])
-        f_complete(&D_(j, idx2), D_(idx1, j) );
-      // Update the distance matrix in the range (idx2, N).
-      for (j=active_nodes.succ[idx2]; j<N; j=active_nodes.succ[j])
-        f_complete(&D_(idx2, j), D_(idx1, j) );
-      break;
+    This algorithm is valid for the distance update methods
+    "Ward", "centroid" and "median" only!
+  */
+  typedef typename t_dissimilarity::float_type t_float;
+  const t_index N_1 = N-1;
+  t_index i, j; // loop variables
+  t_index idx1, idx2; // row and column indices
+  t_index pos1, pos2; // their positions in active_nodes
 
-    case METHOD_METR_AVERAGE: {
-      /*
-        Average linkage.
+  auto_array_ptr<t_index> n_nghbr(N_1); // array of nearest neighbors
+  auto_array_ptr<t_float> mindist(N_1); // distances to the nearest neighbors
+  auto_array_ptr<t_float> new_dist(N); // updated distances to the new node
+  auto_array_ptr<t_index> row_repr(N); // row_repr[i]: node number that the
+                                       // i-th row represents
+  active_index_array active_nodes(N);
+  binary_min_heap<t_float> nn_distances(&*mindist, N_1); // minimum heap
+      // structure for the distance to the nearest neighbor of each point
+  t_index node1, node2;     // node numbers in the output
+  t_float min; // minimum and row index for nearest-neighbor search
 
-        Shorter and longer distances can occur.
-      */
-      // Update the distance matrix in the range [start, idx1).
-      t_float s = size1/(size1+size2);
-      t_float t = size2/(size1+size2);
-      for (j=active_nodes.start; j<idx1; j=active_nodes.succ[j]) {
-        f_average(&D_(j, idx2), D_(j, idx1), s, t);
-        if (n_nghbr[j] == idx1)
-          n_nghbr[j] = idx2;
-      }
-      // Update the distance matrix in the range (idx1, idx2).
-      for (; j<idx2; j=active_nodes.succ[j]) {
-        f_average(&D_(j, idx2), D_(idx1, j), s, t);
-        if (D_(j, idx2) < mindist[j]) {
-          nn_distances.update_leq(j, D_(j, idx2));
-          n_nghbr[j] = idx2;
+  for (i=0; i<N; ++i)
+    // Build a list of row ↔ node label assignments.
+    // Initially i ↦ i
+    row_repr[i] = i;
+
+  // Initialize the minimal distances:
+  // Find the nearest neighbor of each point.
+  // n_nghbr[i] = argmin_{j>i} D(i,j) for i in range(N-1)
+  // The rows are independent and are distributed over the OpenMP threads.
+  bool nan_found = false;
+#pragma omp parallel for schedule(dynamic, 16) reduction(||:nan_found)
+  for (t_index ii=0; ii<N_1; ++ii) {
+    t_float min_val = std::numeric_limits<t_float>::infinity();
+    t_index min_idx = ii+1;
+    try {
+      for (t_index jj=ii+1; jj<N; ++jj) {
+        t_float tmp;
+        switch (method) {
+        case METHOD_VECTOR_WARD:
+          tmp = dist.ward_initial(ii,jj);
+          break;
+        default:
+          tmp = dist.template sqeuclidean<true>(ii,jj);
         }
-      }
-      // Update the distance matrix in the range (idx2, N).
-      if (idx2<N_1) {
-        n_nghbr[idx2] = j = active_nodes.succ[idx2]; // exists, maximally N-1
-        f_average(&D_(idx2, j), D_(idx1, j), s, t);
-        min = D_(idx2,j);
-        for (j=active_nodes.succ[j]; j<N; j=active_nodes.succ[j]) {
-          f_average(&D_(idx2, j), D_(idx1, j), s, t);
-          if (D_(idx2,j) < min) {
-            min = D_(idx2,j);
-            n_nghbr[idx2] = j;
-          }
+        if (tmp<min_val) {
+          min_val = tmp;
+          min_idx = jj;
         }
-        nn_distances.update(idx2, min);
       }
+    }
+    catch (const nan_error &) {
+      nan_found = true;
+    }
+    switch (method) {
+    case METHOD_VECTOR_WARD:
+      mindist[ii] = t_dissimilarity::ward_initial_conversion(min_val);
       break;
+    default:
+      mindist[ii] = min_val;
     }
+    n_nghbr[ii] = min_idx;
+  }
+  if (nan_found) throw(nan_error());
 
-    case METHOD_METR_WEIGHTED:
-      /*
-        Weighted linkage.
+  // Put the minimal distances into a heap structure to make the repeated
+  // global minimum searches fast.
+  nn_distances.heapify();
 
-        Shorter and longer distances can occur.
-      */
-      // Update the distance matrix in the range [start, idx1).
-      for (j=active_nodes.start; j<idx1; j=active_nodes.succ[j]) {
-        f_weighted(&D_(j, idx2), D_(j, idx1) );
-        if (n_nghbr[j] == idx1)
-          n_nghbr[j] = idx2;
-      }
-      // Update the distance matrix in the range (idx1, idx2).
-      for (; j<idx2; j=active_nodes.succ[j]) {
-        f_weighted(&D_(j, idx2), D_(idx1, j) );
-        if (D_(j, idx2) < mindist[j]) {
-          nn_distances.update_leq(j, D_(j, idx2));
-          n_nghbr[j] = idx2;
-        }
-      }
-      // Update the distance matrix in the range (idx2, N).
-      if (idx2<N_1) {
-        n_nghbr[idx2] = j = active_nodes.succ[idx2]; // exists, maximally N-1
-        f_weighted(&D_(idx2, j), D_(idx1, j) );
-        min = D_(idx2,j);
-        for (j=active_nodes.succ[j]; j<N; j=active_nodes.succ[j]) {
-          f_weighted(&D_(idx2, j), D_(idx1, j) );
-          if (D_(idx2,j) < min) {
-            min = D_(idx2,j);
-            n_nghbr[idx2] = j;
-          }
-        }
-        nn_distances.update(idx2, min);
+  // Main loop: We have N-1 merging steps.
+  for (i=0; i<N_1; ++i) {
+    active_nodes.compact();
+    idx1 = nn_distances.argmin();
+
+    while ( active_nodes.is_inactive(n_nghbr[idx1]) ) {
+      // Recompute the minimum mindist[idx1] and n_nghbr[idx1].
+      pos1 = active_nodes.pos(idx1)+1;
+      switch (method) {
+      case METHOD_VECTOR_WARD:
+        n_nghbr[idx1] = nn_scan(active_nodes, pos1, active_nodes.size,
+                                [&dist, idx1](const t_index k) {
+                                  return dist.ward(idx1,k);
+                                }, min);
+        break;
+      default:
+        n_nghbr[idx1] = nn_scan(active_nodes, pos1, active_nodes.size,
+                                [&dist, idx1](const t_index k) {
+                                  return dist.template sqeuclidean<true>(idx1,k);
+                                }, min);
       }
+      /* Update the heap with the new true minimum and search for the (possibly
+         different) minimal entry. */
+      nn_distances.update_geq(idx1, min);
+      idx1 = nn_distances.argmin();
+    }
+
+    nn_distances.heap_pop(); // Remove the current minimum from the heap.
+    idx2 = n_nghbr[idx1];
+
+    // Write the newly found minimal pair of nodes to the output array.
+    node1 = row_repr[idx1];
+    node2 = row_repr[idx2];
+
+    Z2.append(node1, node2, mindist[idx1]);
+    if (progress) (*progress)(i+1, mindist[idx1]);
+
+    switch (method) {
+    case METHOD_VECTOR_WARD:
+    case METHOD_VECTOR_CENTROID:
+      dist.merge_inplace(idx1, idx2);
       break;
+    case METHOD_VECTOR_MEDIAN:
+      dist.merge_inplace_weighted(idx1, idx2);
+      break;
+    default:
+      throw std::runtime_error(std::string("Invalid method."));
+    }
 
-    case METHOD_METR_WARD:
+    // Index idx2 now represents the new (merged) node with label N+i.
+    row_repr[idx2] = N+i;
+    // Remove idx1 from the list of active indices (active_nodes).
+    active_nodes.remove(idx1);  // TBD later!!!
+    pos1 = active_nodes.pos(idx1);
+    pos2 = active_nodes.pos(idx2);
+
+    // Update the distance matrix
+    switch (method) {
+    case METHOD_VECTOR_WARD:
       /*
         Ward linkage.
 
@@ -1422,225 +5529,261 @@ static void generic_linkage(const t_index N, t_float * const D, t_members * cons
         but maybe bigger than max(d1,d2).
       */
       // Update the distance matrix in the range [start, idx1).
-      for (j=active_nodes.start; j<idx1; j=active_nodes.succ[j]) {
-        f_ward(&D_(j, idx2), D_(j, idx1), mindist[idx1],
-               size1, size2, static_cast<t_float>(members[j]) );
-        if (n_nghbr[j] == idx1)
-          n_nghbr[j] = idx2;
+      FOR_ACTIVE(j, active_nodes, 0, pos1) {
+        if (n_nghbr[j] == idx2) {
+          n_nghbr[j] = idx1; // invalidate
+        }
       }
       // Update the distance matrix in the range (idx1, idx2).
-      for (; j<idx2; j=active_nodes.succ[j]) {
-        f_ward(&D_(j, idx2), D_(idx1, j), mindist[idx1], size1, size2,
-               static_cast<t_float>(members[j]) );
-        if (D_(j, idx2) < mindist[j]) {
-          nn_distances.update_leq(j, D_(j, idx2));
+      dist_fill(active_nodes, pos1+1, pos2,
+                [&dist, idx2](const t_index k) {
+                  return dist.ward(k, idx2);
+                }, &*new_dist);
+      FOR_ACTIVE(j, active_nodes, pos1+1, pos2) {
+        t_float const tmp = new_dist[j];
+        if (tmp < mindist[j]) {
+          nn_distances.update_leq(j, tmp);
           n_nghbr[j] = idx2;
         }
+        else if (n_nghbr[j]==idx2) {
+          n_nghbr[j] = idx1; // invalidate
+        }
       }
-      // Update the distance matrix in the range (idx2, N).
+      // Find the nearest neighbor for idx2.
       if (idx2<N_1) {
-        n_nghbr[idx2] = j = active_nodes.succ[idx2]; // exists, maximally N-1
-        f_ward(&D_(idx2, j), D_(idx1, j), mindist[idx1],
-               size1, size2, static_cast<t_float>(members[j]) );
-        min = D_(idx2,j);
-        for (j=active_nodes.succ[j]; j<N; j=active_nodes.succ[j]) {
-          f_ward(&D_(idx2, j), D_(idx1, j), mindist[idx1],
-                 size1, size2, static_cast<t_float>(members[j]) );
-          if (D_(idx2,j) < min) {
-            min = D_(idx2,j);
-            n_nghbr[idx2] = j;
-          }
-        }
+        n_nghbr[idx2] = nn_scan(active_nodes, pos2+1, active_nodes.size,
+                                [&dist, idx2](const t_index k) {
+                                  return dist.ward(idx2,k);
+                                }, min);
         nn_distances.update(idx2, min);
       }
       break;
 
-    case METHOD_METR_CENTROID: {
+    default:
       /*
-        Centroid linkage.
+        Centroid and median linkage.
 
         Shorter and longer distances can occur, not bigger than max(d1,d2)
         but maybe smaller than min(d1,d2).
       */
-      // Update the distance matrix in the range [start, idx1).
-      t_float s = size1/(size1+size2);
-      t_float t = size2/(size1+size2);
-      t_float stc = s*t*mindist[idx1];
-      for (j=active_nodes.start; j<idx1; j=active_nodes.succ[j]) {
-        f_centroid(&D_(j, idx2), D_(j, idx1), stc, s, t);
-        if (D_(j, idx2) < mindist[j]) {
-          nn_distances.update_leq(j, D_(j, idx2));
-          n_nghbr[j] = idx2;
-        }
-        else if (n_nghbr[j] == idx1)
-          n_nghbr[j] = idx2;
-      }
-      // Update the distance matrix in the range (idx1, idx2).
-      for (; j<idx2; j=active_nodes.succ[j]) {
-        f_centroid(&D_(j, idx2), D_(idx1, j), stc, s, t);
-        if (D_(j, idx2) < mindist[j]) {
-          nn_distances.update_leq(j, D_(j, idx2));
+      dist_fill(active_nodes, 0, pos2,
+                [&dist, idx2](const t_index k) {
+                  return dist.template sqeuclidean<true>(k, idx2);
+                }, &*new_dist);
+      FOR_ACTIVE(j, active_nodes, 0, pos2) {
+        t_float const tmp = new_dist[j];
+        if (tmp < mindist[j]) {
+          nn_distances.update_leq(j, tmp);
           n_nghbr[j] = idx2;
         }
+        else if (n_nghbr[j] == idx2)
+          n_nghbr[j] = idx1; // invalidate
       }
-      // Update the distance matrix in the range (idx2, N).
+      // Find the nearest neighbor for idx2.
       if (idx2<N_1) {
-        n_nghbr[idx2] = j = active_nodes.succ[idx2]; // exists, maximally N-1
-        f_centroid(&D_(idx2, j), D_(idx1, j), stc, s, t);
-        min = D_(idx2,j);
-        for (j=active_nodes.succ[j]; j<N; j=active_nodes.succ[j]) {
-          f_centroid(&D_(idx2, j), D_(idx1, j), stc, s, t);
-          if (D_(idx2,j) < min) {
-            min = D_(idx2,j);
-            n_nghbr[idx2] = j;
-          }
-        }
+        n_nghbr[idx2] = nn_scan(active_nodes, pos2+1, active_nodes.size,
+                                [&dist, idx2](const t_index k) {
+                                  return dist.template sqeuclidean<true>(idx2,k);
+                                }, min);
         nn_distances.update(idx2, min);
       }
-      break;
     }
+  }
+}
 
-    case METHOD_METR_MEDIAN: {
-      /*
-        Median linkage.
+template <method_codes_vector method, typename t_dissimilarity>
+static void generic_linkage_vector_alternative_parallel(
+    const t_index N, t_dissimilarity & dist, cluster_result & Z2,
+    linkage_progress * const progress) {
+  /*
+    N: integer, number of data points
+    dist: function pointer to the metric
+    Z2: output data structure
+    progress: progress reports (optional)
 
-        Shorter and longer distances can occur, not bigger than max(d1,d2)
-        but maybe smaller than min(d1,d2).
-      */
-      // Update the distance matrix in the range [start, idx1).
-      t_float c_4 = mindist[idx1]*.25;
-      for (j=active_nodes.start; j<idx1; j=active_nodes.succ[j]) {
-        f_median(&D_(j, idx2), D_(j, idx1), c_4 );
-        if (D_(j, idx2) < mindist[j]) {
-          nn_distances.update_leq(j, D_(j, idx2));
-          n_nghbr[j] = idx2;
-        }
-        else if (n_nghbr[j] == idx1)
-          n_nghbr[j] = idx2;
-      }
-      // Update the distance matrix in the range (idx1, idx2).
-      for (; j<idx2; j=active_nodes.succ[j]) {
-        f_median(&D_(j, idx2), D_(idx1, j), c_4 );
-        if (D_(j, idx2) < mindist[j]) {
-          nn_distances.update_leq(j, D_(j, idx2));
-          n_nghbr[j] = idx2;
+    This algorithm is valid for the distance update methods
+    "Ward", "centroid" and "median" only!
+  */
+  typedef typename t_dissimilarity::float_type t_float;
+  const t_index N_1 = N-1;
+  t_index i; // loop variable
+  t_index idx1, idx2; // row and column indices
+
+  auto_array_ptr<t_index> n_nghbr(2*N-2); // array of nearest neighbors
+  auto_array_ptr<t_float> mindist(2*N-2); // distances to the nearest neighbors
+
+  active_index_array active_nodes(N+N_1);
+  binary_min_heap<t_float> nn_distances(&*mindist, N_1, 2*N-2, 1); // minimum
+      // heap structure for the distance to the nearest neighbor of each point
+
+  t_float min; // minimum for nearest-neighbor searches
+
+  // Initialize the minimal distances:
+  // Find the nearest neighbor of each point.
+  // n_nghbr[i] = argmin_{j<i} D(i,j) for i in range(1,N)
+  // The rows are independent and are distributed over the OpenMP threads.
+  bool nan_found = false;
+#pragma omp parallel for schedule(dynamic, 16) reduction(||:nan_found)
+  for (t_index ii=1; ii<N; ++ii) {
+    t_float min_val = std::numeric_limits<t_float>::infinity();
+    t_index min_idx = 0;
+    try {
+      for (t_index jj=0; jj<ii; ++jj) {
+        t_float tmp;
+        switch (method) {
+        case METHOD_VECTOR_WARD:
+          tmp = dist.ward_initial(ii,jj);
+          break;
+        default:
+          tmp = dist.template sqeuclidean<true>(ii,jj);
         }
-      }
-      // Update the distance matrix in the range (idx2, N).
-      if (idx2<N_1) {
-        n_nghbr[idx2] = j = active_nodes.succ[idx2]; // exists, maximally N-1
-        f_median(&D_(idx2, j), D_(idx1, j), c_4 );
-        min = D_(idx2,j);
-        for (j=active_nodes.succ[j]; j<N; j=active_nodes.succ[j]) {
-          f_median(&D_(idx2, j), D_(idx1, j), c_4 );
-          if (D_(idx2,j) < min) {
-            min = D_(idx2,j);
-            n_nghbr[idx2] = j;
-          }
+        if (tmp<min_val) {
+          min_val = tmp;
+          min_idx = jj;
         }
-        nn_distances.update(idx2, min);
       }
-      break;
     }
-
+    catch (const nan_error &) {
+      nan_found = true;
+    }
+    switch (method) {
+    case METHOD_VECTOR_WARD:
+      mindist[ii] = t_dissimilarity::ward_initial_conversion(min_val);
+      break;
     default:
-      throw std::runtime_error(std::string("Invalid method."));
+      mindist[ii] = min_val;
     }
+    n_nghbr[ii] = min_idx;
   }
-  #ifdef FE_INVALID
-  if (fetestexcept(FE_INVALID)) throw fenv_error();
-  #endif
-}
+  if (nan_found) throw(nan_error());
 
-/*
-  Clustering methods for vector data
-*/
+  // Put the minimal distances into a heap structure to make the repeated
+  // global minimum searches fast.
+  nn_distances.heapify();
 
-template <typename t_dissimilarity>
-static void MST_linkage_core_vector(const t_index N,
-                                    t_dissimilarity & dist,
-                                    cluster_result & Z2) {
-/*
-    N: integer, number of data points
-    dist: function pointer to the metric
-    Z2: output data structure
+  // Main loop: We have N-1 merging steps.
+  for (i=N; i<N+N_1; ++i) {
+    /*
+      The bookkeeping is different from the "stored matrix approach" algorithm
+      generic_linkage.
+
+      mindist[i] stores a lower bound on the minimum distance of the point i to
+      all points of *lower* index:
+
+          mindist[i] ≥ min_{j<i} D(i,j)
+
+      Moreover, new nodes do not re-use one of the old indices, but they are
+      given a new, unique index (SciPy convention: initial nodes are 0,…,N−1,
+      new nodes are N,…,2N−2).
+
+      Invalid nearest neighbors are not recognized by the fact that the stored
+      distance is smaller than the actual distance, but the list active_nodes
+      maintains a flag whether a node is inactive. If n_nghbr[i] points to an
+      active node, the entries nn_distances[i] and n_nghbr[i] are valid,
+      otherwise they must be recomputed.
+    */
+    active_nodes.compact();
+    idx1 = nn_distances.argmin();
+    while ( active_nodes.is_inactive(n_nghbr[idx1]) ) {
+      // Recompute the minimum mindist[idx1] and n_nghbr[idx1].
+      switch (method) {
+      case METHOD_VECTOR_WARD:
+        n_nghbr[idx1] = nn_scan(active_nodes, 0, active_nodes.pos(idx1),
+                                [&dist, idx1](const t_index k) {
+                                  return dist.ward_extended(idx1,k);
+                                }, min);
+        break;
+      default:
+        n_nghbr[idx1] = nn_scan(active_nodes, 0, active_nodes.pos(idx1),
+                                [&dist, idx1](const t_index k) {
+                                  return dist.sqeuclidean_extended(idx1,k);
+                                }, min);
+      }
+      /* Update the heap with the new true minimum and search for the (possibly
+         different) minimal entry. */
+      nn_distances.update_geq(idx1, min);
+      idx1 = nn_distances.argmin();
+    }
 
-    The basis of this algorithm is an algorithm by Rohlf:
+    idx2 = n_nghbr[idx1];
+    active_nodes.remove(idx1);
+    active_nodes.remove(idx2);
 
-    F. James Rohlf, Hierarchical clustering using the minimum spanning tree,
-    The Computer Journal, vol. 16, 1973, p. 93–95.
-*/
-  t_index i;
-  t_index idx2;
-  doubly_linked_list active_nodes(N);
-  auto_array_ptr<t_float> d(N);
+    Z2.append(idx1, idx2, mindist[idx1]);
+    if (progress) (*progress)(i-N+1, mindist[idx1]);
 
-  t_index prev_node;
-  t_float min;
+    if (i<2*N_1) {
+      switch (method) {
+      case METHOD_VECTOR_WARD:
+      case METHOD_VECTOR_CENTROID:
+        dist.merge(idx1, idx2, i);
+        break;
 
-  // first iteration
-  idx2 = 1;
-  min = std::numeric_limits<t_float>::infinity();
-  for (i=1; i<N; ++i) {
-    d[i] = dist(0,i);
-#if HAVE_DIAGNOSTIC
-#pragma GCC diagnostic push
-#pragma GCC diagnostic ignored "-Wfloat-equal"
-#endif
-    if (d[i] < min) {
-      min = d[i];
-      idx2 = i;
-    }
-    else if (fc_isnan(d[i]))
-      throw (nan_error());
-#if HAVE_DIAGNOSTIC
-#pragma GCC diagnostic pop
-#endif
-  }
+      case METHOD_VECTOR_MEDIAN:
+        dist.merge_weighted(idx1, idx2, i);
+        break;
 
-  Z2.append(0, idx2, min);
+      default:
+        throw std::runtime_error(std::string("Invalid method."));
+      }
 
-  for (t_index j=1; j<N-1; ++j) {
-    prev_node = idx2;
-    active_nodes.remove(prev_node);
+      if (method==METHOD_VECTOR_WARD) {
+        /*
+          Ward linkage.
 
-    idx2 = active_nodes.succ[0];
-    min = d[idx2];
+          Shorter and longer distances can occur, not smaller than min(d1,d2)
+          but maybe bigger than max(d1,d2).
+        */
+        n_nghbr[i] = nn_scan(active_nodes, 0, active_nodes.pos(i),
+                             [&dist, i](const t_index k) {
+                               return dist.ward_extended(k, i);
+                             }, min);
+      }
+      else {
+        /*
+          Centroid and median linkage.
 
-    for (i=idx2; i<N; i=active_nodes.succ[i]) {
-      t_float tmp = dist(i, prev_node);
-#if HAVE_DIAGNOSTIC
-#pragma GCC diagnostic push
-#pragma GCC diagnostic ignored "-Wfloat-equal"
-#endif
-      if (d[i] > tmp)
-        d[i] = tmp;
-      else if (fc_isnan(tmp))
-        throw (nan_error());
-#if HAVE_DIAGNOSTIC
-#pragma GCC diagnostic pop
-#endif
-      if (d[i] < min) {
-        min = d[i];
-        idx2 = i;
+          Shorter and longer distances can occur, not bigger than max(d1,d2)
+          but maybe smaller than min(d1,d2).
+        */
+        n_nghbr[i] = nn_scan(active_nodes, 0, active_nodes.pos(i),
+                             [&dist, i](const t_index k) {
+                               return dist.sqeuclidean_extended(k, i);
+                             }, min);
+      }
+      const t_index start = active_nodes.first();
+      if (idx2<start)  {
+        nn_distances.remove(start);
+      } else {
+        nn_distances.remove(idx2);
       }
+      nn_distances.replace(idx1, i, min);
     }
-    Z2.append(prev_node, idx2, min);
   }
 }
+#endif // _OPENMP
 
 template <method_codes_vector method, typename t_dissimilarity>
 static void generic_linkage_vector(const t_index N,
                                    t_dissimilarity & dist,
-                                   cluster_result & Z2) {
+                                   cluster_result & Z2,
+                                   linkage_progress * const progress = NULL) {
   /*
     N: integer, number of data points
     dist: function pointer to the metric
     Z2: output data structure
+    progress: progress reports (optional)
 
     This algorithm is valid for the distance update methods
     "Ward", "centroid" and "median" only!
   */
+#ifdef _OPENMP
+  if (use_parallel(N)) {
+    generic_linkage_vector_parallel<method>(N, dist, Z2, progress);
+    return;
+  }
+#endif
+  typedef typename t_dissimilarity::float_type t_float;
   const t_index N_1 = N-1;
   t_index i, j; // loop variables
   t_index idx1, idx2; // row and column indices
@@ -1650,8 +5793,8 @@ static void generic_linkage_vector(const t_index N,
   auto_array_ptr<t_index> row_repr(N); // row_repr[i]: node number that the
                                        // i-th row represents
   doubly_linked_list active_nodes(N);
-  binary_min_heap nn_distances(&*mindist, N_1); // minimum heap structure for
-                        // the distance to the nearest neighbor of each point
+  binary_min_heap<t_float> nn_distances(&*mindist, N_1); // minimum heap
+      // structure for the distance to the nearest neighbor of each point
   t_index node1, node2;     // node numbers in the output
   t_float min; // minimum and row index for nearest-neighbor search
 
@@ -1736,6 +5879,7 @@ static void generic_linkage_vector(const t_index N,
     node2 = row_repr[idx2];
 
     Z2.append(node1, node2, mindist[idx1]);
+    if (progress) (*progress)(i+1, mindist[idx1]);
 
     switch (method) {
     case METHOD_VECTOR_WARD:
@@ -1831,15 +5975,25 @@ static void generic_linkage_vector(const t_index N,
 template <method_codes_vector method, typename t_dissimilarity>
 static void generic_linkage_vector_alternative(const t_index N,
                                                t_dissimilarity & dist,
-                                               cluster_result & Z2) {
+                                               cluster_result & Z2,
+                                               linkage_progress * const progress = NULL) {
   /*
     N: integer, number of data points
     dist: function pointer to the metric
     Z2: output data structure
+    progress: progress reports (optional)
 
     This algorithm is valid for the distance update methods
     "Ward", "centroid" and "median" only!
   */
+#ifdef _OPENMP
+  if (use_parallel(N)) {
+    generic_linkage_vector_alternative_parallel<method>(N, dist, Z2,
+                                                        progress);
+    return;
+  }
+#endif
+  typedef typename t_dissimilarity::float_type t_float;
   const t_index N_1 = N-1;
   t_index i, j=0; // loop variables
   t_index idx1, idx2; // row and column indices
@@ -1848,8 +6002,8 @@ static void generic_linkage_vector_alternative(const t_index N,
   auto_array_ptr<t_float> mindist(2*N-2); // distances to the nearest neighbors
 
   doubly_linked_list active_nodes(N+N_1);
-  binary_min_heap nn_distances(&*mindist, N_1, 2*N-2, 1); // minimum heap
-      // structure for the distance to the nearest neighbor of each point
+  binary_min_heap<t_float> nn_distances(&*mindist, N_1, 2*N-2, 1); // minimum
+      // heap structure for the distance to the nearest neighbor of each point
 
   t_float min; // minimum for nearest-neighbor searches
 
@@ -1944,6 +6098,7 @@ static void generic_linkage_vector_alternative(const t_index N,
     active_nodes.remove(idx2);
 
     Z2.append(idx1, idx2, mindist[idx1]);
+    if (progress) (*progress)(i-N+1, mindist[idx1]);
 
     if (i<2*N_1) {
       switch (method) {
@@ -2005,6 +6160,668 @@ static void generic_linkage_vector_alternative(const t_index N,
   }
 }
 
+/*
+  Flat clusters from a dendrogram in the SciPy format, ie. the output Z of
+  generate_SciPy_dendrogram: node i<N is a point, and node N+i is the
+  cluster which is formed in step i. The children of a node have smaller
+  indices than the node itself, so that a pass over the steps in increasing
+  order visits every cluster after its children, and the root is the last
+  step N-2. The indices in Z must have been checked by the caller.
+*/
+
+/*
+  Inconsistency coefficients as in scipy.cluster.hierarchy.inconsistent:
+  the height of step i, compared with the mean and standard deviation of
+  the heights of step i and of the steps up to depth-1 levels below it.
+*/
+static void inconsistency_coefficients(const t_index N,
+                                       const t_float * const Z,
+                                       const t_index depth,
+                                       t_float * const coeff) {
+  // Stack for the depth-first search: steps and their levels
+  auto_array_ptr<t_index> step(N), level(N);
+  for (t_index i=0; i<N-1; ++i) {
+    t_float sum = 0, sumsq = 0;
+    t_index count = 0, top = 1;
+    step[0] = i;
+    level[0] = 0;
+    while (top) {
+      --top;
+      const t_index r = step[top];
+      const t_index l = level[top];
+      const t_float h = Z_(r, 2);
+      sum += h;
+      sumsq += h*h;
+      ++count;
+      if (l+1 < depth) {
+        for (t_index c=0; c<2; ++c) {
+          const t_index child = static_cast<t_index>(Z_(r, c));
+          if (child>=N) {
+            step[top] = child-N;
+            level[top++] = l+1;
+          }
+        }
+      }
+    }
+    const t_float mean = sum/static_cast<t_float>(count);
+    const t_float var = (count<2) ? 0 :
+      (sumsq - sum*sum/static_cast<t_float>(count)) /
+      static_cast<t_float>(count-1);
+    coeff[i] = (var>0) ? (Z_(i, 2)-mean)/std::sqrt(var) : 0;
+  }
+}
+
+// Replace each value MC[i] by the maximum over step i and all steps below.
+static void subtree_maximum(const t_index N, const t_float * const Z,
+                            t_float * const MC) {
+  for (t_index i=0; i<N-1; ++i) {
+    for (t_index c=0; c<2; ++c) {
+      const t_index child = static_cast<t_index>(Z_(i, c));
+      if (child>=N && MC[child-N] > MC[i]) {
+        MC[i] = MC[child-N];
+      }
+    }
+  }
+}
+
+/*
+  Flat clusters: the maximal subtrees whose root step i has MC[i] ≤ cutoff
+  form one cluster each, and every other point is a singleton. The labels
+  1, 2, ... are numbered in the same order as by scipy.cluster.hierarchy.
+  fcluster: in a depth-first search from the root, left child first, a
+  cluster gets its label when the search enters its root, and the points
+  which are children of a step get theirs when the search leaves the step.
+*/
+static void flat_clusters(const t_index N, const t_float * const Z,
+                          const t_float * const MC, const t_float cutoff,
+                          int * const T) {
+  if (N==1) {
+    T[0] = 1;
+    return;
+  }
+  auto_array_ptr<t_index> stack(N);
+  auto_array_ptr<char> entered(N-1, 0);
+  t_index top = 0;
+  t_index leader = -1; // root step of the current cluster, if any
+  int label = 0;
+  stack[top++] = N-2;
+  while (top) {
+    const t_index r = stack[top-1];
+    if (!entered[r]) {
+      entered[r] = 1;
+      if (leader<0 && MC[r] <= cutoff) {
+        leader = r;
+        ++label;
+      }
+    }
+    const t_index left = static_cast<t_index>(Z_(r, 0));
+    const t_index right = static_cast<t_index>(Z_(r, 1));
+    if (left>=N && !entered[left-N]) {
+      stack[top++] = left-N;
+      continue;
+    }
+    if (right>=N && !entered[right-N]) {
+      stack[top++] = right-N;
+      continue;
+    }
+    if (left<N) {
+      T[left] = (leader<0) ? ++label : label;
+    }
+    if (right<N) {
+      T[right] = (leader<0) ? ++label : label;
+    }
+    if (leader==r) {
+      leader = -1;
+    }
+    --top;
+  }
+}
+
+/*
+  The smallest cutoff among the values MC for which flat_clusters forms at
+  most k clusters, 1 ≤ k < N. MC must be monotone, ie. not smaller at a step
+  than at the steps below it. Then the number of clusters for the cutoff t
+  is N minus the number of values MC[i] ≤ t, and the cutoff is the
+  (N-k)-th smallest value.
+*/
+static t_float maxclust_cutoff(const t_index N, const t_float * const MC,
+                               const t_index k) {
+  auto_array_ptr<t_float> sorted(N-1);
+  std::copy(MC, MC+N-1, &*sorted);
+  std::nth_element(&*sorted, sorted+(N-1-k), sorted+(N-1));
+  return sorted[N-1-k];
+}
+
+/*
+  The points in the order of the leaves of the dendrogram, from left to
+  right, as in scipy.cluster.hierarchy.leaves_list: a depth-first search
+  which visits the first child of every step first. The explicit stack
+  replaces SciPy's recursion, which fails for deep dendrograms.
+*/
+static void dendrogram_leaves(const t_index N, const t_float * const Z,
+                              int * const leaves) {
+  auto_array_ptr<t_index> stack(N);
+  t_index top = 0, k = 0;
+  stack[top++] = 2*N-2;
+  while (top) {
+    const t_index node = stack[--top];
+    if (node<N) {
+      leaves[k++] = static_cast<int>(node);
+    }
+    else {
+      stack[top++] = static_cast<t_index>(Z_(node-N, 1));
+      stack[top++] = static_cast<t_index>(Z_(node-N, 0));
+    }
+  }
+}
+
+/*
+  Cuts of the dendrogram as in scipy.cluster.hierarchy.cut_tree: the steps
+  are ordered by their height and, for equal heights, in reverse order of a
+  breadth-first search from the root which visits the right child first.
+  Column c of the (N×ncols) output holds the clusters after the first
+  steps[c] steps in this order (0 ≤ steps[c] < N), labeled 0, 1, ... in
+  the order of their smallest points.
+
+  Each cut costs O(N): a pass over the nodes from the root downwards
+  assigns every node to its topmost ancestor among the first steps[c]
+  steps, or to itself.
+*/
+static void cut_tree(const t_index N, const t_float * const Z,
+                     const t_index * const steps, const t_index ncols,
+                     int64_t * const out) {
+  if (N==1) {
+    FILL_N(out, ncols, 0);
+    return;
+  }
+  auto_array_ptr<t_index> order(N-1), rank(N-1), parent(2*N-1);
+  t_index head = 0, tail = 0;
+  order[tail++] = N-2;
+  while (head<tail) {
+    const t_index r = order[head++];
+    for (t_index c=1; c>=0; --c) {
+      const t_index child = static_cast<t_index>(Z_(r, c));
+      if (child>=N) {
+        order[tail++] = child-N;
+      }
+    }
+  }
+  std::reverse(&*order, order+(N-1));
+  std::stable_sort(&*order, order+(N-1),
+                   [&](const t_index a, const t_index b) {
+                     return Z_(a, 2) < Z_(b, 2);
+                   });
+  for (t_index p=0; p<N-1; ++p) {
+    rank[order[p]] = p;
+  }
+  parent[2*N-2] = -1;
+  for (t_index i=0; i<N-1; ++i) {
+    parent[static_cast<t_index>(Z_(i, 0))] =
+      parent[static_cast<t_index>(Z_(i, 1))] = N+i;
+  }
+
+  auto_array_ptr<t_index> group(2*N-1);
+  auto_array_ptr<int64_t> label(2*N-1);
+  for (t_index c=0; c<ncols; ++c) {
+    const t_index k = steps[c];
+    for (t_index node=2*N-2; node>=0; --node) {
+      const t_index p = parent[node];
+      if (p>=0 && group[p]>=0) {
+        group[node] = group[p];
+      }
+      else if (node<N || rank[node-N]<k) {
+        group[node] = node;
+      }
+      else {
+        group[node] = -1;
+      }
+    }
+    FILL_N(&*label, 2*N-1, -1);
+    int64_t next = 0;
+    for (t_index i=0; i<N; ++i) {
+      const t_index g = group[i];
+      if (label[g]<0) {
+        label[g] = next++;
+      }
+      out[i*ncols+c] = label[g];
+    }
+  }
+}
+
+/*
+  Optimal leaf ordering (Z. Bar-Joseph, D. K. Gifford, T. S. Jaakkola, Fast
+  optimal leaf ordering for hierarchical clustering, Bioinformatics 17,
+  2001): swap the children in the dendrogram Z (in the SciPy format, see
+  above) so that the sum of the dissimilarities D between neighboring
+  leaves is minimal.
+
+  For a step with the children L and R and points u in L, w in R, M(u,w)
+  is the minimal sum for an ordering of the points below the step which
+  starts with u and ends with w. Every pair of points gets its value at
+  their lowest common step, so that M is stored like a condensed matrix.
+  The values are computed bottom-up:
+
+    M(u,w) = min_k ( min_m (M(u,m) + D(m,k)) + M(k,w) ),
+
+  where m runs over the points in the child of L which does not contain u
+  (m=u if L is a point), and k likewise over R with respect to w. The inner
+  minima T(k) are computed once for each u. Both loops visit the candidates
+  in increasing order and stop as soon as a lower bound reaches the best
+  value so far: the smallest dissimilarity from k to the candidates m,
+  respectively the smallest M(k,w) for the point w. These bounds do not
+  depend on u, so they are computed once per step. This prunes most of the
+  O(N^3) work for clustered data. The points u of large steps are
+  distributed over the OpenMP threads.
+*/
+template <typename t_dist>
+class leaf_ordering {
+private:
+  // Candidate m or k with its partial sum, in increasing order of both
+  struct candidate {
+    t_float value;
+    t_index point;
+    bool operator< (const candidate & b) const {
+      return value < b.value || (!(b.value < value) && point < b.point);
+    }
+  };
+
+  const t_index N;
+  t_float * const Z;
+  const t_dist * const D;
+  t_float * const M;
+  // Position of each point in the current leaf order, the points in this
+  // order, and the first position and the number of points of each node
+  auto_array_ptr<t_index> pos, order, first, count;
+  // Lower bounds for the current step, indexed by the positions in R: the
+  // smallest dissimilarities to the first and second child of L, and the
+  // smallest M(k,w) for the point w
+  auto_array_ptr<t_float> D_bound0, D_bound1, M_bound;
+
+  t_float dist(const t_index i, const t_index j) const {
+    return static_cast<t_float>((i<j) ? condensed_at(D, N, i, j)
+                                      : condensed_at(D, N, j, i));
+  }
+
+  t_float & M_(const t_index i, const t_index j) const {
+    return (i<j) ? condensed_at(M, N, i, j) : condensed_at(M, N, j, i);
+  }
+
+  t_float M_or_zero(const t_index i, const t_index j) const {
+    return (i==j) ? 0 : M_(i, j);
+  }
+
+  // The positions [begin, end) of the points which can be next to the
+  // point at position p at the border of the node: the other child.
+  void inner(const t_index node, const t_index p,
+             t_index & begin, t_index & end) const {
+    if (node<N) {
+      begin = p;
+      end = p+1;
+      return;
+    }
+    const t_index left = static_cast<t_index>(Z_(node-N, 0));
+    const t_index right = static_cast<t_index>(Z_(node-N, 1));
+    const t_index other = (p < first[left]+count[left]) ? right : left;
+    begin = first[other];
+    end = first[other]+count[other];
+  }
+
+  void bounds(const t_index i, const bool parallel);
+  void row(const t_index i, const t_index p, candidate * const cand,
+           t_float * const T, candidate * const sorted_k) const;
+
+public:
+  leaf_ordering(const t_index N_, t_float * const Z0, const t_dist * const D0,
+                t_float * const M0)
+    : N(N_)
+    , Z(Z0)
+    , D(D0)
+    , M(M0)
+    , pos(N_)
+    , order(N_)
+    , first(2*N_-1)
+    , count(2*N_-1)
+    , D_bound0(N_)
+    , D_bound1(N_)
+    , M_bound(N_)
+  {
+    const std::ptrdiff_t NN = static_cast<std::ptrdiff_t>(N)*(N-1)/2;
+    for (std::ptrdiff_t k=0; k<NN; ++k) {
+      if (fc_isnan(D[k])) throw(nan_error());
+    }
+    for (t_index i=0; i<N; ++i) {
+      count[i] = 1;
+    }
+    for (t_index i=0; i<N-1; ++i) {
+      count[N+i] = count[static_cast<t_index>(Z_(i, 0))] +
+        count[static_cast<t_index>(Z_(i, 1))];
+    }
+    first[2*N-2] = 0;
+    for (t_index i=N-2; i>=0; --i) {
+      const t_index left = static_cast<t_index>(Z_(i, 0));
+      first[left] = first[N+i];
+      first[static_cast<t_index>(Z_(i, 1))] = first[N+i]+count[left];
+    }
+    for (t_index i=0; i<N; ++i) {
+      pos[i] = first[i];
+      order[first[i]] = i;
+    }
+  }
+
+  void operator() ();
+};
+
+// The lower bounds D_bound0/1 and M_bound for step i
+template <typename t_dist>
+void leaf_ordering<t_dist>::bounds(const t_index i, const bool parallel) {
+  const t_index L = static_cast<t_index>(Z_(i, 0));
+  const t_index R = static_cast<t_index>(Z_(i, 1));
+  const t_index L0 = first[L], L1 = first[L]+count[L];
+  const t_index R0 = first[R], nR = count[R];
+  // The first child of L, or L itself
+  const t_index L_split = (L<N) ? L1 :
+    L0+count[static_cast<t_index>(Z_(L-N, 0))];
+#ifdef _OPENMP
+#pragma omp parallel for schedule(static) if(parallel)
+#else
+  (void)parallel;
+#endif
+  for (t_index q=0; q<nR; ++q) {
+    const t_index k = order[R0+q];
+    t_float d0 = std::numeric_limits<t_float>::infinity();
+    t_float d1 = std::numeric_limits<t_float>::infinity();
+    for (t_index p=L0; p<L_split; ++p) {
+      const t_float d = dist(order[p], k);
+      if (d < d0) d0 = d;
+    }
+    for (t_index p=L_split; p<L1; ++p) {
+      const t_float d = dist(order[p], k);
+      if (d < d1) d1 = d;
+    }
+    D_bound0[q] = d0;
+    D_bound1[q] = d1;
+    t_index k0, k1;
+    inner(R, R0+q, k0, k1);
+    t_float m = std::numeric_limits<t_float>::infinity();
+    for (t_index r=k0; r<k1; ++r) {
+      const t_float x = M_or_zero(order[r], k);
+      if (x < m) m = x;
+    }
+    M_bound[q] = m;
+  }
+}
+
+/*
+  M(u,w) for the point u at the position p in the left child of step i and
+  all points w in the right child. cand, T and sorted_k are scratch arrays
+  of size N.
+*/
+template <typename t_dist>
+void leaf_ordering<t_dist>::row(const t_index i, const t_index p,
+                                candidate * const cand, t_float * const T,
+                                candidate * const sorted_k) const {
+  const t_index L = static_cast<t_index>(Z_(i, 0));
+  const t_index R = static_cast<t_index>(Z_(i, 1));
+  const t_index R0 = first[R];
+  const t_index nR = count[R];
+  const t_index u = order[p];
+
+  // T(k) = min_m (M(u,m) + D(m,k)) for all points k in R
+  t_index begin, end;
+  inner(L, p, begin, end);
+  const t_float * const D_bound = (begin==first[L]) ? D_bound0 : D_bound1;
+  t_index nc = 0;
+  for (t_index q=begin; q<end; ++q) {
+    cand[nc].point = order[q];
+    cand[nc++].value = M_or_zero(u, order[q]);
+  }
+  std::sort(cand, cand+nc);
+  for (t_index q=0; q<nR; ++q) {
+    const t_index k = order[R0+q];
+    const t_float bound = D_bound[q];
+    t_float best = std::numeric_limits<t_float>::infinity();
+    for (t_index c=0; c<nc && cand[c].value+bound < best; ++c) {
+      const t_float d = cand[c].value + dist(cand[c].point, k);
+      if (d < best) best = d;
+    }
+    T[q] = best;
+  }
+
+  // M(u,w) = min_k (T(k) + M(k,w)) for all points w in R
+  if (R<N) {
+    M_(u, R) = T[0];
+    return;
+  }
+  const t_index split = count[static_cast<t_index>(Z_(R-N, 0))];
+  for (t_index q=0; q<nR; ++q) {
+    sorted_k[q].point = order[R0+q];
+    sorted_k[q].value = T[q];
+  }
+  std::sort(sorted_k, sorted_k+split);
+  std::sort(sorted_k+split, sorted_k+nR);
+  for (t_index q=0; q<nR; ++q) {
+    const t_index w = order[R0+q];
+    const t_index c0 = (q<split) ? split : 0;
+    const t_index c1 = (q<split) ? nR : split;
+    const t_float bound = M_bound[q];
+    t_float best = std::numeric_limits<t_float>::infinity();
+    for (t_index c=c0; c<c1 && sorted_k[c].value+bound < best; ++c) {
+      const t_float d = sorted_k[c].value + M_(sorted_k[c].point, w);
+      if (d < best) best = d;
+    }
+    M_(u, w) = best;
+  }
+}
+
+template <typename t_dist>
+void leaf_ordering<t_dist>::operator() () {
+  if (N<2) return;
+#ifdef _OPENMP
+  const t_index threads = omp_get_max_threads();
+#else
+  const t_index threads = 1;
+#endif
+  auto_array_ptr<candidate> cand(threads*N), sorted_k(threads*N);
+  auto_array_ptr<t_float> T(threads*N);
+
+  for (t_index i=0; i<N-1; ++i) {
+    const t_index L = static_cast<t_index>(Z_(i, 0));
+    const t_index R = static_cast<t_index>(Z_(i, 1));
+    // The work for a point u is roughly count[R]*(count[L]+count[R]).
+    const bool parallel = threads>1 &&
+      static_cast<double>(count[L])*count[R]*(count[L]+count[R]) >= 1e6;
+    bounds(i, parallel);
+#ifdef _OPENMP
+#pragma omp parallel for schedule(dynamic) if(parallel)
+#endif
+    for (t_index p=first[L]; p<first[L]+count[L]; ++p) {
+#ifdef _OPENMP
+      const t_index t = omp_get_thread_num();
+#else
+      const t_index t = 0;
+#endif
+      row(i, p, cand+t*N, T+t*N, sorted_k+t*N);
+    }
+  }
+
+  // The best end points at the root, and then top-down the orientation of
+  // the children which realizes M: in every step, the child which contains
+  // the first point a goes first, and the border points m and k between
+  // the children are the end points for the children.
+  const t_index L = static_cast<t_index>(Z_(N-2, 0));
+  const t_index R = static_cast<t_index>(Z_(N-2, 1));
+  t_float best = std::numeric_limits<t_float>::infinity();
+  t_index a = order[first[L]], b = order[first[R]];
+  for (t_index p=first[L]; p<first[L]+count[L]; ++p) {
+    for (t_index q=first[R]; q<first[R]+count[R]; ++q) {
+      if (M_(order[p], order[q]) < best) {
+        best = M_(order[p], order[q]);
+        a = order[p];
+        b = order[q];
+      }
+    }
+  }
+
+  auto_array_ptr<t_index> stack_step(N), stack_a(N), stack_b(N);
+  t_index top = 0;
+  stack_step[top] = N-2;
+  stack_a[top] = a;
+  stack_b[top++] = b;
+  while (top) {
+    --top;
+    const t_index i = stack_step[top];
+    a = stack_a[top];
+    b = stack_b[top];
+    const t_index left = static_cast<t_index>(Z_(i, 0));
+    const t_index right = static_cast<t_index>(Z_(i, 1));
+    const t_index A = (pos[a] < first[left]+count[left]) ? left : right;
+    const t_index B = (A==left) ? right : left;
+    t_index m0, m1, k0, k1;
+    inner(A, pos[a], m0, m1);
+    inner(B, pos[b], k0, k1);
+    best = std::numeric_limits<t_float>::infinity();
+    t_index m_best = order[m0], k_best = order[k0];
+    for (t_index p=m0; p<m1; ++p) {
+      const t_index m = order[p];
+      const t_float x = M_or_zero(a, m);
+      for (t_index q=k0; q<k1; ++q) {
+        const t_index k = order[q];
+        const t_float d = x + dist(m, k) + M_or_zero(k, b);
+        if (d < best) {
+          best = d;
+          m_best = m;
+          k_best = k;
+        }
+      }
+    }
+    Z_(i, 0) = static_cast<t_float>(A);
+    Z_(i, 1) = static_cast<t_float>(B);
+    if (A>=N) {
+      stack_step[top] = A-N;
+      stack_a[top] = a;
+      stack_b[top++] = m_best;
+    }
+    if (B>=N) {
+      stack_step[top] = B-N;
+      stack_a[top] = k_best;
+      stack_b[top++] = b;
+    }
+  }
+}
+
+/*
+  Cophenetic correlation: the Pearson correlation between the
+  dissimilarities D (condensed matrix) and the cophenetic distances of the
+  dendrogram Z (in the SciPy format, see above), ie. the heights of the
+  lowest common steps. The result is the same as the first output of
+  scipy.cluster.hierarchy.cophenet, but the cophenetic matrix is never
+  stored.
+
+  The leaves are arranged in the dendrogram order, so that every node
+  covers an interval of positions. For the row r of D, the path from the
+  leaf r to the root is followed, and each node on the path assigns its
+  height to the points in its other child. This fills a buffer of N
+  cophenetic distances in O(N) time, which is then streamed together with
+  the row of D. The mean of the cophenetic distances and their squared
+  deviations are sums over the steps. The rows are distributed over the
+  OpenMP threads, each of which has its own buffer.
+*/
+template <typename t_dist>
+static t_float cophenetic_correlation(const t_index N,
+                                      const t_float * const Z,
+                                      const t_dist * const D) {
+  const std::ptrdiff_t NN = static_cast<std::ptrdiff_t>(N)*(N-1)/2;
+  // The parent step of each node, the number of points below each node,
+  // the first position of each node and the points in the leaf order
+  auto_array_ptr<t_index> parent(2*N-1), count(2*N-1), first(2*N-1), order(N);
+  for (t_index i=0; i<N; ++i) {
+    count[i] = 1;
+  }
+  for (t_index i=0; i<N-1; ++i) {
+    const t_index left = static_cast<t_index>(Z_(i, 0));
+    const t_index right = static_cast<t_index>(Z_(i, 1));
+    parent[left] = parent[right] = i;
+    count[N+i] = count[left] + count[right];
+  }
+  first[2*N-2] = 0;
+  for (t_index i=N-2; i>=0; --i) {
+    const t_index left = static_cast<t_index>(Z_(i, 0));
+    first[left] = first[N+i];
+    first[static_cast<t_index>(Z_(i, 1))] = first[N+i]+count[left];
+  }
+  for (t_index i=0; i<N; ++i) {
+    order[first[i]] = i;
+  }
+
+  // Means and the sum of squared deviations of the cophenetic distances
+  t_float c_mean = 0;
+  for (t_index i=0; i<N-1; ++i) {
+    c_mean += Z_(i, 2) *
+      static_cast<t_float>(count[static_cast<t_index>(Z_(i, 0))]) *
+      static_cast<t_float>(count[static_cast<t_index>(Z_(i, 1))]);
+  }
+  c_mean /= static_cast<t_float>(NN);
+  t_float c_var = 0;
+  for (t_index i=0; i<N-1; ++i) {
+    const t_float h = Z_(i, 2) - c_mean;
+    c_var += h * h *
+      static_cast<t_float>(count[static_cast<t_index>(Z_(i, 0))]) *
+      static_cast<t_float>(count[static_cast<t_index>(Z_(i, 1))]);
+  }
+  t_float d_mean = 0;
+  bool nan_found = false;
+#ifdef _OPENMP
+#pragma omp parallel for schedule(dynamic, 16) reduction(+:d_mean) \
+  reduction(||:nan_found)
+#endif
+  for (t_index r=0; r<N-1; ++r) {
+    const t_dist * const row = &condensed_at(D, N, r, r+1);
+    t_float sum = 0;
+    for (t_index k=0; k<N-1-r; ++k) {
+      sum += static_cast<t_float>(row[k]);
+    }
+    if (fc_isnan(sum)) nan_found = true;
+    d_mean += sum;
+  }
+  if (nan_found) throw(nan_error());
+  d_mean /= static_cast<t_float>(NN);
+
+  // Cross products and squared deviations of the dissimilarities
+  t_float cross = 0, d_var = 0;
+#ifdef _OPENMP
+#pragma omp parallel reduction(+:cross, d_var)
+#endif
+  {
+    auto_array_ptr<t_float> c(N);
+#ifdef _OPENMP
+#pragma omp for schedule(dynamic, 16)
+#endif
+    for (t_index r=0; r<N-1; ++r) {
+      for (t_index node=r; node!=2*N-2; node=N+parent[node]) {
+        const t_index i = parent[node];
+        const t_float h = Z_(i, 2) - c_mean;
+        const t_index left = static_cast<t_index>(Z_(i, 0));
+        const t_index other = (node==left) ?
+          static_cast<t_index>(Z_(i, 1)) : left;
+        for (t_index p=first[other]; p<first[other]+count[other]; ++p) {
+          c[order[p]] = h;
+        }
+      }
+      // The dissimilarities D(r,k), indexed by k>r
+      const t_dist * const row = &condensed_at(D, N, r, r+1) - (r+1);
+      t_float row_cross = 0, row_var = 0;
+      for (t_index k=r+1; k<N; ++k) {
+        const t_float d = static_cast<t_float>(row[k]) - d_mean;
+        row_cross += d * c[k];
+        row_var += d * d;
+      }
+      cross += row_cross;
+      d_var += row_var;
+    }
+  }
+  return cross / std::sqrt(d_var * c_var);
+}
+
 #if HAVE_VISIBILITY
 #pragma GCC visibility pop
 #endif
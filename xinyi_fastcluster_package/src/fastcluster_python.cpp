@@ -58,6 +58,8 @@
 #include <algorithm> // for std::stable_sort
 #include <new> // for std::bad_alloc
 #include <exception> // for std::exception
+#include <atomic> // for std::atomic
+#include <chrono> // for std::chrono::steady_clock
 
 #include "fastcluster.cpp"
 
@@ -148,11 +150,45 @@ static void generate_SciPy_dendrogram(t_float * const Z, cluster_result & Z2, co
 */
 static PyObject * linkage_wrap(PyObject * const self, PyObject * const args);
 static PyObject * linkage_vector_wrap(PyObject * const self, PyObject * const args);
+static PyObject * MST_update_wrap(PyObject * const self,
+                                  PyObject * const args);
+static PyObject * linkage_many_wrap(PyObject * const self, PyObject * const args);
+static PyObject * linkage_vector_many_wrap(PyObject * const self,
+                                           PyObject * const args);
+static PyObject * pdist_wrap(PyObject * const self, PyObject * const args);
+static PyObject * max_threads_wrap(PyObject * const self,
+                                   PyObject * const args);
+static PyObject * simd_level_wrap(PyObject * const self,
+                                  PyObject * const args);
+static PyObject * linkage_sparse_wrap(PyObject * const self,
+                                      PyObject * const args);
+static PyObject * fcluster_wrap(PyObject * const self, PyObject * const args);
+static PyObject * cut_tree_wrap(PyObject * const self, PyObject * const args);
+static PyObject * leaves_list_wrap(PyObject * const self,
+                                   PyObject * const args);
+static PyObject * cophenetic_correlation_wrap(PyObject * const self,
+                                              PyObject * const args);
+static PyObject * optimal_leaf_ordering_wrap(PyObject * const self,
+                                             PyObject * const args);
 
 // List the C++ methods that this extension provides.
 static PyMethodDef _fastclusterWrapMethods[] = {
   {"linkage_wrap", linkage_wrap, METH_VARARGS, NULL},
   {"linkage_vector_wrap", linkage_vector_wrap, METH_VARARGS, NULL},
+  {"linkage_many_wrap", linkage_many_wrap, METH_VARARGS, NULL},
+  {"linkage_vector_many_wrap", linkage_vector_many_wrap, METH_VARARGS, NULL},
+  {"pdist_wrap", pdist_wrap, METH_VARARGS, NULL},
+  {"max_threads_wrap", max_threads_wrap, METH_NOARGS, NULL},
+  {"simd_level_wrap", simd_level_wrap, METH_NOARGS, NULL},
+  {"linkage_sparse_wrap", linkage_sparse_wrap, METH_VARARGS, NULL},
+  {"MST_update_wrap", MST_update_wrap, METH_VARARGS, NULL},
+  {"fcluster_wrap", fcluster_wrap, METH_VARARGS, NULL},
+  {"cut_tree_wrap", cut_tree_wrap, METH_VARARGS, NULL},
+  {"leaves_list_wrap", leaves_list_wrap, METH_VARARGS, NULL},
+  {"cophenetic_correlation_wrap", cophenetic_correlation_wrap, METH_VARARGS,
+   NULL},
+  {"optimal_leaf_ordering_wrap", optimal_leaf_ordering_wrap, METH_VARARGS,
+   NULL},
   {NULL, NULL, 0, NULL}    /* Sentinel - marks the end of this structure */
 };
 
@@ -234,15 +270,263 @@ class GIL_release
     PyThreadState * _save;
   };
 
+/*
+  Limit the number of OpenMP threads for the parallel regions of one call to
+  at most threads, if threads>0. The OpenMP setting belongs to the calling
+  thread, so calls from several Python threads with different limits do not
+  interfere. The previous setting is restored at the end of the call.
+*/
+class thread_limit
+  {
+  private:
+    // noncopyable
+    thread_limit(thread_limit const &);
+    thread_limit & operator=(thread_limit const &);
+  public:
+#ifdef _OPENMP
+    inline
+    thread_limit(const int threads)
+      : _saved(0)
+    {
+      if (threads>0 && threads<omp_get_max_threads()) {
+        _saved = omp_get_max_threads();
+        omp_set_num_threads(threads);
+      }
+    }
+
+    inline
+    ~thread_limit()
+    {
+      if (_saved>0)
+        omp_set_num_threads(_saved);
+    }
+
+  private:
+    int _saved;
+#else
+    inline
+    thread_limit(const int)
+    {
+    }
+#endif
+  };
+
+/*
+   Helper class: Throw this if calling the Python interpreter from within
+   C returned an error.
+*/
+class pythonerror {};
+
+/*
+  Progress reports to a Python callback while the GIL is released. The GIL
+  is reacquired for each report. Pending signals (eg. KeyboardInterrupt from
+  Ctrl-C) and exceptions in the callback abort the clustering, and so does
+  the return value False. Without a callback, only the signals are checked.
+
+  The callback receives the number of merging steps so far, the number of
+  points and the distance of the last merging step. For the methods which
+  work on squared distances, the square root is reported. poll() only checks
+  for signals.
+*/
+class python_progress : public linkage_progress {
+private:
+  PyObject * const callback;
+  const t_index N;
+  const bool squared;
+
+public:
+  python_progress(PyObject * const callback_, const t_index interval,
+                  const t_index N_, const bool squared_)
+    : linkage_progress(interval)
+    , callback(callback_==Py_None ? NULL : callback_)
+    , N(N_)
+    , squared(squared_)
+  {}
+
+  void poll() {
+    check(false, 0, 0);
+  }
+
+protected:
+  void report(const t_index step, const t_float dist) {
+    check(true, step, dist);
+  }
+
+  // The distance for the callback from a distance in the clustering core
+  virtual t_float output_distance(const t_float dist) const {
+    return squared ? std::sqrt(dist) : dist;
+  }
+
+private:
+  void check(const bool call, const t_index step, const t_float dist) {
+    const PyGILState_STATE state = PyGILState_Ensure();
+    bool abort = PyErr_CheckSignals()!=0;
+    if (!abort && call && callback) {
+      PyObject * const result = PyObject_CallFunction(
+          callback, const_cast<char *>("nnd"),
+          static_cast<Py_ssize_t>(step), static_cast<Py_ssize_t>(N),
+          output_distance(dist));
+      if (!result) {
+        abort = true;
+      }
+      else {
+        if (result==Py_False) {
+          PyErr_SetString(PyExc_RuntimeError,
+                          "The clustering was aborted by the callback.");
+          abort = true;
+        }
+        Py_DECREF(result);
+      }
+    }
+    PyGILState_Release(state);
+    if (abort) throw pythonerror();
+  }
+};
+
 /*
   Interface to Python, part 1:
   The input is a dissimilarity matrix.
 */
 
+/*
+  Run the clustering core for the chosen method on a condensed dissimilarity
+  matrix.
+*/
+template <typename t_float>
+static void linkage_core(const t_index N, t_float * const D,
+                         t_index * const members, cluster_result & Z2,
+                         const unsigned char method,
+                         const bool out_of_core,
+                         linkage_checkpoint<t_float> * const checkpoint = NULL,
+                         linkage_progress * const progress = NULL) {
+  // Operate on squared distances for these methods. A matrix from a
+  // checkpoint has been squared before.
+  if ((method==METHOD_METR_WARD ||
+       method==METHOD_METR_CENTROID ||
+       method==METHOD_METR_MEDIAN) &&
+      !(checkpoint && checkpoint->resuming())) {
+    for (t_float * DD = D; DD!=D+static_cast<std::ptrdiff_t>(N)*(N-1)/2;
+         ++DD)
+      *DD *= *DD;
+  }
+
+  switch (method) {
+  case METHOD_METR_SINGLE:
+    MST_linkage_core(N, D, Z2, out_of_core, progress);
+    break;
+  case METHOD_METR_COMPLETE:
+    NN_chain_core<METHOD_METR_COMPLETE, t_index>(N, D, NULL, Z2,
+                                                 out_of_core, progress);
+    break;
+  case METHOD_METR_AVERAGE:
+    NN_chain_core<METHOD_METR_AVERAGE, t_index>(N, D, members, Z2,
+                                                out_of_core, progress);
+    break;
+  case METHOD_METR_WEIGHTED:
+    NN_chain_core<METHOD_METR_WEIGHTED, t_index>(N, D, NULL, Z2,
+                                                 out_of_core, progress);
+    break;
+  case METHOD_METR_WARD:
+    NN_chain_core<METHOD_METR_WARD, t_index>(N, D, members, Z2,
+                                             out_of_core, progress);
+    break;
+  case METHOD_METR_CENTROID:
+    generic_linkage<METHOD_METR_CENTROID, t_index>(N, D, members, Z2,
+                                                   out_of_core, checkpoint,
+                                                   progress);
+    break;
+  case METHOD_METR_MEDIAN:
+    generic_linkage<METHOD_METR_MEDIAN, t_index>(N, D, NULL, Z2,
+                                                 out_of_core, checkpoint,
+                                                 progress);
+    break;
+  default:
+    throw std::runtime_error(std::string("Invalid method index."));
+  }
+}
+
+/*
+  Cluster a condensed dissimilarity matrix in the precision of the input.
+  This function does not touch any Python objects and is called without
+  the GIL.
+
+  If out_of_core is true, D_ is a memory-mapped file, possibly larger than
+  the main memory, and the cores issue read-ahead hints for it.
+
+  If checkpoint_dir is not NULL, the methods 'centroid' and 'median' save
+  their state in this directory every checkpoint_interval steps, or resume
+  from the state there. D_ must then be a shared mapping of a file (see
+  linkage_checkpoint). The code of the metric and the checksum of the
+  input identify the problem in the state file, together with N and the
+  method.
+
+  If progress is not NULL, the cores report their progress to it.
+*/
+template <typename t_float>
+static void linkage_condensed(const t_index N, t_float * const D_,
+                              ::t_float * const Z_,
+                              const unsigned char method,
+                              const bool out_of_core,
+                              const char * const checkpoint_dir = NULL,
+                              const t_index checkpoint_interval = 0,
+                              const t_index checkpoint_metric = 0,
+                              const unsigned long long checkpoint_checksum = 0,
+                              linkage_progress * const progress = NULL) {
+  cluster_result Z2(N-1);
+  auto_array_ptr<t_index> members;
+  // For these methods, the distance update formula needs the number of
+  // data points in a cluster.
+  if (method==METHOD_METR_AVERAGE ||
+      method==METHOD_METR_WARD ||
+      method==METHOD_METR_CENTROID) {
+    members.init(N, 1);
+  }
+  // All cores start with a sequential pass over the matrix.
+  if (out_of_core) {
+    readahead(D_, static_cast<std::ptrdiff_t>(N)*(N-1)/2*
+              static_cast<std::ptrdiff_t>(sizeof(t_float)),
+              READAHEAD_SEQUENTIAL);
+  }
+
+  if (checkpoint_dir) {
+    linkage_checkpoint<t_float> checkpoint(checkpoint_dir, checkpoint_interval,
+                                           N, method, checkpoint_metric,
+                                           checkpoint_checksum);
+    linkage_core(N, D_, members, Z2, method, out_of_core, &checkpoint,
+                 progress);
+  }
+  else {
+    linkage_core(N, D_, members, Z2, method, out_of_core,
+                 static_cast<linkage_checkpoint<t_float> *>(NULL), progress);
+  }
+
+  if (method==METHOD_METR_WARD ||
+      method==METHOD_METR_CENTROID ||
+      method==METHOD_METR_MEDIAN) {
+    Z2.sqrt();
+  }
+
+  if (method==METHOD_METR_CENTROID ||
+      method==METHOD_METR_MEDIAN) {
+    generate_SciPy_dendrogram<true>(Z_, Z2, N);
+  }
+  else {
+    generate_SciPy_dendrogram<false>(Z_, Z2, N);
+  }
+}
+
 static PyObject *linkage_wrap(PyObject * const, PyObject * const args) {
   PyArrayObject * D, * Z;
   long int N_ = 0;
   unsigned char method;
+  int out_of_core = 0;
+  int threads = 0;
+  const char * checkpoint_dir = NULL;
+  long int checkpoint_interval = 0;
+  PyObject * callback = Py_None;
+  long int callback_interval = 0;
+  long int checkpoint_metric = 0;
+  unsigned long long checkpoint_checksum = 0;
 
   try{
 #if HAVE_DIAGNOSTIC
@@ -250,16 +534,25 @@ static PyObject *linkage_wrap(PyObject * const, PyObject * const args) {
 #pragma GCC diagnostic ignored "-Wold-style-cast"
 #endif
     // Parse the input arguments
-    if (!PyArg_ParseTuple(args, "lO!O!b",
+    if (!PyArg_ParseTuple(args, "lO!O!b|pizlOllK",
                           &N_,                // signed long integer
                           &PyArray_Type, &D, // NumPy array
                           &PyArray_Type, &Z, // NumPy array
-                          &method)) {        // unsigned char
+                          &method,           // unsigned char
+                          &out_of_core,      // bool (optional)
+                          &threads,          // integer (optional)
+                          &checkpoint_dir,   // string or None (optional)
+                          &checkpoint_interval, // long integer (optional)
+                          &callback,         // callable or None (optional)
+                          &callback_interval, // long integer (optional)
+                          &checkpoint_metric, // long integer (optional)
+                          &checkpoint_checksum)) { // unsigned long long (opt.)
       return NULL; // Error if the arguments have the wrong type.
     }
 #if HAVE_DIAGNOSTIC
 #pragma GCC diagnostic pop
 #endif
+    thread_limit T(threads);
     if (N_ < 1 ) {
       // N must be at least 1.
       PyErr_SetString(PyExc_ValueError,
@@ -288,69 +581,269 @@ static PyObject *linkage_wrap(PyObject * const, PyObject * const args) {
       return NULL;
     }
     t_index N = static_cast<t_index>(N_);
+    python_progress progress(callback, static_cast<t_index>(callback_interval),
+                             N, method==METHOD_METR_WARD ||
+                             method==METHOD_METR_CENTROID ||
+                             method==METHOD_METR_MEDIAN);
 
     // Allow threads!
     GIL_release G;
 
-    t_float * const D_ = reinterpret_cast<t_float *>(PyArray_DATA(D));
-    cluster_result Z2(N-1);
-    auto_array_ptr<t_index> members;
-    // For these methods, the distance update formula needs the number of
-    // data points in a cluster.
-    if (method==METHOD_METR_AVERAGE ||
-        method==METHOD_METR_WARD ||
-        method==METHOD_METR_CENTROID) {
-      members.init(N, 1);
-    }
-    // Operate on squared distances for these methods.
-    if (method==METHOD_METR_WARD ||
-        method==METHOD_METR_CENTROID ||
-        method==METHOD_METR_MEDIAN) {
-      for (t_float * DD = D_; DD!=D_+static_cast<std::ptrdiff_t>(N)*(N-1)/2;
-           ++DD)
-        *DD *= *DD;
+    t_float * const Z_ = reinterpret_cast<t_float *>(PyArray_DATA(Z));
+    if (PyArray_TYPE(D)==NPY_FLOAT) {
+      linkage_condensed(N, reinterpret_cast<float *>(PyArray_DATA(D)), Z_,
+                        method, out_of_core!=0, checkpoint_dir,
+                        static_cast<t_index>(checkpoint_interval),
+                        static_cast<t_index>(checkpoint_metric),
+                        checkpoint_checksum, &progress);
+    }
+    else {
+      linkage_condensed(N, reinterpret_cast<double *>(PyArray_DATA(D)), Z_,
+                        method, out_of_core!=0, checkpoint_dir,
+                        static_cast<t_index>(checkpoint_interval),
+                        static_cast<t_index>(checkpoint_metric),
+                        checkpoint_checksum, &progress);
     }
+  } // try
+  catch (const std::bad_alloc&) {
+    return PyErr_NoMemory();
+  }
+  catch(const std::invalid_argument& e){
+    PyErr_SetString(PyExc_ValueError, e.what());
+    return NULL;
+  }
+  catch(const std::exception& e){
+    PyErr_SetString(PyExc_EnvironmentError, e.what());
+    return NULL;
+  }
+  catch(const nan_error&){
+    PyErr_SetString(PyExc_FloatingPointError, "NaN dissimilarity value.");
+    return NULL;
+  }
+  #ifdef FE_INVALID
+  catch(const fenv_error&){
+    PyErr_SetString(PyExc_FloatingPointError,
+                    "NaN dissimilarity value in intermediate results.");
+    return NULL;
+  }
+  #endif
+  catch(const pythonerror){
+    return NULL;
+  }
+  catch(...){
+    PyErr_SetString(PyExc_EnvironmentError,
+                    "C++ exception (unknown reason). Please send a bug report.");
+    return NULL;
+  }
+#if HAVE_DIAGNOSTIC
+#pragma GCC diagnostic push
+#pragma GCC diagnostic ignored "-Wold-style-cast"
+#endif
+  Py_RETURN_NONE;
+#if HAVE_DIAGNOSTIC
+#pragma GCC diagnostic pop
+#endif
+}
 
-    switch (method) {
-    case METHOD_METR_SINGLE:
-      MST_linkage_core(N, D_, Z2);
-      break;
-    case METHOD_METR_COMPLETE:
-      NN_chain_core<METHOD_METR_COMPLETE, t_index>(N, D_, NULL, Z2);
-      break;
-    case METHOD_METR_AVERAGE:
-      NN_chain_core<METHOD_METR_AVERAGE, t_index>(N, D_, members, Z2);
-      break;
-    case METHOD_METR_WEIGHTED:
-      NN_chain_core<METHOD_METR_WEIGHTED, t_index>(N, D_, NULL, Z2);
-      break;
-    case METHOD_METR_WARD:
-      NN_chain_core<METHOD_METR_WARD, t_index>(N, D_, members, Z2);
-      break;
-    case METHOD_METR_CENTROID:
-      generic_linkage<METHOD_METR_CENTROID, t_index>(N, D_, members, Z2);
-      break;
-    case METHOD_METR_MEDIAN:
-      generic_linkage<METHOD_METR_MEDIAN, t_index>(N, D_, NULL, Z2);
-      break;
-    default:
-      throw std::runtime_error(std::string("Invalid method index."));
+/*
+  Batches of clustering tasks.
+
+  The tasks are distributed dynamically over the OpenMP threads, largest
+  first, so that a big task does not hold up the batch at the end. Every
+  task runs serially in its thread; the parallel loops in the cores are
+  nested in the batch loop and therefore do not start new threads.
+
+  Exceptions must not leave a parallel region. They are stored per task, and
+  the exception of the first failing task in the batch is rethrown
+  afterwards.
+
+  The GIL is released for the whole batch. Before each of its tasks, the
+  calling thread (the OpenMP master thread) reacquires it to check for
+  pending signals (eg. KeyboardInterrupt from Ctrl-C), at most every
+  signal_interval. If there is one, the tasks which have not started yet are
+  skipped, and pythonerror is thrown after the running tasks have finished.
+*/
+static const std::chrono::milliseconds signal_interval(100);
+
+static bool signal_pending() {
+  const PyGILState_STATE state = PyGILState_Ensure();
+  const bool pending = PyErr_CheckSignals()!=0;
+  PyGILState_Release(state);
+  return pending;
+}
+
+template <typename t_task>
+static void run_batch(const t_index n, const t_index * const size,
+                      const t_task & task) {
+  auto_array_ptr<t_index> order(n);
+  for (t_index k=0; k<n; ++k) {
+    order[k] = k;
+  }
+  std::stable_sort(order+0, order+n, [size](const t_index a, const t_index b) {
+      return size[a] > size[b];
+    });
+  auto_array_ptr<std::exception_ptr> error(n);
+  std::atomic<bool> interrupted(false);
+  std::chrono::steady_clock::time_point next_check =
+    std::chrono::steady_clock::now();
+#ifdef _OPENMP
+#pragma omp parallel for schedule(dynamic, 1)
+#endif
+  for (t_index k=0; k<n; ++k) {
+#ifdef _OPENMP
+    const bool master = omp_get_thread_num()==0;
+#else
+    const bool master = true;
+#endif
+    if (master && !interrupted &&
+        std::chrono::steady_clock::now()>=next_check) {
+      if (signal_pending()) interrupted = true;
+      next_check = std::chrono::steady_clock::now()+signal_interval;
+    }
+    if (interrupted) continue;
+    try {
+      task(order[k]);
     }
+    catch (...) {
+      error[order[k]] = std::current_exception();
+    }
+  }
+  if (interrupted) throw pythonerror();
+  for (t_index k=0; k<n; ++k) {
+    if (error[k]) std::rethrow_exception(error[k]);
+  }
+}
+
+/*
+  Cluster a list of condensed dissimilarity matrices. The argument is a list
+  of triples (N, D, copy) with N and D as for linkage_wrap. If copy is true,
+  the clustering works on a private copy of D, which is made by the thread
+  of the task, so that not all copies exist at the same time. The
+  dendrograms are written one after the other into the stacked output array
+  Z with N-1 rows per task. All tasks are checked before the GIL is released
+  for the whole batch.
+*/
+template <typename t_float>
+static void linkage_condensed_task(const t_index N, t_float * const D,
+                                   ::t_float * const Z_,
+                                   const unsigned char method,
+                                   const bool copy) {
+  if (copy) {
+    const std::ptrdiff_t NN = static_cast<std::ptrdiff_t>(N)*(N-1)/2;
+    auto_array_ptr<t_float> D_copy(NN);
+    std::copy(D, D+NN, D_copy+0);
+    linkage_condensed(N, D_copy+0, Z_, method, false);
+  }
+  else {
+    linkage_condensed(N, D, Z_, method, false);
+  }
+}
 
-    if (method==METHOD_METR_WARD ||
-        method==METHOD_METR_CENTROID ||
-        method==METHOD_METR_MEDIAN) {
-      Z2.sqrt();
+static PyObject *linkage_many_wrap(PyObject * const, PyObject * const args) {
+  PyObject * tasks;
+  PyArrayObject * Z;
+  unsigned char method;
+  int threads = 0;
+
+  try{
+#if HAVE_DIAGNOSTIC
+#pragma GCC diagnostic push
+#pragma GCC diagnostic ignored "-Wold-style-cast"
+#endif
+    // Parse the input arguments
+    if (!PyArg_ParseTuple(args, "O!O!b|i",
+                          &PyList_Type, &tasks, // list of tuples
+                          &PyArray_Type, &Z,    // NumPy array
+                          &method,              // unsigned char
+                          &threads)) {          // integer (optional)
+      return NULL;
+    }
+#if HAVE_DIAGNOSTIC
+#pragma GCC diagnostic pop
+#endif
+    thread_limit T(threads);
+    if (method>METHOD_METR_MEDIAN) {
+      PyErr_SetString(PyExc_IndexError, "Invalid method index.");
+      return NULL;
     }
 
-    t_float * const Z_ = reinterpret_cast<t_float *>(PyArray_DATA(Z));
-    if (method==METHOD_METR_CENTROID ||
-        method==METHOD_METR_MEDIAN) {
-      generate_SciPy_dendrogram<true>(Z_, Z2, N);
+    const t_index n = static_cast<t_index>(PyList_GET_SIZE(tasks));
+    auto_array_ptr<t_index> N(n);
+    auto_array_ptr<void *> D(n);
+    auto_array_ptr<bool> is_float(n);
+    auto_array_ptr<bool> copy(n);
+    auto_array_ptr<npy_intp> row(n);
+    npy_intp rows = 0;
+    for (t_index k=0; k<n; ++k) {
+      long int N_;
+      PyArrayObject * D_;
+      int copy_ = 0;
+#if HAVE_DIAGNOSTIC
+#pragma GCC diagnostic push
+#pragma GCC diagnostic ignored "-Wold-style-cast"
+#endif
+      if (!PyArg_ParseTuple(PyList_GET_ITEM(tasks, k), "lO!p",
+                            &N_, &PyArray_Type, &D_, &copy_)) {
+        return NULL;
+      }
+#if HAVE_DIAGNOSTIC
+#pragma GCC diagnostic pop
+#endif
+      // See linkage_wrap for the bounds.
+      if (N_ < 1) {
+        PyErr_SetString(PyExc_ValueError,
+                        "At least one element is needed for clustering.");
+        return NULL;
+      }
+      if (N_ > MAX_INDEX/4 ||
+          static_cast<int64_t>(N_-1)>>(T_FLOAT_MANT_DIG-1) > 0) {
+        PyErr_SetString(PyExc_ValueError,
+                        "Data is too big, index overflow.");
+        return NULL;
+      }
+      if ((PyArray_TYPE(D_)!=NPY_FLOAT && PyArray_TYPE(D_)!=NPY_DOUBLE) ||
+          !PyArray_IS_C_CONTIGUOUS(D_) ||
+          PyArray_SIZE(D_)!=static_cast<npy_intp>(N_)*(N_-1)/2) {
+        PyErr_SetString(PyExc_ValueError,
+                        "Invalid condensed distance matrix.");
+        return NULL;
+      }
+      N[k] = static_cast<t_index>(N_);
+      D[k] = PyArray_DATA(D_);
+      is_float[k] = PyArray_TYPE(D_)==NPY_FLOAT;
+      copy[k] = copy_!=0;
+      // Single linkage does not modify the matrix.
+      if (!copy[k] && !PyArray_ISWRITEABLE(D_) &&
+          method!=METHOD_METR_SINGLE) {
+        PyErr_SetString(PyExc_ValueError,
+                        "The condensed distance matrix is read-only.");
+        return NULL;
+      }
+      row[k] = rows;
+      rows += N_-1;
     }
-    else {
-      generate_SciPy_dendrogram<false>(Z_, Z2, N);
+    if (PyArray_TYPE(Z)!=NPY_DOUBLE || !PyArray_IS_C_CONTIGUOUS(Z) ||
+        PyArray_SIZE(Z)!=4*rows) {
+      PyErr_SetString(PyExc_ValueError,
+                      "The output array has the wrong size.");
+      return NULL;
     }
+
+    // Allow threads!
+    GIL_release G;
+
+    t_float * const Z_ = reinterpret_cast<t_float *>(PyArray_DATA(Z));
+    run_batch(n, N, [&](const t_index k) {
+        if (N[k] < 2) return;
+        if (is_float[k]) {
+          linkage_condensed_task(N[k], static_cast<float *>(D[k]),
+                                 Z_+4*row[k], method, copy[k]);
+        }
+        else {
+          linkage_condensed_task(N[k], static_cast<double *>(D[k]),
+                                 Z_+4*row[k], method, copy[k]);
+        }
+      });
   } // try
   catch (const std::bad_alloc&) {
     return PyErr_NoMemory();
@@ -370,6 +863,9 @@ static PyObject *linkage_wrap(PyObject * const, PyObject * const args) {
     return NULL;
   }
   #endif
+  catch(const pythonerror){
+    return NULL;
+  }
   catch(...){
     PyErr_SetString(PyExc_EnvironmentError,
                     "C++ exception (unknown reason). Please send a bug report.");
@@ -419,26 +915,48 @@ enum metric_codes {
   METRIC_JACCARD_BOOL    = 21, // separate function for Jaccard metric on
 };                             // Boolean input data
 
+/* Algorithms for single linkage on vector data.
+
+   These codes must agree with the dictionary algidx in fastcluster.py.
+*/
+enum algorithm_codes {
+  ALGORITHM_PRIM         = 0,
+  ALGORITHM_BORUVKA      = 1,
+  ALGORITHM_NNDESCENT    = 2,
+  ALGORITHM_INVALID      = 3, // sentinel
+};
+
 /*
-   Helper class: Throw this if calling the Python interpreter from within
-   C returned an error.
+  NumPy type numbers for the floating point types of the input data.
 */
-class pythonerror {};
+template <typename t_float> struct numpy_type;
+template <> struct numpy_type<double> { enum { num = NPY_DOUBLE }; };
+template <> struct numpy_type<float> { enum { num = NPY_FLOAT }; };
 
 /*
   This class handles all the information about the dissimilarity
   computation.
+
+  The template parameter is the floating point type of the input data.
+  Boolean data is packed into words of 64 bits by pack_boolean, and the class
+  is then instantiated for double precision.
 */
 
+template <typename t_float>
 class python_dissimilarity {
+public:
+  typedef t_float float_type;
+
 private:
   t_float * Xa;
   std::ptrdiff_t dim; // size_t saves many statis_cast<> in products
   t_index N;
   auto_array_ptr<t_float> Xnew;
   t_index * members;
-  void (cluster_result::*postprocessfn) (const t_float) const;
-  t_float postprocessarg;
+  // The postprocessing acts on the list of merging steps, which is always in
+  // double precision.
+  void (cluster_result::*postprocessfn) (const ::t_float) const;
+  ::t_float postprocessarg;
 
   t_float (python_dissimilarity::*distfn) (const t_index, const t_index) const;
 
@@ -452,6 +970,10 @@ private:
   PyArrayObject * V;
   const t_float * V_data;
 
+  // Boolean data, packed into words of 64 bits; see pack_boolean
+  auto_array_ptr<uint64_t> Xpacked;
+  std::ptrdiff_t words;
+
   // noncopyable
   python_dissimilarity();
   python_dissimilarity(python_dissimilarity const &);
@@ -496,7 +1018,7 @@ public:
 #pragma GCC diagnostic ignored "-Wold-style-cast"
 #endif
         V = reinterpret_cast<PyArrayObject *>(PyArray_FromAny(extraarg,
-                PyArray_DescrFromType(NPY_DOUBLE),
+                PyArray_DescrFromType(numpy_type<t_float>::num),
                 1, 1,
                 NPY_ARRAY_CARRAY_RO,
                 NULL));
@@ -533,10 +1055,7 @@ public:
         // precompute norms
         precomputed.init(N);
         for (t_index i=0; i<N; ++i) {
-          t_float sum=0;
-          for (t_index k=0; k<dim; ++k) {
-            sum += X(i,k)*X(i,k);
-          }
+          const t_float sum = simd_utils::simd_dot(Xa+i*dim, Xa+i*dim, dim);
           precomputed[i] = 1/std::sqrt(sum);
         }
         break;
@@ -565,7 +1084,7 @@ public:
 #pragma GCC diagnostic ignored "-Wold-style-cast"
 #endif
         V = reinterpret_cast<PyArrayObject *>(PyArray_FromAny(extraarg,
-              PyArray_DescrFromType(NPY_DOUBLE),
+              PyArray_DescrFromType(numpy_type<t_float>::num),
               2, 2,
               NPY_ARRAY_CARRAY_RO,
               NULL));
@@ -585,36 +1104,40 @@ public:
         postprocessfn = &cluster_result::sqrt;
         break;
       case METRIC_YULE:
+        pack_boolean();
         distfn = &python_dissimilarity::yule;
         break;
       case METRIC_MATCHING:
+        pack_boolean();
         distfn = &python_dissimilarity::matching;
         postprocessfn = &cluster_result::divide;
         postprocessarg = static_cast<t_float>(dim);
         break;
       case METRIC_DICE:
+        pack_boolean();
         distfn = &python_dissimilarity::dice;
         break;
       case METRIC_ROGERSTANIMOTO:
+        pack_boolean();
         distfn = &python_dissimilarity::rogerstanimoto;
         break;
       case METRIC_RUSSELLRAO:
+        pack_boolean();
         distfn = &python_dissimilarity::russellrao;
         postprocessfn = &cluster_result::divide;
         postprocessarg = static_cast<t_float>(dim);
         break;
       case METRIC_SOKALSNEATH:
+        pack_boolean();
         distfn = &python_dissimilarity::sokalsneath;
         break;
       case METRIC_KULSINSKI:
+        pack_boolean();
         distfn = &python_dissimilarity::kulsinski;
         postprocessfn = &cluster_result::plusone;
         precomputed.init(N);
         for (t_index i=0; i<N; ++i) {
-          t_index sum=0;
-          for (t_index k=0; k<dim; ++k) {
-            sum += Xb(i,k);
-          }
+          const t_index sum = nbool_correspond_tt(i, i);
           precomputed[i] = -.5/static_cast<t_float>(sum);
         }
         break;
@@ -624,6 +1147,7 @@ public:
         distfn = &python_dissimilarity::user;
         break;
       default: // case METRIC_JACCARD_BOOL:
+        pack_boolean();
         distfn = &python_dissimilarity::jaccard_bool;
       }
       break;
@@ -655,12 +1179,82 @@ public:
     return (this->*distfn)(i,j);
   }
 
-  inline t_float X (const t_index i, const t_index j) const {
-    return Xa[i*dim+j];
+  /* The dissimilarity with the metric fixed at compile time. The member
+     function is a template argument, so that loops which are instantiated
+     for this class call it directly instead of through distfn.
+  */
+  template <t_float (python_dissimilarity::*fn) (const t_index,
+                                                 const t_index) const>
+  class fixed_metric {
+  public:
+    typedef t_float float_type;
+
+  private:
+    const python_dissimilarity & dist;
+
+  public:
+    explicit fixed_metric(const python_dissimilarity & dist_)
+      : dist(dist_)
+    {}
+
+    inline t_float operator () (const t_index i, const t_index j) const {
+      return (dist.*fn)(i,j);
+    }
+
+    void postprocess(t_float * const D, const std::ptrdiff_t size) const {
+      dist.postprocess(D, size);
+    }
+  };
+
+  /* Call f(d) for a dissimilarity object d of the metric: a fixed_metric
+     object for the metrics with vectorized kernels, so that the loops in f
+     are instantiated for the metric, or *this for the other metrics.
+  */
+  template <typename t_fn>
+  void with_fixed_metric(t_fn & f) const {
+    typedef python_dissimilarity D;
+    if (distfn==&D::sqeuclidean<false>) {
+      fixed_metric<&D::sqeuclidean<false> > d(*this); f(d);
+    }
+    else if (distfn==&D::cityblock) {
+      fixed_metric<&D::cityblock> d(*this); f(d);
+    }
+    else if (distfn==&D::chebychev) {
+      fixed_metric<&D::chebychev> d(*this); f(d);
+    }
+    else if (distfn==&D::minkowski) {
+      fixed_metric<&D::minkowski> d(*this); f(d);
+    }
+    else if (distfn==&D::cosine) {
+      fixed_metric<&D::cosine> d(*this); f(d);
+    }
+    else if (distfn==&D::canberra) {
+      fixed_metric<&D::canberra> d(*this); f(d);
+    }
+    else if (distfn==&D::braycurtis) {
+      fixed_metric<&D::braycurtis> d(*this); f(d);
+    }
+    else {
+      f(*this);
+    }
   }
 
-  inline bool Xb (const t_index i, const t_index j) const {
-    return  reinterpret_cast<bool *>(Xa)[i*dim+j];
+  // Whether the metric is the squared Euclidean distance of the points,
+  // evaluated by sqeuclidean<false>.
+  inline bool is_sqeuclidean() const {
+    return distfn==&python_dissimilarity::sqeuclidean<false>;
+  }
+
+  inline t_float const * data() const {
+    return Xa;
+  }
+
+  inline t_index dimension() const {
+    return dim;
+  }
+
+  inline t_float X (const t_index i, const t_index j) const {
+    return Xa[i*dim+j];
   }
 
   inline t_float * Xptr(const t_index i, const t_index j) const {
@@ -712,6 +1306,38 @@ public:
     }
   }
 
+  /* The same postprocessing for the entries D[k], k<size, of a dissimilarity
+     array, e.g. a condensed distance matrix. */
+  void postprocess(t_float * const D, const std::ptrdiff_t size) const {
+    typedef void (cluster_result::*postprocess_t) (const ::t_float) const;
+    if (postprocessfn==NULL) return;
+    std::ptrdiff_t k;
+    if (postprocessfn==static_cast<postprocess_t>(&cluster_result::sqrt)) {
+#ifdef _OPENMP
+#pragma omp parallel for schedule(static)
+#endif
+      for (k=0; k<size; ++k)
+        D[k] = std::sqrt(D[k]);
+    }
+    else if (postprocessfn==&cluster_result::power) {
+      const ::t_float q = 1/postprocessarg;
+#ifdef _OPENMP
+#pragma omp parallel for schedule(static)
+#endif
+      for (k=0; k<size; ++k)
+        D[k] = static_cast<t_float>(my_pow(static_cast<::t_float>(D[k]), q));
+    }
+    else if (postprocessfn==&cluster_result::plusone) {
+      for (k=0; k<size; ++k)
+        D[k] += 1;
+    }
+    else { // postprocessfn==&cluster_result::divide
+      const t_float denom = static_cast<t_float>(postprocessarg);
+      for (k=0; k<size; ++k)
+        D[k] /= denom;
+    }
+  }
+
   inline t_float ward(const t_index i, const t_index j) const {
     t_float mi = static_cast<t_float>(members[i]);
     t_float mj = static_cast<t_float>(members[j]);
@@ -837,11 +1463,7 @@ private:
   }
 
   t_float cityblock(const t_index i, const t_index j) const {
-    t_float sum = 0;
-    for (t_index k=0; k<dim; ++k) {
-      sum += std::abs(X(i,k)-X(j,k));
-    }
-    return sum;
+    return simd_utils::simd_cityblock(Xa+i*dim, Xa+j*dim, dim);
   }
 
   t_float minkowski(const t_index i, const t_index j) const {
@@ -853,22 +1475,12 @@ private:
   }
 
   t_float chebychev(const t_index i, const t_index j) const {
-    t_float max = 0;
-    for (t_index k=0; k<dim; ++k) {
-      t_float diff = std::abs(X(i,k)-X(j,k));
-      if (diff>max) {
-        max = diff;
-      }
-    }
-    return max;
+    return simd_utils::simd_chebychev(Xa+i*dim, Xa+j*dim, dim);
   }
 
   t_float cosine(const t_index i, const t_index j) const {
-    t_float sum = 0;
-    for (t_index k=0; k<dim; ++k) {
-      sum -= X(i,k)*X(j,k);
-    }
-    return sum*precomputed[i]*precomputed[j];
+    return -simd_utils::simd_dot(Xa+i*dim, Xa+j*dim, dim)
+      *precomputed[i]*precomputed[j];
   }
 
   t_float hamming(const t_index i, const t_index j) const {
@@ -906,22 +1518,10 @@ private:
   }
 
   t_float canberra(const t_index i, const t_index j) const {
-    t_float sum = 0;
-    for (t_index k=0; k<dim; ++k) {
-      t_float numerator = std::abs(X(i,k)-X(j,k));
-#if HAVE_DIAGNOSTIC
-#pragma GCC diagnostic push
-#pragma GCC diagnostic ignored "-Wfloat-equal"
-#endif
-      sum += numerator==0 ? 0 : numerator / (std::abs(X(i,k)) + std::abs(X(j,k)));
-#if HAVE_DIAGNOSTIC
-#pragma GCC diagnostic pop
-#endif
-    }
-    return sum;
-  }
-
-  t_float user(const t_index i, const t_index j) const {
+    return simd_utils::simd_canberra(Xa+i*dim, Xa+j*dim, dim);
+  }
+
+  t_float user(const t_index i, const t_index j) const {
 #if HAVE_DIAGNOSTIC
 #pragma GCC diagnostic push
 #pragma GCC diagnostic ignored "-Wold-style-cast"
@@ -953,13 +1553,7 @@ private:
   }
 
   t_float braycurtis(const t_index i, const t_index j) const {
-    t_float sum1 = 0;
-    t_float sum2 = 0;
-    for (t_index k=0; k<dim; ++k) {
-      sum1 += std::abs(X(i,k)-X(j,k));
-      sum2 += std::abs(X(i,k)+X(j,k));
-    }
-    return sum1/sum2;
+    return simd_utils::simd_braycurtis(Xa+i*dim, Xa+j*dim, dim);
   }
 
   t_float mahalanobis(const t_index i, const t_index j) const {
@@ -971,101 +1565,428 @@ private:
     return sum;
   }
 
-  t_index mutable NTT; // 'local' variables
-  t_index mutable NXO;
-  t_index mutable NTF;
-  #define NTFFT NTF
-  #define NFFTT NTT
-
-  void nbool_correspond(const t_index i, const t_index j) const {
-    NTT = 0;
-    NXO = 0;
-    for (t_index k=0; k<dim; ++k) {
-      NTT += (Xb(i,k) &  Xb(j,k)) ;
-      NXO += (Xb(i,k) ^  Xb(j,k)) ;
+  /* Pack each row of the Boolean data into words of 64 bits, so that the
+     counts below are computed with bitwise operations and popcount on 1/8
+     of the memory of the bool array. The bits beyond dim in the last word
+     of a row are zero and do not contribute to any count.
+  */
+  void pack_boolean() {
+    const bool * const B = reinterpret_cast<bool *>(Xa);
+    words = (dim+63)/64;
+    Xpacked.init(N*words);
+    for (t_index i=0; i<N; ++i) {
+      for (std::ptrdiff_t w=0; w<words; ++w) {
+        const std::ptrdiff_t k0 = 64*w;
+        const std::ptrdiff_t k1 = std::min(k0+64, dim);
+        uint64_t bits = 0;
+        for (std::ptrdiff_t k=k0; k<k1; ++k) {
+          bits |= static_cast<uint64_t>(B[i*dim+k]) << (k-k0);
+        }
+        Xpacked[i*words+w] = bits;
+      }
     }
   }
 
-  void nbool_correspond_tfft(const t_index i, const t_index j) const {
-    NTT = 0;
-    NXO = 0;
-    NTF = 0;
-    for (t_index k=0; k<dim; ++k) {
-      NTT += (Xb(i,k) &  Xb(j,k)) ;
-      NXO += (Xb(i,k) ^  Xb(j,k)) ;
-      NTF += (Xb(i,k) & !Xb(j,k)) ;
-    }
-    NTF *= (NXO-NTF); // NTFFT
-    NTT *= (static_cast<t_index>(dim)-NTT-NXO); // NFFTT
+  /* Counts of True/False combinations for Boolean vectors. The counts are
+     returned in local variables of the caller, so that the metrics can be
+     evaluated concurrently from several threads. */
+  void nbool_correspond(const t_index i, const t_index j,
+                        t_index & NTT, t_index & NXO) const {
+    t_index NTF;
+    simd_utils::simd_bool_counts(Xpacked+i*words, Xpacked+j*words, words,
+                                 NTT, NXO, NTF);
   }
 
-  void nbool_correspond_xo(const t_index i, const t_index j) const {
-    NXO = 0;
-    for (t_index k=0; k<dim; ++k) {
-      NXO += (Xb(i,k) ^ Xb(j,k)) ;
-    }
+  void nbool_correspond_tfft(const t_index i, const t_index j,
+                             t_index & NTFFT, t_index & NFFTT) const {
+    t_index NTT, NXO, NTF;
+    simd_utils::simd_bool_counts(Xpacked+i*words, Xpacked+j*words, words,
+                                 NTT, NXO, NTF);
+    NTFFT = NTF*(NXO-NTF);
+    NFFTT = NTT*(static_cast<t_index>(dim)-NTT-NXO);
   }
 
-  void nbool_correspond_tt(const t_index i, const t_index j) const {
-    NTT = 0;
-    for (t_index k=0; k<dim; ++k) {
-      NTT += (Xb(i,k) & Xb(j,k)) ;
-    }
+  t_index nbool_correspond_xo(const t_index i, const t_index j) const {
+    t_index NTT, NXO;
+    nbool_correspond(i, j, NTT, NXO);
+    return NXO;
+  }
+
+  t_index nbool_correspond_tt(const t_index i, const t_index j) const {
+    t_index NTT, NXO;
+    nbool_correspond(i, j, NTT, NXO);
+    return NTT;
   }
 
   t_float yule(const t_index i, const t_index j) const {
-    nbool_correspond_tfft(i, j);
+    t_index NTFFT, NFFTT;
+    nbool_correspond_tfft(i, j, NTFFT, NFFTT);
     return (NTFFT==0) ? 0 :
       static_cast<t_float>(2*NTFFT) / static_cast<t_float>(NTFFT + NFFTT);
   }
 
   // Prevent a zero denominator for equal vectors.
   t_float dice(const t_index i, const t_index j) const {
-    nbool_correspond(i, j);
+    t_index NTT, NXO;
+    nbool_correspond(i, j, NTT, NXO);
     return (NXO==0) ? 0 :
       static_cast<t_float>(NXO) / static_cast<t_float>(NXO+2*NTT);
   }
 
   t_float rogerstanimoto(const t_index i, const t_index j) const {
-    nbool_correspond_xo(i, j);
+    const t_index NXO = nbool_correspond_xo(i, j);
     return static_cast<t_float>(2*NXO) / static_cast<t_float>(NXO+dim);
   }
 
   t_float russellrao(const t_index i, const t_index j) const {
-    nbool_correspond_tt(i, j);
+    const t_index NTT = nbool_correspond_tt(i, j);
     return static_cast<t_float>(dim-NTT);
   }
 
   // Prevent a zero denominator for equal vectors.
   t_float sokalsneath(const t_index i, const t_index j) const {
-    nbool_correspond(i, j);
+    t_index NTT, NXO;
+    nbool_correspond(i, j, NTT, NXO);
     return (NXO==0) ? 0 :
       static_cast<t_float>(2*NXO) / static_cast<t_float>(NTT+2*NXO);
   }
 
   t_float kulsinski(const t_index i, const t_index j) const {
-    nbool_correspond_tt(i, j);
+    const t_index NTT = nbool_correspond_tt(i, j);
     return static_cast<t_float>(NTT) * (precomputed[i] + precomputed[j]);
   }
 
   // 'matching' distance = Hamming distance
   t_float matching(const t_index i, const t_index j) const {
-    nbool_correspond_xo(i, j);
-    return static_cast<t_float>(NXO);
+    return static_cast<t_float>(nbool_correspond_xo(i, j));
   }
 
   // Prevent a zero denominator for equal vectors.
   t_float jaccard_bool(const t_index i, const t_index j) const {
-    nbool_correspond(i, j);
+    t_index NTT, NXO;
+    nbool_correspond(i, j, NTT, NXO);
     return (NXO==0) ? 0 :
       static_cast<t_float>(NXO) / static_cast<t_float>(NXO+NTT);
   }
 };
 
+/*
+  Fill the condensed dissimilarity matrix D of N points from the
+  dissimilarity object dist. The rows of the upper triangle are distributed
+  dynamically over the OpenMP threads, since they have different lengths.
+
+  The metric must not call the Python interpreter, since this function runs
+  without the GIL.
+*/
+template <typename t_dissimilarity>
+static void condensed_dissimilarities(const t_index N,
+                                      const t_dissimilarity & dist,
+                                      typename t_dissimilarity::float_type
+                                      * const D) {
+  typedef typename t_dissimilarity::float_type t_float;
+#ifdef _OPENMP
+#pragma omp parallel for schedule(dynamic, 16)
+#endif
+  for (t_index i=0; i<N-1; ++i) {
+    // Position of D(i,i+1) in the condensed matrix
+    t_float * DD = D + (static_cast<std::ptrdiff_t>(2*N-3-i)*i>>1) + i;
+    for (t_index j=i+1; j<N; ++j) {
+      *(DD++) = dist(i,j);
+    }
+  }
+  dist.postprocess(D, static_cast<std::ptrdiff_t>(N)*(N-1)>>1);
+}
+
+/*
+  Function objects for python_dissimilarity::with_fixed_metric, which run the
+  loops over the pairs of points for the metric of the dissimilarity object.
+*/
+template <typename t_float>
+struct condensed_dissimilarities_fn {
+  const t_index N;
+  t_float * const D;
+
+  template <typename t_dissimilarity>
+  void operator() (const t_dissimilarity & dist) const {
+    condensed_dissimilarities(N, dist, D);
+  }
+};
+
+struct MST_linkage_vector_fn {
+  const t_index N;
+  cluster_result & Z2;
+  const bool threads;
+  linkage_progress * const progress;
+
+  template <typename t_dissimilarity>
+  void operator() (t_dissimilarity & dist) const {
+    MST_linkage_core_vector(N, dist, Z2, threads, progress);
+  }
+};
+
+struct MST_insert_points_fn {
+  const t_index N0;
+  const t_index N;
+  t_index * const edges;
+  ::t_float * const weight;
+  const bool threads;
+
+  template <typename t_dissimilarity>
+  void operator() (t_dissimilarity & dist) const {
+    MST_insert_points(N0, N, dist, edges, weight, threads);
+  }
+};
+
+template <typename t_float>
+static void pdist_typed(const t_index N,
+                        PyArrayObject * const X,
+                        PyArrayObject * const D,
+                        const unsigned char metric,
+                        PyObject * const extraarg) {
+  python_dissimilarity<t_float> dist(X, NULL, METHOD_METR_SINGLE,
+                                     static_cast<metric_codes>(metric),
+                                     extraarg, false);
+  GIL_release G;
+  condensed_dissimilarities_fn<t_float> fill =
+    {N, reinterpret_cast<t_float *>(PyArray_DATA(D))};
+  dist.with_fixed_metric(fill);
+}
+
+/*
+  Progress reports from the vector cores. Their distances are transformed
+  like the merging distances in python_dissimilarity::postprocess, so that
+  the callback receives the distances of the output.
+*/
+template <typename t_float>
+class python_vector_progress : public python_progress {
+private:
+  const python_dissimilarity<t_float> & dist;
+
+public:
+  python_vector_progress(PyObject * const callback_, const t_index interval,
+                         const t_index N_,
+                         const python_dissimilarity<t_float> & dist_)
+    : python_progress(callback_, interval, N_, false)
+    , dist(dist_)
+  {}
+
+protected:
+  ::t_float output_distance(const ::t_float d) const {
+    cluster_result Z1(1);
+    Z1.append(0, 1, d);
+    dist.postprocess(Z1);
+    return Z1[0]->dist;
+  }
+};
+
+/*
+  Cluster vector data with the dissimilarity object dist, which is set up for
+  the method and the metric. This function does not call the Python
+  interpreter unless the metric is a Python function.
+
+  If progress is not NULL, the cores report their progress to it.
+*/
+template <typename t_float>
+static void linkage_vector_core(const t_index N,
+                                python_dissimilarity<t_float> & dist,
+                                ::t_float * const Z_,
+                                const unsigned char method,
+                                const unsigned char metric,
+                                const unsigned char algorithm,
+                                const t_index n_neighbors,
+                                linkage_progress * const progress = NULL) {
+  cluster_result Z2(N-1);
+
+  switch (method) {
+  case METHOD_METR_SINGLE:
+    // For large n_neighbors, the exact Prim algorithm below is faster.
+    if (algorithm==ALGORITHM_NNDESCENT &&
+        nn_descent_pays_off(N, n_neighbors)) {
+      MST_linkage_core_nndescent(N, dist, n_neighbors, Z2, progress);
+    }
+    else if (algorithm==ALGORITHM_BORUVKA && dist.is_sqeuclidean()) {
+      MST_linkage_core_boruvka(N, dist.data(), dist.dimension(), Z2,
+                               progress);
+    }
+    else if (dist.is_sqeuclidean()) {
+      MST_linkage_core_sqeuclidean(N, dist.data(), dist.dimension(), Z2,
+                                   progress);
+    }
+    else {
+      // A metric in Python must not be called from several threads.
+      MST_linkage_vector_fn MST = {N, Z2, metric!=METRIC_USER, progress};
+      dist.with_fixed_metric(MST);
+    }
+    break;
+  case METHOD_METR_WARD:
+    generic_linkage_vector<METHOD_VECTOR_WARD>(N, dist, Z2, progress);
+    break;
+  case METHOD_METR_CENTROID:
+    generic_linkage_vector_alternative<METHOD_VECTOR_CENTROID>(N, dist, Z2,
+                                                               progress);
+    break;
+  default: // case METHOD_METR_MEDIAN:
+    generic_linkage_vector_alternative<METHOD_VECTOR_MEDIAN>(N, dist, Z2,
+                                                             progress);
+  }
+
+  dist.postprocess(Z2);
+
+  if (method!=METHOD_METR_SINGLE) {
+    generate_SciPy_dendrogram<true>(Z_, Z2, N);
+  }
+  else {
+    generate_SciPy_dendrogram<false>(Z_, Z2, N);
+  }
+}
+
+/*
+  Cluster vector data in the precision of the input. The dissimilarity object
+  is set up while the GIL is held, since it may call the Python interpreter.
+  The GIL is released for the clustering itself unless the metric is a Python
+  function.
+*/
+template <typename t_float>
+static void linkage_vector_typed(const t_index N,
+                                 PyArrayObject * const X,
+                                 ::t_float * const Z_,
+                                 const unsigned char method,
+                                 const unsigned char metric,
+                                 PyObject * const extraarg,
+                                 t_index * const members,
+                                 const unsigned char algorithm,
+                                 const t_index n_neighbors,
+                                 PyObject * const callback,
+                                 const t_index callback_interval) {
+  /* temp_point_array must be true if the alternative algorithm
+     is used below (currently for the centroid and median methods). */
+  bool temp_point_array = (method==METHOD_METR_CENTROID ||
+                           method==METHOD_METR_MEDIAN);
+
+  python_dissimilarity<t_float> dist(X, members,
+                                     static_cast<method_codes>(method),
+                                     static_cast<metric_codes>(metric),
+                                     extraarg, temp_point_array);
+  python_vector_progress<t_float> progress(callback, callback_interval, N,
+                                           dist);
+
+  // Allow threads if the metric is not "user"!
+  GIL_release G(metric!=METRIC_USER);
+
+  linkage_vector_core(N, dist, Z_, method, metric, algorithm, n_neighbors,
+                      &progress);
+}
+
+/*
+  Check the arguments for clustering the vector data X, and translate the
+  metric code for Boolean input. On success, N is the number of data points.
+  Otherwise, a Python exception is set and the function returns false.
+*/
+static bool check_vector_args(PyArrayObject * const X,
+                              const unsigned char method,
+                              unsigned char & metric,
+                              PyObject * const extraarg,
+                              const unsigned char algorithm,
+                              const long int n_neighbors,
+                              t_index & N) {
+  if (PyArray_NDIM(X) != 2) {
+    PyErr_SetString(PyExc_ValueError,
+                    "The input array must be two-dimensional.");
+    return false;
+  }
+  npy_intp const N_ = PyArray_DIM(X, 0);
+  if (N_ < 1 ) {
+    // N must be at least 1.
+    PyErr_SetString(PyExc_ValueError,
+                    "At least one element is needed for clustering.");
+    return false;
+  }
+
+  npy_intp const dim = PyArray_DIM(X, 1);
+  if (dim < 1 ) {
+    PyErr_SetString(PyExc_ValueError,
+                    "Invalid dimension of the data set.");
+    return false;
+  }
+
+  /*
+    (1)
+    The biggest index used below is 4*(N-2)+3, as an index to Z. This must
+    fit into the data type used for indices.
+    (2)
+    The largest representable integer, without loss of precision, by a
+    floating point number of type t_float is 2^T_FLOAT_MANT_DIG. Here, we
+    make sure that all cluster labels from 0 to 2N-2 in the output can be
+    accurately represented by a floating point number.
+
+    Conversion of N to 64 bits below is not really necessary but it prevents
+    a warning ("shift count >= width of type") on systems where "int" is 32
+    bits wide.
+  */
+  if (N_ > MAX_INDEX/4 || dim > MAX_INDEX ||
+      static_cast<int64_t>(N_-1)>>(T_FLOAT_MANT_DIG-1) > 0) {
+    PyErr_SetString(PyExc_ValueError,
+                    "Data is too big, index overflow.");
+    return false;
+  }
+  N = static_cast<t_index>(N_);
+
+  if ((method!=METHOD_METR_SINGLE && metric!=METRIC_EUCLIDEAN) ||
+      metric>=METRIC_INVALID) {
+    PyErr_SetString(PyExc_IndexError, "Invalid metric index.");
+    return false;
+  }
+
+  if (PyArray_ISBOOL(X)) {
+    if (metric==METRIC_HAMMING) {
+      metric = METRIC_MATCHING; // Alias
+    }
+    if (metric==METRIC_JACCARD) {
+      metric = METRIC_JACCARD_BOOL;
+    }
+  }
+
+  if (extraarg!=Py_None &&
+      metric!=METRIC_MINKOWSKI &&
+      metric!=METRIC_SEUCLIDEAN &&
+      metric!=METRIC_MAHALANOBIS &&
+      metric!=METRIC_USER) {
+    PyErr_SetString(PyExc_TypeError,
+                    "No extra parameter is allowed for this metric.");
+    return false;
+  }
+
+  if (method!=METHOD_METR_SINGLE &&
+      method!=METHOD_METR_WARD &&
+      method!=METHOD_METR_CENTROID &&
+      method!=METHOD_METR_MEDIAN) {
+    PyErr_SetString(PyExc_IndexError, "Invalid method index.");
+    return false;
+  }
+
+  if (algorithm>=ALGORITHM_INVALID ||
+      (algorithm!=ALGORITHM_PRIM && method!=METHOD_METR_SINGLE)) {
+    PyErr_SetString(PyExc_IndexError, "Invalid algorithm index.");
+    return false;
+  }
+  if (algorithm==ALGORITHM_NNDESCENT &&
+      (n_neighbors < 1 || n_neighbors > N-1)) {
+    PyErr_SetString(PyExc_ValueError,
+                    "The number of neighbors must be between 1 and N-1.");
+    return false;
+  }
+  return true;
+}
+
 static PyObject *linkage_vector_wrap(PyObject * const, PyObject * const args) {
   PyArrayObject * X, * Z;
   unsigned char method, metric;
   PyObject * extraarg;
+  unsigned char algorithm = ALGORITHM_PRIM;
+  long int n_neighbors = 0;
+  int threads = 0;
+  PyObject * callback = Py_None;
+  long int callback_interval = 0;
 
   try{
     // Parse the input arguments
@@ -1073,138 +1994,195 @@ static PyObject *linkage_vector_wrap(PyObject * const, PyObject * const args) {
 #pragma GCC diagnostic push
 #pragma GCC diagnostic ignored "-Wold-style-cast"
 #endif
-    if (!PyArg_ParseTuple(args, "O!O!bbO",
+    if (!PyArg_ParseTuple(args, "O!O!bbO|bliOl",
                           &PyArray_Type, &X, // NumPy array
                           &PyArray_Type, &Z, // NumPy array
                           &method,           // unsigned char
                           &metric,           // unsigned char
-                          &extraarg )) {     // Python object
+                          &extraarg,         // Python object
+                          &algorithm,        // unsigned char (optional)
+                          &n_neighbors,      // signed long integer (opt.)
+                          &threads,          // integer (optional)
+                          &callback,         // callable or None (optional)
+                          &callback_interval)) { // long integer (optional)
       return NULL;
     }
 #if HAVE_DIAGNOSTIC
 #pragma GCC diagnostic pop
 #endif
+    thread_limit T(threads);
 
-    if (PyArray_NDIM(X) != 2) {
-      PyErr_SetString(PyExc_ValueError,
-                      "The input array must be two-dimensional.");
-    }
-    npy_intp const N_ = PyArray_DIM(X, 0);
-    if (N_ < 1 ) {
-      // N must be at least 1.
-      PyErr_SetString(PyExc_ValueError,
-                      "At least one element is needed for clustering.");
-      return NULL;
-    }
-
-    npy_intp const dim = PyArray_DIM(X, 1);
-    if (dim < 1 ) {
-      PyErr_SetString(PyExc_ValueError,
-                      "Invalid dimension of the data set.");
-      return NULL;
-    }
-
-    /*
-      (1)
-      The biggest index used below is 4*(N-2)+3, as an index to Z. This must
-      fit into the data type used for indices.
-      (2)
-      The largest representable integer, without loss of precision, by a
-      floating point number of type t_float is 2^T_FLOAT_MANT_DIG. Here, we
-      make sure that all cluster labels from 0 to 2N-2 in the output can be
-      accurately represented by a floating point number.
-
-      Conversion of N to 64 bits below is not really necessary but it prevents
-      a warning ("shift count >= width of type") on systems where "int" is 32
-      bits wide.
-    */
-    if (N_ > MAX_INDEX/4 || dim > MAX_INDEX ||
-        static_cast<int64_t>(N_-1)>>(T_FLOAT_MANT_DIG-1) > 0) {
-      PyErr_SetString(PyExc_ValueError,
-                      "Data is too big, index overflow.");
+    t_index N;
+    if (!check_vector_args(X, method, metric, extraarg, algorithm,
+                           n_neighbors, N)) {
       return NULL;
     }
-    t_index N = static_cast<t_index>(N_);
-
-    cluster_result Z2(N-1);
 
     auto_array_ptr<t_index> members;
     if (method==METHOD_METR_WARD || method==METHOD_METR_CENTROID) {
       members.init(2*N-1, 1);
     }
 
-    if ((method!=METHOD_METR_SINGLE && metric!=METRIC_EUCLIDEAN) ||
-        metric>=METRIC_INVALID) {
-      PyErr_SetString(PyExc_IndexError, "Invalid metric index.");
-      return NULL;
+    t_float * const Z_ = reinterpret_cast<t_float *>(PyArray_DATA(Z));
+    if (PyArray_TYPE(X)==NPY_FLOAT) {
+      linkage_vector_typed<float>(N, X, Z_, method, metric, extraarg,
+                                  members, algorithm,
+                                  static_cast<t_index>(n_neighbors), callback,
+                                  static_cast<t_index>(callback_interval));
     }
-
-    if (PyArray_ISBOOL(X)) {
-      if (metric==METRIC_HAMMING) {
-        metric = METRIC_MATCHING; // Alias
-      }
-      if (metric==METRIC_JACCARD) {
-        metric = METRIC_JACCARD_BOOL;
-      }
+    else {
+      linkage_vector_typed<double>(N, X, Z_, method, metric, extraarg,
+                                   members, algorithm,
+                                   static_cast<t_index>(n_neighbors), callback,
+                                   static_cast<t_index>(callback_interval));
     }
+  } // try
+  catch (const std::bad_alloc&) {
+    return PyErr_NoMemory();
+  }
+  catch(const std::exception& e){
+    PyErr_SetString(PyExc_EnvironmentError, e.what());
+    return NULL;
+  }
+  catch(const nan_error&){
+    PyErr_SetString(PyExc_FloatingPointError, "NaN dissimilarity value.");
+    return NULL;
+  }
+  catch(const pythonerror){
+    return NULL;
+  }
+  catch(...){
+    PyErr_SetString(PyExc_EnvironmentError,
+                    "C++ exception (unknown reason). Please send a bug report.");
+    return NULL;
+  }
+#if HAVE_DIAGNOSTIC
+#pragma GCC diagnostic push
+#pragma GCC diagnostic ignored "-Wold-style-cast"
+#endif
+  Py_RETURN_NONE;
+#if HAVE_DIAGNOSTIC
+#pragma GCC diagnostic pop
+#endif
+}
 
-    if (extraarg!=Py_None &&
-        metric!=METRIC_MINKOWSKI &&
-        metric!=METRIC_SEUCLIDEAN &&
-        metric!=METRIC_MAHALANOBIS &&
-        metric!=METRIC_USER) {
-      PyErr_SetString(PyExc_TypeError,
-                      "No extra parameter is allowed for this metric.");
-      return NULL;
+/*
+  Minimum spanning tree of the vector data X for single linkage clustering.
+  If N0 is zero, the tree is computed from scratch with Prim's algorithm or,
+  for the algorithm code ALGORITHM_BORUVKA, with the dual-tree Borůvka
+  algorithm. Otherwise, the edges
+  and weights contain the tree of the first N0 points, and the remaining
+  points are inserted. In both cases, the N-1 edges and weights are written
+  back and the stepwise dendrogram is written to Z.
+*/
+template <typename t_float>
+static void MST_update_typed(const t_index N, const t_index N0,
+                             PyArrayObject * const X,
+                             ::t_float * const Z_,
+                             t_index * const edges,
+                             ::t_float * const weight,
+                             const unsigned char metric,
+                             PyObject * const extraarg,
+                             const unsigned char algorithm) {
+  python_dissimilarity<t_float> dist(X, NULL, METHOD_METR_SINGLE,
+                                     static_cast<metric_codes>(metric),
+                                     extraarg, false);
+
+  // Allow threads if the metric is not "user"!
+  GIL_release G(metric!=METRIC_USER);
+
+  if (N0==0) {
+    cluster_result Z2(N-1);
+    if (algorithm==ALGORITHM_BORUVKA && dist.is_sqeuclidean()) {
+      MST_linkage_core_boruvka(N, dist.data(), dist.dimension(), Z2);
+    }
+    else if (dist.is_sqeuclidean()) {
+      MST_linkage_core_sqeuclidean(N, dist.data(), dist.dimension(), Z2);
     }
+    else {
+      MST_linkage_vector_fn MST = {N, Z2, metric!=METRIC_USER, NULL};
+      dist.with_fixed_metric(MST);
+    }
+    for (t_index e=0; e<N-1; ++e) {
+      edges[2*e] = Z2[e]->node1;
+      edges[2*e+1] = Z2[e]->node2;
+      weight[e] = Z2[e]->dist;
+    }
+  }
+  else {
+    MST_insert_points_fn insert = {N0, N, edges, weight, metric!=METRIC_USER};
+    dist.with_fixed_metric(insert);
+  }
 
-    /* temp_point_array must be true if the alternative algorithm
-       is used below (currently for the centroid and median methods). */
-    bool temp_point_array = (method==METHOD_METR_CENTROID ||
-                             method==METHOD_METR_MEDIAN);
+  cluster_result Z2(N-1);
+  for (t_index e=0; e<N-1; ++e) {
+    Z2.append(edges[2*e], edges[2*e+1], weight[e]);
+  }
+  dist.postprocess(Z2);
+  generate_SciPy_dendrogram<false>(Z_, Z2, N);
+}
 
-    python_dissimilarity dist(X, members, static_cast<method_codes>(method),
-                              static_cast<metric_codes>(metric), extraarg,
-                              temp_point_array);
+/*
+  Python interface for MST_update_typed. E (NPY_INTP, shape (N-1)×2) and W
+  (double, length N-1) are the edges and weights of the tree, which are
+  modified in place. The first N0-1 entries are the input if N0>0.
+*/
+static PyObject *MST_update_wrap(PyObject * const, PyObject * const args) {
+  PyArrayObject * X, * Z, * E, * W;
+  unsigned char metric;
+  PyObject * extraarg;
+  unsigned char algorithm;
+  long int N0;
+  int threads = 0;
 
-    if (method!=METHOD_METR_SINGLE &&
-        method!=METHOD_METR_WARD &&
-        method!=METHOD_METR_CENTROID &&
-        method!=METHOD_METR_MEDIAN) {
-      PyErr_SetString(PyExc_IndexError, "Invalid method index.");
+  try{
+    // Parse the input arguments
+#if HAVE_DIAGNOSTIC
+#pragma GCC diagnostic push
+#pragma GCC diagnostic ignored "-Wold-style-cast"
+#endif
+    if (!PyArg_ParseTuple(args, "O!O!O!O!bObl|i",
+                          &PyArray_Type, &X, // NumPy array
+                          &PyArray_Type, &Z, // NumPy array
+                          &PyArray_Type, &E, // NumPy array
+                          &PyArray_Type, &W, // NumPy array
+                          &metric,           // unsigned char
+                          &extraarg,         // Python object
+                          &algorithm,        // unsigned char
+                          &N0,               // signed long integer
+                          &threads )) {      // integer (optional)
       return NULL;
     }
+#if HAVE_DIAGNOSTIC
+#pragma GCC diagnostic pop
+#endif
+    thread_limit T(threads);
 
-    // Allow threads if the metric is not "user"!
-    GIL_release G(metric!=METRIC_USER);
-
-    switch (method) {
-    case METHOD_METR_SINGLE:
-      MST_linkage_core_vector(N, dist, Z2);
-      break;
-    case METHOD_METR_WARD:
-      generic_linkage_vector<METHOD_VECTOR_WARD>(N, dist, Z2);
-      break;
-    case METHOD_METR_CENTROID:
-      generic_linkage_vector_alternative<METHOD_VECTOR_CENTROID>(N, dist, Z2);
-      break;
-    default: // case METHOD_METR_MEDIAN:
-      generic_linkage_vector_alternative<METHOD_VECTOR_MEDIAN>(N, dist, Z2);
+    t_index N;
+    if (!check_vector_args(X, METHOD_METR_SINGLE, metric, extraarg,
+                           algorithm, 0, N)) {
+      return NULL;
     }
 
-    if (method==METHOD_METR_WARD ||
-        method==METHOD_METR_CENTROID) {
-      members.free();
+    npy_intp * const E_ = reinterpret_cast<npy_intp *>(PyArray_DATA(E));
+    auto_array_ptr<t_index> edges(2*N-2);
+    for (t_index k=0; k<2*N0-2; ++k) {
+      edges[k] = static_cast<t_index>(E_[k]);
     }
 
-    dist.postprocess(Z2);
-
     t_float * const Z_ = reinterpret_cast<t_float *>(PyArray_DATA(Z));
-    if (method!=METHOD_METR_SINGLE) {
-      generate_SciPy_dendrogram<true>(Z_, Z2, N);
+    t_float * const W_ = reinterpret_cast<t_float *>(PyArray_DATA(W));
+    if (PyArray_TYPE(X)==NPY_FLOAT) {
+      MST_update_typed<float>(N, static_cast<t_index>(N0), X, Z_, edges, W_,
+                              metric, extraarg, algorithm);
     }
     else {
-      generate_SciPy_dendrogram<false>(Z_, Z2, N);
+      MST_update_typed<double>(N, static_cast<t_index>(N0), X, Z_, edges, W_,
+                               metric, extraarg, algorithm);
+    }
+
+    for (t_index k=0; k<2*N-2; ++k) {
+      E_[k] = edges[k];
     }
   } // try
   catch (const std::bad_alloc&) {
@@ -1236,6 +2214,766 @@ static PyObject *linkage_vector_wrap(PyObject * const, PyObject * const args) {
 #endif
 }
 
+/*
+  One task of linkage_vector_many_wrap. The dissimilarity objects need the
+  GIL for their setup and cleanup, so they are created before the parallel
+  part and deleted after it.
+*/
+class vector_task {
+private:
+  // noncopyable
+  vector_task(vector_task const &);
+  vector_task & operator=(vector_task const &);
+
+public:
+  t_index N;
+  npy_intp row; // first row in the stacked output
+  unsigned char algorithm;
+  t_index n_neighbors;
+  auto_array_ptr<t_index> members;
+  python_dissimilarity<float> * dist32;
+  python_dissimilarity<double> * dist64;
+
+  vector_task()
+    : N(0), row(0), algorithm(ALGORITHM_PRIM), n_neighbors(0), members(),
+      dist32(NULL), dist64(NULL)
+  {}
+
+  ~vector_task() {
+    delete dist32;
+    delete dist64;
+  }
+};
+
+/*
+  Cluster a list of vector data sets. The argument is a list of tuples
+  (X, extraarg, algorithm, n_neighbors) with the arguments of
+  linkage_vector_wrap for each task; the method and the metric are the same
+  for all tasks. The dendrograms are written one after the other into the
+  stacked output array Z with N-1 rows per task. All tasks are checked and
+  their dissimilarity objects are set up before the GIL is released for the
+  whole batch, hence Python functions as metrics are not allowed.
+*/
+static PyObject *linkage_vector_many_wrap(PyObject * const,
+                                          PyObject * const args) {
+  PyObject * tasks;
+  PyArrayObject * Z;
+  unsigned char method, metric;
+  int threads = 0;
+
+  try{
+#if HAVE_DIAGNOSTIC
+#pragma GCC diagnostic push
+#pragma GCC diagnostic ignored "-Wold-style-cast"
+#endif
+    // Parse the input arguments
+    if (!PyArg_ParseTuple(args, "O!O!bb|i",
+                          &PyList_Type, &tasks, // list of tuples
+                          &PyArray_Type, &Z,    // NumPy array
+                          &method,              // unsigned char
+                          &metric,              // unsigned char
+                          &threads)) {          // integer (optional)
+      return NULL;
+    }
+#if HAVE_DIAGNOSTIC
+#pragma GCC diagnostic pop
+#endif
+    thread_limit T(threads);
+    if (metric==METRIC_USER) {
+      PyErr_SetString(PyExc_ValueError,
+                      "A Python function cannot be used as the metric for a "
+                      "batch.");
+      return NULL;
+    }
+    const bool temp_point_array = (method==METHOD_METR_CENTROID ||
+                                   method==METHOD_METR_MEDIAN);
+
+    const t_index n = static_cast<t_index>(PyList_GET_SIZE(tasks));
+    auto_array_ptr<vector_task> task(n);
+    auto_array_ptr<t_index> N(n);
+    npy_intp rows = 0;
+    for (t_index k=0; k<n; ++k) {
+      PyArrayObject * X;
+      PyObject * extraarg;
+      long int n_neighbors = 0;
+      unsigned char metric_k = metric;
+#if HAVE_DIAGNOSTIC
+#pragma GCC diagnostic push
+#pragma GCC diagnostic ignored "-Wold-style-cast"
+#endif
+      if (!PyArg_ParseTuple(PyList_GET_ITEM(tasks, k), "O!Obl",
+                            &PyArray_Type, &X,
+                            &extraarg,
+                            &task[k].algorithm,
+                            &n_neighbors)) {
+        return NULL;
+      }
+#if HAVE_DIAGNOSTIC
+#pragma GCC diagnostic pop
+#endif
+      if (!check_vector_args(X, method, metric_k, extraarg,
+                             task[k].algorithm, n_neighbors, N[k])) {
+        return NULL;
+      }
+      task[k].N = N[k];
+      task[k].n_neighbors = static_cast<t_index>(n_neighbors);
+      task[k].row = rows;
+      rows += N[k]-1;
+
+      if (method==METHOD_METR_WARD || method==METHOD_METR_CENTROID) {
+        task[k].members.init(2*N[k]-1, 1);
+      }
+      if (PyArray_TYPE(X)==NPY_FLOAT) {
+        task[k].dist32 = new python_dissimilarity<float>(
+            X, task[k].members, static_cast<method_codes>(method),
+            static_cast<metric_codes>(metric_k), extraarg, temp_point_array);
+      }
+      else {
+        task[k].dist64 = new python_dissimilarity<double>(
+            X, task[k].members, static_cast<method_codes>(method),
+            static_cast<metric_codes>(metric_k), extraarg, temp_point_array);
+      }
+    }
+    if (PyArray_TYPE(Z)!=NPY_DOUBLE || !PyArray_IS_C_CONTIGUOUS(Z) ||
+        PyArray_SIZE(Z)!=4*rows) {
+      PyErr_SetString(PyExc_ValueError,
+                      "The output array has the wrong size.");
+      return NULL;
+    }
+
+    // Allow threads!
+    GIL_release G;
+
+    t_float * const Z_ = reinterpret_cast<t_float *>(PyArray_DATA(Z));
+    run_batch(n, N, [&](const t_index k) {
+        const vector_task & t = task[k];
+        if (t.N < 2) return;
+        if (t.dist32) {
+          linkage_vector_core(t.N, *t.dist32, Z_+4*t.row, method, metric,
+                              t.algorithm, t.n_neighbors);
+        }
+        else {
+          linkage_vector_core(t.N, *t.dist64, Z_+4*t.row, method, metric,
+                              t.algorithm, t.n_neighbors);
+        }
+      });
+  } // try
+  catch (const std::bad_alloc&) {
+    return PyErr_NoMemory();
+  }
+  catch(const std::exception& e){
+    PyErr_SetString(PyExc_EnvironmentError, e.what());
+    return NULL;
+  }
+  catch(const nan_error&){
+    PyErr_SetString(PyExc_FloatingPointError, "NaN dissimilarity value.");
+    return NULL;
+  }
+  catch(const pythonerror){
+    return NULL;
+  }
+  catch(...){
+    PyErr_SetString(PyExc_EnvironmentError,
+                    "C++ exception (unknown reason). Please send a bug report.");
+    return NULL;
+  }
+#if HAVE_DIAGNOSTIC
+#pragma GCC diagnostic push
+#pragma GCC diagnostic ignored "-Wold-style-cast"
+#endif
+  Py_RETURN_NONE;
+#if HAVE_DIAGNOSTIC
+#pragma GCC diagnostic pop
+#endif
+}
+
+/*
+  The number of OpenMP threads which a call without a thread limit uses in
+  the calling thread; 1 if the extension was built without OpenMP.
+*/
+static PyObject *max_threads_wrap(PyObject * const, PyObject * const) {
+#ifdef _OPENMP
+  return PyLong_FromLong(omp_get_max_threads());
+#else
+  return PyLong_FromLong(1);
+#endif
+}
+
+/*
+  The instruction set level of the SIMD kernels, which was chosen for the CPU
+  when the extension was loaded.
+*/
+static PyObject *simd_level_wrap(PyObject * const, PyObject * const) {
+  return PyUnicode_FromString(simd_utils::simd_level());
+}
+
+/*
+   Part 3: Condensed dissimilarity matrix from vector data
+*/
+static PyObject *pdist_wrap(PyObject * const, PyObject * const args) {
+  PyArrayObject * X, * D;
+  unsigned char metric;
+  PyObject * extraarg;
+  int threads = 0;
+
+  try{
+    // Parse the input arguments
+#if HAVE_DIAGNOSTIC
+#pragma GCC diagnostic push
+#pragma GCC diagnostic ignored "-Wold-style-cast"
+#endif
+    if (!PyArg_ParseTuple(args, "O!O!bO|i",
+                          &PyArray_Type, &X, // NumPy array
+                          &PyArray_Type, &D, // NumPy array
+                          &metric,           // unsigned char
+                          &extraarg,         // Python object
+                          &threads )) {      // integer (optional)
+      return NULL;
+    }
+#if HAVE_DIAGNOSTIC
+#pragma GCC diagnostic pop
+#endif
+    thread_limit T(threads);
+
+    if (PyArray_NDIM(X) != 2) {
+      PyErr_SetString(PyExc_ValueError,
+                      "The input array must be two-dimensional.");
+      return NULL;
+    }
+    npy_intp const N_ = PyArray_DIM(X, 0);
+    npy_intp const dim = PyArray_DIM(X, 1);
+    if (N_ > MAX_INDEX || dim > MAX_INDEX ||
+        N_*(N_-1)/2 != PyArray_SIZE(D)) {
+      PyErr_SetString(PyExc_ValueError,
+                      "The output array has the wrong size.");
+      return NULL;
+    }
+    t_index N = static_cast<t_index>(N_);
+
+    // A user-defined metric needs the GIL and is handled in Python.
+    if (metric>=METRIC_USER) {
+      PyErr_SetString(PyExc_IndexError, "Invalid metric index.");
+      return NULL;
+    }
+
+    if (PyArray_ISBOOL(X)) {
+      if (metric==METRIC_HAMMING) {
+        metric = METRIC_MATCHING; // Alias
+      }
+      if (metric==METRIC_JACCARD) {
+        metric = METRIC_JACCARD_BOOL;
+      }
+    }
+
+    if (extraarg!=Py_None &&
+        metric!=METRIC_MINKOWSKI &&
+        metric!=METRIC_SEUCLIDEAN &&
+        metric!=METRIC_MAHALANOBIS) {
+      PyErr_SetString(PyExc_TypeError,
+                      "No extra parameter is allowed for this metric.");
+      return NULL;
+    }
+
+    if (PyArray_TYPE(X)==NPY_FLOAT) {
+      pdist_typed<float>(N, X, D, metric, extraarg);
+    }
+    else {
+      pdist_typed<double>(N, X, D, metric, extraarg);
+    }
+  } // try
+  catch (const std::bad_alloc&) {
+    return PyErr_NoMemory();
+  }
+  catch(const std::exception& e){
+    PyErr_SetString(PyExc_EnvironmentError, e.what());
+    return NULL;
+  }
+  catch(const pythonerror){
+    return NULL;
+  }
+  catch(...){
+    PyErr_SetString(PyExc_EnvironmentError,
+                    "C++ exception (unknown reason). Please send a bug report.");
+    return NULL;
+  }
+#if HAVE_DIAGNOSTIC
+#pragma GCC diagnostic push
+#pragma GCC diagnostic ignored "-Wold-style-cast"
+#endif
+  Py_RETURN_NONE;
+#if HAVE_DIAGNOSTIC
+#pragma GCC diagnostic pop
+#endif
+}
+
+template <typename t_float>
+static void linkage_sparse_typed(const t_index N,
+                                 PyArrayObject * const I,
+                                 PyArrayObject * const J,
+                                 PyArrayObject * const W,
+                                 ::t_float * const Z_) {
+  cluster_result Z2(N-1);
+  GIL_release G;
+  MST_linkage_core_sparse(N, PyArray_SIZE(W),
+                          reinterpret_cast<npy_intp *>(PyArray_DATA(I)),
+                          reinterpret_cast<npy_intp *>(PyArray_DATA(J)),
+                          reinterpret_cast<t_float *>(PyArray_DATA(W)), Z2);
+  generate_SciPy_dendrogram<false>(Z_, Z2, N);
+}
+
+/*
+  Single linkage of a sparse dissimilarity graph, given as the edge arrays
+  I, J (NPY_INTP) and W (float or double). The indices have been checked in
+  Python.
+*/
+static PyObject *linkage_sparse_wrap(PyObject * const, PyObject * const args) {
+  PyArrayObject * I, * J, * W, * Z;
+  long int N_ = 0;
+
+  try{
+#if HAVE_DIAGNOSTIC
+#pragma GCC diagnostic push
+#pragma GCC diagnostic ignored "-Wold-style-cast"
+#endif
+    // Parse the input arguments
+    if (!PyArg_ParseTuple(args, "lO!O!O!O!",
+                          &N_,                // signed long integer
+                          &PyArray_Type, &I, // NumPy array
+                          &PyArray_Type, &J, // NumPy array
+                          &PyArray_Type, &W, // NumPy array
+                          &PyArray_Type, &Z)) { // NumPy array
+      return NULL; // Error if the arguments have the wrong type.
+    }
+#if HAVE_DIAGNOSTIC
+#pragma GCC diagnostic pop
+#endif
+    if (N_ < 1 ) {
+      // N must be at least 1.
+      PyErr_SetString(PyExc_ValueError,
+                      "At least one element is needed for clustering.");
+      return NULL;
+    }
+    // See linkage_wrap for the bounds on N.
+    if (N_ > MAX_INDEX/4 ||
+        static_cast<int64_t>(N_-1)>>(T_FLOAT_MANT_DIG-1) > 0) {
+      PyErr_SetString(PyExc_ValueError,
+                      "Data is too big, index overflow.");
+      return NULL;
+    }
+    if (PyArray_SIZE(I)!=PyArray_SIZE(W) ||
+        PyArray_SIZE(J)!=PyArray_SIZE(W)) {
+      PyErr_SetString(PyExc_ValueError,
+                      "The edge arrays must have the same length.");
+      return NULL;
+    }
+    t_index N = static_cast<t_index>(N_);
+
+    t_float * const Z_ = reinterpret_cast<t_float *>(PyArray_DATA(Z));
+    if (PyArray_TYPE(W)==NPY_FLOAT) {
+      linkage_sparse_typed<float>(N, I, J, W, Z_);
+    }
+    else {
+      linkage_sparse_typed<double>(N, I, J, W, Z_);
+    }
+  } // try
+  catch (const std::bad_alloc&) {
+    return PyErr_NoMemory();
+  }
+  catch(const std::exception& e){
+    PyErr_SetString(PyExc_EnvironmentError, e.what());
+    return NULL;
+  }
+  catch(const nan_error&){
+    PyErr_SetString(PyExc_FloatingPointError, "NaN dissimilarity value.");
+    return NULL;
+  }
+  catch(...){
+    PyErr_SetString(PyExc_EnvironmentError,
+                    "C++ exception (unknown reason). Please send a bug report.");
+    return NULL;
+  }
+#if HAVE_DIAGNOSTIC
+#pragma GCC diagnostic push
+#pragma GCC diagnostic ignored "-Wold-style-cast"
+#endif
+  Py_RETURN_NONE;
+#if HAVE_DIAGNOSTIC
+#pragma GCC diagnostic pop
+#endif
+}
+
+// This enum must agree with the dictionary fclidx in fastcluster.py.
+enum criterion_codes {
+  CRITERION_INCONSISTENT       = 0,
+  CRITERION_DISTANCE           = 1,
+  CRITERION_MAXCLUST           = 2,
+  CRITERION_MONOCRIT           = 3,
+  CRITERION_MAXCLUST_MONOCRIT  = 4,
+};
+
+/*
+  Flat clusters T (NPY_INT, length N) from the dendrogram Z, with the same
+  criteria as scipy.cluster.hierarchy.fcluster. V is None or a double array
+  of length N-1: the inconsistency coefficients for the criterion
+  'inconsistent' (otherwise they are computed up to the given depth), or
+  the values of monocrit. For the 'maxclust' criteria, t is the number of
+  clusters, 1 ≤ t ≤ N. Z and the arguments have been checked in Python.
+*/
+static PyObject *fcluster_wrap(PyObject * const, PyObject * const args) {
+  PyArrayObject * Z, * T;
+  PyObject * V;
+  unsigned char criterion;
+  double t;
+  long int depth;
+
+  try{
+#if HAVE_DIAGNOSTIC
+#pragma GCC diagnostic push
+#pragma GCC diagnostic ignored "-Wold-style-cast"
+#endif
+    // Parse the input arguments
+    if (!PyArg_ParseTuple(args, "O!O!bdlO",
+                          &PyArray_Type, &Z, // NumPy array
+                          &PyArray_Type, &T, // NumPy array
+                          &criterion,       // unsigned char
+                          &t,               // double
+                          &depth,           // signed long integer
+                          &V)) {            // None or NumPy array
+      return NULL; // Error if the arguments have the wrong type.
+    }
+    if (V!=Py_None && !PyArray_Check(V)) {
+      PyErr_SetString(PyExc_TypeError, "V must be None or a NumPy array.");
+      return NULL;
+    }
+#if HAVE_DIAGNOSTIC
+#pragma GCC diagnostic pop
+#endif
+    const t_index N = static_cast<t_index>(PyArray_DIM(T, 0));
+    const t_float * const Z_ = reinterpret_cast<t_float *>(PyArray_DATA(Z));
+    int * const T_ = reinterpret_cast<int *>(PyArray_DATA(T));
+    const t_float * const V_ = (V==Py_None) ? NULL :
+      reinterpret_cast<t_float *>(
+          PyArray_DATA(reinterpret_cast<PyArrayObject *>(V)));
+
+    GIL_release G;
+
+    auto_array_ptr<t_float> MC(N-1);
+    if (V_) {
+      std::copy(V_, V_+N-1, &*MC);
+    }
+    else if (criterion==CRITERION_INCONSISTENT) {
+      inconsistency_coefficients(N, Z_, static_cast<t_index>(depth), MC);
+    }
+    else {
+      for (t_index i=0; i<N-1; ++i) {
+        MC[i] = Z_[4*i+2];
+      }
+    }
+    if (criterion==CRITERION_INCONSISTENT ||
+        criterion==CRITERION_DISTANCE ||
+        criterion==CRITERION_MAXCLUST) {
+      subtree_maximum(N, Z_, MC);
+    }
+
+    if (criterion==CRITERION_MAXCLUST ||
+        criterion==CRITERION_MAXCLUST_MONOCRIT) {
+      const t_index k = static_cast<t_index>(t);
+      if (k>=N) {
+        // Every point is a singleton, labeled in the order of the points.
+        for (t_index i=0; i<N; ++i) {
+          T_[i] = static_cast<int>(i+1);
+        }
+      }
+      else {
+        flat_clusters(N, Z_, MC, maxclust_cutoff(N, MC, k), T_);
+      }
+    }
+    else {
+      flat_clusters(N, Z_, MC, t, T_);
+    }
+  } // try
+  catch (const std::bad_alloc&) {
+    return PyErr_NoMemory();
+  }
+  catch(const std::exception& e){
+    PyErr_SetString(PyExc_EnvironmentError, e.what());
+    return NULL;
+  }
+  catch(...){
+    PyErr_SetString(PyExc_EnvironmentError,
+                    "C++ exception (unknown reason). Please send a bug report.");
+    return NULL;
+  }
+#if HAVE_DIAGNOSTIC
+#pragma GCC diagnostic push
+#pragma GCC diagnostic ignored "-Wold-style-cast"
+#endif
+  Py_RETURN_NONE;
+#if HAVE_DIAGNOSTIC
+#pragma GCC diagnostic pop
+#endif
+}
+
+/*
+  Cuts of the dendrogram Z after the numbers of steps S (NPY_INTP, values in
+  [0, N-1]) in the order of scipy.cluster.hierarchy.cut_tree. The output
+  is the (N×len(S)) array C of type int64. Z and S have been checked in
+  Python.
+*/
+static PyObject *cut_tree_wrap(PyObject * const, PyObject * const args) {
+  PyArrayObject * Z, * S, * C;
+
+  try{
+#if HAVE_DIAGNOSTIC
+#pragma GCC diagnostic push
+#pragma GCC diagnostic ignored "-Wold-style-cast"
+#endif
+    // Parse the input arguments
+    if (!PyArg_ParseTuple(args, "O!O!O!",
+                          &PyArray_Type, &Z, // NumPy array
+                          &PyArray_Type, &S, // NumPy array
+                          &PyArray_Type, &C)) { // NumPy array
+      return NULL; // Error if the arguments have the wrong type.
+    }
+#if HAVE_DIAGNOSTIC
+#pragma GCC diagnostic pop
+#endif
+    const t_index N = static_cast<t_index>(PyArray_DIM(C, 0));
+    const t_index ncols = static_cast<t_index>(PyArray_DIM(C, 1));
+    const t_float * const Z_ = reinterpret_cast<t_float *>(PyArray_DATA(Z));
+    const npy_intp * const S_ =
+      reinterpret_cast<npy_intp *>(PyArray_DATA(S));
+    int64_t * const C_ = reinterpret_cast<int64_t *>(PyArray_DATA(C));
+
+    GIL_release G;
+
+    auto_array_ptr<t_index> steps(ncols);
+    for (t_index c=0; c<ncols; ++c) {
+      steps[c] = static_cast<t_index>(S_[c]);
+    }
+    cut_tree(N, Z_, steps, ncols, C_);
+  } // try
+  catch (const std::bad_alloc&) {
+    return PyErr_NoMemory();
+  }
+  catch(const std::exception& e){
+    PyErr_SetString(PyExc_EnvironmentError, e.what());
+    return NULL;
+  }
+  catch(...){
+    PyErr_SetString(PyExc_EnvironmentError,
+                    "C++ exception (unknown reason). Please send a bug report.");
+    return NULL;
+  }
+#if HAVE_DIAGNOSTIC
+#pragma GCC diagnostic push
+#pragma GCC diagnostic ignored "-Wold-style-cast"
+#endif
+  Py_RETURN_NONE;
+#if HAVE_DIAGNOSTIC
+#pragma GCC diagnostic pop
+#endif
+}
+
+/*
+  The order L (NPY_INT, length N) of the leaves of the dendrogram Z. Z has
+  been checked in Python or comes from the clustering functions.
+*/
+static PyObject *leaves_list_wrap(PyObject * const, PyObject * const args) {
+  PyArrayObject * Z, * L;
+
+  try{
+#if HAVE_DIAGNOSTIC
+#pragma GCC diagnostic push
+#pragma GCC diagnostic ignored "-Wold-style-cast"
+#endif
+    // Parse the input arguments
+    if (!PyArg_ParseTuple(args, "O!O!",
+                          &PyArray_Type, &Z, // NumPy array
+                          &PyArray_Type, &L)) { // NumPy array
+      return NULL; // Error if the arguments have the wrong type.
+    }
+#if HAVE_DIAGNOSTIC
+#pragma GCC diagnostic pop
+#endif
+    const t_index N = static_cast<t_index>(PyArray_DIM(L, 0));
+    const t_float * const Z_ = reinterpret_cast<t_float *>(PyArray_DATA(Z));
+    int * const L_ = reinterpret_cast<int *>(PyArray_DATA(L));
+
+    GIL_release G;
+
+    dendrogram_leaves(N, Z_, L_);
+  } // try
+  catch (const std::bad_alloc&) {
+    return PyErr_NoMemory();
+  }
+  catch(const std::exception& e){
+    PyErr_SetString(PyExc_EnvironmentError, e.what());
+    return NULL;
+  }
+  catch(...){
+    PyErr_SetString(PyExc_EnvironmentError,
+                    "C++ exception (unknown reason). Please send a bug report.");
+    return NULL;
+  }
+#if HAVE_DIAGNOSTIC
+#pragma GCC diagnostic push
+#pragma GCC diagnostic ignored "-Wold-style-cast"
+#endif
+  Py_RETURN_NONE;
+#if HAVE_DIAGNOSTIC
+#pragma GCC diagnostic pop
+#endif
+}
+
+template <typename t_dist>
+static void optimal_leaf_ordering_typed(const t_index N, t_float * const Z,
+                                        const t_dist * const D,
+                                        t_float * M) {
+  auto_array_ptr<t_float> M_own;
+  if (!M) {
+    M_own.init(static_cast<std::ptrdiff_t>(N)*(N-1)/2);
+    M = M_own;
+  }
+  leaf_ordering<t_dist>(N, Z, D, M)();
+}
+
+/*
+  Optimal leaf ordering of the dendrogram Z (modified in place) for the
+  condensed matrix D (float or double). M is None or a writeable double
+  array of the same length as D, which is used as scratch memory (the
+  working copy from the clustering step). Z and D have been checked in
+  Python.
+*/
+static PyObject *optimal_leaf_ordering_wrap(PyObject * const,
+                                            PyObject * const args) {
+  PyArrayObject * Z, * D;
+  PyObject * M;
+  int threads = 0;
+
+  try{
+#if HAVE_DIAGNOSTIC
+#pragma GCC diagnostic push
+#pragma GCC diagnostic ignored "-Wold-style-cast"
+#endif
+    // Parse the input arguments
+    if (!PyArg_ParseTuple(args, "O!O!O|i",
+                          &PyArray_Type, &Z, // NumPy array
+                          &PyArray_Type, &D, // NumPy array
+                          &M,               // None or NumPy array
+                          &threads)) {      // integer (optional)
+      return NULL; // Error if the arguments have the wrong type.
+    }
+    if (M!=Py_None && !PyArray_Check(M)) {
+      PyErr_SetString(PyExc_TypeError, "M must be None or a NumPy array.");
+      return NULL;
+    }
+#if HAVE_DIAGNOSTIC
+#pragma GCC diagnostic pop
+#endif
+    thread_limit T(threads);
+    const t_index N = static_cast<t_index>(PyArray_DIM(Z, 0))+1;
+    t_float * const Z_ = reinterpret_cast<t_float *>(PyArray_DATA(Z));
+    t_float * const M_ = (M==Py_None) ? NULL :
+      reinterpret_cast<t_float *>(
+          PyArray_DATA(reinterpret_cast<PyArrayObject *>(M)));
+
+    GIL_release G;
+
+    if (PyArray_TYPE(D)==NPY_FLOAT) {
+      optimal_leaf_ordering_typed(N, Z_,
+          reinterpret_cast<const float *>(PyArray_DATA(D)), M_);
+    }
+    else {
+      optimal_leaf_ordering_typed(N, Z_,
+          reinterpret_cast<const double *>(PyArray_DATA(D)), M_);
+    }
+  } // try
+  catch (const std::bad_alloc&) {
+    return PyErr_NoMemory();
+  }
+  catch(const std::exception& e){
+    PyErr_SetString(PyExc_EnvironmentError, e.what());
+    return NULL;
+  }
+  catch(const nan_error&){
+    PyErr_SetString(PyExc_FloatingPointError, "NaN dissimilarity value.");
+    return NULL;
+  }
+  catch(...){
+    PyErr_SetString(PyExc_EnvironmentError,
+                    "C++ exception (unknown reason). Please send a bug report.");
+    return NULL;
+  }
+#if HAVE_DIAGNOSTIC
+#pragma GCC diagnostic push
+#pragma GCC diagnostic ignored "-Wold-style-cast"
+#endif
+  Py_RETURN_NONE;
+#if HAVE_DIAGNOSTIC
+#pragma GCC diagnostic pop
+#endif
+}
+
+/*
+  Cophenetic correlation of the dendrogram Z and the condensed matrix D
+  (float or double). Z and D have been checked in Python.
+*/
+static PyObject *cophenetic_correlation_wrap(PyObject * const,
+                                             PyObject * const args) {
+  PyArrayObject * Z, * D;
+  int threads = 0;
+  t_float c;
+
+  try{
+#if HAVE_DIAGNOSTIC
+#pragma GCC diagnostic push
+#pragma GCC diagnostic ignored "-Wold-style-cast"
+#endif
+    // Parse the input arguments
+    if (!PyArg_ParseTuple(args, "O!O!|i",
+                          &PyArray_Type, &Z, // NumPy array
+                          &PyArray_Type, &D, // NumPy array
+                          &threads)) {      // integer (optional)
+      return NULL; // Error if the arguments have the wrong type.
+    }
+#if HAVE_DIAGNOSTIC
+#pragma GCC diagnostic pop
+#endif
+    thread_limit T(threads);
+    const t_index N = static_cast<t_index>(PyArray_DIM(Z, 0))+1;
+    const t_float * const Z_ = reinterpret_cast<t_float *>(PyArray_DATA(Z));
+
+    GIL_release G;
+
+    if (PyArray_TYPE(D)==NPY_FLOAT) {
+      c = cophenetic_correlation(N, Z_,
+          reinterpret_cast<const float *>(PyArray_DATA(D)));
+    }
+    else {
+      c = cophenetic_correlation(N, Z_,
+          reinterpret_cast<const double *>(PyArray_DATA(D)));
+    }
+  } // try
+  catch (const std::bad_alloc&) {
+    return PyErr_NoMemory();
+  }
+  catch(const std::exception& e){
+    PyErr_SetString(PyExc_EnvironmentError, e.what());
+    return NULL;
+  }
+  catch(const nan_error&){
+    PyErr_SetString(PyExc_FloatingPointError, "NaN dissimilarity value.");
+    return NULL;
+  }
+  catch(...){
+    PyErr_SetString(PyExc_EnvironmentError,
+                    "C++ exception (unknown reason). Please send a bug report.");
+    return NULL;
+  }
+  return PyFloat_FromDouble(c);
+}
+
 #if HAVE_VISIBILITY
 #pragma GCC visibility pop
 #endif